@@ -53,15 +53,21 @@ class FitsStorageConfig(dict):
     _bools = ['using_sqlite', 'database_debug', 'use_utc', 'is_server',
               'is_archive', 'using_s3', 'using_previews', 'using_fitsverify',
               'logreports_use_materialized_view', 'orcid_enabled',
-              'development_bypass_auth', 'using_calcache']
+              'development_bypass_auth', 'using_calcache', 'htm_cone_search',
+              'object_search_index', 'using_search_row',
+              'multistream_split_extensions']
     _ints = ['postgres_database_pool_size', 'postgres_database_max_overflow',
              'defer_threshold', 'defer_delay', 'fits_open_result_limit',
              'fits_closed_result_limit', 'min_dhs_age_seconds',
-             'robot_badness_threshold']
+             'robot_badness_threshold', 'database_query_cache_size',
+             'tape_blocksize', 'tape_readahead_mb',
+             's3_multipart_threshold_mb', 's3_part_size_mb',
+             's3_transfer_concurrency', 's3_get_flo_ranges',
+             'header_delta_wait']
     _lists = ['blocked_urls', 'export_destinations', 'gemini_fits_upload_auth',
               'gemini_api_authorization', 'block_user_agent_substrings',
               'allow_user_agent_strings', 'gemini_user_transfer']
-    _floats = ['reduce_calcache_gbs']
+    _floats = ['reduce_calcache_gbs', 's3_cache_gb']
 
     def __init__(self, configfile=None, configstring=None,
                  builtin=True, builtinonly=False):
@@ -1,12 +1,13 @@
 """
 This is the hashes module. It provides a convenience interface to hashing.
-Currently, the only hash function we use is md5sum
+Currently, the only hash function we use is md5sum, which we also use to
+work out the ETag S3 gives a multipart upload.
 
 """
 import hashlib
 
 
-__all__ = ["md5sum", "md5sum_size_fp"]
+__all__ = ["md5sum", "md5sum_size_fp", "md5sum_etag"]
 
 
 def md5sum(filename):
@@ -52,3 +53,48 @@ def md5sum_size_fp(fp):
         hashobj.update(data)
 
     return size, hashobj.hexdigest()
+
+
+def md5sum_etag(filename, partsize):
+    """
+    Generates the md5sum of the data in filename, and the ETag S3 gives it
+    if it is uploaded with a multipart upload in parts of partsize bytes, in
+    one pass.
+
+    The ETag of a multipart upload is the md5 of the (binary) md5s of the
+    parts, followed by a dash and the number of parts. The ETag of an object
+    uploaded in one go is just the md5.
+
+    Parameters
+    ----------
+    filename : str
+        File name of an uncompressed file
+    partsize : int
+        Size in bytes of the parts of the upload
+
+    Returns
+    -------
+    str, str : md5 sum and ETag (without the quotes S3 puts round it)
+    """
+    block = 1000000  # 1MB
+    hashobj = hashlib.md5()
+    parthashes = []
+    with open(filename, 'rb') as filep:
+        while True:
+            parthash = hashlib.md5()
+            remaining = partsize
+            while remaining:
+                data = filep.read(min(block, remaining))
+                if not data:
+                    break
+                remaining -= len(data)
+                parthash.update(data)
+                hashobj.update(data)
+            if remaining == partsize:
+                break
+            parthashes.append(parthash.digest())
+            if remaining:
+                break
+
+    etag = hashlib.md5(b''.join(parthashes)).hexdigest()
+    return hashobj.hexdigest(), f"{etag}-{len(parthashes)}"
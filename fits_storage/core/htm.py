@@ -0,0 +1,314 @@
+"""
+This module provides a minimal Hierarchical Triangular Mesh (HTM)
+implementation, used to give each header (and footprint) a spatial cell id
+so that cone searches can be done as a small number of integer range lookups
+on a B-tree index rather than as RA and Dec box filters.
+
+The HTM starts with the 8 faces of an octahedron projected onto the unit
+sphere, and recursively divides each spherical triangle ("trixel") into 4
+children. Trixel ids are integers where the top level trixels are 8..15 and
+each level of subdivision appends two bits. All the trixels at level L
+contained within a trixel at a coarser level therefore form a single
+contiguous range of ids, which is what makes range lookups possible.
+
+We also store the cartesian unit vector (cx, cy, cz) for each position.
+This allows the exact great circle distance cut after the range lookup to be
+expressed as a simple dot product in SQL, which works on both PostgreSQL and
+SQLite as it does not require any trig functions in the database.
+"""
+import math
+
+from sqlalchemy import and_, or_
+
+__all__ = ["HTM_DEPTH", "radec_to_vector", "vector_to_radec", "htm_id",
+           "cone_ranges", "cone_filter", "polygon_centre_radius"]
+
+# The depth at which we store trixel ids in the database. Depth 20 trixels
+# are around 0.3 arcsec on a side and the ids fit comfortably in a BigInteger
+HTM_DEPTH = 20
+
+# Octahedron vertices
+_V = ((0.0, 0.0, 1.0), (1.0, 0.0, 0.0), (0.0, 1.0, 0.0),
+      (-1.0, 0.0, 0.0), (0.0, -1.0, 0.0), (0.0, 0.0, -1.0))
+
+# Top level trixels, as (id, (vertices)). Vertices are counter-clockwise
+# when viewed from outside the sphere.
+_BASE_TRIXELS = ((8, (_V[1], _V[5], _V[2])),
+                 (9, (_V[2], _V[5], _V[3])),
+                 (10, (_V[3], _V[5], _V[4])),
+                 (11, (_V[4], _V[5], _V[1])),
+                 (12, (_V[1], _V[0], _V[4])),
+                 (13, (_V[4], _V[0], _V[3])),
+                 (14, (_V[3], _V[0], _V[2])),
+                 (15, (_V[2], _V[0], _V[1])))
+
+
+def radec_to_vector(ra, dec):
+    """
+    Convert an RA, Dec in decimal degrees to a cartesian unit vector.
+
+    Parameters
+    ----------
+    ra : float
+        Right Ascension in decimal degrees
+    dec : float
+        Declination in decimal degrees
+
+    Returns
+    -------
+    tuple of 3 floats: (x, y, z)
+    """
+    ra = math.radians(ra)
+    dec = math.radians(dec)
+    cosdec = math.cos(dec)
+    return cosdec * math.cos(ra), cosdec * math.sin(ra), math.sin(dec)
+
+
+def vector_to_radec(v):
+    """
+    Convert a (not necessarily normalized) cartesian vector to RA, Dec in
+    decimal degrees.
+    """
+    x, y, z = v
+    ra = math.degrees(math.atan2(y, x)) % 360.0
+    dec = math.degrees(math.atan2(z, math.hypot(x, y)))
+    return ra, dec
+
+
+def _dot(a, b):
+    return a[0] * b[0] + a[1] * b[1] + a[2] * b[2]
+
+
+def _cross(a, b):
+    return (a[1] * b[2] - a[2] * b[1],
+            a[2] * b[0] - a[0] * b[2],
+            a[0] * b[1] - a[1] * b[0])
+
+
+def _normalize(v):
+    norm = math.sqrt(_dot(v, v))
+    return v[0] / norm, v[1] / norm, v[2] / norm
+
+
+def _midpoint(a, b):
+    return _normalize((a[0] + b[0], a[1] + b[1], a[2] + b[2]))
+
+
+def _children(tid, verts):
+    """
+    Generate the 4 child trixels of a trixel as (id, vertices) tuples
+    """
+    v0, v1, v2 = verts
+    w0 = _midpoint(v1, v2)
+    w1 = _midpoint(v0, v2)
+    w2 = _midpoint(v0, v1)
+    tid <<= 2
+    return ((tid, (v0, w2, w1)),
+            (tid + 1, (v1, w0, w2)),
+            (tid + 2, (v2, w1, w0)),
+            (tid + 3, (w0, w1, w2)))
+
+
+def _contains(verts, p):
+    """
+    Is the unit vector p inside the trixel with these vertices?
+    We allow a tiny tolerance so that points exactly on an edge are claimed
+    by at least one trixel.
+    """
+    v0, v1, v2 = verts
+    eps = -1e-15
+    return (_dot(_cross(v0, v1), p) >= eps and
+            _dot(_cross(v1, v2), p) >= eps and
+            _dot(_cross(v2, v0), p) >= eps)
+
+
+def htm_id(ra, dec, depth=HTM_DEPTH):
+    """
+    Calculate the HTM trixel id containing the given position.
+
+    Parameters
+    ----------
+    ra : float
+        Right Ascension in decimal degrees
+    dec : float
+        Declination in decimal degrees
+    depth : int
+        The HTM depth at which to calculate the id
+
+    Returns
+    -------
+    int - the trixel id, or None if ra or dec is None
+    """
+    if ra is None or dec is None:
+        return None
+    p = radec_to_vector(float(ra), float(dec))
+
+    for tid, verts in _BASE_TRIXELS:
+        if _contains(verts, p):
+            break
+
+    for _ in range(depth):
+        for child in _children(tid, verts):
+            if _contains(child[1], p):
+                tid, verts = child
+                break
+        else:
+            # Numerical edge case right on a boundary, the central child is
+            # the safe choice as it shares an edge with each of the others
+            tid, verts = child
+
+    return tid
+
+
+def _classify(verts, centre, cosr, radius):
+    """
+    Classify a trixel against a cap (a cone on the sky) of the given radius
+    (in radians) and cosine of the radius.
+
+    Returns 'inside' if the trixel is entirely within the cap, 'outside' if
+    it definitely does not intersect the cap, and 'partial' otherwise. The
+    'partial' case is conservative - it uses the bounding circle of the
+    trixel, so may include trixels that do not actually overlap the cap.
+    That is fine as we apply an exact distance cut afterwards.
+    """
+    v0, v1, v2 = verts
+    if _dot(v0, centre) >= cosr and _dot(v1, centre) >= cosr and \
+            _dot(v2, centre) >= cosr:
+        return 'inside'
+
+    tcentre = _normalize((v0[0] + v1[0] + v2[0],
+                          v0[1] + v1[1] + v2[1],
+                          v0[2] + v1[2] + v2[2]))
+    mindot = min(_dot(tcentre, v0), _dot(tcentre, v1), _dot(tcentre, v2))
+    tradius = math.acos(max(-1.0, min(1.0, mindot)))
+    sep = math.acos(max(-1.0, min(1.0, _dot(tcentre, centre))))
+    if sep > radius + tradius:
+        return 'outside'
+    return 'partial'
+
+
+def cone_ranges(ra, dec, radius, depth=HTM_DEPTH, max_trixels=64):
+    """
+    Calculate the list of HTM id ranges at the given depth that cover a cone.
+    The covering is guaranteed to be a superset of the cone.
+
+    Parameters
+    ----------
+    ra : float
+        Right Ascension of the cone centre in decimal degrees
+    dec : float
+        Declination of the cone centre in decimal degrees
+    radius : float
+        Radius of the cone in decimal degrees
+    depth : int
+        The HTM depth that ids are stored at
+    max_trixels : int
+        We stop refining the covering when it would exceed this many
+        trixels, to keep the SQL reasonable.
+
+    Returns
+    -------
+    list of (lower, upper) tuples. Ranges are half open, ie lower <= id < upper
+    """
+    centre = radec_to_vector(ra, dec)
+    radius = math.radians(min(radius, 180.0))
+    cosr = math.cos(radius)
+
+    result = []
+    partial = []
+    for tid, verts in _BASE_TRIXELS:
+        c = _classify(verts, centre, cosr, radius)
+        if c == 'inside':
+            result.append((tid, 0))
+        elif c == 'partial':
+            partial.append((tid, verts))
+
+    level = 0
+    while partial and level < depth:
+        inside = []
+        candidates = []
+        for tid, verts in partial:
+            for child in _children(tid, verts):
+                c = _classify(child[1], centre, cosr, radius)
+                if c == 'inside':
+                    inside.append((child[0], level+1))
+                elif c == 'partial':
+                    candidates.append(child)
+        if len(result) + len(inside) + len(candidates) > max_trixels:
+            # Refining would give too many ranges. Use the previous level.
+            break
+        result.extend(inside)
+        partial = candidates
+        level += 1
+
+    result.extend((tid, level) for tid, verts in partial)
+
+    # Convert to ranges at the storage depth and merge adjacent ranges
+    ranges = sorted((tid << 2*(depth-lvl), (tid + 1) << 2*(depth-lvl))
+                    for tid, lvl in result)
+    merged = []
+    for lower, upper in ranges:
+        if merged and lower <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(upper, merged[-1][1]))
+        else:
+            merged.append((lower, upper))
+    return merged
+
+
+def cone_filter(htm_col, cx_col, cy_col, cz_col, ra, dec, radius,
+                extra_radius_col=None, max_extra_radius=0.0):
+    """
+    Build an SQLAlchemy filter clause for a cone search on a table that has
+    an htm_id column and cx, cy, cz unit vector columns.
+
+    The clause consists of the HTM range lookups, which can use the B-tree
+    index on the htm id column, AND an exact great circle distance cut
+    expressed as a dot product against the unit vector columns.
+
+    Parameters
+    ----------
+    htm_col, cx_col, cy_col, cz_col : SQLAlchemy columns to use
+    ra, dec, radius : float
+        Cone centre and radius in decimal degrees
+    extra_radius_col : SQLAlchemy column or None
+        If given, this is a per-row radius in degrees (eg the radius of a
+        footprint) that is added to the search radius in the exact cut.
+    max_extra_radius : float
+        The largest value expected in extra_radius_col. The range lookup
+        covers a cone of radius + max_extra_radius.
+
+    Returns
+    -------
+    SQLAlchemy clause
+    """
+    x, y, z = radec_to_vector(ra, dec)
+    dot = cx_col * x + cy_col * y + cz_col * z
+
+    ranges = cone_ranges(ra, dec, radius + max_extra_radius)
+    range_clause = or_(*[and_(htm_col >= lower, htm_col < upper)
+                         for lower, upper in ranges])
+
+    if extra_radius_col is None:
+        return and_(range_clause, dot >= math.cos(math.radians(radius)))
+
+    # We can't do cos(radius + extra) in portable SQL, so we use
+    # 1 - cos(theta) <= theta^2 / 2, which is conservative (it can only
+    # include extra rows) and very accurate for the small angles involved.
+    theta = math.radians(radius) + extra_radius_col * (math.pi / 180.0)
+    return and_(range_clause, (1.0 - dot) * 2.0 <= theta * theta)
+
+
+def polygon_centre_radius(points):
+    """
+    Given a list of (RA, Dec) points defining a polygon (eg a footprint),
+    return the centre (ra, dec) and the radius in degrees of a circle that
+    encloses all the points.
+    """
+    vectors = [radec_to_vector(float(ra), float(dec)) for ra, dec in points]
+    centre = _normalize((sum(v[0] for v in vectors),
+                         sum(v[1] for v in vectors),
+                         sum(v[2] for v in vectors)))
+    radius = max(math.acos(max(-1.0, min(1.0, _dot(centre, v))))
+                 for v in vectors)
+    ra, dec = vector_to_radec(centre)
+    return ra, dec, math.degrees(radius)
@@ -1,8 +1,12 @@
 """
 This module contains code for ingesting files into the FitsStorage system.
 """
+import json
 import os
 
+import astropy.io.fits
+import astrodata
+
 from sqlalchemy import or_
 from sqlalchemy.exc import NoResultFound, MultipleResultsFound
 
@@ -12,7 +16,7 @@ from fits_storage.core.orm.file import File
 from fits_storage.core.orm.diskfile import DiskFile
 from fits_storage.core.orm.diskfilereport import DiskFileReport
 from fits_storage.core.orm.fulltextheader import FullTextHeader
-from fits_storage.core.orm.header import Header
+from fits_storage.core.orm.header import Header, header_delta_columns
 from fits_storage.core.orm.footprint import Footprint, footprints
 from fits_storage.core import geometryhacks
 from fits_storage.cal.orm import get_inst_rows
@@ -38,6 +42,7 @@ if fsc.is_server:
     if fsc.using_previews:
         from fits_storage.server.previewer import Previewer
     from fits_storage.server.reduce_on_ingest import ReduceOnIngest
+    from fits_storage.server.bz2multistream import read_primary_header
 
 
 
@@ -187,6 +192,12 @@ class Ingester(object):
 
         # At this point, 'fileobj' should be a valid DB  object.
 
+        # If this ingest results from a header update that only changed
+        # keywords we can handle without a full re-ingest, do that instead.
+        if self.is_server and iqe.header_update is not None and not iqe.force\
+                and self.ingest_header_delta(fileobj, iqe):
+            return True
+
         if self.need_to_add_diskfile(iqe, fileobj) or iqe.force:
             diskfile = self.add_diskfile_entry(fileobj, iqe)
             if diskfile is None:
@@ -239,10 +250,7 @@ class Ingester(object):
             if self.using_s3:
                 self.l.error("Export is not supported when using S3")
             else:
-                for destination in self.export_destinations:
-                    self.l.info("Adding %s to exportqueue for destination: %s",
-                                iqe.filename, destination)
-                    self.exportqueue.add(iqe.filename, iqe.path, destination)
+                self.add_to_exportqueue(iqe)
 
         # If we are doing immediate reduction, call for that now
         if fsc.is_server and self.queue_reduction:
@@ -259,6 +267,142 @@ class Ingester(object):
 
         return True
 
+    def ingest_header_delta(self, fileobj, iqe):
+        """
+        Handle an ingest resulting from a header update that only changed
+        primary header keywords listed in HEADER_DELTA_COLUMNS in header.py.
+        Rather than adding a new diskfile and re-ingesting the whole file, we
+        update the existing diskfile md5s in place, re-parse the primary
+        header and update only the affected Header columns and the PHU
+        section of the FullTextHeader. Footprints, objcat, instrument tables,
+        diskfile reports and previews all depend only on things that have
+        not changed, so we leave them alone.
+
+        We use the data md5 that FitsEditor computed when it wrote the file,
+        so we never decompress the file here. We do check the file md5 to make
+        sure the file has not been modified again since the header update,
+        and that the existing diskfile md5 matches the file before the header
+        update, as otherwise the database would not reflect the file.
+
+        If this is not possible for any reason, we return False and the
+        caller proceeds with a normal ingest. If we handle the ingest, we
+        delete the iqe and return True.
+
+        Parameters
+        ----------
+        fileobj - File instance
+        iqe - IngestQueueEntry instance, with header_update hints
+
+        Returns
+        -------
+        True if we handled the ingest, False if a full ingest is needed.
+        """
+        if self.using_s3 or iqe.md5_before_header_update is None or \
+                iqe.md5_after_header_update is None or \
+                iqe.file_md5_after_header_update is None:
+            return False
+
+        try:
+            header_update = json.loads(iqe.header_update)
+            generic = header_update.get('generic', [])
+            keywords = [item[0] for item in generic] if \
+                isinstance(generic, list) else list(generic)
+            if not keywords or set(header_update) != {'generic'}:
+                self.l.debug("Header update hint is not a simple keyword "
+                             "update")
+                return False
+        except (ValueError, TypeError, AttributeError, IndexError):
+            self.l.debug("Cannot parse header update hint: %s",
+                         iqe.header_update)
+            return False
+
+        columns = header_delta_columns(keywords)
+        if columns is None:
+            self.l.debug("Header update of %s needs a full ingest", keywords)
+            return False
+
+        try:
+            diskfile = self.s.query(DiskFile) \
+                .filter(DiskFile.file_id == fileobj.id) \
+                .filter(DiskFile.path == iqe.path) \
+                .filter(DiskFile.present == True).one()
+            header = self.s.query(Header) \
+                .filter(Header.diskfile_id == diskfile.id).one()
+        except (NoResultFound, MultipleResultsFound):
+            self.l.debug("No unique present diskfile and header for header "
+                         "update of %s", iqe.filename)
+            return False
+
+        if diskfile.data_md5 != iqe.md5_before_header_update:
+            self.l.debug("Diskfile data_md5 does not match md5 before header "
+                         "update")
+            return False
+
+        file_md5 = diskfile.get_file_md5()
+        if file_md5 != iqe.file_md5_after_header_update:
+            self.l.debug("File md5 does not match md5 after header update - "
+                         "it has been modified since")
+            return False
+
+        self.l.info("Header-delta ingest of %s: %s", iqe.filename, keywords)
+        try:
+            phu = astropy.io.fits.Header.fromstring(
+                read_primary_header(diskfile.fullpath, diskfile.compressed))
+            ad = astrodata.open(
+                astropy.io.fits.HDUList([astropy.io.fits.PrimaryHDU(
+                    header=phu)]))
+            changed = header.update_columns(ad, columns, log=self.l)
+            self.l.debug("Updated header columns: %s", changed)
+
+            for fth in self.s.query(FullTextHeader) \
+                    .filter(FullTextHeader.diskfile_id == diskfile.id):
+                fth.update_phu(phu)
+
+            diskfile.file_md5 = file_md5
+            diskfile.file_size = diskfile.get_file_size()
+            diskfile.lastmod = diskfile.get_file_lastmod()
+            diskfile.data_md5 = iqe.md5_after_header_update
+            self.s.commit()
+        except Exception:
+            self.l.error("Exception in header-delta ingest of %s, falling back "
+                         "to full ingest", iqe.filename, exc_info=True)
+            self.s.rollback()
+            return False
+
+        # Downstream servers need the updated file, and calibration
+        # associations can depend on the qa_state.
+        if self.export_destinations:
+            self.add_to_exportqueue(iqe)
+
+        if self.is_archive:
+            self.l.info("Adding header id %d to calcachequeue" % header.id)
+            if not self.calcachequeue.add(header.id, diskfile.filename):
+                self.l.error("Error adding to CalCacheQueue")
+
+        self.s.delete(iqe)
+        self.s.commit()
+        return True
+
+    def add_to_exportqueue(self, iqe):
+        """
+        Add the file to the export queue for each export destination. If the
+        ingest resulted from a header update, we pass on the header update
+        hints so that the exporter can try replaying the header update at the
+        destination rather than transferring the whole file.
+
+        Parameters
+        ----------
+        iqe - IngestQueueEntry instance
+        """
+        for destination in self.export_destinations:
+            self.l.info("Adding %s to exportqueue for destination: %s",
+                        iqe.filename, destination)
+            self.exportqueue.add(
+                iqe.filename, iqe.path, destination,
+                header_update=iqe.header_update,
+                md5_before_header_update=iqe.md5_before_header_update,
+                md5_after_header_update=iqe.md5_after_header_update)
+
     def need_to_add_diskfile(self, iqe, fileobj):
         """
         Determine whether we need to add a diskfile for this file object and
@@ -470,7 +614,9 @@ class Ingester(object):
         """
 
         # Note, all these objects use the diskfile ad_object, assuming it is
-        # open and ready to use.
+        # open and ready to use. Open it now, so that DiskFileReport can
+        # validate its headers rather than opening the file again.
+        diskfile.get_ad_object
 
         try:
             self.l.debug("Adding new DiskFileReport entry")
@@ -568,6 +714,8 @@ class Ingester(object):
                     # Hence, the geometryhacks.py module...
                     footprint = Footprint(header)
                     footprint.extension = label
+                    if self.is_server:
+                        footprint.set_htm(fp)
                     self.s.add(footprint)
                     self.s.flush()
                     geometryhacks.add_footprint(self.s, footprint.id, fp)
@@ -2,7 +2,7 @@ from sqlalchemy import Column, ForeignKey
 from sqlalchemy import Integer, Text, Enum
 
 from .diskfile import DiskFile
-from ...fits_verify import fitsverify
+from ...fits_verify import fitsverify, FitsVerifyProcess
 
 from fits_storage.logger_dummy import DummyLogger
 from fits_storage.config import get_config
@@ -61,19 +61,27 @@ class DiskFileReport(Base):
         fitsverify_path = fitsverify_path if fitsverify_path is not None \
             else fsc.fitsverify_path
 
-        if skip_fv or not using_fitsverify:
+        # fitsverify runs in the background while we do the metadata
+        # validation
+        fv_process = None
+        run_fv = not skip_fv and using_fitsverify
+        if not run_fv:
             logger.debug("Skipping fits_verify")
             diskfile.fverrors = 0
         else:
-            logger.debug("Calling fits_verify")
-            self.fits_verify(diskfile, fvpath=fitsverify_path)
+            logger.debug("Starting fits_verify")
+            fv_process = self.fits_verify_start(diskfile,
+                                                fvpath=fitsverify_path)
 
         if skip_md:
             logger.debug("Skipping Metadata validation")
             diskfile.mdready = True
         else:
             logger.debug("Calling Metadata validator")
-            self.md(diskfile)
+            self.md(diskfile, in_memory=run_fv)
+
+        if fv_process is not None:
+            self.fits_verify_result(diskfile, fv_process)
 
     def fits_verify(self, diskfile, fvpath=None):
         """
@@ -102,13 +110,59 @@ class DiskFileReport(Base):
             retlist = fitsverify(filename, fvpath=fvpath)
         except Exception:
             self.logger.error("Exception during fitsverify", exc_info=True)
+            return
+
+        self._record_fitsverify(diskfile, retlist)
+
+    def fits_verify_start(self, diskfile, fvpath=None):
+        """
+        Start fitsverify running on the diskfile in the background. Returns
+        a :class:`~FitsVerifyProcess` to pass to fits_verify_result(), or
+        None if we could not start it.
+
+        Parameters
+        ----------
+        diskfile : :class:`~DiskFile`
+            Run FITS verify report on this :class:`~DiskFile`
+
+        fvpath : str or None
+            Path to the fitsverify executable.
+        """
+        filename = diskfile.get_uncompressed_file()
 
+        try:
+            return FitsVerifyProcess(filename, fvpath=fvpath)
+        except Exception:
+            self.logger.error("Exception during fitsverify", exc_info=True)
+            return None
+
+    def fits_verify_result(self, diskfile, fv_process):
+        """
+        Wait for fitsverify started by fits_verify_start() to finish and
+        record the results, as fits_verify() does.
+
+        Parameters
+        ----------
+        diskfile : :class:`~DiskFile`
+            The :class:`~DiskFile` that was verified
+        fv_process : :class:`~FitsVerifyProcess`
+            The process returned by fits_verify_start()
+        """
+        try:
+            retlist = fv_process.result()
+        except Exception:
+            self.logger.error("Exception during fitsverify", exc_info=True)
+            return
+
+        self._record_fitsverify(diskfile, retlist)
+
+    def _record_fitsverify(self, diskfile, retlist):
         diskfile.isfits = bool(retlist[0])
         diskfile.fvwarnings = retlist[1]
         diskfile.fverrors = retlist[2]
         self.fvreport = retlist[3]
 
-    def md(self, diskfile):
+    def md(self, diskfile, in_memory=False):
         """
         Evaluates the headers and records the md results
 
@@ -120,11 +174,20 @@ class DiskFileReport(Base):
         ---------
         diskfile : :class:`~DiskFile`
             Run the Metadata report on this :class:`~DiskFile`
+        in_memory : bool
+            If `True`, and the diskfile AstroData object has been opened, as
+            the ingester does anyway, validate its headers rather than
+            opening the file again with astropy. Astropy's verification of
+            the file is skipped then, so this should only be used if the file
+            is being checked with fitsverify.
         """
-        filename = diskfile.get_uncompressed_file()
+        if in_memory and diskfile.ad_object is not None:
+            source = diskfile.ad_object
+        else:
+            source = diskfile.get_uncompressed_file()
 
         try:
-            result = evaluate(filename)
+            result = evaluate(source)
             diskfile.mdready = result.passes
             self.mdstatus = result.code
             if result.message is not None:
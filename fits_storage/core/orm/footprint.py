@@ -1,13 +1,22 @@
 import sys
 
 from sqlalchemy import Column, ForeignKey
-from sqlalchemy import Integer, Text
+from sqlalchemy import Integer, BigInteger, Text, Float
 
 from . import Base
 from .header import Header
 
+from fits_storage.core.htm import htm_id, radec_to_vector, \
+    polygon_centre_radius
 from fits_storage.logger_dummy import DummyLogger
 
+from fits_storage.config import get_config
+fsc = get_config()
+
+# The largest footprint radius (degrees) that we expect. This is used to
+# size the spatial index lookup when searching footprints by cone.
+MAX_FOOTPRINT_RADIUS = 0.25
+
 class Footprint(Base):
     """
     This is the ORM object for the Footprint table. Each row is a footprint
@@ -24,6 +33,16 @@ class Footprint(Base):
     # An area column of type polygon gets added using raw sql in
     # CreateTables.py
 
+    if fsc.is_server:
+        # Spatial index columns for the footprint centre. See
+        # fits_storage.core.htm. radius is the radius in degrees of a circle
+        # centred there that encloses the whole footprint.
+        htm_id = Column(BigInteger, index=True)
+        cx = Column(Float)
+        cy = Column(Float)
+        cz = Column(Float)
+        radius = Column(Float)
+
     def __init__(self, header, logger=DummyLogger()):
         """
         Create a :class:`~Footprint`
@@ -36,6 +55,19 @@ class Footprint(Base):
         self.header_id = header.id
         self.logger = logger
 
+    def set_htm(self, fp):
+        """
+        Set the spatial index columns from the footprint corner coordinates.
+
+        Parameters
+        ----------
+        fp : list of (RA, Dec) tuples
+            The footprint corners, as returned by footprints()
+        """
+        ra, dec, self.radius = polygon_centre_radius(fp)
+        self.htm_id = htm_id(ra, dec)
+        self.cx, self.cy, self.cz = radec_to_vector(ra, dec)
+
 
 # Note, this function is not a member of the ORM class. This seemed the best
 # place for it to live though.
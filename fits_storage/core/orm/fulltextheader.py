@@ -18,6 +18,8 @@ class FullTextHeader(Base):
                          index=True)
     fulltext = Column(Text)
 
+    phu_marker = "\n--- PHU ---\n"
+
     def __init__(self, diskfile):
         """
         Create a :class:`~FullTextHeader` record for the given file
@@ -44,7 +46,7 @@ class FullTextHeader(Base):
         self.fulltext = ""
         self.fulltext += "Filename: " + diskfile.filename + "\n\n"
         self.fulltext += "AstroData Tags: " + str(ad.tags) + "\n\n"
-        self.fulltext += "\n--- PHU ---\n"    
+        self.fulltext += self.phu_marker
         self.fulltext += repr(ad.phu).strip()
         self.fulltext += "\n"
         for i in range(len(ad)):
@@ -53,3 +55,20 @@ class FullTextHeader(Base):
             self.fulltext += f"\n--- HDU {i+1} ---\n"
             self.fulltext += repr(ad[i].hdr).strip()
             self.fulltext += '\n'
+
+    def update_phu(self, phu):
+        """
+        Replace the PHU section of the full text with the given astropy
+        Header, leaving the rest untouched. Used when only primary header
+        keywords have changed.
+
+        Parameters
+        ----------
+        phu : :class:`astropy.io.fits.Header`
+            The new primary header
+        """
+        start = self.fulltext.index(self.phu_marker) + len(self.phu_marker)
+        end = self.fulltext.find("\n--- HDU ", start)
+        end = len(self.fulltext) if end == -1 else end
+        self.fulltext = self.fulltext[:start] + repr(phu).strip() + "\n" + \
+            self.fulltext[end:]
@@ -1,12 +1,13 @@
 from sqlalchemy import Column, ForeignKey, Enum, Index, desc, nullslast
 from sqlalchemy import Integer, BigInteger, Text, DateTime, Date, Time, \
-    Boolean, Numeric
+    Boolean, Numeric, Float
 
 from sqlalchemy.orm import relationship, synonym
 
 from . import Base
 
 from fits_storage.core.orm.diskfile import DiskFile
+from fits_storage.core.htm import htm_id, radec_to_vector
 
 from fits_storage.logger_dummy import DummyLogger
 from fits_storage.file_parser import build_parser
@@ -42,6 +43,50 @@ if fsc.is_server:
     from fits_storage.server.orm.processingtag import ProcessingTag
 
 
+# Header columns that depend only on the given primary header keyword. When a
+# header update only changes keywords in this dictionary, the ingester updates
+# just these columns by re-parsing the primary header, rather than fully
+# re-ingesting the file. Keywords that affect other columns or the astrodata
+# tags must not be added here.
+HEADER_DELTA_COLUMNS = {
+    'RAWGEMQA': ('qa_state',),
+    'RAWPIREQ': ('qa_state',),
+    'RAWBG': ('raw_bg',),
+    'RAWCC': ('raw_cc',),
+    'RAWIQ': ('raw_iq',),
+    'RAWWV': ('raw_wv',),
+    'RELEASE': ('release',),
+}
+
+
+def header_delta_columns(keywords):
+    """
+    Return the set of Header columns that need updating when the given primary
+    header keywords change, or None if any of the keywords are not in
+    HEADER_DELTA_COLUMNS, in which case a full re-ingest is needed.
+    """
+    columns = set()
+    for keyword in keywords:
+        if keyword.upper() not in HEADER_DELTA_COLUMNS:
+            return None
+        columns.update(HEADER_DELTA_COLUMNS[keyword.upper()])
+    return columns
+
+
+def normalize_object_name(name):
+    """
+    Normalize an object name for searching. We lower case the name and strip
+    all whitespace from it, so that eg 'NGC 1234' and 'ngc1234' match. This
+    is done in the same way as the SQL used to backfill the object_norm column
+    in rebuild_object_search.py, so the two must be kept in step.
+
+    Wildcard characters are passed through untouched.
+    """
+    if name is None:
+        return None
+    return ''.join(name.split()).lower()
+
+
 class Header(Base):
     """
     This is the ORM class for the Header table.
@@ -128,6 +173,18 @@ class Header(Base):
         # add it in the general case to preserve db compatability for dragons.
         numpix = Column(Integer)
 
+        # Spatial index columns for cone searches. htm_id is the HTM trixel
+        # id of (ra, dec) and cx, cy, cz are the cartesian unit vector. See
+        # fits_storage.core.htm for details. Also server only, as above.
+        htm_id = Column(BigInteger, index=True)
+        cx = Column(Float)
+        cy = Column(Float)
+        cz = Column(Float)
+
+        # Normalized object name for searching. See normalize_object_name().
+        # On postgres, createtables adds trigram and pattern indexes on this.
+        object_norm = Column(Text, index=True)
+
         # Note, we don't define ObslogComment.data_label to be a foreign key to
         # Header.data_label as that would prevent us ingesting and storing
         # obslog comments for which a header entry does not exist (yet), which
@@ -284,6 +341,8 @@ class Header(Base):
 
         if fsc.is_server:
             self.numpix = parser.numpix()
+            self.set_htm()
+            self.object_norm = normalize_object_name(self.object)
 
         # Get the types list
         self.types = str(diskfile.ad_object.tags) \
@@ -294,6 +353,35 @@ class Header(Base):
 
         return
 
+    def update_columns(self, ad, columns, log=DummyLogger()):
+        """
+        Update just the given columns from the AstroData object ad, which
+        need only contain the primary header. Used for header-delta ingests,
+        see header_delta_columns().
+
+        Returns a list of the columns whose values changed.
+        """
+        parser = build_parser(ad, log)
+        changed = []
+        for column in sorted(columns):
+            value = getattr(parser, column)()
+            if getattr(self, column) != value:
+                setattr(self, column, value)
+                changed.append(column)
+        return changed
+
+    def set_htm(self):
+        """
+        Set the spatial index columns (htm_id, cx, cy, cz) from the ra and dec
+        values. These are set to None if either of ra or dec is None.
+        """
+        if self.ra is None or self.dec is None:
+            self.htm_id = self.cx = self.cy = self.cz = None
+            return
+        ra, dec = float(self.ra), float(self.dec)
+        self.htm_id = htm_id(ra, dec)
+        self.cx, self.cy, self.cz = radec_to_vector(ra, dec)
+
     def estimate_numpix(self):
         # This is used in add_to_reduce_queue when numpix is None. This is
         # a temporary workaround when releasing 3.6 to avoid needing a database
@@ -303,3 +391,10 @@ class Header(Base):
             return self.diskfile.data_size // bytepix
         else:
             return None
+
+
+# The search_row projection table is maintained by event listeners on Header,
+# so these need registering whenever Header is used. It needs Header to be
+# defined, hence importing it down here.
+if fsc.is_server:
+    import fits_storage.server.orm.searchrow
@@ -119,6 +119,7 @@ if fsc.is_archive:
     from fits_storage.server.orm.ipprefix import IPPrefix
     from fits_storage.server.orm.usagelog_analysis import UsageLogAnalysis
     from fits_storage.server.orm.glacier import Glacier
+    from fits_storage.server.orm.searchrow import SearchRow
 
 def get_fitsweb_granthelper():
     # Define server database permissions here for clarity. Using helper class
@@ -132,7 +133,7 @@ def get_fitsweb_granthelper():
          'preview', 'obslog', 'miscfile', 'obslog_comment', 'program',
          'publication', 'programpublication', 'provenance', 'history',
          'reduction', 'processingtag', 'monitoring', 'processinglog',
-         'processinglog_files'])
+         'processinglog_files', 'search_row'])
 
     # For the notification system:
     grant.select('notification')
@@ -253,6 +254,22 @@ def create_tables(session: Session):
             session.execute(text(("ALTER TABLE footprint ADD IF NOT EXISTS area polygon;")))
             session.execute(text("ALTER TABLE photstandard ADD IF NOT EXISTS coords point;"))
 
+            # Indexes for wildcard object name searches. The b-tree index
+            # with text_pattern_ops handles prefix searches, the trigram
+            # index handles suffix and infix searches.
+            if fsc.is_server:
+                session.execute(text("CREATE EXTENSION IF NOT EXISTS pg_trgm;"))
+                session.execute(text(
+                    "CREATE INDEX IF NOT EXISTS ix_header_object_norm_pattern "
+                    "ON header (object_norm text_pattern_ops);"))
+                session.execute(text(
+                    "CREATE INDEX IF NOT EXISTS ix_header_object_norm_trgm "
+                    "ON header USING gin (object_norm gin_trgm_ops);"))
+                # Open queries on search_row sort on this
+                session.execute(text(
+                    "CREATE INDEX IF NOT EXISTS ix_search_row_ut_datetime_desc "
+                    "ON search_row (ut_datetime DESC NULLS LAST);"))
+
             # Grant access to server tables for the unprivileged user that runs the
             # wsgi code for the web server (ie 'fitsweb')
             if fsc.is_server:
@@ -8,12 +8,15 @@ from fits_storage.core.orm.diskfile import DiskFile
 from fits_storage.core.orm.header import Header
 
 from sqlalchemy import asc, desc, nullslast, func
+from sqlalchemy.orm import joinedload
 
 from fits_storage.config import get_config
 
 if get_config().is_server:
     from fits_storage.server.wsgi.context import get_context
     from fits_storage.server.orm.processingtag import ProcessingTag
+    from fits_storage.server.orm.searchrow import SearchRow, \
+        searchrow_criteria, translate_to_search_row
 
 
 def list_headers(selection, orderby, session=None, unlimit=False):
@@ -30,12 +33,75 @@ def list_headers(selection, orderby, session=None, unlimit=False):
     if session is None:
         session = get_context().session
 
+    fsc = get_config()
+    if fsc.is_server and fsc.using_search_row:
+        # Do the selection and ordering on the search_row table, joined to
+        # header to load the headers themselves.
+        query = session.query(Header)\
+            .join(SearchRow, SearchRow.header_id == Header.id)\
+            .options(joinedload(Header.diskfile).joinedload(DiskFile.file))
+        query = _search_row_query(query, selection, orderby, unlimit)
+        if query is not None:
+            return query.all()
+
     # The basic query...
     query = session.query(Header).join(DiskFile).join(File)
 
     # Add the selection...
     query = selection.filter(query)
 
+    query = query.order_by(*_order_criteria(selection, orderby))
+    query = _limit(query, selection, unlimit)
+
+    # Return the list of DiskFile objects
+    return query.all()
+
+
+def list_search_rows(selection, orderby, session=None, unlimit=False):
+    """
+    This function queries the search_row table for a list of entries that
+    satisfy the selection criteria. This is a single table query, so is much
+    cheaper than the equivalent header query.
+
+    selection is a dictionary containing fields to select on
+    orderby is a list of fields to sort the results by
+
+    Returns a list of SearchRow objects, or None if the selection can't be
+    answered from the search_row table, in which case use list_headers.
+    """
+    if session is None:
+        session = get_context().session
+
+    query = _search_row_query(session.query(SearchRow), selection, orderby,
+                              unlimit)
+    return None if query is None else query.all()
+
+
+def _search_row_query(query, selection, orderby, unlimit):
+    """
+    Add the selection criteria, ordering and limit, translated to the
+    search_row table, to query, which must include the search_row table.
+    Returns None if the selection can't be answered from the search_row table.
+    """
+    criteria = searchrow_criteria(selection)
+    if criteria is None:
+        return None
+
+    order_criteria = [translate_to_search_row(oc)
+                      for oc in _order_criteria(selection, orderby)]
+    if any(oc is None for oc in order_criteria):
+        return None
+
+    if criteria is not True:
+        query = query.filter(criteria)
+    query = query.order_by(*order_criteria)
+    return _limit(query, selection, unlimit)
+
+
+def _order_criteria(selection, orderby):
+    """
+    Convert the orderby list to a list of SQLAlchemy order criteria
+    """
     # Do we have any order by arguments?
 
     whichorderby = ['instrument', 'data_label', 'observation_class',
@@ -80,18 +146,21 @@ def list_headers(selection, orderby, session=None, unlimit=False):
         # order_criteria.append(asc(Header.ut_datetime))
         order_criteria.append(nullslast(asc(Header.ut_datetime)))
 
-    query = query.order_by(*order_criteria)
+    return order_criteria
+
 
-    # If this is an open query, we should limit the number of responses
+def _limit(query, selection, unlimit):
+    """
+    If this is an open query, we should limit the number of responses
+    """
     fsc = get_config()
     if not unlimit:
         if selection.openquery:
             query = query.limit(fsc.fits_open_result_limit)
         else:
             query = query.limit(fsc.fits_closed_result_limit)
+    return query
 
-    # Return the list of DiskFile objects
-    return query.all()
 
 def available_processing_tags(selection, session=None):
     """
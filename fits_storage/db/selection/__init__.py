@@ -10,6 +10,10 @@ class Selection(dict):
 
         self._url = None
 
+        # Set by filter() to describe how any object name search was done.
+        # This is not a selection item, so it is an attribute, not a key.
+        self.object_search_strategy = None
+
     from .say_selection import say
     from .to_url import to_url
     from .query_selection import filter
@@ -1,5 +1,7 @@
 import re
 import math
+import datetime
+import functools
 
 from sqlalchemy import or_, and_, func, case
 
@@ -8,9 +10,10 @@ import fits_storage.gemini_metadata_utils as gmu
 # TODO - get rid of this link into the GPI table
 from fits_storage.cal.orm.gpi import Gpi
 
-from fits_storage.core.orm.header import Header
+from fits_storage.core.orm.header import Header, normalize_object_name
 from fits_storage.core.orm.diskfile import DiskFile
 from fits_storage.core.orm.file import File
+from fits_storage.core.htm import cone_filter
 
 from fits_storage.config import get_config
 fsc = get_config()
@@ -54,6 +57,29 @@ queryselection_filters = (
     )
 
 
+_yyyymmdd_cre = re.compile(r'^\d{8}$')
+
+
+@functools.lru_cache(maxsize=1024)
+def _cached_time_period(start, end):
+    return gmu.get_time_period(start, end)
+
+
+def _time_period(start, end=None):
+    """
+    Memoizing wrapper around gmu.get_time_period(). We only cache values that
+    do not depend on the current date - ie explicit YYYYMMDD strings or date
+    instances, not eg 'today'.
+    """
+    def cacheable(value):
+        return value is None or isinstance(value, datetime.date) or \
+            (isinstance(value, str) and _yyyymmdd_cre.match(value))
+
+    if cacheable(start) and cacheable(end):
+        return _cached_time_period(start, end)
+    return gmu.get_time_period(start, end)
+
+
 # This function is used to add the stuff to stop it finding data by coords
 # when the coords are proprietary.
 def querypropcoords(query):
@@ -92,13 +118,18 @@ def filter(self, query, ignore_processing_tag=False):
 
     if ('object' in self) and (
             ('ra' not in self) and ('dec' not in self)):
-        # Handle the "wildcards" allowed on the object name
-        object = self['object']
-        if object.startswith('*') or object.endswith('*'):
-            # Wildcards are used, replace with SQL wildcards and use ilike query
-            object = object.replace('*', '%')
-        # ilike is a case-insensitive version of like
-        query = query.filter(Header.object.ilike(object))
+        if fsc.is_server and fsc.object_search_index:
+            query = _object_search(self, query)
+        else:
+            # Handle the "wildcards" allowed on the object name
+            object = self['object']
+            if object.startswith('*') or object.endswith('*'):
+                # Wildcards are used, replace with SQL wildcards and use
+                # ilike query
+                object = object.replace('*', '%')
+            # ilike is a case-insensitive version of like
+            query = query.filter(Header.object.ilike(object))
+            self.object_search_strategy = 'case-insensitive match (no index)'
         query = querypropcoords(query)
 
     # Should we query by date?
@@ -106,7 +137,7 @@ def filter(self, query, ignore_processing_tag=False):
         # This is now a literal UTC date query. To query by observing night
         # use the 'night' selection
 
-        startdt, enddt = gmu.get_time_period(self['date'])
+        startdt, enddt = _time_period(self['date'])
 
         # check it's between these two
         query = query.filter(Header.ut_datetime >= startdt)\
@@ -117,7 +148,7 @@ def filter(self, query, ignore_processing_tag=False):
         # Parse the date to start and end datetime objects
         startd, endd = gmu.gemini_daterange(self['daterange'],
                                             as_dates=True)
-        startdt, enddt = gmu.get_time_period(startd, endd)
+        startdt, enddt = _time_period(startd, endd)
 
         # check it's between these two
         query = query.filter(Header.ut_datetime >= startdt)\
@@ -125,7 +156,7 @@ def filter(self, query, ignore_processing_tag=False):
 
     # Query by Observing Night
     if 'night' in self:
-        startdt, enddt = gmu.get_time_period(self['night'])
+        startdt, enddt = _time_period(self['night'])
         query = query.filter(
             or_(
                 and_(Header.telescope == 'Gemini-North',
@@ -141,7 +172,7 @@ def filter(self, query, ignore_processing_tag=False):
     if 'nightrange' in self:
         startd, endd = gmu.gemini_daterange(self['nightrange'],
                                             as_dates=True)
-        startdt, enddt = gmu.get_time_period(startd, endd)
+        startdt, enddt = _time_period(startd, endd)
         query = query.filter(
             or_(
                 and_(Header.telescope == 'Gemini-North',
@@ -280,9 +311,20 @@ def filter(self, query, ignore_processing_tag=False):
                 filter(Header.elevation < b)
             query = querypropcoords(query)
 
+    # If this is a cone search (single ra and dec values) and the spatial
+    # index is enabled, use that rather than the ra and dec box filters below.
+    cone = None
+    if fsc.is_server and fsc.htm_cone_search:
+        cone = _parse_cone(self)
+    if cone is not None:
+        ra, dec, sr = cone
+        query = query.filter(cone_filter(Header.htm_id, Header.cx, Header.cy,
+                                         Header.cz, ra, dec, sr))
+        query = querypropcoords(query)
+
     # cosdec value is used in 'ra' code below to scale the search radius
     cosdec = None
-    if 'dec' in self:
+    if 'dec' in self and cone is None:
         valid = True
         # might be a range or a single value
         match = re.match(r"(-?[\d:\.]+)-(-?[\d:\.]+)", self['dec'])
@@ -338,7 +380,7 @@ def filter(self, query, ignore_processing_tag=False):
                     .filter(Header.dec < upper)
             query = querypropcoords(query)
 
-    if 'ra' in self:
+    if 'ra' in self and cone is None:
         valid = True
         # might be a range or a single value
         value = self['ra'].split('-')
@@ -550,6 +592,80 @@ def filter(self, query, ignore_processing_tag=False):
     return query
 
 
+def _object_search(selection, query):
+    """
+    Add the filter for an object name search using the normalized object name
+    column, and record the strategy used in selection.object_search_strategy.
+
+    Searches without wildcards are an equality match, which uses the b-tree
+    index. Prefix searches (foo*) use the text_pattern_ops index, and other
+    wildcard searches (*foo, *foo*, f*o) use the trigram index, provided
+    there are at least 3 characters to match on, which is the minimum the
+    trigram index can use. These indexes are postgres only - see
+    createtables.py.
+    """
+    name = normalize_object_name(selection['object'])
+    if '*' not in name:
+        selection.object_search_strategy = 'exact match (b-tree index)'
+        return query.filter(Header.object_norm == name)
+
+    pattern = name.replace('*', '%')
+    literal = name.strip('*')
+    if '*' not in literal:
+        if name.startswith('*') and name.endswith('*'):
+            kind = 'infix'
+        elif name.endswith('*'):
+            kind = 'prefix'
+        else:
+            kind = 'suffix'
+    else:
+        kind = 'wildcard'
+
+    if kind == 'prefix':
+        selection.object_search_strategy = 'prefix match (pattern index)'
+    elif max((len(part) for part in name.split('*')), default=0) >= 3:
+        selection.object_search_strategy = f'{kind} match (trigram index)'
+    else:
+        selection.object_search_strategy = f'{kind} match (too short to ' \
+                                           f'use index)'
+
+    return query.filter(Header.object_norm.like(pattern))
+
+
+def _parse_cone(selection):
+    """
+    If the selection contains single values (ie not ranges) for ra and dec,
+    return a tuple of (ra, dec, sr) in decimal degrees, defaulting the search
+    radius in the same way as the box search code does. Otherwise, or if the
+    values are invalid, return None, and the box search code will handle them
+    and set any warnings.
+    """
+    if 'ra' not in selection or 'dec' not in selection:
+        return None
+    if len(selection['ra'].split('-')) != 1:
+        return None
+    if re.match(r"(-?[\d:\.]+)-(-?[\d:\.]+)", selection['dec']):
+        return None
+
+    ra = gmu.ratodeg(selection['ra'])
+    dec = gmu.dectodeg(selection['dec'])
+    if ra is None or dec is None:
+        return None
+
+    sr = gmu.srtodeg(selection['sr']) if 'sr' in selection else None
+    if sr is None:
+        if 'sr' in selection:
+            selection['warning'] = 'Invalid Search Radius, ' \
+                                   'defaulting to 3 arcmin'
+        else:
+            selection['warning'] = 'No Search Radius given, ' \
+                                   'defaulting to 3 arcmin'
+        selection['sr'] = '180'
+        sr = gmu.srtodeg(selection['sr'])
+
+    return ra, dec, sr
+
+
 range_cre = re.compile(r'(-?\d*\.?\d*)-(-?\d*\.?\d*)')
 
 def _parse_range(string):
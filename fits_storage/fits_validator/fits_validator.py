@@ -11,7 +11,7 @@ __all__ = ['RuleSetFactory', 'RuleSet', 'RuleCollection', 'Environment', 'Valida
 """
 This module contains all the machinery for metadata testing. The easiest way to
 use it is to import Evaluator, instanciate it and then pass call the evaluator
-object passing an HDUList.
+object passing an HDUList, or the list of headers from one.
 
   >>> evaluate = Evaluator()
   >>> evaluate(fits)
@@ -27,6 +27,7 @@ The result is a named tuple with elements:
 
 import os
 import re
+import threading
 from collections import namedtuple, defaultdict
 from datetime import datetime
 from time import strptime
@@ -715,7 +716,14 @@ def get_from_scope(sourcename, scope, name):
     return ret
 
 class RuleSetFactory(object):
+    """Parses the rule files into trees of RuleSet objects.
+
+       The parsed rules are kept for the life of the process, per RuleSet class,
+       so that every factory (and every Evaluator) shares them, and each file
+       is read and parsed only once"""
     __registry = {}
+    __parsed = {}
+    lock = threading.RLock()
 
     @classmethod
     def register_function(cls, name, excIfTrue = None, excIfFalse = None):
@@ -729,7 +737,7 @@ class RuleSetFactory(object):
 
     def __init__(self, ruleSetClass):
         self._cls = ruleSetClass
-        self._cache = {}
+        self._cache = RuleSetFactory.__parsed.setdefault(ruleSetClass, {})
 
     def __parse_tests(self, sourcename, data, name=None):
         result = AndTest(name=name)
@@ -776,6 +784,8 @@ class RuleSetFactory(object):
                     if _element == 'matching(pdu)':
                         test_to_add = lambda hlist,env: mtest(hlist[0], env)
                         test_to_add.name='matching(pdu)'
+                        # Used by AlternateRuleSets to index the alternatives
+                        test_to_add.matches = dict(iter_pairs(content))
                     else:
                         test_to_add = mtest
                 elif _element in RuleSetFactory.__registry:
@@ -1078,11 +1088,16 @@ class RuleSet(list):
 class AlternateRuleSets(object):
     """This class is an interface to multiple RuleSets. It chooses among a number of
        alternate rulesets and offers the same behaviour as the first one that matches the
-       current environment and headers"""
+       current environment and headers
+
+       If the first condition of every alternate is a `matching(pdu)` on the same
+       keyword (eg. the instrument rulesets, on INSTRUME), the alternates are indexed
+       by the values of that keyword, and only those that can apply are tried"""
     def __init__(self):
         self.alts = []
         self.conditions = AndTest()
         self._features = []
+        self._index = None
         self.winner = None
 
     @property
@@ -1099,6 +1114,49 @@ class AlternateRuleSets(object):
 
     def add(self, alt):
         self.alts.append(alt)
+        self._index = None
+
+    def _build_index(self):
+        """Returns (keyword, {value: [alternates]}) if the alternates can be indexed,
+           or False otherwise"""
+        keyword = None
+        index = defaultdict(list)
+        for alt in self.alts:
+            if not isinstance(alt, RuleSet) or not alt.conditions:
+                return False
+            matches = getattr(alt.conditions[0], 'matches', None)
+            if not matches or len(matches) != 1:
+                return False
+            (kw, value), = matches.items()
+            if keyword is None:
+                keyword = kw
+            elif kw != keyword:
+                return False
+            if isinstance(value, str):
+                value = [value]
+            elif not isinstance(value, (list, tuple)):
+                return False
+            for v in value:
+                if not index[v] or index[v][-1] is not alt:
+                    index[v].append(alt)
+        return (keyword, dict(index)) if keyword is not None else False
+
+    def candidates(self, hlist, env):
+        """Returns the alternates that may apply to `hlist`, in order. All of them
+           are tried for a final validation, as they are tested even if their
+           conditions don't apply"""
+        if env.final:
+            return self.alts
+        if self._index is None:
+            self._index = self._build_index()
+        if not self._index:
+            return self.alts
+        keyword, index = self._index
+        try:
+            return index.get(hlist[0].get(keyword), ())
+        except TypeError:
+            # Unhashable value. It can't match any of them anyway
+            return ()
 
     def set_attributes(self, cond=None, feat=None):
         if cond:
@@ -1112,11 +1170,12 @@ class AlternateRuleSets(object):
         return self.test(hlist, env)
 
     def applies_to(self, hlist, env):
-        return self.conditions.test(hlist, env) and any(x.applies_to(hlist, env) for x in self.alts)
+        return self.conditions.test(hlist, env) and any(x.applies_to(hlist, env)
+                                                        for x in self.candidates(hlist, env))
 
     def test(self, hlist, env):
         collect = []
-        for alt in self.alts:
+        for alt in self.candidates(hlist, env):
             valid, messages = alt.validate(hlist, env)
             if valid:
                 self.winner = alt
@@ -1138,7 +1197,8 @@ class RuleCollection(object):
         self._ruleSetClass = ruleSetClass
 
     def initialize(self, mainFileName):
-        self.entryPoint = RuleSetFactory(self._ruleSetClass).parse(mainFileName)
+        with RuleSetFactory.lock:
+            self.entryPoint = RuleSetFactory(self._ruleSetClass).parse(mainFileName)
 
     @property
     def initialized(self):
@@ -1165,18 +1225,26 @@ class Evaluator(object):
     def validate_file(self, fits, tags):
         """Evaluates the validity of a FITS file and returns a tuple (valid, messages, environment),
            where `valid` is a boolean, `messages` is a list of error messages, if there were any, and
-           `environment` is the Environment object with the features collected during the evaluation"""
+           `environment` is the Environment object with the features collected during the evaluation
+
+           `fits` is either an HDUList, which is verified by astropy first, or a list with the
+           headers (astropy Headers, or anything offering `in`, `[]` and `get` like them) of a file
+           that has already been read, in which case checking the structure of the file is left to the caller"""
         if not self.rq.initialized:
             self.init()
 
-        fits.verify('exception')
+        if isinstance(fits, pf.HDUList):
+            fits.verify('exception')
+            headers = [hdu.header for hdu in fits]
+        else:
+            headers = fits
         env = Environment()
         env.features = self._set_initial_features(fits, tags)
         env.final = False
         env.keeptesting = True
         env.overrides = OverrideStack()
 
-        return self.rq.test([hdu.header for hdu in fits], env) + (env,)
+        return self.rq.test(list(headers), env) + (env,)
 
     def evaluate(self, fits, tags=set()):
         try:
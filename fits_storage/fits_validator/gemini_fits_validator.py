@@ -16,6 +16,7 @@ import astrodata
 import gemini_instruments
 from datetime import datetime, timedelta
 from io import StringIO
+import os
 import sys
 import astropy.io.fits as pf
 import logging
@@ -29,6 +30,12 @@ STATUSES.append('NOTGEMINI')
 OLDIMAGE = datetime(2007, 6, 28)
 OBSCLASS_VALUES = {'dayCal',  'partnerCal',  'acqCal',  'acq',  'science',  'progCal'}
 
+# The comment AstroData gives keywords it adds to the headers when opening a file
+ADDED_BY_ASTRODATA = 'Added by AstroData'
+# Keywords that differ between the PHU and extension AstroData makes from a single
+# image FITS file
+SINGLE_IMAGE_KEYWORDS = {'SIMPLE', 'BITPIX', 'NAXIS', 'EXTEND', 'ORIGNAME'}
+
 class NotGeminiData(ValidationError):
     pass
 
@@ -164,6 +171,48 @@ def set_date(header, env):
 def check_for_bad_RAWGEMWA(hlist, env):
     return hlist[0].get('RAWGEMQA', '') == 'BAD'
 
+class HeaderView(object):
+    """A read only view of a header, without the keywords in `hidden`. It offers
+       what the validator uses from a header: `in`, `[]` and `get`"""
+    def __init__(self, header, hidden):
+        self.header = header
+        self.hidden = hidden
+
+    def __contains__(self, kw):
+        return kw not in self.hidden and kw in self.header
+
+    def __getitem__(self, kw):
+        if kw in self.hidden:
+            raise KeyError(kw)
+        return self.header[kw]
+
+    def get(self, kw, default=None):
+        try:
+            return self[kw]
+        except KeyError:
+            return default
+
+def astrodata_headers(ad):
+    """Returns the headers of an AstroData object as near as we can get to those in
+       the file it was opened from, to validate. AstroData adds EXTNAME and EXTVER to
+       image extensions that don't have them, and splits a single image FITS file into
+       a PHU and an extension, so we undo those. Extensions that AstroData doesn't
+       present as slices (tables, VAR and DQ planes) are not included."""
+    exts = [ext.hdr for ext in ad]
+    if (len(exts) == 1 and 'EXTNAME' in exts[0]
+            and exts[0].comments['EXTNAME'] == ADDED_BY_ASTRODATA):
+        # The extension of a single image file has a copy of the whole header
+        keywords = set(ad.phu) - SINGLE_IMAGE_KEYWORDS
+        if keywords and keywords <= set(exts[0]):
+            return [ad.phu]
+
+    headers = [ad.phu]
+    for ext in exts:
+        added = {kw for kw in ('EXTNAME', 'EXTVER')
+                 if kw in ext and ext.comments[kw] == ADDED_BY_ASTRODATA}
+        headers.append(HeaderView(ext, added) if added else ext)
+    return headers
+
 class AstroDataEvaluator(Evaluator):
     def __init__(self, *args, **kw):
         super(AstroDataEvaluator, self).__init__(*args, **kw)
@@ -175,11 +224,17 @@ class AstroDataEvaluator(Evaluator):
 
         return s
 
-    def evaluate(self, filename):
+    def evaluate(self, source):
+        """`source` is the name of a FITS file, which is opened and verified by astropy
+           here, or an AstroData object, an HDUList or a list of headers (see
+           Evaluator.validate_file) from a file that is already open."""
         try:
-            # Opens the raw FITS file and sends it to 
-            return super(AstroDataEvaluator, self).evaluate(
-                    pf.open(filename, memmap=True, do_not_scale_image_data=True, mode='readonly'))
+            if isinstance(source, (str, os.PathLike)):
+                # Opens the raw FITS file and sends it to the validator
+                source = pf.open(source, memmap=True, do_not_scale_image_data=True, mode='readonly')
+            elif isinstance(source, astrodata.AstroData):
+                source = astrodata_headers(source)
+            return super(AstroDataEvaluator, self).evaluate(source)
         except NotGeminiData:
             return Result(False, 'NOTGEMINI', "This doesn't look at all like data produced at Gemini")
         except BadFilter:
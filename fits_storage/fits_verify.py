@@ -1,6 +1,11 @@
 """
 This is the FitsVerify module. It provides a python interface to the
 fitsverify command.
+
+fitsverify() runs fitsverify on one file and waits for the result.
+FitsVerifyProcess starts fitsverify on a file in the background, so callers
+can get on with something else while the file is being verified, and collect
+the result later.
 """
 
 import subprocess
@@ -8,44 +13,41 @@ import os
 import re
 import shutil
 
-def fitsverify(filename, fvpath=None):
-    """
-    Runs the fitsverify command on the filename argument.
-    Returns a 4 component array containing
+SUMMARY_RE = re.compile(r'\*\*\*\* Verification found (\d*) warning\(s\) and '
+                        r'(\d*) error\(s\). \*\*\*\*')
 
-    * a boolean that is true if the argument is a fits file
-    * an integer giving the number of warnings (-1 on error)
-    * an integer giving the number of errors (-1 on error)
-    * a string containing the full fitsverify report or an error message
 
+def find_fitsverify(fvpath=None):
+    """
     if fvpath evaluates False (None or an empty string) then we search
     $PATH for the fitsverify executable. Otherwise, we assume this value
     is the full path of the fitsverify executable
     """
+    if not fvpath:
+        fvpath = shutil.which('fitsverify')
+        if fvpath is None:
+            raise OSError("fitsverify executable not found on path")
+    return fvpath
 
-    # First check that the filename exists is readable and is a file
+
+def check_readable(filename):
+    """
+    Check that the filename exists is readable and is a file. Returns None
+    if it is, otherwise the result list to return for it.
+    """
     exists = os.access(filename, os.F_OK | os.R_OK)
     isfile = os.path.isfile(filename)
     if not(exists and isfile):
         report = "%s is not readable or is not a file" % (filename)
-        isfits = False
-        warnings = 0
-        errors = 1
-        return [isfits, warnings, errors, report]
-
-
-    if not fvpath:
-        fvpath = shutil.which('fitsverify')
-        if fvpath is None:
-            raise OSError("fitsverify executable not found on path")
+        return [False, 0, 1, report]
+    return None
 
-    # Fire off the subprocess and capture the output
-    subp = subprocess.Popen([fvpath, filename],
-                            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    (stdoutstring, stderrstring) = subp.communicate()
 
-    stdoutstring = stdoutstring.decode('utf8', errors='ignore')
-    stderrstring = stderrstring.decode('utf8', errors='ignore')
+def parse_report(stdoutstring, stderrstring):
+    """
+    Parse the fitsverify output for one file, and return the 4 component
+    result list, as for fitsverify()
+    """
     report = stdoutstring + stderrstring
 
     # Check to see if we got a not a fits file situation
@@ -54,15 +56,69 @@ def fitsverify(filename, fvpath=None):
     else:
         isfits = True
 
+    warnings = 0
+    errors = 0
     # If it is a fits file, parse how many warnings and errors we got
     if isfits:
-        match = re.search(r'\*\*\*\* Verification found (\d*) warning\(s\) and (\d*) error\(s\). \*\*\*\*', stdoutstring)
+        match = SUMMARY_RE.search(stdoutstring)
         if match:
-            warnings = match.group(1)
-            errors = match.group(2)
+            warnings = int(match.group(1))
+            errors = int(match.group(2))
         else:
-            report = "Could not match warnings and errors string\n" + stdoutstring + stderrstring
+            report = "Could not match warnings and errors string\n" + report
             warnings = -1
             errors = -1
 
     return [isfits, warnings, errors, report]
+
+
+class FitsVerifyProcess(object):
+    """
+    Start fitsverify running on filename in the background. Call result() to
+    wait for it to finish and get the result list, as for fitsverify().
+
+    if fvpath evaluates False (None or an empty string) then we search
+    $PATH for the fitsverify executable. Otherwise, we assume this value
+    is the full path of the fitsverify executable
+    """
+    def __init__(self, filename, fvpath=None):
+        self.subp = None
+
+        # First check that the filename exists is readable and is a file
+        self.notreadable = check_readable(filename)
+        if self.notreadable:
+            return
+
+        fvpath = find_fitsverify(fvpath)
+
+        # Fire off the subprocess. We capture the output in result()
+        self.subp = subprocess.Popen([fvpath, filename],
+                                     stdout=subprocess.PIPE,
+                                     stderr=subprocess.PIPE)
+
+    def result(self):
+        if self.notreadable:
+            return self.notreadable
+
+        (stdoutstring, stderrstring) = self.subp.communicate()
+
+        stdoutstring = stdoutstring.decode('utf8', errors='ignore')
+        stderrstring = stderrstring.decode('utf8', errors='ignore')
+        return parse_report(stdoutstring, stderrstring)
+
+
+def fitsverify(filename, fvpath=None):
+    """
+    Runs the fitsverify command on the filename argument.
+    Returns a 4 component array containing
+
+    * a boolean that is true if the argument is a fits file
+    * an integer giving the number of warnings (-1 on error)
+    * an integer giving the number of errors (-1 on error)
+    * a string containing the full fitsverify report or an error message
+
+    if fvpath evaluates False (None or an empty string) then we search
+    $PATH for the fitsverify executable. Otherwise, we assume this value
+    is the full path of the fitsverify executable
+    """
+    return FitsVerifyProcess(filename, fvpath=fvpath).result()
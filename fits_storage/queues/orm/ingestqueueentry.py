@@ -38,6 +38,7 @@ class IngestQueueEntry(OrmQueueMixin, Base):
     error = Column(Text)
     md5_before_header_update = Column(Text)
     md5_after_header_update = Column(Text)
+    file_md5_after_header_update = Column(Text)
     header_update = Column(Text)
 
     # Store these configuration items in the class to allow manipulating
@@ -47,7 +48,8 @@ class IngestQueueEntry(OrmQueueMixin, Base):
     def __init__(self, filename, path, force=False, force_md5=False,
                  after=None, no_defer=False, batch=None, header_update=None,
                  md5_before_header_update=None,
-                 md5_after_header_update=None):
+                 md5_after_header_update=None,
+                 file_md5_after_header_update=None):
         """
         Create an :class:`~orm.ingestqueue.IngestQueue` instance with the
         given filename and path
@@ -76,6 +78,11 @@ class IngestQueueEntry(OrmQueueMixin, Base):
             md5sum of the file after the header update
         md5_before_header_update: str
             md5sum of the file before the header update
+        file_md5_after_header_update: str
+            md5sum of the (possibly compressed) file itself after the header
+            update. The md5_*_header_update values are data_md5s, this is
+            the file_md5. The ingester uses it to check that the file has
+            not been modified again since the header update.
         """
 
         self.filename = filename
@@ -92,6 +99,7 @@ class IngestQueueEntry(OrmQueueMixin, Base):
         self.header_update = header_update
         self.md5_before_header_update = md5_before_header_update
         self.md5_after_header_update = md5_after_header_update
+        self.file_md5_after_header_update = file_md5_after_header_update
 
         fsc = get_config()
         self.storage_root = fsc.storage_root
@@ -6,57 +6,70 @@ import datetime
 import os
 import fcntl
 
+from sqlalchemy import event, text
+from sqlalchemy.orm import Session
+
 from fits_storage.gemini_metadata_utils import sortkey_regex_dict
 from fits_storage.config import get_config
 
+
+def sortkey_from_filename(filename):
+    """
+    Return a key to be used in the database sorting. Used for queues,
+    where sorting directly by filename works for facility standard
+    filenames but not when we have non-standard filenames in the queue.
+
+    We extract a date (YYYYMMDD) string and a serial number string from
+    the filename and form a sortkey based on those.
+
+    We also exert some prioritization by prepending a 'z' to high
+    priority files (e.g. regular science filenames), and other letters to
+    lower priority files such as site monitoring data. The sort is done
+    in descending order, so 'z' is high priority and 'a' is low priority.
+
+    The regexes for this are in a dict imported from gemini_metadata_utils.
+
+    Filenames that do not match the regex are given sortkeys that are
+    simply 'aaaa' followed by the filename. This effectively gives them a
+    lower priority than any filenames that do match.
+
+    sortkey_regex_dict: These regular expressions are used by the queues
+    to determine how to sort ( ie prioritize) files when despooling the
+    queues. The regexes should provide two named groups - date (YYYYMMDD)
+    and optional num (serial number). The regexes are keys in a dict,
+    where the value is a higher level priority. ie files matching regexes
+    with value z are considered the highest priority, and those matching
+    regexes with value x are next in priority.
+    """
+
+    # If the filename has a path component, remove it.
+    if '/' in filename:
+        path, slash, filename = filename.rpartition('/')
+
+    sortkey = 'aaaa' + filename
+
+    # Note, we can't do a 'for a, b in blah' unpack here as the dictionary
+    # key is a compiled regular expression and isn't iterable.
+    for cre in sortkey_regex_dict.keys():
+        m = cre.match(filename)
+        if m:
+            sortkey = sortkey_regex_dict[cre] + \
+                      m.group('date') + m.group('num')
+
+    return sortkey
+
+
 class OrmQueueMixin:
     def sortkey_from_filename(self, filename=None):
         """
-        Return a key to be used in the database sorting. Used for queues,
-        where sorting directly by filename works for facility standard
-        filenames but not when we have non-standard filenames in the queue.
-
-        We extract a date (YYYYMMDD) string and a serial number string from
-        the filename and form a sortkey based on those.
-
-        We also exert some prioritization by prepending a 'z' to high
-        priority files (e.g. regular science filenames), and other letters to
-        lower priority files such as site monitoring data. The sort is done
-        in descending order, so 'z' is high priority and 'a' is low priority.
-
-        The regexes for this are in a dict imported from gemini_metadata_utils.
-
-        Filenames that do not match the regex are given sortkeys that are
-        simply 'aaaa' followed by the filename. This effectively gives them a
-        lower priority than any filenames that do match.
-
-        sortkey_regex_dict: These regular expressions are used by the queues
-        to determine how to sort ( ie prioritize) files when despooling the
-        queues. The regexes should provide two named groups - date (YYYYMMDD)
-        and optional num (serial number). The regexes are keys in a dict,
-        where the value is a higher level priority. ie files matching regexes
-        with value z are considered the highest priority, and those matching
-        regexes with value x are next in priority.
+        Return a key to be used in the database sorting, from the given
+        filename or the filename of this queue entry. See the
+        sortkey_from_filename() function for details.
         """
-
         if filename is None:
             filename = self.filename
 
-        # If the filename has a path component, remove it.
-        if '/' in filename:
-            path, slash, filename = filename.rpartition('/')
-
-        sortkey = 'aaaa' + filename
-
-        # Note, we can't do a 'for a, b in blah' unpack here as the dictionary
-        # key is a compiled regular expression and isn't iterable.
-        for cre in sortkey_regex_dict.keys():
-            m = cre.match(filename)
-            if m:
-                sortkey = sortkey_regex_dict[cre] + \
-                          m.group('date') + m.group('num')
-
-        return sortkey
+        return sortkey_from_filename(filename)
 
     # This is the magic value to represent failed = False.
     fail_dt_false = datetime.datetime.max
@@ -181,4 +194,22 @@ class OrmQueueMixin:
             self.error += '\n\n' + message
 
         self.inprogress = False
-        self.failed = True
\ No newline at end of file
+        self.failed = True
+
+
+@event.listens_for(Session, 'after_flush')
+def notify_queue_inserts(session, flush_context):
+    """
+    When new queue entries are flushed to a PostgreSQL database, send a
+    NOTIFY on a channel named after the queue table, so that queue service
+    jobs waiting in Queue.wait() wake up immediately. The NOTIFY is part of
+    the same transaction as the insert, so it is delivered when (and only if)
+    the transaction commits. PostgreSQL collapses duplicate notifications
+    within a transaction, and we send at most one per queue table per flush.
+    """
+    tables = {obj.__tablename__ for obj in session.new
+              if isinstance(obj, OrmQueueMixin)}
+    if tables and session.get_bind().dialect.name == 'postgresql':
+        connection = session.connection()
+        for table in sorted(tables):
+            connection.execute(text(f"NOTIFY {table}"))
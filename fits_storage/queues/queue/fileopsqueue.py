@@ -48,6 +48,38 @@ class FileopsQueue(Queue):
             self.session.rollback()
             return None
 
+    def add_many(self, fo_requests, response_required=False, batch=None):
+        """
+        Add several entries to the fileops queue in one transaction. The
+        entries are flushed together, so SQLAlchemy inserts them with a
+        single multi-row INSERT where the database supports it.
+
+        Parameters
+        ----------
+        fo_requests - list of (FileopsRequest, filename) tuples. filename can
+            be None.
+        response_required (Boolean)
+        batch
+
+        Returns
+        -------
+        list of fileops queue entries added. Empty list on failure.
+        """
+        fqes = [FileopsQueueEntry(fo_request.json(), filename=filename,
+                                  response_required=response_required,
+                                  batch=batch)
+                for fo_request, filename in fo_requests]
+
+        self.session.add_all(fqes)
+        try:
+            self.session.commit()
+            return fqes
+        except IntegrityError:
+            self.logger.debug(f"Integrity error adding {len(fqes)} requests "
+                              "to Fileops Queue. Rolling back.")
+            self.session.rollback()
+            return []
+
     def poll_for_response(self, id, timeout=10):
         """
         Poll filequeue entry id until response is not null. Timeout value
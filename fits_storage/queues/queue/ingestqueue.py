@@ -3,10 +3,37 @@ which is now called IngestQueueEntry as it represents an entry on the queue
 as opposed to the queue itself."""
 
 import json
+import re
+from itertools import islice
+
+from sqlalchemy import text
 from sqlalchemy.exc import IntegrityError
+from sqlalchemy.dialects import postgresql, sqlite
+
+from fits_storage import utcnow
 
 from .queue import Queue
 from ..orm.ingestqueueentry import IngestQueueEntry
+from ..orm.ormqueuemixin import sortkey_from_filename
+
+# Number of entries to insert per transaction in IngestQueue.add_many()
+ADD_MANY_CHUNK_SIZE = 10000
+
+# Skip various tmp files, and require .fits, _obslog.txt or miscfile_ in the
+# filename. Files starting with a dot are usually temporary files that are
+# being written and will be renamed when complete, eg by rsync.
+_tmpcre = re.compile(r"(tmp)|(tiled)|(swp)|(^\.)")
+_previewcre = re.compile(".jpg")
+_ingestcre = re.compile("(.fits)|(_obslog.txt)|(miscfile_)")
+
+
+def skip_file(filename):
+    """
+    Returns True if filename is not something we should add to the ingest
+    queue, for example a temporary file or a preview.
+    """
+    return bool(_tmpcre.search(filename) or _previewcre.search(filename)
+                or not _ingestcre.search(filename))
 
 
 class IngestQueue(Queue):
@@ -16,7 +43,8 @@ class IngestQueue(Queue):
 
     def add(self, filename, path, force_md5=False, force=False, after=None,
             no_defer=False, batch=None, header_update=None,
-            md5_before_header_update=None, md5_after_header_update=None):
+            md5_before_header_update=None, md5_after_header_update=None,
+            file_md5_after_header_update=None):
         """
         Add an entry to the ingest queue. This instantiates an IngestQueueEntry
         object using the arguments passed, and adds it to the database.
@@ -26,6 +54,8 @@ class IngestQueue(Queue):
         queues, we can pass on the header_update items as a hint which may
         facilitate replicating the destination by calling the header update
         API on the destination rather than re-transmitting the entire file.
+        The ingester also uses them to update the database from just the
+        changed keywords rather than fully re-ingesting the file.
 
         Parameters
         ----------
@@ -39,6 +69,7 @@ class IngestQueue(Queue):
         header_update
         md5_before_header_update
         md5_after_header_update
+        file_md5_after_header_update
 
         Returns
         -------
@@ -56,7 +87,9 @@ class IngestQueue(Queue):
                                header_update=header_update,
                                batch=batch,
                                md5_before_header_update=md5_before_header_update,
-                               md5_after_header_update=md5_after_header_update)
+                               md5_after_header_update=md5_after_header_update,
+                               file_md5_after_header_update=
+                               file_md5_after_header_update)
 
         self.session.add(iqe)
         try:
@@ -68,3 +101,78 @@ class IngestQueue(Queue):
                               f"on queue. Silently rolling back.")
             self.session.rollback()
             return None
+
+    def add_many(self, files, force_md5=False, force=False, after=None,
+                 no_defer=False, batch=None, chunk_size=None):
+        """
+        Add many entries to the ingest queue. This is for requeueing whole
+        directories or instruments, where calling add() for each file, which
+        instantiates an ORM object and commits for each one, is far too slow.
+
+        We build the rows for the ingestqueue table directly, and insert them
+        with an INSERT ... ON CONFLICT DO NOTHING on the unique constraint, so
+        that files already on the queue are silently skipped like they are in
+        add(). On PostgreSQL, SQLAlchemy sends each chunk as multi-row INSERT
+        statements, on SQLite it uses executemany. We commit after each chunk
+        so that the ingest queue services can start on the first files
+        while we are adding the rest.
+
+        Parameters
+        ----------
+        files - iterable of (filename, path) tuples. This can be a generator,
+        we only consume it a chunk at a time.
+        force_md5, force, after, no_defer, batch - as for add(), applied to
+        all the entries.
+        chunk_size - number of entries to insert per transaction. Defaults to
+        ADD_MANY_CHUNK_SIZE
+
+        Returns
+        -------
+        Number of entries added, not counting those already on the queue.
+        """
+        chunk_size = chunk_size or ADD_MANY_CHUNK_SIZE
+        table = IngestQueueEntry.__table__
+
+        # With multi-row INSERTs, PostgreSQL rowcount is not the number of
+        # rows actually inserted, so we count the ids RETURNed instead.
+        dialect = self.session.get_bind().dialect.name
+        index_elements = ['filename', 'path', 'inprogress', 'fail_dt']
+        if dialect == 'postgresql':
+            stmt = postgresql.insert(table)\
+                .on_conflict_do_nothing(index_elements=index_elements)\
+                .returning(table.c.id)
+        else:
+            stmt = sqlite.insert(table)\
+                .on_conflict_do_nothing(index_elements=index_elements)
+
+        files = iter(files)
+        added = 0
+        while chunk := list(islice(files, chunk_size)):
+            now = utcnow()
+            rows = [{'filename': filename,
+                     'path': path,
+                     'inprogress': False,
+                     'fail_dt': IngestQueueEntry.fail_dt_false,
+                     'added': now,
+                     'force_md5': force_md5,
+                     'force': force,
+                     'after': after if after is not None else now,
+                     'no_defer': no_defer,
+                     'batch': batch,
+                     'sortkey': sortkey_from_filename(filename)}
+                    for filename, path in chunk]
+
+            result = self.session.execute(stmt, rows)
+            if dialect == 'postgresql':
+                added += len(result.all())
+                # Core inserts bypass the after_flush hook in ormqueuemixin
+                # that notifies the queue services, so notify them here.
+                self.session.execute(text(f"NOTIFY {table.name}"))
+            else:
+                added += result.rowcount
+            self.session.commit()
+
+            self.logger.debug(f"Added chunk of {len(rows)} files to Ingest "
+                              f"Queue, {added} added so far")
+
+        return added
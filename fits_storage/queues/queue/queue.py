@@ -5,6 +5,9 @@ this in order to provide queue specific functionality. Note that these are
 *not* the ORM classes - those are now called e.g. ExportQueueEntry
 as instances of those represent entries in the queue, not the queue itself.
 """
+import select
+import time
+
 from fits_storage import utcnow
 from sqlalchemy import desc
 
@@ -24,6 +27,93 @@ class Queue(object):
         self.ormclass = ormclass
         self.logger = logger
 
+        # DBAPI connection LISTENing for notifications on this queue. This is
+        # set up on the first call to wait()
+        self._listen_connection = None
+
+    def wait(self, timeout):
+        """
+        Wait until something is added to the queue, or for timeout seconds,
+        whichever is sooner. The queue service scripts call this when pop()
+        returns None.
+
+        On PostgreSQL, adding entries to a queue sends a NOTIFY on a channel
+        named after the queue table (see notify_queue_inserts() in
+        ormqueuemixin.py), and we LISTEN on that channel here. On SQLite, or
+        if the LISTEN connection fails, we simply sleep for timeout seconds.
+
+        The timeout is still needed with LISTEN, as entries can become
+        available to pop without being added - eg when their 'after' time
+        passes or another entry for the same filename completes.
+
+        Parameters
+        ----------
+        timeout - maximum time to wait, in seconds
+
+        Returns
+        -------
+        True if we were notified, False otherwise
+        """
+        conn = self._get_listen_connection()
+        if conn is None:
+            time.sleep(timeout)
+            return False
+
+        try:
+            # Notifications that arrived since we last checked will already
+            # be waiting, in which case this returns immediately.
+            conn.poll()
+            if not conn.notifies:
+                readable, _, _ = select.select([conn], [], [], timeout)
+                if readable:
+                    conn.poll()
+            notified = bool(conn.notifies)
+            conn.notifies.clear()
+            return notified
+        except Exception as e:
+            # Most likely the database connection went away. Drop the
+            # connection so we re-connect next time, and fall back to sleeping
+            self.logger.warning(f"Error waiting for queue notification: {e}")
+            self._close_listen_connection()
+            time.sleep(timeout)
+            return False
+
+    def _get_listen_connection(self):
+        """
+        Get a DBAPI connection that is LISTENing for notifications on this
+        queue, or None if notifications are not available. We use a dedicated
+        connection outside the SQLAlchemy pool as it lives as long as the queue
+        service process and needs to be in autocommit mode.
+        """
+        if self._listen_connection is not None:
+            return self._listen_connection
+
+        engine = self.session.get_bind()
+        if engine.dialect.name != 'postgresql':
+            return None
+
+        try:
+            cargs, cparams = engine.dialect.create_connect_args(engine.url)
+            conn = engine.dialect.dbapi.connect(*cargs, **cparams)
+            conn.autocommit = True
+            with conn.cursor() as cursor:
+                cursor.execute(f"LISTEN {self.ormclass.__tablename__}")
+        except Exception as e:
+            self.logger.warning(f"Cannot LISTEN for queue notifications, "
+                                f"falling back to polling: {e}")
+            return None
+
+        self._listen_connection = conn
+        return conn
+
+    def _close_listen_connection(self):
+        if self._listen_connection is not None:
+            try:
+                self._listen_connection.close()
+            except Exception:
+                pass
+            self._listen_connection = None
+
     def length(self, include_inprogress=False):
         with self.session.begin_nested():
             query = self.session.query(self.ormclass)
@@ -33,7 +123,7 @@ class Queue(object):
 
             return query.count()
 
-    def pop(self):
+    def pop(self, filters=None):
         """
         Pop an entry from the queue. We use select-for-update to ensure that
         this works correctly with multiple clients attempting to pop the
@@ -47,6 +137,9 @@ class Queue(object):
 
         So we first create a list of the filenames that are inprogress (but
         not marked as failed), and we exclude that from the selection criteria.
+
+        filters is an optional list of additional SQLAlchemy filter criteria
+        that the popped entry must satisfy.
         """
         # for brevity:
         session = self.session
@@ -85,6 +178,9 @@ class Queue(object):
             if hasattr(ormclass, 'after'):
                 query = query.filter(ormclass.after < utcnow())
 
+            if filters:
+                query = query.filter(*filters)
+
             query = query.with_for_update(skip_locked=True).\
                 order_by(desc(ormclass.sortkey))
 
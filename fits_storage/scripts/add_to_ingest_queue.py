@@ -2,6 +2,7 @@
 
 import os
 import re
+import sys
 import datetime
 import time
 
@@ -12,6 +13,7 @@ from fits_storage.logger import logger, setdebug, setdemon, setlogfilesuffix
 
 from fits_storage.db import session_scope
 from fits_storage.queues.queue import IngestQueue
+from fits_storage.queues.queue.ingestqueue import skip_file
 
 from fits_storage.db.selection.get_selection import from_url_things
 from fits_storage.db.list_headers import list_headers
@@ -44,6 +46,22 @@ def _dayoptions(string):
         return re.compile(string)
 
 
+def _scan_directory(dirpath, newer_than=None):
+    # List the files in dirpath, optionally only those modified after the
+    # newer_than timestamp. os.scandir gives us the file type from the
+    # directory listing, and we only stat the files if we need the mtime.
+    with os.scandir(dirpath) as it:
+        for entry in it:
+            if not entry.is_file():
+                continue
+            if newer_than is not None and \
+                    entry.stat().st_mtime < newer_than:
+                logger.debug("Skipping %s: older than %s", entry.name,
+                             datetime.datetime.fromtimestamp(newer_than))
+                continue
+            yield entry.name
+
+
 if __name__ == "__main__":
     # Option Parsing
     from argparse import ArgumentParser
@@ -89,7 +107,8 @@ if __name__ == "__main__":
 
     parser.add_argument("--listfile", action="store", type=str, dest="listfile",
                         default=None,
-                        help="Read filenames to add from this text file")
+                        help="Read filenames to add from this text file, "
+                             "or from stdin if this is -")
 
     parser.add_argument("--selection", action="store", type=str,
                         dest="selection", default=None,
@@ -116,11 +135,22 @@ if __name__ == "__main__":
                 .format(datetime.datetime.now()))
     logger.debug("Config files used: %s", ', '.join(fsc.configfiles_used))
 
+    # --newfiles needs the file modification times from the directory scan
+    if options.newfiles and (options.filename or options.listfile or
+                             options.selection or fsc.using_s3):
+        logger.warning("--newfiles only applies when queueing files from a "
+                       "storage_root directory, ignoring it")
+
     if options.filename:
         # Just add a single filename
         logger.info("Adding single file: {}".format(options.filename))
         files = [options.filename]
 
+    elif options.listfile == '-':
+        # Get list of files from stdin
+        logger.info("Adding files from stdin")
+        files = [line.strip() for line in sys.stdin if line.strip()]
+
     elif options.listfile:
         # Get list of files from list file
         logger.info("Adding files from list file: {}".format(options.listfile))
@@ -163,7 +193,9 @@ if __name__ == "__main__":
             # Get the directory listing of path within the storage_root
             fulldirpath = os.path.join(fsc.storage_root, path)
             logger.info("Queueing files for ingest from: %s", fulldirpath)
-            fulllist = os.listdir(fulldirpath)
+            newer_than = time.time() - options.newfiles * 86400 \
+                if options.newfiles else None
+            fulllist = list(_scan_directory(fulldirpath, newer_than))
 
         logger.info("Got full file list.")
 
@@ -175,23 +207,8 @@ if __name__ == "__main__":
             files = fulllist
 
     # Skip various tmp files
-    # Also require .fits in the filename
-    tmpcre = re.compile("(tmp)|(tiled)")
-    fitscre = re.compile(".fits")
-    obslogcre = re.compile("_obslog.txt")
-    previewcre = re.compile(".jpg")
-    miscfilecre = re.compile("miscfile_")
     logger.info("Checking for tmp files")
 
-    def skip_file(filename):
-        return (
-            tmpcre.search(filename)
-            or previewcre.search(filename)
-            or not (fitscre.search(filename)
-                    or obslogcre.search(filename)
-                    or miscfilecre.search(filename))
-         )
-
     thefiles = []
     for filename in files:
         if skip_file(filename):
@@ -201,38 +218,30 @@ if __name__ == "__main__":
 
     n = len(thefiles)
     # print what we're about to do, and give abort opportunity
-    logger.info("About to scan {} files".format(n))
+    logger.info("About to queue {} files".format(n))
     if n > 5000:
         logger.info("That's a lot of files. Hit ctrl-c within 5 secs to abort")
         time.sleep(6)
 
-    if options.newfiles:
-        now = datetime.datetime.now()
-        newfiles_seconds = options.newfiles * 86400
+    if options.after:
+        after = datetime.datetime.fromisoformat(options.after)
+    else:
+        after = None
 
-    with session_scope() as session:
-        iq = IngestQueue(session, logger=logger)
-        for i, filename in enumerate(thefiles, 1):
-            if options.newfiles:
-                fullpath = os.path.join(fulldirpath, filename)
-                mtime = datetime.datetime.fromtimestamp(os.path.getmtime(fullpath))
-                age = now - mtime
-                age = age.total_seconds()
-                if age > newfiles_seconds:
-                    logger.debug("Skipping %s: older than %s secs", filename,
-                                 newfiles_seconds)
-                    continue
-            if options.after:
-                after = datetime.datetime.fromisoformat(options.after)
-            else:
-                after = None
+    def files_and_paths():
+        for filename in thefiles:
             if fsc.using_s3:
                 # If filename comes from S3, it is actually a keyname with path
-                path = os.path.dirname(filename)
-                filename = os.path.basename(filename)
-            logger.info(f"Queueing for Ingest: ({i}/{n}): {path} / {filename}")
-            iq.add(filename, path, force=options.force,
-                   force_md5=options.force_md5, after=after)
+                yield os.path.basename(filename), os.path.dirname(filename)
+            else:
+                yield filename, path
+
+    with session_scope() as session:
+        iq = IngestQueue(session, logger=logger)
+        added = iq.add_many(files_and_paths(), force=options.force,
+                            force_md5=options.force_md5, after=after)
+        logger.info("Queued %d files for ingest. %d were already on the "
+                    "queue", added, n - added)
 
     logger.info("*** add_to_ingestqueue.py exiting normally at %s",
                 datetime.datetime.now())
@@ -1,14 +1,13 @@
 #!/usr/bin/env python3
 
-import http
 import sys
 import datetime
-import requests
 from optparse import OptionParser
 
 from fits_storage.logger import logger, setdebug, setdemon
 from fits_storage.db import session_scope
 from fits_storage.core.orm.diskfile import DiskFile
+from fits_storage.server.tapeutils import FileOnTapeHelper
 
 from fits_storage.config import get_config
 fsc = get_config()
@@ -67,30 +66,24 @@ with session_scope() as session:
     sumbytes = 0
     sumfiles = 0
 
-    url = f"http://{options.tapeserver}/jsontapefile/{options.filepre}"
-    r = requests.get(url)
-    if r.status_code != http.HTTPStatus.OK:
-        logger.error("Got status code %s for url %s", (r.status_code, url))
+    # Get the tape server results for all the files in one go
+    foth = FileOnTapeHelper(tapeserver=f"http://{options.tapeserver}",
+                            logger=logger)
+    filenames = [fn for (fn, ) in query.with_entities(DiskFile.filename)]
+    if not foth.populate_cache_bulk(filenames):
+        logger.error("Could not get the files on tape from %s",
+                     options.tapeserver)
         sys.exit(1)
-    filesontape = r.json()
-    if len(filesontape) == 0:
+    if not foth.cached_count():
         logger.error("Server returned no fies on tape, exiting")
         sys.exit(2)
 
-    # There might be a more optimized way to do this...
     for diskfile in query:
         fullpath = diskfile.fullpath
-        dbfilename = diskfile.filename.rstrip(".bz2")
         dbmd5 = diskfile.data_md5
 
-        tapeids = set()
-        for d in filesontape:
-            if d['filename'].rstrip(".bz2") == dbfilename \
-                    and d['data_md5'] == dbmd5:
-                if options.tapeset and options.tapeset != d['tape_set']:
-                    continue
-
-                tapeids.add(d['tape_id'])
+        tapeids = foth.check_results(diskfile.filename, dbmd5,
+                                     tape_set=options.tapeset or None)
 
         if len(tapeids) < options.mintapes:
             sumbytes += diskfile.file_size
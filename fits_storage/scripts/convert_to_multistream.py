@@ -0,0 +1,124 @@
+#! /usr/bin/env python3
+
+import bz2
+import datetime
+import os
+import shutil
+import tempfile
+from argparse import ArgumentParser
+
+from fits_storage.logger import logger, setdebug, setdemon
+
+from fits_storage.db import session_scope
+
+from fits_storage.core.orm.diskfile import DiskFile
+from fits_storage.core.hashes import md5sum, md5sum_size_fp
+from fits_storage.server.bz2multistream import is_multistream, \
+    write_multistream
+
+from fits_storage.config import get_config
+fsc = get_config()
+
+
+parser = ArgumentParser(prog='convert_to_multistream.py',
+                        description='Convert bz2 compressed files in the '
+                                    'storage_root to multi-stream bz2 files '
+                                    'with the headers in separate streams, '
+                                    'so that header updates do not need to '
+                                    'recompress the whole file')
+parser.add_argument("--file-pre", action="store", dest="filepre", default='',
+                    help="Only convert files with this filename prefix")
+parser.add_argument("--split-extensions", action="store_true",
+                    dest="split_extensions",
+                    default=fsc.multistream_split_extensions,
+                    help="Put each extension header in its own stream too")
+parser.add_argument("--limit", action="store", type=int, dest="limit",
+                    help="Maximum number of files to convert")
+parser.add_argument("--dryrun", action="store_true", dest="dryrun",
+                    help="Don't actually convert anything")
+parser.add_argument("--debug", action="store_true", dest="debug",
+                    default=False, help="Increase log level to debug")
+parser.add_argument("--demon", action="store_true", dest="demon", default=False,
+                    help="Run as background demon, do not generate stdout")
+options = parser.parse_args()
+
+# Logging level to debug? Include stdio log?
+setdebug(options.debug)
+setdemon(options.demon)
+
+# Announce startup
+logger.info("***   convert_to_multistream.py - starting up at %s",
+            datetime.datetime.now())
+logger.debug("Config files used: %s", ', '.join(fsc.configfiles_used))
+
+if fsc.using_s3:
+    logger.error("Converting files in S3 is not supported")
+    exit(1)
+
+
+def convert(diskfile):
+    """
+    Convert the file for this diskfile to multi-stream. We write the new
+    file alongside the original, and check that it decompresses to the same
+    data as the original before replacing the original with it. The file
+    content is unchanged, so we update the diskfile file_md5 and file_size
+    in place rather than re-ingesting the file.
+    """
+    fullpath = diskfile.fullpath
+    with open(fullpath, 'rb') as f:
+        if is_multistream(f):
+            logger.debug("%s is already multi-stream", diskfile.filename)
+            return False
+
+    logger.info("Converting %s", diskfile.filename)
+    if options.dryrun:
+        return False
+
+    fd, tmpname = tempfile.mkstemp(dir=os.path.dirname(fullpath),
+                                   prefix='.multistream_')
+    try:
+        with bz2.open(fullpath, 'rb') as src, os.fdopen(fd, 'wb') as dest:
+            write_multistream(src, dest,
+                              split_extensions=options.split_extensions)
+
+        with bz2.open(tmpname, 'rb') as check:
+            data_size, data_md5 = md5sum_size_fp(check)
+        if data_md5 != diskfile.data_md5 or data_size != diskfile.data_size:
+            logger.error("Converted %s does not match original data. "
+                         "Leaving original file in place", diskfile.filename)
+            os.unlink(tmpname)
+            return False
+
+        shutil.copystat(fullpath, tmpname)
+        os.replace(tmpname, fullpath)
+    except Exception:
+        logger.error("Error converting %s", diskfile.filename, exc_info=True)
+        if os.path.exists(tmpname):
+            os.unlink(tmpname)
+        return False
+
+    diskfile.file_md5 = md5sum(fullpath)
+    diskfile.file_size = os.path.getsize(fullpath)
+    return True
+
+
+with session_scope() as session:
+    query = session.query(DiskFile)\
+        .filter(DiskFile.present == True)\
+        .filter(DiskFile.compressed == True)\
+        .filter(DiskFile.filename.startswith(options.filepre))\
+        .order_by(DiskFile.filename)
+
+    n = 0
+    for diskfile in query:
+        if convert(diskfile):
+            session.commit()
+            n += 1
+            if options.limit and n >= options.limit:
+                logger.info("Reached limit of %d files", options.limit)
+                break
+
+    logger.info("Converted %d files", n)
+
+logger.info("***   convert_to_multistream.py - exiting at %s",
+            datetime.datetime.now())
@@ -2,6 +2,7 @@
 
 import datetime
 import argparse
+import os
 
 from sqlalchemy import and_
 
@@ -60,6 +61,11 @@ else:
     logger.error("No s3_glacier_bucket_name config defined. Exiting")
     exit(1)
 
+# To list what is in Glacier already, so we don't copy files that are there
+# but not in the database, without asking about each one.
+glacier_s3 = Boto3Helper(bucket_name=fsc.s3_glacier_bucket_name,
+                         underlay_bucket_name='', logger=logger)
+
 try:
     with PidFile(logger) as pidfile:
         session = sessionfactory()
@@ -109,13 +115,28 @@ try:
 
         logger.info("Found %d files to copy", query.count())
 
+        # Not worth it if we're only doing a few files
+        if not args.limit:
+            glacier_s3.preload(os.path.join(args.path, args.filepre or '')
+                               if args.path else '')
+
         for diskfile in query.yield_per(FETCH_SIZE):
-            if args.dryrun:
+            if glacier_s3.listings is not None and \
+                    glacier_s3.exists_key(diskfile.keyname) and \
+                    glacier_s3.get_md5(diskfile.keyname) == diskfile.file_md5:
+                logger.info("%s is in Glacier already", diskfile.keyname)
+                if args.dryrun:
+                    logger.info("Dryrun - not recording %s in the database",
+                                diskfile.keyname)
+                    continue
+            elif args.dryrun:
                 logger.info("Dryrun - not actually copying %s to Glacier",
                             diskfile.keyname)
                 continue
-            logger.info("Copying %s to Glacier", diskfile.keyname)
-            s3.copy(diskfile.keyname, to_bucket=fsc.s3_glacier_bucket_name)
+            else:
+                logger.info("Copying %s to Glacier", diskfile.keyname)
+                s3.copy(diskfile.keyname,
+                        to_bucket=fsc.s3_glacier_bucket_name)
             glacier = Glacier()
             glacier.filename = diskfile.filename
             glacier.path = diskfile.path
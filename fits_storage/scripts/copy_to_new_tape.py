@@ -15,7 +15,7 @@ from fits_storage.db import sessionfactory
 from fits_storage.server.orm.tapestuff import Tape, TapeWrite, TapeFile, \
     TapeRead
 from fits_storage.logger import logger, setdebug, setdemon
-from fits_storage.server.tapeutils import TapeDrive
+from fits_storage.server.tapeutils import get_tapedrive
 from fits_storage.config import get_config
 from fits_storage import utcnow
 
@@ -120,7 +120,8 @@ if __name__ == "__main__":
     try:
         # Make a FitsStorageTape object from class TapeDrive initializing the
         # device and scratchdir
-        fromtd = TapeDrive(options.fromtapedrive, fsc.fits_tape_scratchdir)
+        fromtd = get_tapedrive(options.fromtapedrive,
+                               fsc.fits_tape_scratchdir)
         logger.info("Reading tape labels...")
         fromlabel = fromtd.readlabel()
         logger.info("You are reading from this tape: %s" % fromlabel)
@@ -129,7 +130,7 @@ if __name__ == "__main__":
                         "Aborting")
             sys.exit(1)
 
-        totd = TapeDrive(options.totapedrive, fsc.fits_tape_scratchdir)
+        totd = get_tapedrive(options.totapedrive, fsc.fits_tape_scratchdir)
         tolabel = totd.readlabel()
         logger.info("You are writing to this tape: %s" % tolabel)
 
@@ -239,23 +240,21 @@ if __name__ == "__main__":
 
             # Write the tape.
             bytecount = 0
-            blksize = 64 * 1024
+            blksize = fsc.tape_blocksize
             totarok = True
 
             # Create the tarfile on the write tape
             logger.info("Creating tar archive on tape %s on drive %s",
                         totape.label, totd.dev)
             try:
-                totar = tarfile.open(name=totd.dev, mode='w|',
-                                     bufsize=blksize)
+                totar = totd.opentar(mode='w|', bufsize=blksize)
             except:
                 logger.error("Exception opening tar destination archive",
                              exc_info=True)
                 tarok = False
 
             # Open the tarfile on the read tape
-            fromtar = tarfile.open(name=fromtd.dev, mode='r|',
-                                   bufsize=blksize)
+            fromtar = fromtd.opentar(mode='r|', bufsize=blksize)
 
             # Loop through the tar file. Don't delete from the to-do lists
             # until we sucessfully close the files
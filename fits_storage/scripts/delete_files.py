@@ -144,11 +144,15 @@ with (session_scope() as session):
     # The same helper class helps with the archive check
     foah = FileOnTapeHelper(archive="https://archive.gemini.edu", logger=logger)
 
-    if options.filepre:
-        logger.info("Pre-populating tape server results cache from filepre")
-        foth.populate_cache(options.filepre)
-        logger.info("Pre-populating archive results cache from filepre")
-        foah.populate_cache(options.filepre)
+    # Get the results for all the files we are considering in one go, rather
+    # than querying as we go through them
+    filenames = [fn for (fn, ) in query.with_entities(DiskFile.filename)]
+    logger.info("Pre-populating tape server results cache for %d files",
+                len(filenames))
+    foth.populate_cache_bulk(filenames)
+    if not options.noarchive:
+        logger.info("Pre-populating archive results cache")
+        foah.populate_cache_bulk(filenames)
 
     sumbytes = 0
     numfiles = 0
@@ -51,7 +51,9 @@ if __name__ == "__main__":
 
 
     def deleteorlist(gl, delete=False):
-        if delete:
+        if not s3.exists_key(gl.keyname):
+            logger.info(f"Keyname {gl.keyname} is not in the bucket")
+        elif delete:
             logger.info(f"Deleting S3 key: {gl.keyname}")
             try:
                 if s3.delete_key(gl.keyname) is False:
@@ -68,6 +70,9 @@ if __name__ == "__main__":
             logger.error("No Glacier Bucket name configured. Exiting")
             exit(1)
         s3 = Boto3Helper(fsc.s3_glacier_bucket_name)
+        # The keys we delete are at the top level of the bucket, list them
+        # rather than asking about each one
+        s3.preload(options.filepre or '')
     else:
         logger.error("Not an S3 configuration")
         exit()
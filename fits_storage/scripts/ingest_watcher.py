@@ -0,0 +1,121 @@
+#! /usr/bin/env python3
+
+import datetime
+import signal
+
+from argparse import ArgumentParser
+
+from fits_storage.logger import logger, setdebug, setdemon, setlogfilesuffix
+from fits_storage.server.pidfile import PidFile, PidFileError
+
+from fits_storage.db import sessionfactory
+from fits_storage.server.ingestwatcher import IngestWatcher
+
+from fits_storage.config import get_config
+fsc = get_config()
+
+
+parser = ArgumentParser(prog='ingest_watcher.py',
+                        description='Watch the storage_root with inotify and '
+                                    'add new files to the ingest queue')
+parser.add_argument("--path", action="append", dest="paths",
+                    help="Watch this path relative to the storage_root. "
+                         "Can be given more than once. Default is the "
+                         "storage_root itself")
+parser.add_argument("--debounce", action="store", type=float,
+                    dest="debounce", default=2.0,
+                    help="Queue files once there have been no new files for "
+                         "this many seconds. Default 2")
+parser.add_argument("--max-delay", action="store", type=float,
+                    dest="max_delay", default=30.0,
+                    help="Queue files no later than this many seconds after "
+                         "they arrive, even if more keep arriving. Default 30")
+parser.add_argument("--force", action="store_true", dest="force",
+                    default=False, help="Force re-ingestion of these files")
+parser.add_argument("--force_md5", action="store_true", dest="force_md5",
+                    default=False, help="Force md5 check, not just lastmod")
+parser.add_argument("--debug", action="store_true", dest="debug",
+                    default=False, help="Increase log level to debug")
+parser.add_argument("--demon", action="store_true", dest="demon", default=False,
+                    help="Run as background demon, do not generate stdout")
+parser.add_argument("--name", action="store", dest="name",
+                    help="Name for this instance of this task. "
+                         "Used in logfile and lockfile")
+parser.add_argument("--lockfile", action="store_true", dest="lockfile",
+                    help="Use a lockfile to limit instances")
+options = parser.parse_args()
+
+# Logging level to debug? Include stdio log?
+setdebug(options.debug)
+setdemon(options.demon)
+
+if options.name is not None:
+    setlogfilesuffix(options.name)
+
+# Need to set up the global loop variable before we define the signal handlers
+loop = True
+
+
+# Define signal handlers. This allows us to bail out cleanly e.g. if we get
+# a signal. These need to be defined after logger is set up as there is no
+# way to pass the logger as an argument to these.
+def handler(signum, frame):
+    logger.error("Received signal: %d. Crashing out.", signum)
+    raise KeyboardInterrupt('Signal', signum)
+
+
+def nicehandler(signum, frame):
+    logger.error("Received signal: %d. Attempting to stop nicely.", signum)
+    global loop
+    loop = False
+
+
+# Set handlers for the signals we want to handle
+# Cannot trap SIGKILL or SIGSTOP, all others are fair game
+# Don't trap SIGPIPE - if that happens, we want to see the exception.
+signal.signal(signal.SIGHUP, nicehandler)
+signal.signal(signal.SIGINT, nicehandler)
+signal.signal(signal.SIGQUIT, nicehandler)
+signal.signal(signal.SIGILL, handler)
+signal.signal(signal.SIGABRT, handler)
+signal.signal(signal.SIGFPE, handler)
+signal.signal(signal.SIGSEGV, handler)
+signal.signal(signal.SIGTERM, nicehandler)
+
+# Announce startup
+logger.info("***   ingest_watcher.py - starting up at %s",
+            datetime.datetime.now())
+logger.debug("Config files used: %s", ', '.join(fsc.configfiles_used))
+
+if fsc.using_s3:
+    logger.error("Cannot watch for new files when using S3")
+    exit(1)
+
+try:
+    with PidFile(logger, options.name, dummy=not options.lockfile) as pidfile:
+        session = sessionfactory()
+        watcher = IngestWatcher(session, logger,
+                                paths=options.paths or [''],
+                                debounce=options.debounce,
+                                max_delay=options.max_delay,
+                                force=options.force,
+                                force_md5=options.force_md5)
+        watcher.start()
+
+        # Loop forever. loop is a global variable defined up top
+        try:
+            while loop:
+                if not watcher.watches:
+                    logger.error("No directories left to watch, exiting")
+                    break
+                watcher.poll(timeout=1.0)
+        except KeyboardInterrupt:
+            logger.error("KeyboardInterrupt - exiting ungracefully!")
+        finally:
+            # Queue anything that's pending before we exit
+            watcher.stop()
+except PidFileError as e:
+    logger.error(str(e))
+
+logger.info("***    ingest_watcher.py - exiting at %s",
+            datetime.datetime.now())
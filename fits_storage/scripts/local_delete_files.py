@@ -93,9 +93,8 @@ if len(candidates) > 2000 and not options.yesimsure:
 # We use the FileOnTapeHelper class here which provides caching.
 foth = FileOnTapeHelper(tapeserver="http://"+options.tapeserver, logger=logger)
 
-if options.filepre:
-    logger.info("Pre-populating tape server results cache from filepre")
-    foth.populate_cache(options.filepre)
+logger.info("Pre-populating tape server results cache")
+foth.populate_cache_bulk(candidates)
 
 numfiles = 0
 for candidate in candidates:
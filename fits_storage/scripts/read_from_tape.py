@@ -1,8 +1,8 @@
 #!/usr/bin/env python3
 
+import os
 import sys
 import datetime
-import tarfile
 from sqlalchemy import func, delete
 from optparse import OptionParser
 
@@ -10,7 +10,9 @@ from fits_storage.db import sessionfactory
 from fits_storage.logger import logger, setdebug, setdemon, setlogfilesuffix
 from fits_storage.server.orm.tapestuff import TapeWrite, Tape, TapeFile, \
     TapeRead
-from fits_storage.server.tapeutils import TapeDrive
+from fits_storage.server.tapeutils import get_tapedrive
+from fits_storage.server.tapereader import read_members, extract_member, \
+    TarIndexError
 from fits_storage.config import get_config
 
 # Option Parsing
@@ -106,7 +108,7 @@ if options.list_tapes:
     sys.exit(0)
 
 try:
-    td = TapeDrive(options.tapedrive, fsc.fits_tape_scratchdir)
+    td = get_tapedrive(options.tapedrive, fsc.fits_tape_scratchdir)
     label = td.readlabel()
     logger.info("You are reading from this tape: %s", label)
 
@@ -183,6 +185,34 @@ try:
         # on the fly slows things down too much with the faster tapedrives
         completed = []
 
+        # If we have the index for all the files, go straight to each of them
+        # rather than reading through the whole archive.
+        indexed = tw.blocksize and \
+            all(tf.offset is not None for tf in fileresults)
+        if indexed:
+            logger.debug("Reading files using the tar index")
+            tapefo = td.open('rb')
+            try:
+                for tf, tarinfo, f in read_members(td, tapefo, fileresults,
+                                                   tw.blocksize):
+                    logger.info("Reading file %s", tf.filename)
+                    size, md5 = extract_member(tarinfo, f)
+                    if md5 != tf.md5:
+                        logger.error("md5 mismatch reading file %s from "
+                                     "filenum %d. On tape md5: %s, db md5: "
+                                     "%s", tf.filename, filenum, md5, tf.md5)
+                        os.unlink(tf.filename)
+                        continue
+                    completed.append(tf.filename)
+            except TarIndexError as e:
+                logger.warning("%s - reading the whole tar archive instead", e)
+                indexed = False
+                filenames = [fn for fn in filenames if fn not in completed]
+            finally:
+                tapefo.close()
+            if not indexed:
+                td.skipto(filenum=filenum)
+
         # A function to yeild all tarinfo objects and keep a list of completed
         # filenames
         def fits_files(members):
@@ -193,11 +223,12 @@ try:
                     logger.info("Reading file %s", tarinfo.name)
                     yield tarinfo
 
-        # Open the tarfile on the tape and extract the tarinfo object
-        blksize = 64*1024
-        tar = tarfile.open(name=options.tapedrive, mode='r|', bufsize=blksize)
-        tar.extractall(members=fits_files(tar), filter='tar')
-        tar.close()
+        if not indexed:
+            # Open the tarfile on the tape and extract the tarinfo object
+            blksize = fsc.tape_blocksize
+            tar = td.opentar(mode='r|', bufsize=blksize)
+            tar.extractall(members=fits_files(tar), filter='tar')
+            tar.close()
 
         # Delete the completed files from taperead
         logger.debug("deleting completed taperead entries...")
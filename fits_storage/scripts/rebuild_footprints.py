@@ -1,5 +1,7 @@
 #!/usr/bin/env python3
 
+import re
+import sys
 from argparse import ArgumentParser
 from datetime import datetime
 
@@ -14,7 +16,7 @@ from fits_storage.core.orm.footprint import Footprint, footprints
 
 from fits_storage.core.geometryhacks import add_footprint
 
-from sqlalchemy import desc
+from sqlalchemy import desc, text
 
 parser = ArgumentParser(
     description="This script is used to rebuild the footprints table. "
@@ -25,6 +27,13 @@ parser.add_argument("--debug", action="store_true", dest="debug",
                     help="Increase log level to debug")
 parser.add_argument("--demon", action="store_true", dest="demon",
                     help="Run as a background demon, do not generate stdout")
+parser.add_argument("--backfill-htm", action="store_true", dest="backfill_htm",
+                    help="Do not rebuild the footprints, simply populate the "
+                         "HTM spatial index columns of the header and "
+                         "footprint tables where they are not already set")
+parser.add_argument("--batch", action="store", type=int, dest="batch",
+                    default=10000, help="Number of rows to commit at a time "
+                                        "when backfilling")
 
 args = parser.parse_args()
 
@@ -35,6 +44,63 @@ setdemon(args.demon)
 # Announce startup
 logger.info("***   rebuild_footprints.py - starting up at %s", datetime.now())
 
+# Postgres returns the footprint area polygon as a string like
+# ((x1,y1),(x2,y2),...)
+pointcre = re.compile(r'\(([-\d.eE+]+),([-\d.eE+]+)\)')
+
+
+def backfill_htm(session, batch):
+    """
+    Populate the HTM spatial index columns of the header and footprint tables
+    for rows where they have not already been set. This does not need access
+    to the files themselves.
+    """
+    query = session.query(Header) \
+        .filter(Header.htm_id == None) \
+        .filter(Header.ra != None).filter(Header.dec != None)
+    n = 0
+    while True:
+        headers = query.limit(batch).all()
+        if not headers:
+            break
+        for header in headers:
+            header.set_htm()
+        session.commit()
+        n += len(headers)
+        logger.info("Backfilled HTM for %d headers", n)
+
+    # Footprints whose area we can't parse keep a NULL htm_id, so we page
+    # through by id rather than re-selecting them on every pass.
+    n = 0
+    last_id = 0
+    while True:
+        rows = session.execute(
+            text("SELECT id, area FROM footprint WHERE htm_id IS NULL "
+                 "AND area IS NOT NULL AND id > :last_id ORDER BY id "
+                 "LIMIT :batch"), {'last_id': last_id, 'batch': batch}).all()
+        if not rows:
+            break
+        for fpid, area in rows:
+            last_id = fpid
+            fp = [(float(x), float(y)) for x, y in pointcre.findall(str(area))]
+            if len(fp) < 3:
+                logger.warning("Cannot parse area of footprint id %d: %s",
+                               fpid, area)
+                continue
+            footprint = session.get(Footprint, fpid)
+            footprint.set_htm(fp)
+            n += 1
+        session.commit()
+        logger.info("Backfilled HTM for %d footprints", n)
+
+
+if args.backfill_htm:
+    with session_scope() as session:
+        backfill_htm(session, args.batch)
+    logger.info("***   rebuild_footprints.py - exiting up at %s",
+                datetime.now())
+    sys.exit(0)
+
 with session_scope() as session:
     # First up, we need to get a list of Headers that we're going to process.
     query = session.query(Header.id).join(DiskFile)
@@ -59,6 +125,7 @@ with session_scope() as session:
             for label, fp in footprints(ad, logger).items():
                 footprint = Footprint(header)
                 footprint.extension = label
+                footprint.set_htm(fp)
                 session.add(footprint)
                 session.flush()
                 add_footprint(session, footprint.id, fp)
@@ -0,0 +1,67 @@
+#! /usr/bin/env python3
+
+import datetime
+from argparse import ArgumentParser
+
+from sqlalchemy import text
+
+from fits_storage.logger import logger, setdebug, setdemon
+
+from fits_storage.db import session_scope
+
+from fits_storage.core.orm.header import Header, normalize_object_name
+
+from fits_storage.config import get_config
+fsc = get_config()
+
+
+parser = ArgumentParser(prog='rebuild_object_search.py',
+                        description='Populate the normalized object name '
+                                    'column (header.object_norm) used for '
+                                    'indexed object name searches')
+parser.add_argument("--all", action="store_true", dest="all",
+                    help="Recompute all rows, not just those where "
+                         "object_norm is not yet set")
+parser.add_argument("--batch", action="store", type=int, dest="batch",
+                    default=10000, help="Rows per commit when not using "
+                                        "postgres")
+parser.add_argument("--debug", action="store_true", dest="debug",
+                    default=False, help="Increase log level to debug")
+parser.add_argument("--demon", action="store_true", dest="demon", default=False,
+                    help="Run as background demon, do not generate stdout")
+options = parser.parse_args()
+
+# Logging level to debug? Include stdio log?
+setdebug(options.debug)
+setdemon(options.demon)
+
+# Announce startup
+logger.info("***   rebuild_object_search.py - starting up at %s",
+            datetime.datetime.now())
+logger.debug("Config files used: %s", ', '.join(fsc.configfiles_used))
+
+with session_scope() as session:
+    if not fsc.using_sqlite:
+        # On postgres, we can do this in one statement. This must give the
+        # same result as normalize_object_name()
+        sql = "UPDATE header SET object_norm = " \
+              "lower(regexp_replace(object, '\\s', '', 'g'))"
+        if not options.all:
+            sql += " WHERE object_norm IS NULL AND object IS NOT NULL"
+        result = session.execute(text(sql))
+        logger.info("Updated %d rows", result.rowcount)
+    else:
+        query = session.query(Header).filter(Header.object != None)
+        if not options.all:
+            query = query.filter(Header.object_norm == None)
+        n = 0
+        for header in query.yield_per(options.batch):
+            header.object_norm = normalize_object_name(header.object)
+            n += 1
+            if n % options.batch == 0:
+                session.flush()
+                logger.info("Updated %d rows", n)
+        logger.info("Updated %d rows", n)
+
+logger.info("***   rebuild_object_search.py - exiting at %s",
+            datetime.datetime.now())
@@ -0,0 +1,84 @@
+#! /usr/bin/env python3
+
+import datetime
+import sys
+from argparse import ArgumentParser
+
+from fits_storage.logger import logger, setdebug, setdemon
+
+from fits_storage.db import session_scope
+
+from fits_storage.server.orm.searchrow import rebuild_search_rows, \
+    refresh_search_rows, inconsistent_search_rows, search_row_table
+
+from fits_storage.config import get_config
+fsc = get_config()
+
+
+parser = ArgumentParser(prog='rebuild_search_row.py',
+                        description='Rebuild or check the search_row table, '
+                                    'which is a denormalized copy of the '
+                                    'header, diskfile and file tables used '
+                                    'for searches')
+parser.add_argument("--rebuild", action="store_true", dest="rebuild",
+                    help="Rebuild the entire search_row table")
+parser.add_argument("--check", action="store_true", dest="check",
+                    help="Check the search_row table is consistent with the "
+                         "header, diskfile and file tables. Exit status is "
+                         "1 if it is not")
+parser.add_argument("--fix", action="store_true", dest="fix",
+                    help="With --check, refresh any inconsistent rows")
+parser.add_argument("--debug", action="store_true", dest="debug",
+                    default=False, help="Increase log level to debug")
+parser.add_argument("--demon", action="store_true", dest="demon", default=False,
+                    help="Run as background demon, do not generate stdout")
+options = parser.parse_args()
+
+# Logging level to debug? Include stdio log?
+setdebug(options.debug)
+setdemon(options.demon)
+
+# Announce startup
+logger.info("***   rebuild_search_row.py - starting up at %s",
+            datetime.datetime.now())
+logger.debug("Config files used: %s", ', '.join(fsc.configfiles_used))
+
+if not fsc.using_search_row:
+    logger.warning("using_search_row is not set in the configuration. The "
+                   "search_row table will not be maintained or used.")
+
+if not (options.rebuild or options.check):
+    logger.error("Nothing to do - specify --rebuild and / or --check")
+    sys.exit(1)
+
+consistent = True
+with session_scope() as session:
+    if options.rebuild:
+        logger.info("Rebuilding search_row table")
+        rebuild_search_rows(session)
+        session.commit()
+        n = session.query(search_row_table).count()
+        logger.info("Rebuilt search_row table with %d rows", n)
+
+    if options.check:
+        missing, extra, different = inconsistent_search_rows(session)
+        logger.info("search_row check: %d missing, %d extra, %d different",
+                    len(missing), len(extra), len(different))
+        for desc, ids in (('Missing', missing), ('Extra', extra),
+                          ('Different', different)):
+            if ids:
+                logger.debug("%s header ids: %s", desc,
+                             ', '.join(str(i) for i in ids))
+        consistent = not (missing or extra or different)
+
+        if options.fix and not consistent:
+            # Refreshing extra ids simply deletes them, as there's no header
+            refresh_search_rows(session, missing + extra + different)
+            session.commit()
+            logger.info("Refreshed %d search_rows",
+                        len(missing) + len(extra) + len(different))
+            consistent = True
+
+logger.info("***   rebuild_search_row.py - exiting at %s",
+            datetime.datetime.now())
+sys.exit(0 if consistent else 1)
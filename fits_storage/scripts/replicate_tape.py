@@ -12,7 +12,7 @@ from sqlalchemy.exc import NoResultFound
 from fits_storage.db import sessionfactory
 from fits_storage.server.orm.tapestuff import Tape, TapeWrite, TapeFile
 from fits_storage.logger import logger, setdebug, setdemon
-from fits_storage.server.tapeutils import TapeDrive
+from fits_storage.server.tapeutils import get_tapedrive
 from fits_storage.config import get_config
 from fits_storage import utcnow
 
@@ -39,17 +39,17 @@ if __name__ == "__main__":
                 datetime.datetime.now())
 
     fsc = get_config()
-    blksize = 64 * 1024
+    blksize = fsc.tape_blocksize
 
     # Method:
     # Loop through the TapeWrites on fromtape, read files and write to a new
     # TapeWrite on totape.
 
     logger.info("Reading tape labels...")
-    fromtd = TapeDrive(args.fromtapedrive, fsc.fits_tape_scratchdir)
+    fromtd = get_tapedrive(args.fromtapedrive, fsc.fits_tape_scratchdir)
     fromlabel = fromtd.readlabel()
     logger.info(f"You are reading from this tape: {fromlabel}")
-    totd = TapeDrive(args.totapedrive, fsc.fits_tape_scratchdir)
+    totd = get_tapedrive(args.totapedrive, fsc.fits_tape_scratchdir)
     tolabel = totd.readlabel()
     logger.info("You are writing to this tape: %s" % tolabel)
 
@@ -81,7 +81,7 @@ if __name__ == "__main__":
         totd.eod()
 
         # Open the tarfile on the read tape
-        fromtar = tarfile.open(name=fromtd.dev, mode='r|', bufsize=blksize)
+        fromtar = fromtd.opentar(mode='r|', bufsize=blksize)
 
         # Create tapewrite record.
         logger.debug(f"Creating TapeWrite record for tape {totape.label}...")
@@ -102,8 +102,7 @@ if __name__ == "__main__":
         # Create the tarfile on the write tape
         logger.info(f"Creating tar archive on {totape.label} on {totd.dev}")
         try:
-            totar = tarfile.open(name=totd.dev, mode='w|',
-                                 bufsize=blksize)
+            totar = totd.opentar(mode='w|', bufsize=blksize)
         except:
             logger.error("Exception opening tar destination archive, aborting",
                          exc_info=True)
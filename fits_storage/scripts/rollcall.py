@@ -66,6 +66,10 @@ with session_scope() as session:
     if fsc.using_s3:
         logger.debug("Connecting to s3")
         s3 = Boto3Helper()
+        if not options.limit:
+            # We're going to ask about most of the keys, so list them all,
+            # rather than asking about each one
+            s3.preload(options.filepre or '')
 
     i = 0
     missingfiles = []
@@ -90,17 +94,17 @@ with session_scope() as session:
                 logger.info("File %d/%d: present", i, n)
             if options.checkmd5:
                 if fsc.using_s3:
-                    logger.error("md5 check with S3 not implemented")
+                    file_md5 = s3.get_md5(df.filename)
                 else:
                     file_md5 = df.get_file_md5()
-                    logger.debug("File md5: %s  DB md5: %s",
-                                 file_md5, df.file_md5)
-                    if file_md5 != df.file_md5:
-                        logger.warning("MD5 mismatch between file and DB: %s",
-                                       df.filename)
-                        badfiles.append(df.filename)
-                    else:
-                        goodfiles.append(df.filename)
+                logger.debug("File md5: %s  DB md5: %s",
+                             file_md5, df.file_md5)
+                if file_md5 != df.file_md5:
+                    logger.warning("MD5 mismatch between file and DB: %s",
+                                   df.filename)
+                    badfiles.append(df.filename)
+                else:
+                    goodfiles.append(df.filename)
         i += 1
 
     if len(badfiles):
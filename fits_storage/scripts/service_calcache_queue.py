@@ -2,7 +2,6 @@
 
 import signal
 import datetime
-import time
 
 from argparse import ArgumentParser
 
@@ -95,7 +94,7 @@ try:
                         break
                     else:
                         logger.info("Nothing on queue. Waiting...")
-                        time.sleep(10)
+                        ccq.wait(10)
                         continue
 
                 # Don't query queue length in fast_rebuild mode
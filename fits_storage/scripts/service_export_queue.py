@@ -2,12 +2,12 @@
 
 import signal
 import datetime
-import time
 
 from argparse import ArgumentParser
 
 from fits_storage.queues.queue.exportqueue import ExportQueue
 from fits_storage.server.exporter import Exporter
+from fits_storage.server.exportsupervisor import ExportSupervisor
 from fits_storage.logger import logger, setdebug, setdemon, setlogfilesuffix
 from fits_storage.server.pidfile import PidFile, PidFileError
 from fits_storage.db import session_scope
@@ -36,6 +36,13 @@ parser.add_argument("--fast-rebuild", action="store_true", dest="fastrebuild",
 parser.add_argument("--retry-delay", action="store", type=int, dest="delay",
                     default=60, help="Number of seconds to delay retries after "
                                      "the queue becomes empty")
+parser.add_argument("--workers", action="store", type=int, dest="workers",
+                    default=1, help="Number of files to export concurrently. "
+                                    "Default 1")
+parser.add_argument("--destination-limit", action="store", type=int,
+                    dest="destination_limit", default=2,
+                    help="With --workers, the maximum number of files to "
+                         "export to each destination concurrently. Default 2")
 options = parser.parse_args()
 
 # Logging level to debug? Include stdio log?
@@ -86,6 +93,20 @@ try:
     with PidFile(logger, options.name, dummy=not options.lockfile) as pidfile, \
             session_scope() as session:
 
+        if options.workers > 1:
+            # Export with a pool of workers. The supervisor handles
+            # everything, including exceptions in the workers.
+            logger.info("Exporting with %d workers", options.workers)
+            supervisor = ExportSupervisor(
+                session, logger, workers=options.workers,
+                destination_limit=options.destination_limit, timeout=10)
+            try:
+                supervisor.run(keep_going=lambda: loop, empty=options.empty,
+                               retry_delay=options.delay)
+            except KeyboardInterrupt:
+                logger.error("KeyboardInterrupt - exiting ungracefully!")
+            loop = False
+
         export_queue = ExportQueue(session, logger=logger)
         exporter = Exporter(session, logger, timeout=10)
 
@@ -103,7 +124,7 @@ try:
                         break
                     else:
                         logger.info("Nothing on Queue... Waiting")
-                        time.sleep(2)
+                        export_queue.wait(2)
                         # Mark any old failures for retry
                         export_queue.retry_failures(options.delay)
                         continue
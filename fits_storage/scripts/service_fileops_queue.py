@@ -2,7 +2,6 @@
 
 import datetime
 import signal
-import time
 from argparse import ArgumentParser
 
 from fits_storage.logger import logger, setdebug, setdemon, setlogfilesuffix
@@ -96,7 +95,7 @@ try:
                         break
                     else:
                         logger.info("Nothing on queue... Waiting")
-                        time.sleep(1)
+                        fileops_queue.wait(1)
                         continue
                 else:
                     logger.info("Popped queue id %d to process", fqe.id)
@@ -2,7 +2,6 @@
 
 import datetime
 import signal
-import time
 
 from sqlalchemy.exc import OperationalError, IntegrityError
 
@@ -122,7 +121,7 @@ try:
                         break
                     else:
                         logger.info("Nothing on queue... Waiting")
-                        time.sleep(2)
+                        ingest_queue.wait(2)
                         continue
 
                 if options.oneshot:
@@ -2,7 +2,6 @@
 
 import signal
 import datetime
-import time
 from argparse import ArgumentParser
 
 from fits_storage.config import get_config
@@ -91,7 +90,7 @@ try:
                         break
                     else:
                         logger.info("Nothing on queue... Waiting")
-                        time.sleep(5)
+                        pq.wait(5)
                         continue
 
                 if options.oneshot:
@@ -2,7 +2,6 @@
 
 import datetime
 import signal
-import time
 import os
 
 from argparse import ArgumentParser
@@ -112,7 +111,7 @@ if __name__ == "__main__":
                             break
                         else:
                             logger.info("Nothing on queue... Waiting")
-                            time.sleep(2)
+                            reduce_queue.wait(2)
                             continue
 
                     if options.oneshot:
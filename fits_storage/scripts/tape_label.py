@@ -4,7 +4,7 @@ import sys
 from optparse import OptionParser
 
 from fits_storage.logger import logger, setdebug, setdemon
-from fits_storage.server.tapeutils import TapeDrive
+from fits_storage.server.tapeutils import get_tapedrive
 from fits_storage.config import get_config
 
 # Option Parsing
@@ -37,7 +37,8 @@ if not (options.read or options.label):
     logger.error("You must supply either the --read or the --label option")
     sys.exit(1)
 
-td = TapeDrive(options.tapedrive, fsc.fits_tape_scratchdir, logger=logger)
+td = get_tapedrive(options.tapedrive, fsc.fits_tape_scratchdir,
+                   logger=logger)
 
 if options.read:
     logger.info(td.readlabel(fail=False))
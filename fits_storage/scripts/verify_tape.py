@@ -9,7 +9,7 @@ from optparse import OptionParser
 
 from fits_storage.logger import logger, setdebug, setdemon, setlogfilesuffix
 from fits_storage.server.orm.tapestuff import Tape, TapeWrite, TapeFile
-from fits_storage.server.tapeutils import TapeDrive
+from fits_storage.server.tapeutils import get_tapedrive
 
 from fits_storage.db import session_scope
 from fits_storage.core.hashes import md5sum_size_fp
@@ -55,7 +55,7 @@ if options.demon:
 logger.info("***   verify_tape.py - starting up at %s", datetime.datetime.now())
 
 with session_scope() as session:
-    td = TapeDrive(options.tapedrive, fsc.fits_tape_scratchdir)
+    td = get_tapedrive(options.tapedrive, fsc.fits_tape_scratchdir)
     td.setblk0()
     label = td.readlabel()
     logger.debug('Read tape label: %s', label)
@@ -97,13 +97,16 @@ with session_scope() as session:
         # Read all the fits files in the tar archive, one at a time,
         # looping through and calculating the md5
         files_on_tape = []
-        block = 64*1024
+        block = fsc.tape_blocksize
+        # Get all the tapefile objects for this file number in one go
+        tapefiles = {tf.filename: tf for tf in session.query(TapeFile)
+                     .filter(TapeFile.tapewrite_id == tw.id)}
         tdfileobj = None
         try:
             # We have to open the tape drive manually, so that we can close it
             # ourselves if the tar header read fails
-            tdfileobj = open(td.dev, 'rb')
-            tar = tarfile.open(name=td.dev, fileobj=tdfileobj, mode='r|',
+            tdfileobj = td.open('rb')
+            tar = tarfile.open(fileobj=tdfileobj, mode='r|',
                                bufsize=block)
             for tar_info in tar:
                 filename = tar_info.name
@@ -111,11 +114,8 @@ with session_scope() as session:
                 logger.debug("Found file %s on tape.", filename)
 
                 # Find the tapefile object
-                try:
-                    tf = session.query(TapeFile)\
-                        .filter(TapeFile.tapewrite_id==tw.id)\
-                        .filter(TapeFile.filename==filename).first()
-                except NoResultFound:
+                tf = tapefiles.get(filename)
+                if tf is None:
                     logger.error("File %s on tape but not found in DB - at "
                                  "filenum %d.", filename, tw.filenum)
                     errors_this_file = True
@@ -130,6 +130,21 @@ with session_scope() as session:
                                  "DB size: %d", tf.filename, tw.filenum,
                                                  tar_info.size, tf.size)
                     errors_this_file = True
+                # Check the index that read_from_tape uses to go straight to
+                # the file is right
+                if tf.offset is not None and tar_info.offset != tf.offset:
+                    logger.error("Offset mismatch between tar_info and in DB "
+                                 "for file %s in filenum %d. tar_info offset: "
+                                 "%d, DB offset: %d", tf.filename, tw.filenum,
+                                 tar_info.offset, tf.offset)
+                    errors_this_file = True
+                if tf.block is not None and tw.blocksize and \
+                        tar_info.offset // tw.blocksize != tf.block:
+                    logger.error("Block mismatch between tar_info and in DB "
+                                 "for file %s in filenum %d. tar_info block: "
+                                 "%d, DB block: %d", tf.filename, tw.filenum,
+                                 tar_info.offset // tw.blocksize, tf.block)
+                    errors_this_file = True
                 # Calculate the md5 of the data on tape
                 f = tar.extractfile(tar_info)
                 try:
@@ -169,10 +184,8 @@ with session_scope() as session:
                 error_happened = True
             else:
                 # Check whether we read everything in the DB
-                files_in_DB = session.query(TapeFile)\
-                    .filter(TapeFile.tapewrite_id==tw.id)\
-                    .order_by(TapeFile.filename).all()
-                for dbfile in files_in_DB:
+                for dbfile in sorted(tapefiles.values(),
+                                     key=lambda tf: tf.filename):
                     if dbfile.filename not in files_on_tape:
                         logger.error("This file was in the database, but not"
                                      " on the tape: %s, in filenum: %d",
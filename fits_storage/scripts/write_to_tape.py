@@ -3,17 +3,16 @@
 import sys
 import os
 import datetime
-import tarfile
 from optparse import OptionParser
 
-from sqlalchemy import join
 from sqlalchemy.exc import NoResultFound, MultipleResultsFound
 
 from fits_storage.db import session_scope
-from fits_storage.server.orm.tapestuff import Tape, TapeWrite, TapeFile
+from fits_storage.server.orm.tapestuff import Tape, TapeWrite
 from fits_storage.logger import logger, setdebug, setdemon
-from fits_storage.server.tapeutils import TapeDrive
-from fits_storage.db.list_headers import list_headers
+from fits_storage.server.tapeutils import get_tapedrive
+from fits_storage.server.tapewriter import TarTapeWriter, write_diskfiles, \
+    list_tape_diskfiles
 from fits_storage.db.selection.get_selection import from_url_things
 from fits_storage import utcnow
 
@@ -52,6 +51,10 @@ parser.add_option("--ndays", action="store", type="int", dest="ndays",
                   default=14, help="Number of days for auto mode")
 parser.add_option("--skipdays", action="store", type="int", dest="skipdays",
                   default=10, help="Number of days to skip for auto mode")
+parser.add_option("--checkpoint", action="store", type="int",
+                  dest="checkpoint", default=1000,
+                  help="Record the files written in the database every "
+                       "checkpoint files")
 parser.add_option("--debug", action="store_true", dest="debug",
                   help="Increase log level to debug")
 parser.add_option("--demon", action="store_true", dest="demon",
@@ -106,20 +109,9 @@ logger.info("Selection: %s", selection)
 logger.info("Selection is open: %s", selection.openquery)
 
 with session_scope() as session:
-    logger.info("Getting header object list")
-    orderby = ['ut_datetime']
-    headers = list_headers(selection, orderby, session=session, unlimit=True)
-
-    # For some reason, looping through the header list directly for the add
-    # is really slow if the list is big.
-    logger.info("Building diskfile list")
-    diskfiles = []
-    for header in headers:
-        diskfiles.append(header.diskfile)
-    headers = None
-
     # Make a list containing the tape device objects
-    tapedrives = [TapeDrive(tapedrive, fsc.fits_tape_scratchdir, logger=logger)
+    tapedrives = [get_tapedrive(tapedrive, fsc.fits_tape_scratchdir,
+                                logger=logger)
                   for tapedrive in options.tapedrive]
 
     # Get the database tape object for each tape label given
@@ -149,54 +141,19 @@ with session_scope() as session:
 
     tapeids = {t.id for t in tapes}
 
-    if options.nodedup:
+    # Get the list of files to write, leaving out those already on these
+    # tapes, or on any tape if we are skipping files, in a single query.
+    if options.skip:
+        logger.info("Skipping files that are already on any tapes")
+    elif options.nodedup:
         logger.info("Nodeduplicate option given - not skipping files "
                     "already on any of these tapes")
     else:
-        logger.info("Checking for duplication on these tapes")
-        deduplicated_diskfiles = []
-        for df in diskfiles:
-            numtapes = session.query(Tape)\
-                .select_from(join(TapeFile, join(TapeWrite, Tape)))\
-                .filter(Tape.active == True)\
-                .filter(TapeWrite.succeeded == True)\
-                .filter(TapeFile.filename == df.filename)\
-                .filter(TapeFile.md5 == df.file_md5)\
-                .filter(Tape.id.in_(tapeids))\
-                .count()
-
-            if numtapes == 0:
-                # this file is not on any of these tapes, include it
-                logger.debug("File not on these tapes, not de-duping it")
-                deduplicated_diskfiles.append(df)
-            else:
-                logger.debug("File %s is on at least one of these tapes, "
-                             "removing it from list as a duplicate",
-                             df.filename)
-
-        diskfiles = deduplicated_diskfiles
-
-    if options.skip:
-        logger.info("Checking for duplication to any tapes")
-        actual_diskfiles = []
-        for df in diskfiles:
-            num = session.query(TapeFile)\
-                .select_from(join(TapeFile, join(TapeWrite, Tape)))\
-                .filter(Tape.active == True)\
-                .filter(TapeWrite.succeeded == True)\
-                .filter(TapeFile.filename == df.filename)\
-                .filter(TapeFile.md5 == df.file_md5)\
-                .count()
-
-            if num == 0:
-                actual_diskfiles.append(df)
-                logger.debug("Not skipping file %s as it is on 0 tapes",
-                             df.filename)
-            else:
-                logger.debug("Skipping File %s : is already on tape %d times",
-                             df.filename, num)
-
-        diskfiles = actual_diskfiles
+        logger.info("Skipping files that are already on these tapes")
+    logger.info("Building diskfile list")
+    diskfiles = list_tape_diskfiles(
+        session, selection, tape_ids=None if options.nodedup else tapeids,
+        skip=options.skip)
 
     # At this point, diskfiles is the list of diskfiles to go to tape.
     numfiles = len(diskfiles)
@@ -228,19 +185,6 @@ with session_scope() as session:
             logger.info("OK - found tape in drive %s with label: %s",
                         td.dev, thislabel)
 
-    # check md5sums match what's on disk.
-    logger.info("Verifying md5s")
-    for df in diskfiles:
-        actual_md5 = df.get_file_md5()
-        db_md5 = df.file_md5
-        if actual_md5 != db_md5:
-            logger.error("md5sum mismatch for file %s: file: %s, database: %s",
-                         df.filename, actual_md5, db_md5)
-            session.close()
-            sys.exit(1)
-
-    logger.info("All file md5s verified OK")
-
     # Now loop through the tapes, doing all the stuff on each
     oldcwd = os.getcwd()
     os.chdir(fsc.storage_root)
@@ -283,73 +227,51 @@ with session_scope() as session:
             tw.startdate = utcnow()
             tw.hostname = os.uname()[1]
             tw.tapedrive = td.dev
+            tw.blocksize = fsc.tape_blocksize
             tw.succeeded = False
             session.commit()
 
-            # Write the tape.
-            bytecount = 0
-            blksize = 64 * 1024
-
+            # Write the tape. The files are checked against their md5s in the
+            # database as they are written, any that don't match are left out
             logger.info("Creating tar archive on tape %s on drive %s",
                         tape.label, td.dev)
+            tarok = True
             try:
-                tar = tarfile.open(name=td.dev, mode='w|', bufsize=blksize)
-                tarok = True
+                tapefo = td.open('wb')
             except Exception:
                 logger.error("Error opening tar archive", exc_info=True)
                 tarok = False
 
-            backup_files = list()
-            for df in diskfiles:
-                filename = df.filename
-
+            if tarok:
+                writer = TarTapeWriter(tapefo, blocksize=fsc.tape_blocksize,
+                                       backspace=td.backspace_records)
                 try:
-                    statinfo = os.stat(df.fullpath)
-                    f = open(df.fullpath, "rb")
-                    tarinfo = tarfile.TarInfo(df.filename)
-                    tarinfo.size = statinfo.st_size  # tarinfo.size
-                    tarinfo.mtime = statinfo.st_mtime
-                    tarinfo.mode = statinfo.st_mode
-                    tarinfo.type = tarfile.REGTYPE
-                    tarinfo.uid = statinfo.st_uid
-                    tarinfo.gid = statinfo.st_gid
-
-                    logger.info("Adding %s to tar file on tape %s in drive %s",
-                                df.filename, tape.label, td.dev)
-                    tar.addfile(tarinfo, f)
-                    f.close()
-                    # Create the TapeFile entry and add to DB
-                    tapefile = TapeFile()
-                    tapefile.tapewrite_id = tw.id
-                    tapefile.filename = df.filename
-                    tapefile.md5 = df.file_md5
-                    tapefile.size = df.file_size
-                    tapefile.lastmod = df.lastmod
-                    tapefile.compressed = df.compressed
-                    tapefile.data_size = df.data_size
-                    tapefile.data_md5 = df.data_md5
-                    session.add(tapefile)
-                    # Do the commit at the end for speed.
-                    bytecount += df.file_size
+                    bytecount, bad = write_diskfiles(
+                        session, tw, writer, diskfiles,
+                        checkpoint=options.checkpoint, logger=logger)
+                    if bad:
+                        logger.error("%d files were not written to tape %s "
+                                     "as they did not match the database",
+                                     len(bad), tape.label)
+                    logger.info("Completed writing tar archive on tape %s in "
+                                "drive %s", tape.label, td.dev)
                 except Exception:
-                    logger.error("Exception adding file to tar archive",
+                    logger.error("Exception writing tar archive",
                                  exc_info=True)
-                    logger.info("Probably the tape filled up - Marking tape as "
-                                "full in the DB - label: %s", tape.label)
+                    logger.info("Probably the tape filled up - Marking tape "
+                                "as full in the DB - label: %s", tape.label)
                     tape.full = True
                     session.commit()
                     tarok = False
-                    break
-
-            session.commit()
-            logger.info("Completed writing tar archive on tape %s in drive %s",
-                        tape.label, td.dev)
-            logger.info("Wrote %.2f GB ", bytecount/1.0E9)
-            try:
-                tar.close()
-            except Exception:
-                logger.error("Exception closing tar archive", exc_info=True)
-                tarok = False
+                finally:
+                    # tw.size is updated as the files are recorded in the DB
+                    logger.info("Wrote %.2f GB ", (tw.size or 0)/1.0E9)
+                    try:
+                        tapefo.close()
+                    except Exception:
+                        logger.error("Exception closing tar archive",
+                                     exc_info=True)
+                        tarok = False
 
             # update records post-write
             logger.debug("Updating tapewrite record")
@@ -357,7 +279,6 @@ with session_scope() as session:
             logger.debug("Succeeded: %s", tarok)
             tw.succeeded = tarok
             tw.afterstatus = td.status()
-            tw.size = bytecount
             session.commit()
 
     os.chdir(oldcwd)
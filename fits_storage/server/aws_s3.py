@@ -2,15 +2,22 @@
 This module contains utility functions for interacting with AWS S3
 """
 
+import io
 import os
+import shutil
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
 from fits_storage.config import get_config
 from fits_storage.logger_dummy import DummyLogger
 
-from fits_storage.core.hashes import md5sum
+from fits_storage.core.hashes import md5sum, md5sum_etag
+from fits_storage.server.s3cache import get_s3_cache
+from fits_storage.server.s3listing import S3Listing
 
 import boto3
-from boto3.s3.transfer import S3UploadFailedError, RetriesExceededError
+from boto3.s3.transfer import S3UploadFailedError, RetriesExceededError, \
+    TransferConfig
 from botocore.exceptions import ClientError
 import logging
 
@@ -18,6 +25,15 @@ class DownloadError(Exception):
     pass
 
 
+def key_missing(clienterror):
+    """
+    Returns True if the botocore ClientError clienterror is because the key
+    does not exist, rather than some other failure.
+    """
+    code = clienterror.response.get('Error', {}).get('Code')
+    return code in ('NoSuchKey', 'NotFound', '404')
+
+
 boto3.set_stream_logger(level=logging.CRITICAL)
 logging.getLogger('boto').setLevel(logging.CRITICAL)
 logging.getLogger('botocore').setLevel(logging.CRITICAL)
@@ -25,11 +41,155 @@ logging.getLogger('utils').setLevel(logging.CRITICAL)
 logging.getLogger('tasks').setLevel(logging.CRITICAL)
 logging.getLogger('futures').setLevel(logging.CRITICAL)
 
+MB = 1024 * 1024
+# boto3's default part size, which objects uploaded before we set our own
+# will have been uploaded with
+DEFAULT_PART_SIZE = 8 * MB
+
+
+class RangedReader(io.RawIOBase):
+    """
+    A read only file object giving the data of an S3 object of size bytes,
+    which it gets in ranges of rangesize bytes, with a pool of depth threads
+    getting the next depth ranges while the caller reads the current one.
+    The ranges are read in order, so the caller sees one stream of data.
+
+    Each range request is conditional on the ETag, so if the object is
+    replaced while we are reading it, reading fails rather than giving a mix
+    of the old and new data.
+
+    If the caller has already requested the first range, it passes the body
+    of the response as first, and we carry on from there.
+    """
+    def __init__(self, client, bucket, keyname, size, etag, rangesize,
+                 depth, first=None):
+        super().__init__()
+        self.client = client
+        self.bucket = bucket
+        self.keyname = keyname
+        self.size = size
+        self.etag = etag
+        self.rangesize = rangesize
+        self.executor = ThreadPoolExecutor(max_workers=depth)
+        self.pending = deque()
+        self.nextstart = 0
+        self.buffer = memoryview(b'')
+        self.pos = 0
+        if first is not None:
+            end = min(rangesize, size) - 1
+            self.pending.append(self.executor.submit(self._read_body, first,
+                                                     0, end))
+            self.nextstart = end + 1
+        while len(self.pending) < depth and self.nextstart < size:
+            self._submit()
+
+    def _submit(self):
+        if self.nextstart >= self.size:
+            return
+        end = min(self.nextstart + self.rangesize, self.size) - 1
+        self.pending.append(self.executor.submit(self._get_range,
+                                                 self.nextstart, end))
+        self.nextstart = end + 1
+
+    def _get_range(self, start, end):
+        response = self.client.get_object(Bucket=self.bucket, Key=self.keyname,
+                                          Range=f'bytes={start}-{end}',
+                                          IfMatch=self.etag)
+        return self._read_body(response['Body'], start, end)
+
+    def _read_body(self, body, start, end):
+        try:
+            data = body.read()
+        finally:
+            body.close()
+        if len(data) != end - start + 1:
+            raise DownloadError(f"Got {len(data)} bytes for range {start}-"
+                                f"{end} of {self.keyname}")
+        return data
+
+    def _fill(self):
+        """
+        Make sure we have data in the buffer, unless we are at the end.
+        Returns False at the end.
+        """
+        if not self.buffer:
+            if not self.pending:
+                return False
+            self.buffer = memoryview(self.pending.popleft().result())
+            self._submit()
+        return True
+
+    def readable(self):
+        return True
+
+    def tell(self):
+        return self.pos
+
+    def readinto(self, b):
+        if not self._fill():
+            return 0
+        n = min(len(b), len(self.buffer))
+        b[:n] = self.buffer[:n]
+        self.buffer = self.buffer[n:]
+        self.pos += n
+        return n
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            return self.readall()
+        # Callers such as tarfile expect a short read to mean the end
+        buf = bytearray(size)
+        view = memoryview(buf)
+        n = 0
+        while n < size:
+            got = self.readinto(view[n:])
+            if not got:
+                break
+            n += got
+        view.release()
+        del buf[n:]
+        return bytes(buf)
+
+    def __iter__(self):
+        # Iterate over the data in ranges, like a botocore StreamingBody
+        # does in chunks, rather than lines
+        while self._fill():
+            chunk = self.buffer.tobytes()
+            self.buffer = memoryview(b'')
+            self.pos += len(chunk)
+            yield chunk
+
+    def close(self):
+        if not self.closed:
+            for future in self.pending:
+                future.cancel()
+            self.executor.shutdown(wait=False)
+            self.buffer = memoryview(b'')
+        super().close()
+
+
+class CachedFile(io.FileIO):
+    """
+    A read only file object for an object in the S3 cache. Iterating over it
+    gives the data in chunks of chunksize bytes, as iterating a botocore
+    StreamingBody or a RangedReader does, rather than in lines, which would
+    be arbitrarily long for binary data.
+    """
+    chunksize = MB
+
+    def __init__(self, path):
+        super().__init__(path, 'rb')
+
+    def __iter__(self):
+        while chunk := self.read(self.chunksize):
+            yield chunk
+
 
 class Boto3Helper(object):
     def __init__(self, bucket_name=None, underlay_bucket_name=None,
                  logger=None, access_key=None, secret_key=None,
-                 s3_staging_dir=None, storage_root=None):
+                 s3_staging_dir=None, storage_root=None, cache_dir=None,
+                 cache_gb=None):
         fsc = get_config()
         self.l = logger if logger is not None else DummyLogger()
         self.b = None
@@ -49,6 +209,22 @@ class Boto3Helper(object):
         self.storage_root = storage_root if storage_root is not None \
             else fsc.storage_root
 
+        # Settings for transfers. See fits_storage.conf
+        self.multipart_threshold = fsc.s3_multipart_threshold_mb * MB
+        self.part_size = fsc.s3_part_size_mb * MB
+        self.transfer_concurrency = fsc.s3_transfer_concurrency
+        self.get_flo_ranges = fsc.s3_get_flo_ranges
+
+        # Local disk cache of objects we fetch, if configured
+        cache_dir = cache_dir if cache_dir is not None else fsc.s3_cache_dir
+        cache_gb = cache_gb if cache_gb is not None else fsc.s3_cache_gb
+        self.cache = get_s3_cache(cache_dir, int(cache_gb * 1E9),
+                                  logger=self.l) if cache_dir else None
+
+        # Snapshots of the keys in the bucket and underlay bucket, once
+        # preload() has been called
+        self.listings = None
+
     @property
     def session(self):
         if boto3.DEFAULT_SESSION is None:
@@ -64,6 +240,13 @@ class Boto3Helper(object):
     def s3(self):
         return self.session.resource('s3')
 
+    @property
+    def transfer_config(self):
+        return TransferConfig(multipart_threshold=self.multipart_threshold,
+                              multipart_chunksize=self.part_size,
+                              max_concurrency=self.transfer_concurrency,
+                              use_threads=self.transfer_concurrency > 1)
+
     @property
     def bucket(self):
         if self.b is None:
@@ -95,7 +278,60 @@ class Boto3Helper(object):
                       self.underlay_bucket.objects.filter(Prefix=prefix)])
         return l
 
+    def preload(self, prefix='', reload=False):
+        """
+        List the keys starting with prefix in the bucket, and the underlay
+        bucket, so that exists_key and get_md5 can answer for those keys
+        without a request per key. This is for scripts that work through
+        many keys - changes made by anyone else after this are not seen,
+        unless preload is called again with reload=True.
+        """
+        if self.listings is None:
+            names = [self.b_name]
+            if self.underlay_b_name is not None:
+                names.append(self.underlay_b_name)
+            self.listings = [S3Listing(name, logger=self.l) for name in names]
+        client = self.s3_client
+        for listing in self.listings:
+            listing.load(client, prefix, reload=reload)
+
+    def _listed(self, keyname):
+        """
+        Look keyname up in the listings, if we have them. Returns the
+        ListedKey, False if we know the key doesn't exist, or None if we don't
+        know.
+        """
+        if self.listings is None:
+            return None
+        for listing in self.listings:
+            listed = listing.lookup(keyname)
+            if listed is not False:
+                return listed
+        return False
+
+    def _listed_md5(self, keyname):
+        """
+        Look the md5 of keyname up in the listings, if we have them. Returns
+        None if we can't tell it from the listings.
+        """
+        if self.listings is None:
+            return None
+        for listing in self.listings:
+            md5 = listing.lookup_md5(self.s3_client, keyname)
+            if md5 is not False:
+                return md5
+        return None
+
+    def _invalidate(self, keyname, deleted=False):
+        # Only the bucket, we never write to the underlay bucket
+        if self.listings is not None:
+            self.listings[0].invalidate(keyname, deleted=deleted)
+
     def exists_key(self, key):
+        if isinstance(key, str):
+            listed = self._listed(key)
+            if listed is not None:
+                return listed is not False
         try:
             if isinstance(key, str):
                 mykey = self.bucket.Object(key)
@@ -132,15 +368,22 @@ class Boto3Helper(object):
         # This does not fall back to the underlay bucket
         try:
             self.s3_client.delete_object(Bucket=self.b_name, Key=key)
+            self._invalidate(key, deleted=True)
             return True
         except ClientError:
             return False
 
     def get_md5(self, key):
         """
-        Get the MD5 that the S3 metadata has for this key.
+        Get the MD5 that the S3 metadata has for this key. If we have a
+        listing of the key, we use the ETag instead, which is the same thing
+        unless it was a multipart upload, or the bucket uses SSE-KMS or SSE-C
+        encryption.
         """
         if isinstance(key, str):
+            md5 = self._listed_md5(key)
+            if md5:
+                return md5
             key = self.get_key(key)
 
         try:
@@ -152,6 +395,31 @@ class Boto3Helper(object):
     def get_size(self, key):
         return key.content_length
 
+    def etag_matches(self, key, filename):
+        """
+        Check the ETag of key against the data in filename, without fetching
+        the object again. If the object was uploaded in one go, the ETag is
+        the md5 of the data. If it was a multipart upload, we need the part
+        size to work it out, which we don't know, so we try our part size,
+        boto3's default, and the smallest whole number of MB that gives the
+        number of parts in the ETag.
+        """
+        etag = key.e_tag.strip('"')
+        if '-' not in etag:
+            return md5sum(filename) == etag
+
+        nparts = int(etag.split('-')[1])
+        size = os.path.getsize(filename)
+        inferred = -(-size // nparts)
+        inferred = -(-inferred // MB) * MB
+        for partsize in dict.fromkeys([self.part_size, DEFAULT_PART_SIZE,
+                                       inferred]):
+            if -(-size // partsize) != nparts:
+                continue
+            if md5sum_etag(filename, partsize)[1] == etag:
+                return True
+        return False
+
     def set_metadata(self, keyname, **kw):
         obj = self.get_key(keyname)
         md = obj.metadata
@@ -160,6 +428,7 @@ class Boto3Helper(object):
         self.s3_client.copy_object(Bucket=bn, Key=keyname,
                                    CopySource=f'{bn}/{keyname}',
                                    MetadataDirective='REPLACE', Metadata=md)
+        self._invalidate(keyname)
 
     def copy(self, keyname, to_bucket):
         # As of 2024-Oct seems like if this does a multipart copy, then
@@ -175,6 +444,8 @@ class Boto3Helper(object):
 
         self.s3_client.copy(copy_source, to_bucket, keyname,
                             ExtraArgs={'Metadata': md})
+        if to_bucket == self.b_name:
+            self._invalidate(keyname)
 
     def rename(self, oldkey, newkey):
         # There's no move or rename on S3, have to copy and delete.
@@ -188,28 +459,54 @@ class Boto3Helper(object):
         }
         self.s3_client.copy(copy_source, self.bucket.name, newkey,
                             ExtraArgs={'Metadata': md})
+        self._invalidate(newkey)
         if self.exists_key(newkey):
             self.s3_client.delete_object(Bucket=self.bucket.name, Key=oldkey)
+            self._invalidate(oldkey, deleted=True)
         else:
             self.l.error(f"Error renaming {oldkey} to {newkey} - new key"
                          f"does not exist after copy. Not deleting old key")
             raise OSError("New S3 key does not exist in rename operation")
 
     def upload_file(self, keyname, filename, extra_meta={}):
-        md5 = md5sum(filename)
+        # Work out the md5, and the ETag S3 should give the object, together
+        md5, etag = md5sum_etag(filename, self.part_size)
+        if os.path.getsize(filename) < self.multipart_threshold:
+            etag = md5
         try:
             meta = dict(md5=md5)
             meta.update(extra_meta)
             self.s3_client.upload_file(filename, self.bucket.name, keyname,
-                                       ExtraArgs={'Metadata': meta})
+                                       ExtraArgs={'Metadata': meta},
+                                       Config=self.transfer_config)
         except S3UploadFailedError:
             self.l.error("S3 Upload Failed", exc_info=True)
             return None
+        finally:
+            self._invalidate(keyname)
 
         obj = self.get_key(keyname)
         # Make sure that the object is available before returning the key
         obj.wait_until_exists()
 
+        # Check S3 got the data we sent, without fetching it back. The ETag
+        # is only the md5 (or multipart md5) of the data if the object is not
+        # encrypted with SSE-KMS or SSE-C, so if it doesn't match, we can't
+        # tell anything from it, and fall back to checking the size and the
+        # md5 in the metadata.
+        if obj.e_tag.strip('"') != etag:
+            self.l.debug("S3 Upload of %s has ETag %s, expected %s. Cannot "
+                         "verify by ETag, checking size and metadata instead",
+                         keyname, obj.e_tag, etag)
+            size = os.path.getsize(filename)
+            if obj.content_length != size or \
+                    obj.metadata.get('md5') != md5:
+                self.l.error("S3 Upload of %s has size %s and md5 %s, "
+                             "expected %s and %s", keyname,
+                             obj.content_length, obj.metadata.get('md5'),
+                             size, md5)
+                return None
+
         return obj
 
     def fetch_key_to_file(self, keyname, fullpath):
@@ -217,7 +514,8 @@ class Boto3Helper(object):
         Fetch an object from S3 to a local file
         """
         try:
-            self.s3_client.download_file(self.bucket.name, keyname, fullpath)
+            self.s3_client.download_file(self.bucket.name, keyname, fullpath,
+                                         Config=self.transfer_config)
         except RetriesExceededError:
             self.l.error("Retries Exceeded", exc_info=True)
             return False
@@ -225,7 +523,8 @@ class Boto3Helper(object):
             if self.underlay_bucket:
                 try:
                     self.s3_client.download_file(self.underlay_bucket.name,
-                                                 keyname, fullpath)
+                                                 keyname, fullpath,
+                                                 Config=self.transfer_config)
                 except RetriesExceededError:
                     self.l.error("Retries Exceeded", exc_info=True)
                     return False
@@ -233,6 +532,30 @@ class Boto3Helper(object):
                     return False
         return True
 
+    def cached_file(self, keyname, key=None):
+        """
+        Return the path of the copy of keyname in the cache, fetching it into
+        the cache if it is not there already. Returns None if we don't have a
+        cache, or can't use it for this key - it doesn't exist, is too big to
+        cache, or has no md5 in the metadata - or fetching it failed, in which
+        case the caller should fetch it from S3 directly. If the caller has
+        the key for keyname from get_key() already, pass it as key to save
+        looking it up again.
+        """
+        if self.cache is None:
+            return None
+        if key is None:
+            key = self.get_key(keyname)
+        try:
+            size = self.get_size(key)
+            md5 = self.get_md5(key)
+        except ClientError:
+            return None
+        if md5 is None or not self.cache.cacheable(size):
+            return None
+        return self.cache.get(
+            md5, lambda filename: self.fetch_key_to_file(keyname, filename))
+
     def fetch_to_storageroot(self, keyname, fullpath=None, skip_tests=False):
         """
         Fetch the file from s3. By default, put it in the storage_root directory
@@ -263,20 +586,39 @@ class Boto3Helper(object):
                          f"{os.path.dirname(fullpath)}", exc_info=True)
             return False
 
+        # If we have a cache, we need the key to look the object up in it,
+        # and we use the same key to check the download if it's not cached.
+        key = self.get_key(keyname) if self.cache is not None else None
+        cached = self.cached_file(keyname, key)
+        if cached is not None:
+            # The cache checked the md5 when it fetched it
+            shutil.copyfile(cached, fullpath)
+            return True
+
         if self.fetch_key_to_file(keyname, fullpath) is False:
             return False
 
         if skip_tests:
             return True
 
-        key = self.get_key(keyname)
+        if key is None:
+            key = self.get_key(keyname)
         # Check size and md5
         filesize = os.path.getsize(fullpath)
         s3size = self.get_size(key)
         if filesize == s3size:
+            s3md5 = self.get_md5(key)
+            if s3md5 is None:
+                # No md5 in the metadata, check the ETag instead
+                if self.etag_matches(key, fullpath):
+                    self.l.debug("Downloaded file from S3 successfully")
+                    return True
+                self.l.error("Problem fetching %s from S3 - size OK, but "
+                             "ETag %s doesn't match", keyname, key.e_tag)
+                return False
+
             # It's the right size, check the md5
             filemd5 = md5sum(fullpath)
-            s3md5 = self.get_md5(key)
             if filemd5 == s3md5:
                 # md5 matches
                 self.l.debug("Downloaded file from S3 successfully")
@@ -294,17 +636,80 @@ class Boto3Helper(object):
             return False
 
     def get_flo(self, keyname):
+        """
+        Return a file like object to read the object keyname from. This is
+        the cached copy if we have a cache, otherwise we read it from S3 - in
+        ranges, in parallel, if it is bigger than one range, or in one stream
+        if not.
+
+        Without a cache, we don't make a HEAD request to find the size of the
+        object. We request the first range, and the response gives the size
+        of the whole object, so a small object is read with that one request.
+        """
+        key = None
+        if self.cache is not None:
+            key = self.get_key(keyname)
+            cached = self.cached_file(keyname, key)
+            if cached is not None:
+                return CachedFile(cached)
+
+        if self.get_flo_ranges <= 1:
+            return self.get_object(keyname)['Body']
+
+        if key is not None:
+            # We have the size from looking in the cache already
+            try:
+                size = self.get_size(key)
+            except ClientError:
+                # Doesn't exist. Let get_object below raise as usual
+                size = 0
+            if size > self.part_size:
+                return RangedReader(self.s3_client, key.bucket_name, keyname,
+                                    size, key.e_tag, self.part_size,
+                                    self.get_flo_ranges)
+            return self.get_object(keyname)['Body']
+
         try:
-            response = self.s3_client.get_object(Bucket=self.b_name,
-                                                 Key=keyname)
+            bucket, response = self._get_object(
+                keyname, Range=f'bytes=0-{self.part_size - 1}')
+        except ClientError as clienterror:
+            # An empty object has no first range
+            if clienterror.response.get('Error', {}).get('Code') != \
+                    'InvalidRange':
+                raise
+            return self.get_object(keyname)['Body']
+        # ContentRange is like 'bytes 0-1023/123456'
+        size = int(response['ContentRange'].rsplit('/', 1)[1])
+        if size <= self.part_size:
             return response['Body']
+        return RangedReader(self.s3_client, bucket, keyname, size,
+                            response['ETag'], self.part_size,
+                            self.get_flo_ranges, first=response['Body'])
+
+    def get_object(self, keyname):
+        """
+        GET the object keyname, from the underlay bucket if it is not in the
+        bucket. Returns the get_object response, which has the data stream in
+        'Body', along with the 'ETag', 'LastModified', 'ContentLength' and
+        'Metadata' of the object, so there is no need for a separate HEAD
+        request to get those. Raises ClientError if it does not exist.
+        """
+        return self._get_object(keyname)[1]
+
+    def _get_object(self, keyname, **kwargs):
+        """
+        As get_object, passing any kwargs on to the client get_object, but
+        return a tuple of the name of the bucket we found the object in and
+        the response.
+        """
+        try:
+            return self.b_name, self.s3_client.get_object(
+                Bucket=self.b_name, Key=keyname, **kwargs)
         except ClientError as clienterror:
             if self.underlay_bucket:
                 try:
-                    response = self.s3_client.get_object(
-                        Bucket=self.underlay_b_name,
-                        Key=keyname)
-                    return response['Body']
+                    return self.underlay_b_name, self.s3_client.get_object(
+                        Bucket=self.underlay_b_name, Key=keyname, **kwargs)
                 except ClientError:
                     raise clienterror
             else:
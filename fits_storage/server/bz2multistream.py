@@ -0,0 +1,518 @@
+"""
+This module contains code to write and edit "multi-stream" bz2 compressed
+FITS files.
+
+A bz2 file can consist of several complete bz2 streams concatenated together,
+and it decompresses to the concatenation of the decompressed streams. All
+the usual tools (bzip2, python's bz2 module and hence astropy) handle this
+transparently, so a multi-stream file is a perfectly normal .bz2 file.
+
+We write FITS files with the primary header in its own bz2 stream, followed
+by the rest of the file. Optionally, each extension header is also in its own
+stream, with the data of each HDU in separate streams between them. This
+means that we can modify headers by decompressing and recompressing only the
+header streams and splicing them back together with the untouched compressed
+data streams, rather than decompressing and recompressing the whole file.
+
+HeaderOnlyEditor does that, and also handles uncompressed FITS files in the
+same way. If the edited headers are the same size on disk as the originals
+(which is usually the case for uncompressed files, as headers are padded to
+2880 byte blocks) the file is patched in place. Otherwise, the file is
+rewritten by splicing the new headers with the original bytes of the rest of
+the file.
+"""
+import bz2
+import hashlib
+import os
+import re
+import shutil
+import tempfile
+
+import astropy.io.fits
+
+FITS_BLOCK = 2880
+CARD = 80
+END_CARD = b'END' + b' ' * 77
+
+# bz2 streams start with 'BZh' and a block size digit, followed by either the
+# block header magic (pi) or, for an empty stream, the end of stream magic
+# (sqrt(pi)). Streams start on byte boundaries within a multi-stream file.
+_stream_start_cre = re.compile(rb'BZh[1-9](?:1AY&SY|\x17rE8P\x90)')
+
+# Size of the chunks we read and write when copying and scanning files
+CHUNKSIZE = 1024 * 1024
+
+
+def _padded(size):
+    return ((size + FITS_BLOCK - 1) // FITS_BLOCK) * FITS_BLOCK
+
+
+def _find_end(buffer):
+    """
+    Find the end of the header in buffer, which must start at the start of a
+    header. Returns the padded length of the header, or None if the END card
+    is not present in buffer.
+    """
+    i = buffer.find(END_CARD)
+    while i != -1:
+        if i % CARD == 0:
+            return _padded(i + CARD)
+        i = buffer.find(END_CARD, i + 1)
+    return None
+
+
+def read_fits_header(fileobj):
+    """
+    Read a FITS header from fileobj, which should be positioned at the start
+    of the header. Returns the header bytes, including the padding to a
+    2880 byte boundary. Raises ValueError if there is no END card.
+    """
+    header = b''
+    while True:
+        block = fileobj.read(FITS_BLOCK)
+        if len(block) < FITS_BLOCK:
+            raise ValueError('Reached end of file reading FITS header')
+        header += block
+        if _find_end(block) is not None:
+            return header
+
+
+def data_size(header):
+    """
+    Calculate the size of the data section, including padding, that follows
+    the given header. header can be an astropy Header or the header bytes.
+    """
+    if isinstance(header, bytes):
+        header = astropy.io.fits.Header.fromstring(header)
+    naxis = header.get('NAXIS', 0)
+    if naxis == 0:
+        return 0
+    axes = [header.get(f'NAXIS{i}', 0) for i in range(1, naxis + 1)]
+    if header.get('GROUPS', False) and axes[0] == 0:
+        # Random groups - NAXIS1 = 0 is a placeholder
+        axes = axes[1:]
+    npix = 1
+    for axis in axes:
+        npix *= axis
+    size = abs(header.get('BITPIX', 8)) // 8 * header.get('GCOUNT', 1) * \
+        (header.get('PCOUNT', 0) + npix)
+    return _padded(size)
+
+
+def _copy(src, dest, size=None):
+    """
+    Copy size bytes (or to EOF if size is None) from src to dest
+    """
+    while size is None or size > 0:
+        chunk = src.read(CHUNKSIZE if size is None else min(size, CHUNKSIZE))
+        if not chunk:
+            break
+        dest.write(chunk)
+        if size is not None:
+            size -= len(chunk)
+
+
+def _compress_to(src, dest, size, comp):
+    """
+    Read size bytes from src, compress with the BZ2Compressor comp and write
+    the compressed data to dest.
+    """
+    while size > 0:
+        chunk = src.read(min(size, CHUNKSIZE))
+        if not chunk:
+            raise ValueError('Unexpected end of file in FITS data')
+        size -= len(chunk)
+        dest.write(comp.compress(chunk))
+
+
+class Md5Sums(object):
+    """
+    Accumulate the size and md5sum of a file, and of the data in it, as the
+    file is read or written. Pass the bytes of the file, in order, to file().
+    For compressed files, either pass the uncompressed data, in order, to
+    data(), or set decompress to have file() decompress it for us. We handle
+    multi-stream bz2 files by starting a new decompressor at the end of each
+    stream. For uncompressed files, the file and the data are the same.
+    """
+    def __init__(self, compressed, decompress=False):
+        self.compressed = compressed
+        self.decompress = compressed and decompress
+        self.file_size = self.data_size = 0
+        self.file_hash = hashlib.md5()
+        self.data_hash = hashlib.md5()
+        self.decomp = bz2.BZ2Decompressor()
+
+    def file(self, chunk):
+        self.file_size += len(chunk)
+        self.file_hash.update(chunk)
+        while self.decompress and chunk:
+            if self.decomp.eof:
+                self.decomp = bz2.BZ2Decompressor()
+            self.data(self.decomp.decompress(chunk))
+            chunk = self.decomp.unused_data if self.decomp.eof else b''
+
+    def data(self, chunk):
+        self.data_size += len(chunk)
+        self.data_hash.update(chunk)
+
+    def result(self):
+        """
+        Returns (file_size, file_md5, data_size, data_md5)
+        """
+        file_md5 = self.file_hash.hexdigest()
+        if not self.compressed:
+            return self.file_size, file_md5, self.file_size, file_md5
+        return self.file_size, file_md5, self.data_size, \
+            self.data_hash.hexdigest()
+
+
+class _HashingReader(object):
+    """
+    Pass the data read from fileobj to sums.data()
+    """
+    def __init__(self, fileobj, sums):
+        self.fileobj = fileobj
+        self.sums = sums
+
+    def read(self, size=-1):
+        data = self.fileobj.read(size)
+        self.sums.data(data)
+        return data
+
+
+class _HashingWriter(object):
+    """
+    Pass the data written to fileobj to sums.file()
+    """
+    def __init__(self, fileobj, sums):
+        self.fileobj = fileobj
+        self.sums = sums
+
+    def write(self, data):
+        self.sums.file(data)
+        return self.fileobj.write(data)
+
+
+def write_multistream(src, dest, split_extensions=False, compresslevel=9):
+    """
+    Compress the uncompressed FITS file in src to dest, as a multi-stream bz2
+    file with the primary header in its own stream.
+
+    Returns (file_size, file_md5, data_size, data_md5) of the file written,
+    which we work out as we go, so the caller doesn't need to read it back.
+
+    Parameters
+    ----------
+    src : binary file-like object containing the uncompressed FITS file
+    dest : binary file-like object to write the compressed file to
+    split_extensions : bool
+        If True, put each extension header and each data section in its own
+        stream too. Otherwise, everything after the primary header is in
+        one stream.
+    compresslevel : int
+        bz2 compression level
+    """
+    sums = Md5Sums(compressed=True)
+    src = _HashingReader(src, sums)
+    dest = _HashingWriter(dest, sums)
+
+    header = read_fits_header(src)
+    dest.write(bz2.compress(header, compresslevel))
+
+    if not split_extensions:
+        comp = bz2.BZ2Compressor(compresslevel)
+        while chunk := src.read(CHUNKSIZE):
+            dest.write(comp.compress(chunk))
+        dest.write(comp.flush())
+        return sums.result()
+
+    while True:
+        size = data_size(header)
+        if size:
+            comp = bz2.BZ2Compressor(compresslevel)
+            _compress_to(src, dest, size, comp)
+            dest.write(comp.flush())
+        try:
+            header = read_fits_header(src)
+        except ValueError:
+            # No more HDUs
+            break
+        dest.write(bz2.compress(header, compresslevel))
+    return sums.result()
+
+
+def read_header_stream(fileobj, offset):
+    """
+    Try to read a bz2 stream containing exactly one FITS header starting at
+    offset in fileobj.
+
+    Returns (header bytes, compressed length of the stream), or None if there
+    is not a complete bz2 stream at offset that decompresses to exactly one
+    FITS header. We stop decompressing as soon as we can tell, so this is
+    cheap even if the stream is not a header stream.
+    """
+    fileobj.seek(offset)
+    decomp = bz2.BZ2Decompressor()
+    output = b''
+    consumed = 0
+    try:
+        while not decomp.eof:
+            chunk = fileobj.read(64 * 1024)
+            if not chunk:
+                return None
+            output += decomp.decompress(chunk)
+            consumed += len(chunk)
+            if len(output) >= 8 and output[:8] not in (b'SIMPLE  ',
+                                                       b'XTENSION'):
+                return None
+            end = _find_end(output)
+            if end is not None and len(output) > end:
+                # Stream contains more than just the header
+                return None
+            if end is None and len(output) > 10 * 1024 * 1024:
+                # Unreasonably large for a header
+                return None
+    except (OSError, EOFError):
+        # Not a valid bz2 stream
+        return None
+
+    if _find_end(output) != len(output):
+        return None
+    return output, consumed - len(decomp.unused_data)
+
+
+def is_multistream(fileobj):
+    """
+    Is fileobj a multi-stream bz2 FITS file with the primary header in its
+    own stream?
+    """
+    return read_header_stream(fileobj, 0) is not None
+
+
+def read_primary_header(path, compressed):
+    """
+    Read the primary header bytes from the file at path. For compressed
+    files, this only decompresses the start of the file, irrespective of
+    whether it is a multi-stream file.
+    """
+    opener = bz2.open if compressed else open
+    with opener(path, 'rb') as f:
+        return read_fits_header(f)
+
+
+def md5sums(path, compressed):
+    """
+    Calculate the size and md5sum of the file at path and of the data in it,
+    in one pass through the file. For uncompressed files, these are the same.
+
+    Returns (file_size, file_md5, data_size, data_md5)
+    """
+    sums = Md5Sums(compressed, decompress=True)
+    with open(path, 'rb') as f:
+        while chunk := f.read(CHUNKSIZE):
+            sums.file(chunk)
+    return sums.result()
+
+
+class _HeaderHDU(object):
+    """
+    Minimal stand-in for an astropy HDU, for code that only accesses .header
+    """
+    def __init__(self, header):
+        self.header = header
+
+
+class HeaderOnlyEditor(object):
+    """
+    Edit the headers of a FITS file without touching the data.
+
+    Instantiate with the path to the file and whether it is bz2 compressed.
+    Compressed files must be multi-stream files with the primary header in
+    its own stream - use the can_edit() class method to check. Index the
+    instance to get an object with a .header attribute (an astropy Header) for
+    that HDU, like an astropy HDUList, modify the headers, and call write() to
+    write the changes.
+
+    Extension headers are located when first requested. For compressed
+    files, this is only possible if the extension headers are in their own
+    streams, and IndexError is raised otherwise, as it is for non-existent
+    extensions.
+
+    After write() has modified the file, md5sums is the (file_size, file_md5,
+    data_size, data_md5) of the new file.
+    """
+    md5sums = None
+
+    def __init__(self, path, compressed):
+        self.path = path
+        self.compressed = compressed
+        # For each HDU located so far: [offset, length on disk,
+        #  original header bytes, astropy Header]
+        self._hdus = []
+        # For uncompressed files, or compressed files with split extensions,
+        # the offset on disk of the start of the next HDU, if known
+        self._next_offset = None
+        with open(path, 'rb') as f:
+            self._locate(f, 0)
+
+    @classmethod
+    def can_edit(cls, path, compressed):
+        if not compressed:
+            return True
+        with open(path, 'rb') as f:
+            return is_multistream(f)
+
+    def _locate(self, f, index):
+        """
+        Locate HDU index, after all the preceding ones have been located
+        """
+        if index == 0:
+            offset = 0
+        elif self._next_offset is not None:
+            offset = self._next_offset
+        else:
+            raise IndexError(index)
+
+        if not self.compressed:
+            f.seek(offset)
+            try:
+                header = read_fits_header(f)
+            except ValueError:
+                raise IndexError(index)
+            length = len(header)
+            self._next_offset = offset + length + data_size(header)
+        else:
+            if index > 0:
+                offset = self._find_header_stream(f, offset)
+            hs = read_header_stream(f, offset) if offset is not None else None
+            if hs is None:
+                raise IndexError(index)
+            header, length = hs
+            self._next_offset = offset + length
+
+        self._hdus.append([offset, length, header,
+                           astropy.io.fits.Header.fromstring(header)])
+
+    def _find_header_stream(self, f, offset):
+        """
+        Find the next extension header stream at or after offset in a
+        compressed file. There may be a data stream in between, so we scan
+        for bz2 stream starts and check if each is an extension header.
+        Returns None if there isn't one.
+        """
+        f.seek(offset)
+        pos = offset
+        buffer = b''
+        while True:
+            chunk = f.read(CHUNKSIZE)
+            if not chunk:
+                return None
+            buffer += chunk
+            for m in _stream_start_cre.finditer(buffer):
+                candidate = pos + m.start()
+                hs = read_header_stream(f, candidate)
+                if hs is not None and hs[0].startswith(b'XTENSION'):
+                    return candidate
+            f.seek(pos + len(buffer))
+            # Keep the end of the buffer in case a stream start straddles the
+            # chunk boundary
+            keep = 9
+            pos += len(buffer) - keep
+            buffer = buffer[-keep:]
+
+    def __getitem__(self, index):
+        if index < 0:
+            raise IndexError(index)
+        if index >= len(self._hdus):
+            with open(self.path, 'rb') as f:
+                while len(self._hdus) <= index:
+                    self._locate(f, len(self._hdus))
+        return _HeaderHDU(self._hdus[index][3])
+
+    @property
+    def headers(self):
+        """
+        The astropy Headers located so far
+        """
+        return [hdu[3] for hdu in self._hdus]
+
+    def _new_bytes(self, hdu):
+        """
+        Return (new header bytes, new on disk bytes) for hdu, or None if
+        the header has not been modified.
+        """
+        offset, length, old, header = hdu
+        new = header.tostring(padding=True).encode('ascii')
+        if new == old:
+            return None
+        if self.compressed:
+            return new, bz2.compress(new)
+        return new, new
+
+    def write(self):
+        """
+        Write any modifications to the file.
+
+        Returns 'unchanged' if no headers were modified, 'in place' if the file
+        was patched in place, or 'spliced' if it was rewritten. The md5sums are
+        worked out as the spliced file is written, or in one read through the
+        file after patching it in place.
+        """
+        changes = []
+        for hdu in self._hdus:
+            new = self._new_bytes(hdu)
+            if new is not None:
+                changes.append((hdu, new))
+        if not changes:
+            return 'unchanged'
+
+        if all(len(ondisk) == hdu[1] for hdu, (new, ondisk) in changes):
+            with open(self.path, 'r+b') as f:
+                for hdu, (new, ondisk) in changes:
+                    f.seek(hdu[0])
+                    f.write(ondisk)
+            self.md5sums = md5sums(self.path, self.compressed)
+            result = 'in place'
+        else:
+            self._splice(changes)
+            result = 'spliced'
+
+        # Update our records so that we can be written again
+        shift = 0
+        changed = {id(hdu): new for hdu, new in changes}
+        for hdu in self._hdus:
+            hdu[0] += shift
+            if id(hdu) in changed:
+                new, ondisk = changed[id(hdu)]
+                shift += len(ondisk) - hdu[1]
+                hdu[1] = len(ondisk)
+                hdu[2] = new
+        if self._next_offset is not None:
+            self._next_offset += shift
+        return result
+
+    def _splice(self, changes):
+        """
+        Write a new copy of the file with the new headers and the original
+        bytes of everything else, then replace the original file with it.
+        """
+        dirname = os.path.dirname(self.path) or '.'
+        fd, tmpname = tempfile.mkstemp(dir=dirname, prefix='.fitseditor_')
+        sums = Md5Sums(self.compressed, decompress=True)
+        try:
+            with open(self.path, 'rb') as src, os.fdopen(fd, 'wb') as f:
+                dest = _HashingWriter(f, sums)
+                pos = 0
+                for hdu, (new, ondisk) in changes:
+                    _copy(src, dest, hdu[0] - pos)
+                    dest.write(ondisk)
+                    pos = hdu[0] + hdu[1]
+                    src.seek(pos)
+                _copy(src, dest)
+            shutil.copymode(self.path, tmpname)
+            os.replace(tmpname, self.path)
+            self.md5sums = sums.result()
+        except BaseException:
+            if os.path.exists(tmpname):
+                os.unlink(tmpname)
+            raise
@@ -7,6 +7,9 @@ data, but not the other way round, which is what we're doing here.
 
 import bz2
 import hashlib
+import io
+import os
+from collections import deque
 
 
 class StreamBz2Compressor(object):
@@ -19,9 +22,17 @@ class StreamBz2Compressor(object):
     object from which to read the data to be compressed. The only method this
     function calls on this object is .read(size).
 
-    You can then call .read(size) on this object and that will return the
-    source data after bz2 compressing it. The only file-like method this class
-    supports is .read(size).
+    You can then call .read(size) or .readinto(buffer) on this object and
+    that will return the source data after bz2 compressing it. These are the
+    only file-like methods this class supports.
+
+    If the source data are already bz2 compressed, pass passthrough=True and
+    the data will be passed through as they are, rather than compressed again.
+    This is useful so that the extra properties below are available either
+    way, without having to read the file again to calculate the md5sum. In
+    that case, if src is a real file, len() gives the number of bytes left to
+    read, so that requests sets a Content-Length header rather than using a
+    chunked upload.
 
     This class provides two extra properties:
         * bytes_output which gives the number of bytes that have been read
@@ -29,40 +40,86 @@ class StreamBz2Compressor(object):
         * md5sum_output which gives the md5sum of the data output so far.
     These update as data is read from the class, they are most useful after
     all the data have been read of course.
+
+    The compressor returns data in blocks of several hundred kB, so rather
+    than concatenating them into one buffer and slicing the data off the
+    front of it for each read, which copies the whole buffer on every read,
+    we keep a queue of the compressed blocks and an offset into the first
+    one, and only copy the data that are actually read.
     """
-    def __init__(self, src, chunksize=1000000, itersize=1000000):
+    def __init__(self, src, chunksize=1000000, itersize=1000000,
+                 passthrough=False):
         """
         Instantiate a StreamBz2Compressor instance.
         src - file-like-object to read data from
         chunksize (default 1MB) size of the chunks of data we will compress
         itersize (default 1MB) size of the chunks we return as an iterator
+        passthrough (default False) - src data are already bz2 compressed,
+        do not compress them again.
         """
         self.src = src
-        self.comp = bz2.BZ2Compressor()
-        self.output_buffer = bytes(0)
+        self.comp = None if passthrough else bz2.BZ2Compressor()
+        self.blocks = deque()
+        self.offset = 0
+        self.buffered = 0
         self.done = False
         self.chunksize = chunksize
         self.itersize = itersize
         self._bytes_output = 0
         self.hashobj = hashlib.md5()
+        # The number of bytes we will output in total, if we know it. We only
+        # know that in advance when passing through data from a real file.
+        self.size = None
+        if passthrough:
+            try:
+                self.size = os.fstat(src.fileno()).st_size - src.tell()
+            except (AttributeError, io.UnsupportedOperation):
+                pass
 
     def _fill_buffer(self, request_size):
         """
-        Attempt to fill the output_buffer to contain at least request_size
+        Attempt to fill the output buffer to contain at least request_size
         bytes of bz2 compressed data. If there are not that many bytes
         available, fill the buffer with whatever is available.
         """
-        while not self.done and len(self.output_buffer) < request_size:
+        while not self.done and self.buffered < request_size:
             chunk = self.src.read(self.chunksize)
             if not chunk:
-                comp = self.comp.flush()
-                if comp:
-                    self.output_buffer += comp
+                comp = self.comp.flush() if self.comp else None
                 self.done = True
-            else:
+            elif self.comp:
                 comp = self.comp.compress(chunk)
-                if comp:
-                    self.output_buffer += comp
+            else:
+                comp = chunk
+            if comp:
+                self.blocks.append(comp)
+                self.buffered += len(comp)
+
+    def readinto(self, b):
+        """
+        Read up to len(b) bytes into the writable buffer b. Returns the
+        number of bytes read, which is 0 if no more data are available.
+        """
+        view = memoryview(b).cast('B')
+        n = len(view)
+        if self.buffered < n:
+            self._fill_buffer(n)
+
+        pos = 0
+        while pos < n and self.blocks:
+            block = memoryview(self.blocks[0])
+            size = min(n - pos, len(block) - self.offset)
+            view[pos:pos+size] = block[self.offset:self.offset+size]
+            pos += size
+            self.offset += size
+            if self.offset == len(block):
+                self.blocks.popleft()
+                self.offset = 0
+
+        self.buffered -= pos
+        self._bytes_output += pos
+        self.hashobj.update(view[:pos])
+        return pos
 
     def read(self, n):
         """
@@ -71,22 +128,35 @@ class StreamBz2Compressor(object):
         """
         # If we don't have enough data in the output buffer, top it up to the
         # number of bytes requested
-        if len(self.output_buffer) < n:
+        if self.buffered < n:
             self._fill_buffer(n)
 
         # If the output buffer is empty, even after the top-up, we're at EOF.
-        if not self.output_buffer:
+        if not self.buffered:
             return None
 
-        # If we get here, we have sufficient data in the output buffer to
-        # satisfy the request. Return the first n bytes of the buffer and
-        # remove those bytes from the buffer.
-        ret = self.output_buffer[:n]
-        self.output_buffer = self.output_buffer[n:]
+        # Most reads are satisfied by the first block, in which case we just
+        # need to copy out the bytes requested.
+        block = self.blocks[0]
+        if len(block) - self.offset >= n or len(self.blocks) == 1:
+            if self.offset == 0 and len(block) <= n:
+                ret = block
+                self.blocks.popleft()
+            else:
+                ret = block[self.offset:self.offset+n]
+                self.offset += len(ret)
+                if self.offset == len(block):
+                    self.blocks.popleft()
+                    self.offset = 0
+            self.buffered -= len(ret)
+            self._bytes_output += len(ret)
+            self.hashobj.update(ret)
+            return ret
 
-        self._bytes_output += len(ret)
-        self.hashobj.update(ret)
-        return ret
+        # Otherwise, gather the data from several blocks.
+        ret = bytearray(min(n, self.buffered))
+        self.readinto(ret)
+        return bytes(ret)
 
     @property
     def bytes_output(self):
@@ -96,6 +166,15 @@ class StreamBz2Compressor(object):
     def md5sum_output(self):
         return self.hashobj.hexdigest()
 
+    # requests uses len() to set the Content-Length header. 0 tells it that
+    # we don't know the length, in which case it does a chunked upload. We
+    # still want the object to be truthy in that case.
+    def __len__(self):
+        return 0 if self.size is None else self.size - self._bytes_output
+
+    def __bool__(self):
+        return True
+
     # requests uses the presence of __iter__ to determine that the thing
     # passed is a file-like-object, and itterates the object to retrieve
     # the contents.
@@ -16,7 +16,6 @@ from sqlalchemy import update
 from fits_storage.queues.orm.exportqueueentry import ExportQueueEntry
 from fits_storage.core.orm.diskfile import DiskFile
 from fits_storage.server.bz2stream import StreamBz2Compressor
-from fits_storage.core.hashes import md5sum
 from fits_storage import utcnow
 
 from fits_storage.config import get_config
@@ -63,6 +62,7 @@ class Exporter(object):
         # We pull these configuration values into the local namespace for
         # convenience and to allow poking them for testing
         self.storage_root = fsc.storage_root
+        self.header_delta_wait = fsc.header_delta_wait
 
         pmc = fsc.get('export_destination_path_map')
         pmd = json.loads(pmc) if pmc else {}
@@ -87,6 +87,12 @@ class Exporter(object):
         # We store the diskfile we are exporting here too for convenience
         self.df = None
 
+        # If set, this is called with the destination and the new 'after'
+        # time whenever we delay all exports to a destination. The
+        # ExportSupervisor uses this to stop handing its workers files for
+        # that destination.
+        self.on_delay_destination = None
+
         # Reset / initialize per-file state
         self.reset()
 
@@ -106,9 +112,13 @@ class Exporter(object):
         self.eqe.seterror(message)
         self.s.commit()
 
-    def export_file(self, eqe: ExportQueueEntry):
+    def export_file(self, eqe: ExportQueueEntry, destination_info=None):
         """
         Exports a file.
+
+        destination_info is an optional (data_md5, ingest_pending) tuple for
+        the file at the destination, as returned by get_destination_info_many.
+        If it is not given, we query the destination for it.
         """
 
         # Start with a clean state. It's simpler and more robust to do that here
@@ -123,7 +133,12 @@ class Exporter(object):
 
         # First, get info about this file from the destination end, This info
         # is the data_md5 and also the ingest_pending flag
-        self.got_destination_info = self._get_destination_file_info()
+        if destination_info is not None:
+            self.destination_md5, self.destination_ingest_pending = \
+                destination_info
+            self.got_destination_info = True
+        else:
+            self.got_destination_info = self._get_destination_file_info()
 
         if self.got_destination_info is False:
             error_text = "Failed to get destination file info for filename " \
@@ -135,17 +150,15 @@ class Exporter(object):
                          eqe.filename)
 
         # if there is an ingest pending on this at the destination, we simply
-        # log a message and postpone the export by 40 seconds
+        # log a message and postpone the export by 40 seconds. This includes
+        # header updates we sent on an earlier pass that the destination has
+        # not applied yet.
         if self.destination_ingest_pending:
             delay = 40
             self.l.info("File %s is ingest pending at destination %s. "
                         "Deferring ingest for %d seconds", eqe.filename,
                         eqe.destination, delay)
-            now = utcnow()
-            dt = datetime.timedelta(seconds=delay)
-            eqe.after = now + dt
-            eqe.inprogress = False
-            self.s.commit()
+            self._defer(delay)
             return
 
         # Look up the diskfile on the local server now
@@ -180,8 +193,10 @@ class Exporter(object):
         # destination with the correct data_md5. Go ahead and transfer it.
         self.l.debug("export_file: go ahead and transfer")
         # If we have header update data, we attempt to send the header update
-        # to the destination and then verify we ended up with the same data_md5.
-        # If we did, then the transfer is complete, if not, we fall back to a
+        # to the destination, which queues it for its fileops service. We then
+        # defer the export, and the at_destination() check on the next pass
+        # verifies we ended up with the same data_md5. We only send the header
+        # update once, so if it didn't work, the next pass falls back to a
         # regular file transfer.
 
         got_header_update = self.eqe.md5_before_header_update is not None\
@@ -190,10 +205,12 @@ class Exporter(object):
 
         if got_header_update:
             self.l.info("Attempting pseudo-transfer by header update")
-            if self.transfer_headers():
-                self.l.info("Header update pseudo-transfer successful")
-                self.s.delete(self.eqe)
-                self.s.commit()
+            sent = self.transfer_headers()
+            self.eqe.header_update = None
+            if sent:
+                self.l.info("Header update queued at destination, checking "
+                            "it in %d seconds", self.header_delta_wait)
+                self._defer(self.header_delta_wait)
                 return
             self.l.info("Header update failed. Falling back to file transfer")
 
@@ -204,14 +221,79 @@ class Exporter(object):
     def transfer_headers(self):
         """
         Pseudo transfer the file to the destination using the header update
-        hints. Return True on success, False on failure. If the before_md5
-        does not match, immediately return False, otherwise attempt to apply
-        the header_update and check the after_md5. Iff the after_md5 matches,
-        return True.
-
+        hints. Return True if the destination queued the header update, False
+        on failure. If the before_md5 does not match, or our file has changed
+        since the header update, immediately return False.
+
+        The header update is POSTed to the header_delta URL at the
+        destination, which queues it for the destination's fileops
+        update_headers and returns without waiting for it. The destination
+        fileops checks the before_md5 against its own diskfile before
+        modifying anything. The caller checks the resulting data_md5 on a
+        later pass. The md5s are data_md5s, so this works irrespective of
+        whether the file is compressed at either end.
+
+        We don't treat any failure here as an export failure, as the caller
+        falls back to a regular file transfer.
         """
-        self.l.error("transfer_headers not implemented yet")
-        return False
+        # For convenience
+        eqe = self.eqe
+        filename = eqe.filename if eqe.filename.endswith('.bz2') \
+            else eqe.filename + '.bz2'
+
+        if self.destination_md5 != eqe.md5_before_header_update:
+            self.l.info("Destination data_md5 %s does not match md5 before "
+                        "header update %s", self.destination_md5,
+                        eqe.md5_before_header_update)
+            return False
+
+        if self.df.data_md5 != eqe.md5_after_header_update:
+            # The file has been modified again since the header update. There
+            # will be another export queued for that.
+            self.l.info("Local data_md5 %s does not match md5 after header "
+                        "update %s", self.df.data_md5,
+                        eqe.md5_after_header_update)
+            return False
+
+        try:
+            header_update = json.loads(eqe.header_update)
+        except ValueError:
+            self.l.error("Cannot decode header_update: %s", eqe.header_update)
+            return False
+
+        payload = {'md5_before': eqe.md5_before_header_update,
+                   'header_update': header_update}
+        url = os.path.join(eqe.destination, 'header_delta',
+                           eqe.destination_path, filename)
+
+        self.l.debug("POSTing header update %s to %s", payload, url)
+        try:
+            req = self.rs.post(url, json=payload, timeout=self.timeout)
+        except requests.RequestException:
+            self.l.warning("Exception posting header update to %s", url,
+                           exc_info=True)
+            return False
+
+        if req.status_code != http.HTTPStatus.OK:
+            self.l.warning("Bad HTTP status %s from header update post to %s",
+                           req.status_code, url)
+            return False
+
+        try:
+            result = json.loads(req.text)[0]
+        except (ValueError, TypeError, KeyError, IndexError):
+            self.l.warning("Cannot decode header update response: %s",
+                           req.text)
+            return False
+
+        if result.get('result') is not True:
+            self.l.info("Destination header update failed: %s",
+                        result.get('error'))
+            return False
+
+        self.l.info("Header update queued at destination %s as fileops id %s",
+                    eqe.destination, result.get('fileops_id'))
+        return True
 
     def file_transfer(self):
         """
@@ -237,9 +319,12 @@ class Exporter(object):
         # Note that we always export bz2 compressed data.
         fpfn = os.path.join(self.storage_root, path, filename)
         with open(fpfn, mode='rb') as f:
+            # If the file is already compressed, pass it through as it is.
+            # Either way, flo provides the size and md5sum of what we sent,
+            # for the verification.
             if filename.endswith('.bz2'):
                 destination_filename = filename
-                flo = f
+                flo = StreamBz2Compressor(f, passthrough=True)
             else:
                 destination_filename = filename + '.bz2'
                 flo = StreamBz2Compressor(f)
@@ -272,9 +357,7 @@ class Exporter(object):
             enddtime = utcnow()
 
             secs = (enddtime - starttime).total_seconds()
-            bytes_transferred = flo.bytes_output \
-                if isinstance(flo, StreamBz2Compressor) else flo.tell()
-            mbytes_transferred = bytes_transferred / 1048576
+            mbytes_transferred = flo.bytes_output / 1048576
 
             self.l.info(f"Transfer completed: {mbytes_transferred:.2f} MB "
                         f"in {secs:.1f} secs - "
@@ -292,11 +375,6 @@ class Exporter(object):
                 return
 
             # The response should be a short json document
-            if flo is f:
-                # Need to provide the extra properties that our bz2streamer
-                # provides that are used in the verification.
-                flo.bytes_output = os.path.getsize(fpfn)
-                flo.md5sum_output = md5sum(fpfn)
             try:
                 verification = json.loads(req.text)[0]
                 if verification['filename'] != destination_filename:
@@ -325,6 +403,15 @@ class Exporter(object):
             self.s.delete(self.eqe)
             self.s.commit()
 
+    def _defer(self, delay):
+        """
+        Put the export queue entry back on the queue, not to be tried again
+        for delay seconds, and commit the session.
+        """
+        self.eqe.after = utcnow() + datetime.timedelta(seconds=delay)
+        self.eqe.inprogress = False
+        self.s.commit()
+
     def get_df(self):
         """
         Find the diskfile we are exporting, and store it in the instance.
@@ -441,6 +528,75 @@ class Exporter(object):
                      self.destination_ingest_pending)
         return True
 
+    def get_destination_info_many(self, destination, files):
+        """
+        Get the destination file info for many files at once, by POSTing the
+        list of files to the jsonfilelist URL at the destination.
+
+        Parameters
+        ----------
+        destination - the destination server URL
+        files - list of (destination_path, filename) tuples
+
+        Returns
+        -------
+        A dictionary mapping (destination_path, filename) to (data_md5,
+        ingest_pending) tuples, which are (None, None) if the file is not at
+        the destination. Files we could not determine the info for are left
+        out, so that the caller falls back to querying them individually. That
+        includes all of them if the request fails, for example because the
+        destination is running an older version that does not support this.
+        """
+        def key(path, filename):
+            # Paths and filenames as used in the jsonfilelist filelist
+            filename = filename.removesuffix('.bz2')
+            return f"{path}/{filename}" if path else filename
+
+        # Obslogs have no header entries, so the POST jsonfilelist does not
+        # find them.
+        wanted = {key(path, filename): (path, filename)
+                  for path, filename in files if 'obslog' not in filename}
+        if not wanted:
+            return {}
+
+        url = f"{destination}/jsonfilelist"
+        try:
+            r = self.rs.post(url, json=sorted(wanted), timeout=self.timeout)
+        except requests.RequestException:
+            self.l.warning("Exception posting to %s", url, exc_info=True)
+            return {}
+
+        if r.status_code != http.HTTPStatus.OK:
+            self.l.info("Got HTTP status %s from %s, will query files "
+                        "individually", r.status_code, url)
+            return {}
+
+        try:
+            thelist = json.loads(r.text)
+            found = {}
+            for item in thelist:
+                k = key(item['path'], item['filename'])
+                found.setdefault(k, []).append(
+                    (item['data_md5'], item.get('pending_ingest', False)))
+        except (ValueError, TypeError, KeyError):
+            self.l.error("Error parsing json response from %s", url,
+                         exc_info=True)
+            return {}
+
+        info = {}
+        for k, file in wanted.items():
+            results = found.get(k, [])
+            if len(results) == 0:
+                info[file] = (None, None)
+            elif len(results) == 1:
+                info[file] = results[0]
+            # Otherwise, leave it out and let _get_destination_file_info()
+            # report the multiple results as an error.
+
+        self.l.debug("Got destination file info for %d of %d files from %s",
+                     len(info), len(files), destination)
+        return info
+
     def _delay_destination(self, delaysecs=300):
         # If the destination server is in a bad state, we need to prevent
         # rapid-fire failures, but also bear in mind we may be
@@ -463,11 +619,14 @@ class Exporter(object):
         )
         self.s.execute(stmt)
         self.s.commit()
+        if self.on_delay_destination is not None:
+            self.on_delay_destination(self.eqe.destination, after)
 
-    def _set_eqe_destination_path(self):
+    def _set_eqe_destination_path(self, eqe=None):
+        eqe = self.eqe if eqe is None else eqe
         for key in self.destination_path_map:
-            if re.fullmatch(key, self.eqe.path):
-                self.eqe.destination_path = self.destination_path_map[key]
+            if re.fullmatch(key, eqe.path):
+                eqe.destination_path = self.destination_path_map[key]
                 break
         else:
-            self.eqe.destination_path = self.eqe.path
\ No newline at end of file
+            eqe.destination_path = eqe.path
\ No newline at end of file
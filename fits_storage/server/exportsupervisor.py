@@ -0,0 +1,284 @@
+"""
+This module contains the ExportSupervisor class, which exports files using a
+pool of worker threads. This is used by service_export_queue.py when it is
+run with more than one worker.
+"""
+import threading
+import time
+from collections import Counter, defaultdict, deque
+
+from sqlalchemy.exc import OperationalError
+
+from fits_storage.db import sessionfactory
+from fits_storage.queues.queue.exportqueue import ExportQueue
+from fits_storage.queues.orm.exportqueueentry import ExportQueueEntry
+from fits_storage.server.exporter import Exporter
+from fits_storage import utcnow
+
+# Number of times to retry popping the queue after a database error, and the
+# initial delay in seconds between retries, which doubles with each retry.
+POP_RETRIES = 6
+POP_RETRY_DELAY = 0.05
+
+
+class ExportSupervisor(object):
+    """
+    Exporting a file is mostly waiting for the destination server - first to
+    tell us whether it already has the file, then to receive and verify it.
+    With a large backlog, exporting one file at a time is limited by that
+    latency rather than by bandwidth, so this class exports several files at
+    once.
+
+    The supervisor pops entries from the export queue, and hands them to a
+    bounded pool of worker threads. Each worker has its own database session
+    and its own Exporter, which keeps a requests session so that connections
+    to the destinations are kept alive between files.
+
+    Rather than each worker asking the destination about each file, the
+    supervisor pops a batch of entries and asks each destination about all
+    the files in the batch for it with one jsonfilelist request.
+
+    We limit the number of files being exported to each destination at once,
+    so that one slow destination cannot occupy all the workers and we don't
+    overwhelm the destinations. The workers only pick up a job for a
+    destination if it is below that limit. We keep up to twice that many
+    entries popped for each destination, and only pop more for a destination
+    once half of those are done, so that the destination checks stay batched.
+    When an exporter delays a destination because it is failing, we stop
+    popping files for it until the delay expires.
+    """
+    def __init__(self, session, logger, workers=4, destination_limit=2,
+                 batch_size=50, timeout=10):
+        """
+        Parameters
+        ----------
+        session - database session, used by the supervisor to pop the queue
+        logger - Fits Storage Logger
+        workers - number of worker threads
+        destination_limit - maximum number of files to be exporting to each
+            destination at once.
+        batch_size - maximum number of entries to pop for each batch of
+            destination checks.
+        timeout - timeout value to pass to the Exporters
+        """
+        self.s = session
+        self.l = logger
+        self.workers = workers
+        self.destination_limit = destination_limit
+        self.batch_size = batch_size
+        self.timeout = timeout
+
+        self.export_queue = ExportQueue(session, logger=logger)
+        # The supervisor uses this exporter for the destination checks
+        self.exporter = Exporter(session, logger, timeout=timeout)
+        self.threads = []
+
+        # Jobs waiting for a worker, per destination. Jobs are (eqe id,
+        # destination, destination_info). The number of entries popped but
+        # not finished, and the number being exported, per destination. The
+        # utc time until which destinations are delayed. These are all
+        # protected by self.lock, and we notify self.changed when we add jobs
+        # or a worker finishes one.
+        self.lock = threading.Lock()
+        self.changed = threading.Condition(self.lock)
+        self.waiting = defaultdict(deque)
+        self.inflight = Counter()
+        self.exporting = Counter()
+        self.delayed = {}
+        self.stopping = False
+
+    def start(self):
+        self.stopping = False
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._worker,
+                                      name=f"export-worker-{i}", daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    def stop(self):
+        """
+        Tell the workers to exit once the jobs they have been given are done,
+        and wait for them to do so.
+        """
+        with self.lock:
+            self.stopping = True
+            self.changed.notify_all()
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
+
+    def run(self, keep_going=lambda: True, empty=False, retry_delay=60):
+        """
+        Export files until keep_going() returns False, or until the queue is
+        empty if empty is True.
+        """
+        self.start()
+        try:
+            while keep_going():
+                if self.dispatch():
+                    continue
+
+                with self.lock:
+                    busy = sum(self.inflight.values())
+                    if busy:
+                        # Wait for a worker to make room for more
+                        self.changed.wait(1)
+                        continue
+
+                if empty:
+                    self.l.info("Nothing on queue and --empty flag set, "
+                                "exiting")
+                    break
+                self.l.info("Nothing on Queue... Waiting")
+                self.export_queue.wait(2)
+                # Mark any old failures for retry
+                self.export_queue.retry_failures(retry_delay)
+        finally:
+            self.stop()
+
+    def _excluded_destinations(self):
+        # Destinations that we should not pop entries for: those that are
+        # delayed, and those that have enough entries popped already.
+        # Call with self.lock held.
+        now = utcnow()
+        for destination, after in list(self.delayed.items()):
+            if after <= now:
+                del self.delayed[destination]
+        excluded = set(self.delayed)
+        excluded.update(d for d, n in self.inflight.items()
+                        if n > self.destination_limit)
+        return excluded
+
+    def dispatch(self):
+        """
+        Pop a batch of entries for the destinations that need more, check
+        which files are already at their destinations, and hand them to the
+        workers. Returns the number of entries dispatched.
+        """
+        with self.lock:
+            excluded = self._excluded_destinations()
+
+        popped = []
+        retries = 0
+        while len(popped) < self.batch_size:
+            with self.lock:
+                excluded.update(d for d, n in self.inflight.items()
+                                if n >= 2 * self.destination_limit)
+            filters = [ExportQueueEntry.destination.notin_(excluded)] \
+                if excluded else None
+            try:
+                eqe = self.export_queue.pop(filters=filters)
+            except OperationalError:
+                # Most likely a lock conflict with one of the workers, which
+                # happens with SQLite. Roll back and try again shortly.
+                retries += 1
+                if retries > POP_RETRIES:
+                    raise
+                self.l.warning("Database error popping export queue, "
+                               "retrying", exc_info=True)
+                self.s.rollback()
+                time.sleep(POP_RETRY_DELAY * 2 ** (retries - 1))
+                continue
+            if eqe is None:
+                break
+            with self.lock:
+                self.inflight[eqe.destination] += 1
+            self.exporter._set_eqe_destination_path(eqe)
+            popped.append((eqe.id, eqe.destination, eqe.destination_path,
+                           eqe.filename))
+            # The worker loads the entry in its own session.
+            self.s.expunge(eqe)
+
+        by_destination = defaultdict(list)
+        for item in popped:
+            by_destination[item[1]].append(item)
+
+        for destination, items in by_destination.items():
+            info = self.exporter.get_destination_info_many(
+                destination, [(path, filename)
+                              for _, _, path, filename in items])
+            with self.lock:
+                for eqe_id, _, path, filename in items:
+                    self.waiting[destination].append(
+                        (eqe_id, destination, info.get((path, filename))))
+                self.changed.notify_all()
+
+        if popped:
+            self.l.debug("Dispatched %d entries for %d destinations",
+                         len(popped), len(by_destination))
+        return len(popped)
+
+    def _delay_destination(self, destination, after):
+        with self.lock:
+            self.delayed[destination] = after
+
+    def _next_job(self):
+        # Return the next job for a worker, from the destination with the
+        # fewest exports in progress that is below its limit, or None if there
+        # are no jobs we can start. Call with self.lock held.
+        runnable = [d for d, jobs in self.waiting.items()
+                    if jobs and self.exporting[d] < self.destination_limit]
+        if not runnable:
+            return None
+        destination = min(runnable, key=lambda d: self.exporting[d])
+        self.exporting[destination] += 1
+        return self.waiting[destination].popleft()
+
+    def _worker(self):
+        session = sessionfactory()
+        exporter = Exporter(session, self.l, timeout=self.timeout)
+        exporter.on_delay_destination = self._delay_destination
+        try:
+            while True:
+                with self.lock:
+                    while (job := self._next_job()) is None:
+                        if self.stopping and not any(self.waiting.values()):
+                            return
+                        self.changed.wait()
+                eqe_id, destination, destination_info = job
+                try:
+                    self._export(session, exporter, eqe_id, destination,
+                                 destination_info)
+                finally:
+                    with self.lock:
+                        self.exporting[destination] -= 1
+                        self.inflight[destination] -= 1
+                        self.changed.notify_all()
+        finally:
+            session.close()
+
+    def _export(self, session, exporter, eqe_id, destination,
+                destination_info):
+        eqe = session.get(ExportQueueEntry, eqe_id)
+        if eqe is None:
+            self.l.debug("Export queue entry %d has gone away", eqe_id)
+            return
+
+        with self.lock:
+            delayed = destination in self.delayed
+        if delayed:
+            # Another worker delayed this destination after we were given
+            # this entry. The delay has already updated its after time, so
+            # just put it back on the queue.
+            self.l.info("Not exporting %s, %s is delayed", eqe.filename,
+                        destination)
+            eqe.inprogress = False
+            session.commit()
+            return
+
+        self.l.info("Exporting %s - %d", eqe.filename, eqe.id)
+        try:
+            # export_file() handles its own errors and should never raise.
+            exporter.export_file(eqe, destination_info=destination_info)
+        except Exception:
+            # If it does, we log the error and mark the entry as failed, as
+            # the error would likely reoccur if we retried it. Unlike
+            # service_export_queue.py, we carry on with the other files.
+            self.l.error("Unhandled Exception exporting %s", eqe.filename,
+                         exc_info=True)
+            session.rollback()
+            eqe = session.get(ExportQueueEntry, eqe_id)
+            if eqe is not None:
+                eqe.seterror(f"Exception in ExportSupervisor while "
+                             f"processing {eqe.filename}")
+                session.commit()
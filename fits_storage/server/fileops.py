@@ -164,8 +164,11 @@ def update_headers(args, session, logger):
     'release': 'YYYY-MM-DD' release date
     'generic': {'KEYWORD1': 'value1', ...}
     'reject_new': Bool - if True, then refuse to insert new keywords.
+    'md5_before': data_md5 that the file must have before the update. If it
+        does not, we raise FileOpsError without modifying the file. This is
+        used when replaying header updates exported from upstream servers.
 
-    We return the md5sum of the updated fits file. This goes into the 'value'
+    We return the data_md5 of the updated fits file. This goes into the 'value'
     field of the FileOpsResponse instance and is used when we export a file
     using update headers to avoid retransferring the entire file. If there's
     an error, we raise FileOpsError.
@@ -173,6 +176,96 @@ def update_headers(args, session, logger):
 
     logger.info("update_headers: %s", args)
 
+    fe = _open_fitseditor(args, session, logger)
+
+    if 'md5_before' in args and fe.diskfile.data_md5 != args['md5_before']:
+        # Don't close() the FitsEditor as that could rewrite the file
+        fe.diskfile.cleanup()
+        raise FileOpsError(f'data_md5 {fe.diskfile.data_md5} does not match '
+                           f'md5_before {args["md5_before"]}')
+
+    _apply_header_updates(fe, args, logger)
+    return _close_and_ingest(fe, session, logger)
+
+
+def update_headers_batch(args, session, logger):
+    """
+    Update headers on a batch of fits files. args must contain an 'updates'
+    key, which is a list of dictionaries each in the format of the
+    update_headers args.
+
+    Updates are grouped by their 'diskfile_id' if they have one, or otherwise
+    by their filename or data_label, so that each file is opened, written and
+    queued for ingest once, with the updates applied in the order given, even
+    if several updates refer to the same file. The web update_headers handler
+    adds the id of the present diskfile each update resolved to, so that
+    updates giving the same file by filename, with or without .bz2, or by
+    data label are grouped together. The file is opened using the filename or
+    data_label of the first update in each group.
+
+    We return a list with one dictionary for each file, containing 'id' (the
+    filename or data_label), 'result' (True or False), and either 'md5'
+    (the data_md5 of the updated file) or 'error'. A failure for one file does
+    not prevent the others being updated, so we never raise FileOpsError for
+    a failure updating an individual file.
+    """
+    updates = args.get('updates')
+    if not isinstance(updates, list):
+        raise FileOpsError('update_headers_batch args must contain a list of '
+                           'updates')
+
+    logger.info("update_headers_batch: %d updates", len(updates))
+
+    # dicts preserve insertion order, so we process files in the order they
+    # first appear in the updates.
+    groups = {}
+    for update in updates:
+        if 'diskfile_id' in update:
+            key = ('diskfile_id', update['diskfile_id'])
+        elif 'filename' in update:
+            key = ('filename', update['filename'])
+        elif 'data_label' in update:
+            key = ('data_label', update['data_label'])
+        else:
+            key = (None, None)
+        groups.setdefault(key, []).append(update)
+
+    results = []
+    for group in groups.values():
+        fe = None
+        keytype = 'filename' if 'filename' in group[0] else 'data_label'
+        keyvalue = group[0].get(keytype)
+        try:
+            if keyvalue is None:
+                raise FileOpsError('No filename or data_label in update')
+            logger.info("update_headers_batch: %d updates for %s %s",
+                        len(group), keytype, keyvalue)
+            fe = _open_fitseditor({keytype: keyvalue}, session, logger)
+            for update in group:
+                _apply_header_updates(fe, update, logger)
+            md5 = _close_and_ingest(fe, session, logger)
+            results.append({'id': keyvalue, 'result': True, 'md5': md5})
+        except FileOpsError as e:
+            logger.error("update_headers_batch failed for %s: %s", keyvalue, e)
+            results.append({'id': keyvalue, 'result': False, 'error': str(e)})
+        except Exception as e:
+            logger.error("update_headers_batch failed for %s", keyvalue,
+                         exc_info=True)
+            session.rollback()
+            results.append({'id': keyvalue, 'result': False, 'error': str(e)})
+        finally:
+            # Remove any uncompressed cache file the FitsEditor made, even if
+            # we didn't get as far as closing it.
+            if fe is not None and fe.diskfile is not None:
+                fe.diskfile.cleanup()
+    return results
+
+
+def _open_fitseditor(args, session, logger):
+    """
+    Instantiate a FitsEditor for the file given by the filename or data_label
+    in args. Raise FileOpsError if we cannot.
+    """
     if 'filename' in args:
         logger.debug("Instantiating FitsEditor on filename %s",
                      args['filename'])
@@ -189,7 +282,13 @@ def update_headers(args, session, logger):
 
     if fe.error is True:
         raise FileOpsError(f'Error instantiating FitsEditor: {fe.message}')
+    return fe
 
+
+def _apply_header_updates(fe, args, logger):
+    """
+    Apply the updates in the update_headers args to the FitsEditor fe
+    """
     if 'qa_state' in args:
         logger.debug("Updating qa_state: %s", args['qa_state'])
         fe.set_qa_state(args['qa_state'])
@@ -219,20 +318,45 @@ def update_headers(args, session, logger):
             logger.error('Unknown format for generic headers args: %s',
                          args['generic'])
 
+
+def _close_and_ingest(fe, session, logger):
+    """
+    Close the FitsEditor fe, writing the changes to the file, and queue the
+    file for ingest. Returns the data_md5 of the updated file.
+    """
     filename = fe.diskfile.filename
     path = fe.diskfile.path
+    md5_before = fe.diskfile.data_md5
+    size_before = fe.diskfile.data_size
     fe.close()
 
     if fe.error:
         raise FileOpsError(fe.message)
 
+    # If we only changed keywords in the primary header and the data size is
+    # unchanged (ie the header did not grow by a FITS block), pass the edits
+    # and the data md5s to the ingester as a hint that it can update the
+    # database from the changed keywords rather than fully re-ingesting the
+    # file.
+    header_update = fe.header_update
+    if header_update is None or fe.data_size != size_before:
+        header_update = md5_before = md5_after = file_md5_after = None
+    else:
+        md5_after = fe.data_md5
+        file_md5_after = fe.file_md5
+
     # Queue the file for ingest. Pass no_defer=True as we know the file is
     # complete and not still being modified
     iq = IngestQueue(session, logger)
-    iqe=iq.add(filename, path, no_defer=True)
+    iqe=iq.add(filename, path, no_defer=True, header_update=header_update,
+               md5_before_header_update=md5_before,
+               md5_after_header_update=md5_after,
+               file_md5_after_header_update=file_md5_after)
     if iqe:
         logger.info("Queued %s for Ingest", filename)
     else:
         logger.info("Queued %s for Ingest and got None - already on queue",
                     filename)
     session.commit()
+
+    return fe.data_md5
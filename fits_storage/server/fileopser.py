@@ -30,7 +30,7 @@ from fits_storage.queues.queue.fileopsqueue import FileOpsResponse
 from fits_storage.server.fileops import FileOpsError
 
 from .fileops import echo
-from .fileops import ingest_upload, update_headers
+from .fileops import ingest_upload, update_headers, update_headers_batch
 
 
 class FileOpser(object):
@@ -59,7 +59,8 @@ class FileOpser(object):
         self.workers = {
             'echo': echo,
             'ingest_upload': ingest_upload,
-            'update_headers': update_headers
+            'update_headers': update_headers,
+            'update_headers_batch': update_headers_batch
         }
 
         # These are per-operation values stored centrally for convenience.
@@ -1,10 +1,11 @@
 import astropy.io.fits
-import bz2
 from time import strptime
 
 from sqlalchemy.exc import NoResultFound, MultipleResultsFound
 
 from fits_storage.logger_dummy import DummyLogger
+from fits_storage.server.bz2multistream import HeaderOnlyEditor, \
+    write_multistream, md5sums
 from fits_storage.core.orm.file import File
 from fits_storage.core.orm.diskfile import DiskFile
 from fits_storage.core.orm.header import Header
@@ -45,6 +46,20 @@ class FitsEditor(object):
     methods to modify the headers. The class will take care of all the details
     such as S3, bz2, etc.
 
+    Where possible, we edit just the headers in place using HeaderOnlyEditor,
+    in which case hdulist is the HeaderOnlyEditor instance. This is possible
+    for uncompressed files and for bz2 files that are stored as multi-stream
+    files with the headers in separate streams (see bz2multistream.py).
+    Otherwise, or if we need an extension header that is not available that
+    way, we decompress the whole file and open it with astropy, and hdulist
+    is an astropy HDUList. When we write bz2 files out in that case, we write
+    them as multi-stream files so that subsequent edits are header-only.
+
+    After close(), file_md5, file_size, data_md5 and data_size contain the
+    values for the modified file, and header_update describes the edits made,
+    so that the caller can pass them to the ingester as a hint that only the
+    headers have changed.
+
     This class can be used as a context manager.
     """
     searchkey = None
@@ -53,6 +68,11 @@ class FitsEditor(object):
     message = None
     localfile = None
     hdulist = None
+    header_editor = None
+    file_md5 = None
+    file_size = None
+    data_md5 = None
+    data_size = None
 
     def __init__(self, filename=None, datalabel=None, session=None,
                  logger=DummyLogger(), do_setup=True):
@@ -62,6 +82,9 @@ class FitsEditor(object):
         self.logger = logger
         self.error = False
         self.message = ''
+        # List of (ext, keyword, value) edits made, in case we need to replay
+        # them when switching from header-only to full file editing
+        self.edits = []
         if filename is None and datalabel is None:
             self.error = True
             self.message = "Must provide either filename or datalabel. "
@@ -71,8 +94,10 @@ class FitsEditor(object):
         # This is here to support alternate setups for testing.
         if do_setup:
             self._find_diskfile()
-            self._get_localfile()
-            self._get_hdulist()
+            self._get_header_editor()
+            if self.header_editor is None:
+                self._get_localfile()
+                self._get_hdulist()
 
     def __enter__(self, filename=None, datalabel=None, logger=DummyLogger()):
         self.__init__(filename=filename, datalabel=datalabel, logger=logger)
@@ -119,6 +144,80 @@ class FitsEditor(object):
                               self.diskfile.id, self.diskfile.path,
                               self.diskfile.filename)
 
+    def _setup_diskfile(self):
+        # We need to set these values here for get_uncompressed_file etc.
+        # to work as __init__ hasn't been called on this diskfile instance.
+        # However, these may have been set by the testing framework
+        fsc = get_config()
+
+        self.diskfile._storage_root = fsc.storage_root if \
+            self.diskfile._storage_root is None else \
+            self.diskfile._storage_root
+
+        self.diskfile._z_staging_dir = fsc.z_staging_dir if \
+            self.diskfile._z_staging_dir is None else \
+            self.diskfile._z_staging_dir
+
+        self.diskfile._logger = self.logger
+
+    def _get_header_editor(self):
+        """
+        Set up for header-only editing, if the file supports it. If not,
+        header_editor is left as None and the caller should fall back to
+        _get_localfile() and _get_hdulist()
+        """
+        fsc = get_config()
+
+        if self.error is True or fsc.using_s3:
+            return
+
+        self._setup_diskfile()
+        fullpath = self.diskfile.fullpath
+        try:
+            if HeaderOnlyEditor.can_edit(fullpath, self.diskfile.compressed):
+                self.header_editor = HeaderOnlyEditor(fullpath,
+                                                      self.diskfile.compressed)
+                self.hdulist = self.header_editor
+                self.logger.debug("FitsEditor editing headers only: %s",
+                                  fullpath)
+            else:
+                self.logger.debug("FitsEditor cannot edit headers only, bz2 "
+                                  "file is not multi-stream: %s", fullpath)
+        except Exception:
+            self.logger.debug("FitsEditor cannot edit headers only: %s",
+                              fullpath, exc_info=True)
+            self.header_editor = None
+
+    def _use_full_file(self):
+        """
+        Switch from header-only editing to decompressing and opening the
+        whole file, replaying any edits made so far.
+        """
+        self.logger.debug("FitsEditor switching to full file editing")
+        self.header_editor = None
+        self.hdulist = None
+        self._get_localfile()
+        self._get_hdulist()
+        if self.error is not True:
+            for ext, keyword, value in self.edits:
+                self.hdulist[ext].header[keyword] = value
+
+    def _hdu(self, ext):
+        """
+        Get the HDU (or stand-in with a .header) for extension ext.
+        """
+        try:
+            return self.hdulist[ext]
+        except IndexError:
+            if self.header_editor is None:
+                raise
+        self._use_full_file()
+        return self.hdulist[ext]
+
+    def _set(self, ext, keyword, value):
+        self._hdu(ext).header[keyword] = value
+        self.edits.append((ext, keyword, value))
+
     def _get_localfile(self):
         fsc = get_config()
 
@@ -138,19 +237,7 @@ class FitsEditor(object):
         # Note, we need to take care of deleting the uncompressed_cache_file
         # once we're done! We do this by calling diskfile.cleanup()
 
-        # We need to set these values here for get_uncompressed_file etc.
-        # to work as __init__ hasn't been called on this diskfile instance.
-        # However, these may have been set by the testing framework
-
-        self.diskfile._storage_root = fsc.storage_root if \
-            self.diskfile._storage_root is None else \
-            self.diskfile._storage_root
-
-        self.diskfile._z_staging_dir = fsc.z_staging_dir if \
-            self.diskfile._z_staging_dir is None else \
-            self.diskfile._z_staging_dir
-
-        self.diskfile._logger = self.logger
+        self._setup_diskfile()
 
         # Note, this will return the path to the diskfile itself if it is not
         # compressed. If it is compressed, it's a tmpfile containing the
@@ -189,33 +276,49 @@ class FitsEditor(object):
             # Will have errored as not implemented on open
             return
 
+        # The size and md5s of the file we write, which we work out as we
+        # write it, rather than reading it all back afterwards
+        sums = None
+
+        if self.header_editor is not None:
+            result = self.header_editor.write()
+            self.logger.info("FitsEditor header-only update of %s: %s",
+                             self.diskfile.fullpath, result)
+            if result == 'unchanged':
+                sums = (self.diskfile.file_size, self.diskfile.file_md5,
+                        self.diskfile.data_size, self.diskfile.data_md5)
+            else:
+                sums = self.header_editor.md5sums
+            self.header_editor = None
+            self.hdulist = None
+
         if self.hdulist is not None:
             # Remember, the file behind the hdulist is either the diskfile file
             # itself in storage_root, or the diskfile uncompressed_cache_file
 
-            # If the diskfile was compressed, we're using a cache file, and we
-            # now need to write a compressed copy back in place of the original
-            # (compressed) file in the storage_root
-            if self.diskfile.compressed:
-                # Write the hdulist to the compressed file.
-                # Note, in astropy 6.x, io.fits can write the bz2 file directly.
-                # Note this is not the S3 case
-                self.logger.info("FitsEditor writing bz2 compressed file: %s",
-                                 self.diskfile.fullpath)
-                with bz2.open(self.diskfile.fullpath, mode='wb') as f:
-                    self.hdulist.writeto(f)
-
             # Note, this calls hdulist.flush() as we are in mode = 'update'.
-            # The flush is pointless if we're in compressed mode as we just
-            # wrote it all out to a new file anyway, but we still need to close
-            # the uncompressed_cache_file and it's cheap to flush as it's
-            # uncompressed.
             # If we're not in compressed mode, this is the actual file update
             # with the changes we made going directly to the fits file.
-            # TODO - check if this is still the case in astropy 6.x
+            # If we are in compressed mode, this updates the
+            # uncompressed_cache_file, which we then compress back in place
+            # of the original file below.
             self.logger.debug("Closing hdulist: %s", self.hdulist.filename())
             self.hdulist.close()
 
+            # If the diskfile was compressed, we're using a cache file, and we
+            # now need to write a compressed copy back in place of the original
+            # (compressed) file in the storage_root. We write it as a
+            # multi-stream file so that future edits can be header-only.
+            # Note this is not the S3 case
+            if self.diskfile.compressed:
+                self.logger.info("FitsEditor writing bz2 compressed file: %s",
+                                 self.diskfile.fullpath)
+                with open(self.localfile, mode='rb') as src, \
+                        open(self.diskfile.fullpath, mode='wb') as dest:
+                    sums = write_multistream(
+                        src, dest,
+                        split_extensions=fsc.multistream_split_extensions)
+
         # If we were using an uncompressed_cache_file, delete it now. Note that
         # this can be the case even if self.hdulist is None - ie we failed to
         # instantiate an hdulist for some reason.
@@ -223,6 +326,26 @@ class FitsEditor(object):
         # This deletes the uncompressed_cache_file if we are using one.
         self.diskfile.cleanup()
 
+        if self.edits and not self.error:
+            if sums is None:
+                # astropy updated the uncompressed file in place. It's not
+                # compressed, so this is just reading it.
+                sums = md5sums(self.diskfile.fullpath, False)
+            self.file_size, self.file_md5, self.data_size, self.data_md5 = \
+                sums
+
+    @property
+    def header_update(self):
+        """
+        The edits made, as a header update dictionary in the 'generic' format
+        accepted by update_headers, or None if there were no edits or if any
+        of them were to extension headers, which that format cannot express.
+        """
+        if not self.edits or any(ext != 0 for ext, _, _ in self.edits):
+            return None
+        return {'generic': [[keyword, value]
+                            for _, keyword, value in self.edits]}
+
     def set_qa_state(self, qa_state):
         if qa_state is None or (qa_state := qa_state.lower()) not in \
                 qa_states.keys():
@@ -231,7 +354,7 @@ class FitsEditor(object):
             self.logger.error(self.message)
             return False
         for keyword in qa_states[qa_state]:
-            self.hdulist[0].header[keyword] = qa_states[qa_state][keyword]
+            self._set(0, keyword, qa_states[qa_state][keyword])
         return True
 
     def set_release(self, release):
@@ -242,7 +365,7 @@ class FitsEditor(object):
             self.error = True
             self.message += f'Invalid Release date: {release}. '
             return False
-        self.hdulist[0].header['RELEASE'] = release
+        self._set(0, 'RELEASE', release)
         return True
 
     def set_rawsite(self, rawsite):
@@ -252,11 +375,11 @@ class FitsEditor(object):
             self.message += f'Invalid Raw Site Quality state: {rawsite}. '
             return False
         for keyword in rawsite_states[rawsite]:
-            self.hdulist[0].header[keyword] = rawsite_states[rawsite][keyword]
+            self._set(0, keyword, rawsite_states[rawsite][keyword])
         return True
 
     def set_header(self, keyword, value, ext=0, reject_new=False):
-        if keyword not in self.hdulist[ext].header and reject_new:
+        if keyword not in self._hdu(ext).header and reject_new:
             self.error = True
             self.message += f"keyword {keyword} is new and reject_new = True. "
             return False
@@ -264,5 +387,5 @@ class FitsEditor(object):
             self.error = True
             self.message += f"Invalid keyword: {keyword}. "
             return False
-        self.hdulist[ext].header[keyword] = value
+        self._set(ext, keyword, value)
         return True
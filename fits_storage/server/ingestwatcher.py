@@ -0,0 +1,204 @@
+"""
+This module contains the IngestWatcher class, which watches directories in
+the storage_root with inotify and adds new or modified files to the ingest
+queue. This is used by the ingest_watcher.py service script.
+"""
+import datetime
+import os
+import time
+
+from fits_storage.core.orm.diskfile import DiskFile
+from fits_storage.queues.queue.ingestqueue import IngestQueue, skip_file
+from fits_storage.server.inotify import Inotify, IN_CLOSE_WRITE, \
+    IN_MOVED_TO, IN_Q_OVERFLOW, IN_IGNORED, IN_ISDIR, IN_ONLYDIR
+
+from fits_storage.config import get_config
+
+
+class IngestWatcher(object):
+    """
+    Watch directories in the storage_root and add files to the ingest queue
+    when they are written or moved into them, rather than repeatedly scanning
+    the directories with add_to_ingest_queue.py.
+
+    We watch for IN_CLOSE_WRITE and IN_MOVED_TO events. Files often get
+    several events in quick succession, and files generally arrive in bursts,
+    so we collect events and add them to the ingest queue in one go with
+    IngestQueue.add_many() once no more events have arrived for debounce
+    seconds, or max_delay seconds after the first pending event if they
+    keep coming.
+
+    We do not get events for files that arrived while we were not running, or
+    if the kernel event queue overflows, so we reconcile() the directories
+    with the database on startup and after an overflow. That is a single
+    scandir pass over each directory, adding files that are not in the
+    database or have a different lastmod to the queue.
+    """
+    mask = IN_CLOSE_WRITE | IN_MOVED_TO | IN_ONLYDIR
+
+    def __init__(self, session, logger, paths=('',), debounce=2.0,
+                 max_delay=30.0, force=False, force_md5=False):
+        """
+        Parameters
+        ----------
+        session - SQLAlchemy session
+        logger - a FitsStorageLogger instance
+        paths - directories to watch, relative to the storage_root
+        debounce - wait until there have been no events for this many
+            seconds before adding the pending files to the ingest queue
+        max_delay - do not wait more than this many seconds after the first
+            pending event before adding files to the ingest queue.
+        force, force_md5 - passed to the ingest queue.
+        """
+        fsc = get_config()
+        self.session = session
+        self.logger = logger
+        self.storage_root = fsc.storage_root
+        self.paths = list(paths)
+        self.debounce = debounce
+        self.max_delay = max_delay
+        self.force = force
+        self.force_md5 = force_md5
+
+        self.ingest_queue = IngestQueue(session, logger=logger)
+        self.inotify = None
+        self.watches = {}
+
+        # (filename, path) of files with events that are not queued yet, and
+        # the time.monotonic() of the first and most recent of those events.
+        self.pending = set()
+        self.first_event = None
+        self.last_event = None
+
+    def start(self):
+        """
+        Set up the inotify watches and reconcile the watched directories.
+        The watches are in place before we reconcile, so we don't miss files
+        that arrive while we are doing that.
+        """
+        self.inotify = Inotify()
+        for path in self.paths:
+            fullpath = os.path.join(self.storage_root, path)
+            wd = self.inotify.add_watch(fullpath, self.mask)
+            self.watches[wd] = path
+            self.logger.info("Watching %s for new files", fullpath)
+        self.reconcile()
+
+    def stop(self):
+        self.flush()
+        if self.inotify is not None:
+            self.inotify.close()
+            self.inotify = None
+        self.watches = {}
+
+    def reconcile(self):
+        """
+        Scan the watched directories and add any files that are not in the
+        database, or have a different lastmod than the database has, to the
+        ingest queue. Returns the number of files added to the queue.
+        """
+        added = 0
+        for path in self.paths:
+            fullpath = os.path.join(self.storage_root, path)
+            self.logger.info("Reconciling %s with the database", fullpath)
+
+            # The DiskFile lastmods are the local time mtimes of the files
+            known = dict(self.session.query(DiskFile.filename, DiskFile.lastmod)
+                         .filter(DiskFile.present == True)
+                         .filter(DiskFile.path == path))
+
+            files = []
+            with os.scandir(fullpath) as it:
+                for entry in it:
+                    if skip_file(entry.name) or not entry.is_file():
+                        continue
+                    lastmod = known.get(entry.name)
+                    if lastmod is not None and \
+                            lastmod.replace(tzinfo=None) == \
+                            datetime.datetime.fromtimestamp(
+                                entry.stat().st_mtime):
+                        continue
+                    files.append((entry.name, path))
+
+            n = self.ingest_queue.add_many(files, force=self.force,
+                                           force_md5=self.force_md5)
+            self.logger.info("Found %d new or modified files in %s, added %d "
+                             "to the ingest queue", len(files), fullpath, n)
+            added += n
+        return added
+
+    def handle_events(self, timeout):
+        """
+        Wait up to timeout seconds for inotify events, and handle them.
+        """
+        for event in self.inotify.read(timeout):
+            if event.mask & IN_Q_OVERFLOW:
+                self.logger.warning("inotify event queue overflowed, "
+                                    "reconciling watched directories")
+                self.flush()
+                self.reconcile()
+                continue
+
+            if event.mask & IN_IGNORED:
+                # The watched directory went away, eg it was unmounted
+                path = self.watches.pop(event.wd, None)
+                self.logger.error("Watch on storage_root path '%s' was "
+                                  "removed", path)
+                continue
+
+            if event.mask & IN_ISDIR:
+                continue
+
+            path = self.watches.get(event.wd)
+            if path is None or skip_file(event.name):
+                self.logger.debug("Ignoring event on %s", event.name)
+                continue
+
+            self.logger.debug("inotify event on %s / %s", path, event.name)
+            now = time.monotonic()
+            if not self.pending:
+                self.first_event = now
+            self.last_event = now
+            self.pending.add((event.name, path))
+
+    def flush_due(self):
+        """
+        Returns True if there are pending files that should be added to the
+        ingest queue now.
+        """
+        if not self.pending:
+            return False
+        now = time.monotonic()
+        return now - self.last_event >= self.debounce or \
+            now - self.first_event >= self.max_delay
+
+    def flush(self):
+        """
+        Add any pending files to the ingest queue. Returns the number of
+        files added to the queue.
+        """
+        if not self.pending:
+            return 0
+        files = sorted(self.pending)
+        self.pending = set()
+        added = self.ingest_queue.add_many(files, force=self.force,
+                                           force_md5=self.force_md5)
+        self.logger.info("Added %d of %d files to the ingest queue", added,
+                         len(files))
+        return added
+
+    def poll(self, timeout=1.0):
+        """
+        Handle events for up to timeout seconds, and add pending files to the
+        ingest queue if it's time to. This is what the service script calls
+        in its main loop.
+        """
+        if self.pending:
+            # Don't wait past when the pending files are due
+            now = time.monotonic()
+            due = min(self.last_event + self.debounce,
+                      self.first_event + self.max_delay)
+            timeout = max(0, min(timeout, due - now))
+        self.handle_events(timeout)
+        if self.flush_due():
+            self.flush()
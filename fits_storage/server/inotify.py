@@ -0,0 +1,130 @@
+"""
+A minimal interface to the Linux inotify API, using ctypes to call the libc
+inotify functions directly, so that we don't need an external package for it.
+"""
+import ctypes
+import ctypes.util
+import errno
+import os
+import select
+import struct
+from collections import namedtuple
+
+# Event mask bits, from sys/inotify.h
+IN_ACCESS = 0x00000001
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_CLOSE_NOWRITE = 0x00000010
+IN_OPEN = 0x00000020
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_UNMOUNT = 0x00002000
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+
+IN_CLOEXEC = 0o2000000
+IN_NONBLOCK = 0o4000
+
+# struct inotify_event {int wd; uint32_t mask; uint32_t cookie; uint32_t len;
+# char name[]}
+_EVENT_HEADER = struct.Struct('iIII')
+
+# Big enough for a good number of events per read(). The kernel queue length
+# is limited by /proc/sys/fs/inotify/max_queued_events, not by this.
+READ_SIZE = 64 * 1024
+
+InotifyEvent = namedtuple('InotifyEvent', ['wd', 'mask', 'cookie', 'name'])
+
+
+class InotifyError(OSError):
+    pass
+
+
+_libc = None
+
+
+def _get_libc():
+    global _libc
+    if _libc is None:
+        _libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6',
+                            use_errno=True)
+        for name in ('inotify_init1', 'inotify_add_watch', 'inotify_rm_watch'):
+            if not hasattr(_libc, name):
+                raise InotifyError(errno.ENOSYS, 'inotify is not available')
+    return _libc
+
+
+def _check(result, what):
+    if result < 0:
+        err = ctypes.get_errno()
+        raise InotifyError(err, f"{what}: {os.strerror(err)}")
+    return result
+
+
+class Inotify(object):
+    """
+    An inotify instance. Use add_watch() to watch directories or files, then
+    read() to get the events on them.
+    """
+    def __init__(self):
+        libc = _get_libc()
+        self._libc = libc
+        self.fd = _check(libc.inotify_init1(IN_CLOEXEC | IN_NONBLOCK),
+                         'inotify_init1')
+
+    def fileno(self):
+        return self.fd
+
+    def add_watch(self, path, mask):
+        """
+        Add a watch on path for the events in mask. Returns the watch
+        descriptor, which is the wd value in the events for this path.
+        """
+        return _check(self._libc.inotify_add_watch(self.fd, os.fsencode(path),
+                                                   ctypes.c_uint32(mask)),
+                      f"inotify_add_watch {path}")
+
+    def rm_watch(self, wd):
+        _check(self._libc.inotify_rm_watch(self.fd, wd), 'inotify_rm_watch')
+
+    def read(self, timeout=None):
+        """
+        Wait up to timeout seconds (forever if None) for events, and return a
+        list of InotifyEvents, which will be empty if we timed out.
+        """
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return []
+        try:
+            data = os.read(self.fd, READ_SIZE)
+        except BlockingIOError:
+            return []
+        return list(self.parse(data))
+
+    @staticmethod
+    def parse(data):
+        offset = 0
+        while offset < len(data):
+            wd, mask, cookie, length = _EVENT_HEADER.unpack_from(data, offset)
+            offset += _EVENT_HEADER.size
+            name = data[offset:offset + length].rstrip(b'\0')
+            offset += length
+            yield InotifyEvent(wd, mask, cookie, os.fsdecode(name))
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
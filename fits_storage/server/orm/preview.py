@@ -11,6 +11,11 @@ class Preview(Base):
     """
     This is the ORM object for the preview table. Use this to find preview
     (jpeg) files for a given diskfile.
+
+    As well as the full size preview, there may be smaller versions of it,
+    which are named with the size appended to the preview filename, eg
+    N20200101S0001_128.jpg. sizes is a comma separated list of the sizes
+    that there are, or None if there are no smaller versions.
     """
     __tablename__ = 'preview'
 
@@ -18,6 +23,7 @@ class Preview(Base):
     diskfile_id = Column(Integer, ForeignKey('diskfile.id'), nullable=False,
                          index=True)
     filename = Column(Text)
+    sizes = Column(Text)
     diskfile = relationship("DiskFile")
 
     def __init__(self, diskfile, preview_filename: str):
@@ -34,3 +40,31 @@ class Preview(Base):
         """
         self.diskfile_id = diskfile.id
         self.filename = preview_filename
+
+    @staticmethod
+    def sized_filename(filename, size):
+        """
+        The filename of the size version of the preview file filename
+        """
+        base, ext = filename.rsplit('.', 1)
+        return f"{base}_{size}.{ext}"
+
+    @property
+    def sizelist(self):
+        """
+        List of the sizes of the smaller versions of this preview
+        """
+        return [int(size) for size in self.sizes.split(',')] \
+            if self.sizes else []
+
+    def filename_for_size(self, size=None):
+        """
+        Returns the filename of the smallest version of the preview that is
+        at least size pixels, or the full size preview if there isn't one or
+        size is None.
+        """
+        if size is not None:
+            for available in sorted(self.sizelist):
+                if available >= size:
+                    return self.sized_filename(self.filename, available)
+        return self.filename
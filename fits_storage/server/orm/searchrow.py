@@ -0,0 +1,244 @@
+"""
+This module defines the SearchRow ORM class and the code that maintains it.
+
+The search_row table is an optional denormalized projection of the header,
+diskfile and file tables - one row per header, containing the header columns
+along with the diskfile present / canonical flags and the other diskfile
+columns used in summaries. Common searches can then be answered with a
+single table indexed scan rather than a three-way join.
+
+The table is kept up to date by ORM event listeners on Header and DiskFile,
+so that everything that adds headers (the ingester) or modifies them or their
+diskfiles (header updates, marking files not present etc) maintains it
+without needing to know about it. These only do anything if using_search_row
+is set in the configuration. rebuild_search_row.py rebuilds and checks the
+table.
+"""
+from sqlalchemy import Table, Column, ForeignKey, Integer, Text, event, \
+    select, insert, delete, update, or_
+from sqlalchemy.sql import visitors
+from sqlalchemy.sql.elements import ColumnClause
+
+from fits_storage.core.orm import Base
+from fits_storage.core.orm.file import File
+from fits_storage.core.orm.diskfile import DiskFile
+from fits_storage.core.orm.header import Header
+
+from fits_storage.config import get_config
+
+# Header columns mirrored into search_row. These are all the header columns
+# except id and diskfile_id, which become header_id and diskfile_id.
+HEADER_COLUMNS = tuple(c.name for c in Header.__table__.columns
+                       if c.name not in ('id', 'diskfile_id'))
+
+# DiskFile columns mirrored into search_row.
+DISKFILE_COLUMNS = ('filename', 'path', 'present', 'canonical', 'compressed',
+                    'file_size', 'data_size', 'file_md5', 'data_md5',
+                    'lastmod', 'entrytime', 'mdready', 'fverrors')
+
+# Columns that get their own index in search_row. These are the commonly
+# searched and sorted on columns.
+INDEXED_COLUMNS = {'program_id', 'observation_id', 'data_label', 'telescope',
+                   'instrument', 'ut_datetime', 'observation_type',
+                   'observation_class', 'filter_name', 'disperser',
+                   'focal_plane_mask', 'qa_state', 'processing_tag',
+                   'object_norm', 'htm_id', 'filename', 'present',
+                   'canonical', 'entrytime', 'lastmod', 'engineering',
+                   'science_verification'}
+
+# Selection keys that need joins to tables that are not in search_row. We
+# fall back to the normal header query for these.
+UNSUPPORTED_SELECTION_KEYS = {'publication', 'PIname', 'ProgramText',
+                              'gpi_astrometric_standard'}
+
+search_row_table = Table(
+    'search_row', Base.metadata,
+    Column('header_id', Integer, ForeignKey('header.id', ondelete='CASCADE'),
+           primary_key=True),
+    Column('diskfile_id', Integer, nullable=False, index=True),
+    Column('file_name', Text, index=True),
+    *[Column(name, DiskFile.__table__.c[name].type,
+             index=name in INDEXED_COLUMNS) for name in DISKFILE_COLUMNS],
+    *[Column(name, Header.__table__.c[name].type,
+             index=name in INDEXED_COLUMNS) for name in HEADER_COLUMNS]
+)
+
+
+class SearchRow(Base):
+    """
+    This is the ORM class for the search_row table. See the module docstring.
+
+    For convenience, the id attribute is a synonym for header_id, so that
+    SearchRow instances can be used in place of Header instances by code
+    that only needs the header columns.
+    """
+    __table__ = search_row_table
+
+    @property
+    def id(self):
+        return self.header_id
+
+    def __repr__(self):
+        return "<SearchRow('%s', '%s')>" % (self.header_id, self.filename)
+
+
+# Map from header, diskfile and file table columns to search_row columns
+_column_map = {}
+for _name in HEADER_COLUMNS:
+    _column_map[('header', _name)] = search_row_table.c[_name]
+for _name in DISKFILE_COLUMNS:
+    _column_map[('diskfile', _name)] = search_row_table.c[_name]
+_column_map[('header', 'id')] = search_row_table.c.header_id
+_column_map[('header', 'diskfile_id')] = search_row_table.c.diskfile_id
+_column_map[('diskfile', 'id')] = search_row_table.c.diskfile_id
+_column_map[('file', 'name')] = search_row_table.c.file_name
+
+
+def _source_select():
+    """
+    A select statement that generates search_row rows from the header,
+    diskfile and file tables, in the column order of the search_row table.
+    """
+    columns = [Header.__table__.c.id, DiskFile.__table__.c.id,
+               File.__table__.c.name]
+    columns += [DiskFile.__table__.c[name] for name in DISKFILE_COLUMNS]
+    columns += [Header.__table__.c[name] for name in HEADER_COLUMNS]
+    return select(*columns)\
+        .select_from(Header.__table__)\
+        .join(DiskFile.__table__,
+              Header.__table__.c.diskfile_id == DiskFile.__table__.c.id)\
+        .join(File.__table__, DiskFile.__table__.c.file_id == File.__table__.c.id)
+
+
+def _insert_from(source):
+    return insert(search_row_table).from_select(
+        [c.name for c in search_row_table.columns], source)
+
+
+def refresh_search_rows(connection, header_ids):
+    """
+    (Re)build the search_row rows for the given header ids from the header,
+    diskfile and file tables.
+
+    Parameters
+    ----------
+    connection : SQLAlchemy connection or session
+    header_ids : list of int
+    """
+    if not header_ids:
+        return
+    connection.execute(delete(search_row_table)
+                       .where(search_row_table.c.header_id.in_(header_ids)))
+    source = _source_select().where(Header.__table__.c.id.in_(header_ids))
+    connection.execute(_insert_from(source))
+
+
+def rebuild_search_rows(connection):
+    """
+    Rebuild the entire search_row table from the header, diskfile and file
+    tables.
+    """
+    connection.execute(delete(search_row_table))
+    connection.execute(_insert_from(_source_select()))
+
+
+def inconsistent_search_rows(connection):
+    """
+    Find header ids for which the search_row table is inconsistent with the
+    header, diskfile and file tables.
+
+    Returns
+    -------
+    (missing, extra, different) - three lists of header ids. missing are
+    headers that have no search_row, extra are search_rows for headers that
+    do not exist, different are search_rows with values that do not match.
+    """
+    sr = search_row_table
+    hdr = Header.__table__
+    source = _source_select().subquery()
+
+    missing = connection.execute(
+        select(hdr.c.id).where(~hdr.c.id.in_(select(sr.c.header_id)))
+    ).scalars().all()
+
+    extra = connection.execute(
+        select(sr.c.header_id).where(~sr.c.header_id.in_(select(hdr.c.id)))
+    ).scalars().all()
+
+    # Source columns are in the same order as the search_row columns
+    comparisons = [sc.is_distinct_from(src)
+                   for sc, src in zip(list(sr.columns)[1:],
+                                      list(source.columns)[1:])]
+    different = connection.execute(
+        select(sr.c.header_id)
+        .join(source, list(source.columns)[0] == sr.c.header_id)
+        .where(or_(*comparisons))
+    ).scalars().all()
+
+    return missing, extra, different
+
+
+def searchrow_criteria(selection, ignore_processing_tag=False):
+    """
+    Translate the filter criteria for a selection into criteria on the
+    search_row table.
+
+    Returns None if the selection cannot be answered from the search_row
+    table, in which case the caller should use the normal header query.
+    """
+    if UNSUPPORTED_SELECTION_KEYS & set(selection.keys()):
+        return None
+
+    stmt = select(Header.id).select_from(Header).join(DiskFile).join(File)
+    stmt = selection.filter(stmt, ignore_processing_tag=ignore_processing_tag)
+    if stmt.whereclause is None:
+        return True
+    return translate_to_search_row(stmt.whereclause)
+
+
+def translate_to_search_row(clause):
+    """
+    Translate an SQLAlchemy clause referring to header, diskfile and file
+    columns into one referring to the equivalent search_row columns.
+
+    Returns None if the clause refers to any column that is not in search_row.
+    """
+    unmapped = []
+
+    def replace(element):
+        if isinstance(element, ColumnClause) and element.table is not None:
+            key = (getattr(element.table, 'name', None), element.name)
+            if key in _column_map:
+                return _column_map[key]
+            unmapped.append(key)
+        return None
+
+    translated = visitors.replacement_traverse(clause, {}, replace)
+    if unmapped:
+        return None
+    return translated
+
+
+# Event listeners to maintain the search_row table. These check the
+# configuration when they fire rather than when they are registered.
+@event.listens_for(Header, 'after_insert')
+@event.listens_for(Header, 'after_update')
+def _header_changed(mapper, connection, target):
+    if get_config().using_search_row:
+        refresh_search_rows(connection, [target.id])
+
+
+@event.listens_for(Header, 'before_delete')
+def _header_deleted(mapper, connection, target):
+    if get_config().using_search_row:
+        connection.execute(delete(search_row_table)
+                           .where(search_row_table.c.header_id == target.id))
+
+
+@event.listens_for(DiskFile, 'after_update')
+def _diskfile_changed(mapper, connection, target):
+    if get_config().using_search_row:
+        values = {name: getattr(target, name) for name in DISKFILE_COLUMNS}
+        connection.execute(update(search_row_table)
+                           .where(search_row_table.c.diskfile_id == target.id)
+                           .values(values))
@@ -65,6 +65,8 @@ class TapeWrite(Base):
     hostname = Column(Text)
     tapedrive = Column(Text)
     notes = Column(Text)
+    # Size of the blocks the tar archive was written in, if known
+    blocksize = Column(Integer)
 
     tapefiles = relationship('TapeFile')
 
@@ -86,6 +88,11 @@ class TapeFile(Base):
     data_size = Column(BigInteger)
     data_md5 = Column(Text)
     lastmod = Column(DateTime(timezone=True), index=True)
+    # Offset in bytes of the tar header(s) of this member from the start of
+    # the tar archive, and the number of the tape block that is in. These
+    # allow us to go directly to the member when reading the tape.
+    offset = Column(BigInteger)
+    block = Column(Integer)
 
 
 class TapeRead(Base):
@@ -0,0 +1,136 @@
+"""
+This module contains numpy functions for rendering preview images, and for
+encoding them as jpeg or png files with Pillow. These are used by the
+Previewer class when the preview_renderer configuration setting is 'pillow'.
+
+Preview images are small compared to the data, so we reduce the data to
+about the size of the preview before doing anything else with it, and we
+estimate the percentiles used for normalization from a sample of the pixels
+rather than sorting them all.
+"""
+import math
+
+import numpy
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+# Maximum width or height of a preview image, in pixels
+MAX_SIZE = 1024
+
+# Maximum width or height of the smaller versions of preview images that we
+# make for thumbnails, in pixels
+THUMBNAIL_SIZES = (512, 128)
+
+# Maximum number of pixels to sample when estimating percentiles
+MAX_SAMPLES = 250000
+
+
+def have_pillow():
+    return Image is not None
+
+
+def downsample(data, maxsize=MAX_SIZE, method='mean'):
+    """
+    Reduce a 2D array by an integer factor so that neither axis is longer
+    than maxsize. Other arrays are not reduced. method is 'mean' to average
+    blocks of pixels, or 'stride' to simply take every nth pixel, which is
+    faster but noisier. Pixels that don't fill a whole block at the right and
+    top edges are dropped.
+
+    Returns a float32 array, which is always a new array so that the caller
+    can modify it in place.
+    """
+    factor = math.ceil(max(data.shape) / maxsize)
+    if factor <= 1 or data.ndim != 2:
+        return data.astype(numpy.float32)
+    if method == 'stride':
+        return data[::factor, ::factor].astype(numpy.float32)
+
+    ny, nx = data.shape[0] // factor, data.shape[1] // factor
+    blocks = data[:ny*factor, :nx*factor].reshape(ny, factor, nx, factor)
+    return blocks.mean(axis=(1, 3), dtype=numpy.float32)
+
+
+def pyramid(data, sizes=THUMBNAIL_SIZES):
+    """
+    Make smaller versions of a 2D image, for each of sizes that is smaller
+    than the image. Each one is made from the next larger one, so this is
+    cheap once the image has been reduced to preview size. Returns a dict of
+    the smaller images, keyed by size.
+    """
+    images = {}
+    for size in sorted(sizes, reverse=True):
+        if max(data.shape) > size:
+            data = downsample(data, maxsize=size)
+            images[size] = data
+    return images
+
+
+def sample(data, max_samples=MAX_SAMPLES):
+    """
+    Return up to about max_samples of the finite values in data, taken at
+    regular intervals through the array. For 2D data the interval is chosen
+    so that it is not a multiple of a factor of the row length, so that we
+    don't sample the same few columns in every row.
+    """
+    flat = data.ravel()
+    step = max(1, flat.size // max_samples)
+    if data.ndim > 1:
+        while step > 1 and math.gcd(step, data.shape[-1]) != 1:
+            step += 1
+    values = flat[::step]
+    return values[numpy.isfinite(values)]
+
+
+def sampled_percentiles(data, percentiles, max_samples=MAX_SAMPLES):
+    """
+    Estimate the given percentiles of the finite values in data from a
+    sample of them. Returns a list of the same length as percentiles, which
+    are all zero if there are no finite values.
+    """
+    values = sample(data, max_samples=max_samples)
+    if values.size == 0:
+        return [0.0] * len(percentiles)
+    return list(numpy.percentile(values, percentiles))
+
+
+def sampled_median(data, max_samples=MAX_SAMPLES):
+    """
+    Estimate the median of the finite values in data from a sample of them
+    """
+    return sampled_percentiles(data, [50], max_samples=max_samples)[0]
+
+
+def norm(data, percentile=0.3, max_samples=MAX_SAMPLES):
+    """
+    Normalize the data onto 0:1 using percentiles estimated from a sample of
+    the data. Non-finite values are set to 0. Floating point data are
+    normalized in place, other types are converted to a new float32 array.
+    """
+    if not numpy.issubdtype(data.dtype, numpy.floating):
+        data = data.astype(numpy.float32)
+    plow, phigh = sampled_percentiles(data, [percentile, 100.0 - percentile],
+                                      max_samples=max_samples)
+    numpy.clip(data, plow, phigh, out=data)
+    data -= plow
+    if phigh > plow:
+        data /= (phigh - plow)
+    numpy.nan_to_num(data, copy=False, nan=0.0)
+    return data
+
+
+def encode(data, fp, filetype='jpg', quality=75):
+    """
+    Write a 2D array of values normalized onto 0:1 to the file-like fp as a
+    greyscale jpg or png image, with the first row of data at the top.
+    """
+    pixels = numpy.clip(data * 255 + 0.5, 0, 255).astype(numpy.uint8)
+
+    image = Image.fromarray(pixels)
+    if filetype == 'png':
+        image.save(fp, format='PNG', optimize=False)
+    else:
+        image.save(fp, format='JPEG', quality=quality)
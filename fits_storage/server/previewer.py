@@ -4,9 +4,6 @@ This module contains a helper class for generating preview images
 import os
 import os.path
 import numpy
-import matplotlib
-matplotlib.use('Agg')
-import matplotlib.pyplot as plt
 
 from sqlalchemy import select
 from sqlalchemy.exc import NoResultFound
@@ -25,6 +22,19 @@ from fits_storage.config import get_config
 
 from fits_storage.core.orm.header import Header
 from fits_storage.server.orm.preview import Preview
+from fits_storage.server import preview_render
+
+
+def pyplot():
+    """
+    Import and return matplotlib.pyplot. This is a slow import and we only
+    need it for spectra, or if we are rendering images with matplotlib, so we
+    only do it when we need to.
+    """
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+    return plt
 
 
 class Previewer(object):
@@ -35,7 +45,8 @@ class Previewer(object):
     """
 
     def __init__(self, diskfile, session, logger=None, previewpath = None,
-                 using_s3 = None, force=False, scavengeonly=False, header=None):
+                 using_s3 = None, force=False, scavengeonly=False, header=None,
+                 renderer=None):
         self.diskfile = diskfile
         self.session = session
         self.logger = logger if logger is not None else DummyLogger()
@@ -69,22 +80,43 @@ class Previewer(object):
         self.filename += '.' + self.filetype
         self.fpfn = os.path.join(self.previewpath, self.filename)
 
+        # Smaller versions of the preview image, keyed by size. The renderer
+        # fills this in, and we write them out alongside the preview file.
+        self.thumbnails = {}
+
         self.force = force
         self.scavengeonly = scavengeonly
 
+        # 'pillow' renders images with numpy and encodes them with Pillow,
+        # 'matplotlib' renders them with matplotlib as we used to. Spectra are
+        # always plotted with matplotlib.
+        self.renderer = renderer if renderer is not None \
+            else fsc.preview_renderer
+        if self.renderer == 'pillow' and not preview_render.have_pillow():
+            self.logger.warning("Pillow is not available, rendering previews "
+                                "with matplotlib")
+            self.renderer = 'matplotlib'
+
         if self.using_s3:
             from fits_storage.server.aws_s3 import Boto3Helper
             self.s3 = Boto3Helper()
 
 
+    def sized_fpfn(self, size):
+        return os.path.join(self.previewpath,
+                            Preview.sized_filename(self.filename, size))
+
     def delete_file(self):
         """
-        Delete the preview file. Fail silently if unable
+        Delete the preview file, and any smaller versions of it. Fail
+        silently if unable
         """
-        try:
-            os.unlink(self.fpfn)
-        except Exception:
-            pass
+        for fpfn in [self.fpfn] + [self.sized_fpfn(size) for size in
+                                   preview_render.THUMBNAIL_SIZES]:
+            try:
+                os.unlink(fpfn)
+            except Exception:
+                pass
 
 
     def make_preview(self):
@@ -156,6 +188,11 @@ class Previewer(object):
                 self.logger.debug("Creating DB preview entry")
                 dbp = Preview(self.diskfile, self.filename)
                 self.session.add(dbp)
+            if upload:
+                # We made a new preview file, record which smaller versions
+                # of it we made along with it.
+                dbp.sizes = ','.join(str(size) for size in
+                                     sorted(self.thumbnails)) or None
         else:
             # If the status is bad, delete any preview database entry.
             if dbp is not None:
@@ -165,12 +202,16 @@ class Previewer(object):
         self.session.commit()
 
         if self.using_s3 and upload:
-            # Upload preview file to S3 and delete local copy
-            keyname = f"{self.s3_preview_path}/{self.filename}"
-            self.logger.info("Uploading preview %s to S3", keyname)
-            if self.s3.upload_file(keyname, self.fpfn) is None:
-                self.logger.error("Error uploading %s to S3 as %s",
-                                  self.fpfn, self.filename)
+            # Upload preview files to S3 and delete local copies
+            uploads = [(self.filename, self.fpfn)] + \
+                [(Preview.sized_filename(self.filename, size),
+                  self.sized_fpfn(size)) for size in sorted(self.thumbnails)]
+            for filename, fpfn in uploads:
+                keyname = f"{self.s3_preview_path}/{filename}"
+                self.logger.info("Uploading preview %s to S3", keyname)
+                if self.s3.upload_file(keyname, fpfn) is None:
+                    self.logger.error("Error uploading %s to S3 as %s",
+                                      fpfn, filename)
 
             self.delete_file()
         if self.using_s3:
@@ -200,12 +241,16 @@ class Previewer(object):
             self.logger.info(f"Rendering preview for {self.diskfile.filename} at {self.fpfn}")
             # Ensure the path within the previewpath exists
             os.makedirs(os.path.dirname(self.fpfn), exist_ok=True)
+            self.thumbnails = {}
             with open(self.fpfn, 'wb') as fp:
                 if self.spectrum:
                     rendered = self.render_spectrum(fp)
                 else:
                     rendered = self.render_image(fp)
             if rendered:
+                for size, data in self.thumbnails.items():
+                    with open(self.sized_fpfn(size), 'wb') as fp:
+                        preview_render.encode(data, fp, self.filetype)
                 return True
             else:
                 self.logger.warning("Could not render preview for %s",
@@ -242,6 +287,7 @@ class Previewer(object):
         if self.header.instrument == 'GHOST' and self.header.processing != 'Raw' and '_dragons' in self.diskfile.filename:
             # This doesn't work for _calibrated files
             self.logger.debug("GHOST processed spectrum plot")
+            plt = pyplot()
 
             # This is based heavily on https://gitlab.com/nsf-noirlab/csdc/usngo/ghostdr/-/blob/main/code/plot_ghost_spect.py
             band = ad.arm()
@@ -316,6 +362,8 @@ class Previewer(object):
         """
         Normalize the data onto 0:1 using percentiles
         """
+        if self.renderer == 'pillow':
+            return preview_render.norm(data, percentile=percentile)
         lower = percentile
         upper = 100.0 - percentile
         plow = numpy.percentile(data, lower)
@@ -325,6 +373,24 @@ class Previewer(object):
         data /= (phigh - plow)
         return data
 
+    def shrink(self, data):
+        """
+        Reduce large images to about the size of the preview before we
+        normalize them. matplotlib does this itself when it renders them.
+        """
+        if self.renderer == 'pillow':
+            return preview_render.downsample(data)
+        return data
+
+    def median(self, data):
+        """
+        Median of the data, estimated from a sample of it if we're using the
+        pillow renderer
+        """
+        if self.renderer == 'pillow':
+            return preview_render.sampled_median(data)
+        return numpy.median(data)
+
 
     def render_image(self, fp):
         """
@@ -378,7 +444,9 @@ class Previewer(object):
             shape = (ymax - ymin, (xmax - xmin) + 2 * gap)
 
             # needs to not be uint16 before bias/gain adjust (per ext)
-            full = numpy.zeros(shape, numpy.float64)
+            dtype = numpy.float32 if self.renderer == 'pillow' \
+                else numpy.float64
+            full = numpy.zeros(shape, dtype)
 
             # Loop through ads, pasting them in. Do gmos bias and gain hack
             if len(ad[0].data.shape) == 1:
@@ -411,7 +479,7 @@ class Previewer(object):
 
                     try:
                         o_xmin, o_xmax, o_ymin, o_ymax = add.overscan_section()
-                        bias = numpy.median(
+                        bias = self.median(
                             add.data[o_ymin:o_ymax, o_xmin:o_xmax])
                     except:
                         try:
@@ -428,10 +496,13 @@ class Previewer(object):
                     self.logger.debug(fmt3.format(s_xmin, s_xmax, s_ymin,
                                                   s_ymax, d_xmin, d_xmax,
                                                   d_ymin, d_ymax))
-                    full[d_ymin:d_ymax, d_xmin:d_xmax] = (add.data[
-                                                          s_ymin:s_ymax,
-                                                          s_xmin:s_xmax] - bias) * gain
-                full = self.norm(full, percentile=5)
+                    # Subtract and scale in place in the full image, to
+                    # avoid making temporary copies of each extension.
+                    dest = full[d_ymin:d_ymax, d_xmin:d_xmax]
+                    numpy.subtract(add.data[s_ymin:s_ymax, s_xmin:s_xmax],
+                                   bias, out=dest, casting='unsafe')
+                    dest *= gain
+                full = self.norm(self.shrink(full), percentile=5)
 
         elif str(ad.instrument()) == 'GSAOI':
             gap = 125
@@ -452,7 +523,7 @@ class Previewer(object):
                 full[y1 + yoffset:y2 + yoffset,
                 x1 + xoffset:x2 + xoffset] = add.data
 
-            full = self.norm(full)
+            full = self.norm(self.shrink(full))
 
         elif str(ad.instrument()) in {'TReCS', 'michelle'}:
             chopping = False
@@ -526,7 +597,7 @@ class Previewer(object):
         elif str(ad.instrument()) == "GHOST" and 'BUNDLE' in ad.tags:
             full = ad[1].data
 
-            full = self.norm(full)
+            full = self.norm(self.shrink(full))
         else:
             # Generic plot the first extention case
             full = ad[0].data
@@ -534,13 +605,20 @@ class Previewer(object):
             # Do a numpy squeeze on it - this collapses any axis with 1-pixel extent
             full = numpy.squeeze(full)
 
-            full = self.norm(full)
+            full = self.norm(self.shrink(full))
 
         if full.ndim > 1:
             # flip the image - seems we need this for everything
             full = numpy.flip(full, 0)
 
+        if self.renderer == 'pillow' and full.ndim == 2:
+            preview_render.encode(full, fp, self.filetype)
+            # Make the smaller versions while we have the image to hand
+            self.thumbnails = preview_render.pyramid(full)
+            return True
+
         # plot without axes or frame
+        plt = pyplot()
         fig = plt.figure(frameon=False)
 
         if full.ndim == 1:
@@ -524,9 +524,12 @@ class Reducer(object):
         # Note that we always export bz2 compressed data.
         fpfn = os.path.join(self.workingdir, filename)
         with open(fpfn, mode='rb') as f:
+            # If the file is already compressed, pass it through as it is.
+            # Either way, flo provides the size and md5sum of what we sent,
+            # for the verification.
             if filename.endswith('.bz2'):
                 destination_filename = filename
-                flo = f
+                flo = StreamBz2Compressor(f, passthrough=True)
             else:
                 destination_filename = filename + '.bz2'
                 flo = StreamBz2Compressor(f)
@@ -568,11 +571,6 @@ class Reducer(object):
                 return True
 
             # The response should be a short json document
-            if flo is f:
-                # Need to provide the extra properties that our bz2streamer
-                # provides that are used in the verification.
-                flo.bytes_output = os.path.getsize(fpfn)
-                flo.md5sum_output = md5sum(fpfn)
             try:
                 verification = json.loads(req.text)[0]
                 if verification['filename'] != destination_filename:
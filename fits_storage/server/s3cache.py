@@ -0,0 +1,197 @@
+"""
+This module provides S3DiskCache, a cache on local disk of objects fetched
+from S3. Boto3Helper uses it, if the s3_cache_dir configuration value is set,
+so that files that are used over and over - calibrations for the reducer,
+popular downloads - are fetched from S3 once, rather than every time.
+
+The cache is content addressed: each object is stored under its md5, so a
+key that is replaced with new data gets a new entry, and the old one just
+ages out. Objects are fetched into a temporary file, checked against the md5
+and moved into place, so nobody ever sees a partial entry. A lock file per
+entry stops several processes (or threads) fetching the same object at once;
+the ones that lose the race wait and then use the entry the winner fetched.
+
+The size of the cache is bounded. When it goes over, the least recently used
+entries are deleted - each hit touches the modification time of the entry,
+so that is the order we delete in. Processes sharing the cache directory
+each keep count of what they add, and recount the whole directory every
+scan_interval seconds, so the total can go a little over the bound, briefly.
+"""
+import fcntl
+import os
+import tempfile
+import threading
+import time
+
+from fits_storage.core.hashes import md5sum
+from fits_storage.logger_dummy import DummyLogger
+
+
+class S3DiskCache(object):
+    """
+    A cache of S3 objects in directory, holding up to max_bytes. Objects
+    bigger than max_object_fraction of that are not cached, so one huge file
+    doesn't flush everything else out.
+    """
+    scan_interval = 60
+    max_object_fraction = 0.1
+
+    def __init__(self, directory, max_bytes, logger=DummyLogger()):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.l = logger
+        self.tmpdir = os.path.join(directory, 'tmp')
+        os.makedirs(self.tmpdir, exist_ok=True)
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.bytes_fetched = 0
+        self._lock = threading.Lock()
+        # The size of the cache as of the last scan, plus what we have added
+        # since, and when that scan was
+        self._size = None
+        self._scanned = 0
+
+    def path(self, md5):
+        return os.path.join(self.directory, md5[:2], md5)
+
+    def cacheable(self, size):
+        return size <= self.max_bytes * self.max_object_fraction
+
+    def stats(self):
+        """
+        Return a dictionary of the hit and miss counts etc. for this process.
+        """
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses,
+                    'evictions': self.evictions,
+                    'bytes_fetched': self.bytes_fetched}
+
+    def _hit(self, path):
+        """
+        If path is in the cache, mark it as used, count the hit and return
+        True.
+        """
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            return False
+        with self._lock:
+            self.hits += 1
+        self.l.debug("S3 cache hit: %s", path)
+        return True
+
+    def get(self, md5, fetch):
+        """
+        Return the path of the cached copy of the object with the given md5.
+        If it is not in the cache, we call fetch(filename), which should fetch
+        the object into filename and return True if it succeeded. Returns None
+        if fetch fails or the data we get don't match the md5.
+
+        The caller should open the file straight away - it may be evicted
+        once it is no longer the most recently used, but once it is open, we
+        can read it regardless.
+        """
+        path = self.path(md5)
+        if self._hit(path):
+            return path
+
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path + '.lock', 'a') as lockfile:
+            fcntl.flock(lockfile, fcntl.LOCK_EX)
+            # Someone else may have fetched it while we waited for the lock
+            if self._hit(path):
+                return path
+
+            with self._lock:
+                self.misses += 1
+            self.l.debug("S3 cache miss: %s", path)
+            fd, tmpfile = tempfile.mkstemp(dir=self.tmpdir)
+            os.close(fd)
+            try:
+                if not fetch(tmpfile):
+                    return None
+                filemd5 = md5sum(tmpfile)
+                if filemd5 != md5:
+                    self.l.error("md5 mismatch fetching %s into S3 cache - "
+                                 "got %s", md5, filemd5)
+                    return None
+                size = os.path.getsize(tmpfile)
+                os.replace(tmpfile, path)
+            finally:
+                if os.path.exists(tmpfile):
+                    os.unlink(tmpfile)
+
+        with self._lock:
+            self.bytes_fetched += size
+            if self._size is not None:
+                self._size += size
+            rescan = self._size is None or self._size > self.max_bytes or \
+                time.time() - self._scanned > self.scan_interval
+        if rescan:
+            self.evict()
+        return path
+
+    def entries(self):
+        """
+        Return a list of (mtime, size, path) for each entry in the cache,
+        least recently used first.
+        """
+        entries = []
+        for subdir in os.scandir(self.directory):
+            if not subdir.is_dir() or subdir.path == self.tmpdir:
+                continue
+            for entry in os.scandir(subdir.path):
+                if entry.name.endswith('.lock'):
+                    continue
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+        entries.sort()
+        return entries
+
+    def evict(self):
+        """
+        Count the size of the cache, and delete the least recently used
+        entries until it is no bigger than max_bytes.
+        """
+        entries = self.entries()
+        total = sum(size for mtime, size, path in entries)
+        evicted = 0
+        for mtime, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            self.l.debug("Evicting %s from S3 cache", path)
+            # If another process is waiting on the lock file, it will fetch
+            # the object again, which is a waste, but harmless.
+            for filename in (path, path + '.lock'):
+                try:
+                    os.unlink(filename)
+                except FileNotFoundError:
+                    pass
+            total -= size
+            evicted += 1
+
+        with self._lock:
+            self._size = total
+            self._scanned = time.time()
+            self.evictions += evicted
+
+
+_caches = {}
+_caches_lock = threading.Lock()
+
+
+def get_s3_cache(directory, max_bytes, logger=DummyLogger()):
+    """
+    Return the S3DiskCache for directory shared by everything in this process,
+    so the statistics cover all of it.
+    """
+    with _caches_lock:
+        if directory not in _caches:
+            _caches[directory] = S3DiskCache(directory, max_bytes,
+                                             logger=logger)
+        return _caches[directory]
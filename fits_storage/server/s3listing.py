@@ -0,0 +1,136 @@
+"""
+This module provides S3Listing, a snapshot of the keys in an S3 bucket, with
+the size and ETag of each, made by listing them. Boto3Helper uses it, once
+preload() has been called, to answer exists_key and get_md5 without a HEAD
+request per key. That is for scripts that work through many keys - a listing
+request gives us up to 1000 keys at once.
+
+The snapshot is as of when it was made. Boto3Helper invalidates the keys it
+writes to or deletes, and those are looked up with HEAD requests again, but
+changes made by anyone else are not seen until the prefix is loaded again
+with reload=True, so it is for bulk operations that don't care about keys
+changing while they run.
+
+A listing doesn't say how the objects are encrypted, and the ETag is only the
+md5 of the data if the object is not encrypted or uses SSE-S3. We check that
+with one HEAD request per bucket before using the ETags as md5s.
+"""
+from collections import namedtuple
+
+from botocore.exceptions import ClientError
+
+from fits_storage.logger_dummy import DummyLogger
+
+# ServerSideEncryption values for which the ETag is the md5 of the data
+ETAG_MD5_ENCRYPTION = (None, 'AES256')
+
+
+class ListedKey(namedtuple('ListedKey', 'size etag')):
+    @property
+    def md5(self):
+        """
+        The md5 of the data, which is the ETag unless the object was uploaded
+        with a multipart upload, in which case we don't know it.
+        """
+        return None if '-' in self.etag else self.etag
+
+
+class S3Listing(object):
+    """
+    A snapshot of the keys in the bucket bucket_name, for the prefixes that
+    have been loaded.
+    """
+    def __init__(self, bucket_name, logger=DummyLogger()):
+        self.bucket_name = bucket_name
+        self.l = logger
+        self.prefixes = []
+        self.keys = {}
+        # Keys that have changed since we listed them
+        self.stale = set()
+        self.requests = 0
+        # Whether the ETags in this bucket are md5s. None until we check.
+        self.etags_are_md5s = None
+
+    def covers(self, keyname):
+        return any(keyname.startswith(prefix) for prefix in self.prefixes)
+
+    def load(self, client, prefix='', reload=False):
+        """
+        List the keys in the bucket starting with prefix, using client, unless
+        we have already. If reload is True, list them again anyway, to bring
+        the snapshot of those keys up to date.
+        """
+        covered = self.covers(prefix)
+        if covered and not reload:
+            return
+        # Forget what we had for these keys, so that any deleted since are
+        # not left behind
+        self.keys = {keyname: listed for keyname, listed in self.keys.items()
+                     if not keyname.startswith(prefix)}
+        paginator = client.get_paginator('list_objects_v2')
+        n = 0
+        for page in paginator.paginate(Bucket=self.bucket_name, Prefix=prefix):
+            self.requests += 1
+            for obj in page.get('Contents', []):
+                self.keys[obj['Key']] = ListedKey(obj['Size'],
+                                                  obj['ETag'].strip('"'))
+                n += 1
+        # The new listing is up to date for the keys in it
+        self.stale = {keyname for keyname in self.stale
+                      if not keyname.startswith(prefix)}
+        if not covered:
+            self.prefixes.append(prefix)
+        self.l.info("Listed %d keys with prefix '%s' in bucket %s",
+                    n, prefix, self.bucket_name)
+
+    def lookup(self, keyname):
+        """
+        Returns the ListedKey for keyname, False if we know it doesn't exist,
+        or None if we don't know - it is not in the prefixes we have listed,
+        or has changed since.
+        """
+        if keyname in self.stale or not self.covers(keyname):
+            return None
+        return self.keys.get(keyname, False)
+
+    def lookup_md5(self, client, keyname):
+        """
+        Returns the md5 of the data of keyname, if we can tell it from the
+        ETag in the listing, False if we know keyname doesn't exist, or None
+        if we don't know. The first time we have an ETag to use as an md5, we
+        HEAD that key, using client, to check that the ETags in this bucket
+        are md5s.
+        """
+        listed = self.lookup(keyname)
+        if listed is None or listed is False:
+            return listed
+        if listed.md5 is None:
+            return None
+        if self.etags_are_md5s is None:
+            try:
+                response = client.head_object(Bucket=self.bucket_name,
+                                              Key=keyname)
+            except ClientError:
+                self.l.warning("Cannot check the ETag of %s in bucket %s",
+                               keyname, self.bucket_name, exc_info=True)
+                return None
+            encryption = response.get('ServerSideEncryption')
+            md5 = response.get('Metadata', {}).get('md5')
+            self.etags_are_md5s = encryption in ETAG_MD5_ENCRYPTION and \
+                md5 in (None, response['ETag'].strip('"'))
+            self.l.info("ETags in bucket %s are %smd5s (%s has encryption "
+                        "%s)", self.bucket_name,
+                        '' if self.etags_are_md5s else 'not ', keyname,
+                        encryption)
+        return listed.md5 if self.etags_are_md5s else None
+
+    def invalidate(self, keyname, deleted=False):
+        """
+        Note that keyname has been written to, or deleted if deleted is True,
+        since we listed it.
+        """
+        self.keys.pop(keyname, None)
+        if deleted:
+            self.stale.discard(keyname)
+        else:
+            self.stale.add(keyname)
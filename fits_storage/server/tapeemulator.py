@@ -0,0 +1,372 @@
+"""
+This module provides TapeEmulator, a stand in for a tape drive with a tape in
+it, which stores the tape in a directory. It has the same interface as
+TapeDrive, so the tape scripts can be run and profiled, and the tape code can
+be tested, without tape hardware. get_tapedrive() in tapeutils returns one if
+the tape drive device given is a directory.
+
+The emulator behaves like a linux st tape device in variable block mode:
+    * Each write() writes one block (record) on the tape. Writing anywhere
+      but the end of the data truncates the tape at that point.
+    * Closing the device after writing writes a file mark, and leaves the
+      tape positioned at the start of the next file, which is the end of data
+      (EOD).
+    * Each read() returns one block. Reading with a buffer smaller than the
+      block fails with ENOMEM, as on a real drive. Reading a file mark
+      returns no data and moves to the start of the next file. Reading at EOD
+      fails with EIO.
+    * mt commands (rewind, fsf, bsf, fsr, bsr, eod, setblk, status) move the
+      tape and report its status in the same way as mt does, so all the
+      TapeDrive methods built on them work unchanged.
+
+Optionally, the tape can have a capacity, beyond which writes fail with
+ENOSPC, and the drive can have a throughput for reading and writing data, and
+a (normally higher) speed for spacing over data when positioning the tape. If
+we don't keep data coming fast enough to keep the drive buffer from running
+empty while writing, the drive stops and has to reposition before carrying
+on, which takes backhitch seconds, as on a real drive.
+
+The data of each tape file are stored in a file in the directory, and the
+block sizes and position of the tape in a state.json file, so the tape keeps
+its position between processes like a real tape does.
+"""
+import errno
+import io
+import json
+import os
+import time
+
+from fits_storage.server.tapeutils import TapeDrive
+
+
+class TapeEmulator(TapeDrive):
+    """
+    A TapeDrive which stores the tape in the directory given as the device.
+    rate, locate_rate (in bytes per second), capacity (in bytes), buffer (in
+    bytes) and backhitch (in seconds) are as described in the module
+    docstring. They are saved with the tape, so only need to be given when
+    the tape is created or to change them. None means no limit.
+    """
+    settings = ('capacity', 'rate', 'locate_rate', 'buffer', 'backhitch')
+
+    def __init__(self, device, scratchdir, logger=None, **kwargs):
+        super().__init__(device, scratchdir, logger=logger)
+        os.makedirs(device, exist_ok=True)
+        self.statefile = os.path.join(device, 'state.json')
+        try:
+            with open(self.statefile) as f:
+                state = json.load(f)
+        except FileNotFoundError:
+            state = {}
+        # files is a list of the block sizes in each file on the tape, stored
+        # as run lengths: [[size, count], ...]
+        self.files = state.get('files', [])
+        self.filenum = state.get('filenum', 0)
+        self.blocknum = state.get('blocknum', 0)
+        self.blocksize = state.get('blocksize', 0)
+        # Set when a write fails because we reached the end of the tape
+        self.full = state.get('full', False)
+        self.capacity = state.get('capacity')
+        self.rate = state.get('rate')
+        self.locate_rate = state.get('locate_rate')
+        self.buffer = state.get('buffer', 64 * 1048576)
+        self.backhitch = state.get('backhitch', 0)
+        for key, value in kwargs.items():
+            if key not in self.settings:
+                raise TypeError("Unknown TapeEmulator setting %s" % key)
+            setattr(self, key, value)
+        # The time at which the drive will have finished transferring the
+        # data we have given it so far
+        self.busy_until = 0
+        self.save()
+
+    def save(self):
+        state = {'files': self.files, 'filenum': self.filenum,
+                 'blocknum': self.blocknum, 'blocksize': self.blocksize,
+                 'full': self.full}
+        state.update({key: getattr(self, key) for key in self.settings})
+        tmpfile = self.statefile + '.tmp'
+        with open(tmpfile, 'w') as f:
+            json.dump(state, f)
+        os.replace(tmpfile, self.statefile)
+
+    def datafile(self, filenum):
+        return os.path.join(self.dev, 'file%05d' % filenum)
+
+    @staticmethod
+    def nblocks(runs):
+        return sum(count for size, count in runs)
+
+    @staticmethod
+    def block_offset(runs, blocknum):
+        """
+        Offset in bytes of block blocknum in a file with block sizes runs
+        """
+        offset = 0
+        for size, count in runs:
+            n = min(count, blocknum)
+            offset += n * size
+            blocknum -= n
+            if blocknum == 0:
+                break
+        return offset
+
+    @staticmethod
+    def block_size(runs, blocknum):
+        for size, count in runs:
+            if blocknum < count:
+                return size
+            blocknum -= count
+        return None
+
+    @property
+    def used(self):
+        return sum(self.block_offset(runs, self.nblocks(runs))
+                   for runs in self.files)
+
+    def at_eod(self):
+        return self.filenum >= len(self.files)
+
+    def locate(self, nbytes):
+        """
+        Wait for the drive to space over nbytes of data
+        """
+        self.wait()
+        if self.locate_rate:
+            time.sleep(nbytes / self.locate_rate)
+
+    def transfer(self, nbytes, write=False):
+        """
+        Wait for the drive to transfer nbytes of data. When writing, the
+        drive has a buffer, so we only wait if it is full, but if it has run
+        empty, the drive has stopped and has to reposition before it can
+        start again.
+        """
+        if not self.rate:
+            return
+        now = time.monotonic()
+        if write and self.busy_until and now > self.busy_until:
+            self.logger.debug("Tape drive buffer ran empty")
+            self.busy_until = now + self.backhitch
+        self.busy_until = max(now, self.busy_until) + nbytes / self.rate
+        delay = self.busy_until - now
+        if write and self.buffer:
+            delay -= self.buffer / self.rate
+        if delay > 0:
+            time.sleep(delay)
+
+    def wait(self):
+        """
+        Wait for the drive to finish writing the data in its buffer
+        """
+        delay = self.busy_until - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+        self.busy_until = 0
+
+    def _mt(self, mtcmd, mtarg=''):
+        count = int(mtarg) if mtarg else 1
+        retval = 0
+        try:
+            if mtcmd == 'status':
+                return [0, self.status_string().encode('ascii'), b'']
+            elif mtcmd == 'rewind':
+                self.locate(sum(self.block_offset(runs, self.nblocks(runs))
+                                for runs in self.files[:self.filenum]))
+                self.filenum, self.blocknum = 0, 0
+            elif mtcmd == 'eod':
+                self.locate(sum(self.block_offset(runs, self.nblocks(runs))
+                                for runs in self.files[self.filenum:]))
+                self.filenum, self.blocknum = len(self.files), 0
+            elif mtcmd == 'setblk':
+                self.blocksize = count
+            elif mtcmd == 'fsf':
+                self.space_files_forward(count)
+            elif mtcmd == 'bsf':
+                self.space_files_back(count)
+            elif mtcmd == 'fsr':
+                self.space_records(count)
+            elif mtcmd == 'bsr':
+                self.space_records(-count)
+            else:
+                raise OSError(errno.EINVAL, "Unsupported mt command")
+        except OSError as e:
+            retval = 2
+            return [retval, b'',
+                    ("%s: %s\n" % (self.dev, e.strerror)).encode('ascii')]
+        finally:
+            self.save()
+        return [retval, b'', b'']
+
+    def space_files_forward(self, count):
+        nbytes = 0
+        for _ in range(count):
+            if self.at_eod():
+                raise OSError(errno.EIO, "Input/output error")
+            runs = self.files[self.filenum]
+            nbytes += self.block_offset(runs, self.nblocks(runs)) - \
+                self.block_offset(runs, self.blocknum)
+            self.filenum, self.blocknum = self.filenum + 1, 0
+        self.locate(nbytes)
+
+    def space_files_back(self, count):
+        # We end up on the BOT side of the file mark, ie at the end of the
+        # previous file.
+        nbytes = 0
+        for _ in range(count):
+            if self.filenum == 0:
+                self.blocknum = 0
+                raise OSError(errno.EIO, "Input/output error")
+            if self.filenum < len(self.files):
+                nbytes += self.block_offset(self.files[self.filenum],
+                                            self.blocknum)
+            self.filenum -= 1
+            runs = self.files[self.filenum]
+            self.blocknum = self.nblocks(runs)
+        self.locate(nbytes)
+
+    def space_records(self, count):
+        # Move count blocks within the current file, stopping at a file mark
+        runs = self.files[self.filenum] if not self.at_eod() else []
+        target = self.blocknum + count
+        if target < 0 or target > self.nblocks(runs):
+            self.blocknum = min(max(target, 0), self.nblocks(runs))
+            raise OSError(errno.EIO, "Input/output error")
+        self.locate(abs(self.block_offset(runs, target) -
+                        self.block_offset(runs, self.blocknum)))
+        self.blocknum = target
+
+    def status_string(self):
+        bits = []
+        if self.filenum == 0 and self.blocknum == 0:
+            bits.append('BOT')
+        if self.at_eod():
+            bits.append('EOD')
+            if self.full or (self.capacity is not None and
+                             self.used >= self.capacity):
+                bits.append('EOT')
+        bits.append('ONLINE')
+        return ("SCSI 2 tape drive:\n"
+                "File number=%d, block number=%d, partition=0.\n"
+                "Tape block size %d bytes. Density code 0x0 (emulated).\n"
+                "Soft error count since last status=0\n"
+                "General status bits on (0):\n"
+                " %s\n" % (self.filenum, self.blocknum, self.blocksize,
+                           ' '.join(bits)))
+
+    def open(self, mode='rb'):
+        return EmulatedTapeFile(self, mode)
+
+    def backspace_records(self, fileobj, nrecords, blocksize=None):
+        self.logger.debug("Backspacing %d records on %s", nrecords, self.dev)
+        self.wait()
+        self.space_records(-nrecords)
+
+    def skip_records(self, fileobj, nrecords):
+        self.logger.debug("Skipping %d records on %s", nrecords, self.dev)
+        fileobj.close_datafile()
+        self.space_records(nrecords)
+
+
+class EmulatedTapeFile(io.RawIOBase):
+    """
+    The device file of a TapeEmulator, opened for reading ('rb') or
+    writing ('wb').
+    """
+    def __init__(self, emulator, mode='rb'):
+        super().__init__()
+        self.emulator = emulator
+        self.mode = mode
+        self.written = False
+        self.fp = None
+
+    def readable(self):
+        return 'r' in self.mode
+
+    def writable(self):
+        return 'w' in self.mode
+
+    def _open_datafile(self, mode):
+        emu = self.emulator
+        if self.fp is None:
+            self.fp = open(emu.datafile(emu.filenum), mode)
+            self.fp.seek(emu.block_offset(emu.files[emu.filenum],
+                                          emu.blocknum))
+
+    def readinto(self, b):
+        emu = self.emulator
+        if emu.at_eod():
+            raise OSError(errno.EIO, "Input/output error")
+        runs = emu.files[emu.filenum]
+        size = emu.block_size(runs, emu.blocknum)
+        if size is None:
+            # We read the file mark
+            self.close_datafile()
+            emu.filenum, emu.blocknum = emu.filenum + 1, 0
+            return 0
+        self._open_datafile('rb')
+        emu.blocknum += 1
+        if len(b) < size:
+            self.fp.seek(size, os.SEEK_CUR)
+            raise OSError(errno.ENOMEM, "Cannot allocate memory")
+        n = self.fp.readinto(memoryview(b)[:size])
+        emu.transfer(n)
+        return n
+
+    def write(self, b):
+        emu = self.emulator
+        n = len(b)
+        if not self.written:
+            # Writing truncates the tape at the current position
+            if emu.at_eod():
+                emu.files.append([])
+                open(emu.datafile(emu.filenum), 'wb').close()
+            for filenum in range(emu.filenum + 1, len(emu.files)):
+                os.unlink(emu.datafile(filenum))
+            del emu.files[emu.filenum + 1:]
+            self.written = True
+        runs = emu.files[emu.filenum]
+        if emu.blocknum < emu.nblocks(runs):
+            self.close_datafile()
+            offset = emu.block_offset(runs, emu.blocknum)
+            os.truncate(emu.datafile(emu.filenum), offset)
+            truncated = []
+            remaining = emu.blocknum
+            for size, count in runs:
+                if remaining == 0:
+                    break
+                truncated.append([size, min(count, remaining)])
+                remaining -= truncated[-1][1]
+            emu.files[emu.filenum] = runs = truncated
+        if emu.blocksize and n != emu.blocksize:
+            raise OSError(errno.EINVAL, "Invalid argument")
+        if emu.capacity is not None and emu.used + n > emu.capacity:
+            emu.full = True
+            raise OSError(errno.ENOSPC, "No space left on device")
+        emu.full = False
+        self._open_datafile('r+b')
+        self.fp.write(b)
+        if runs and runs[-1][0] == n:
+            runs[-1][1] += 1
+        else:
+            runs.append([n, 1])
+        emu.blocknum += 1
+        emu.transfer(n, write=True)
+        return n
+
+    def close_datafile(self):
+        if self.fp is not None:
+            self.fp.close()
+            self.fp = None
+
+    def close(self):
+        if self.closed:
+            return
+        emu = self.emulator
+        self.close_datafile()
+        if self.written:
+            # Write the file mark, we are then at EOD.
+            emu.wait()
+            emu.filenum, emu.blocknum = emu.filenum + 1, 0
+        emu.save()
+        super().close()
@@ -0,0 +1,156 @@
+"""
+This module provides the classes used to read individual files from tar
+archives on tape, using the index we record when writing them.
+
+For each TapeFile, write_diskfiles() records the offset of its tar header in
+the archive, and the number of the tape block that is in. Given those, rather
+than reading the whole tar archive to find the files we want, we can space
+the tape forward over the blocks in between (which the drive does at its
+locate speed, without transferring the data), read the tar header, and the
+data following it. The members are read in order of offset, and hashed as we
+read them, so the caller can check them against the database.
+"""
+import hashlib
+import io
+import os
+import tarfile
+
+
+class TarIndexError(Exception):
+    """
+    Raised by read_members() if what we find on the tape at the offset of a
+    TapeFile is not that file. The caller can fall back to reading the whole
+    archive.
+    """
+    pass
+
+
+class TapeBlockReader(io.RawIOBase):
+    """
+    A read only file object giving the tar archive in the tape file the tape
+    device fileobj is positioned at the start of. The archive must have been
+    written in blocks of blocksize.
+
+    Seeking forward is done by spacing the tape over the blocks in between
+    with skip(fileobj, nrecords) - normally TapeDrive.skip_records. We keep
+    the last block read, so we can seek back within that, but not before it.
+    """
+    def __init__(self, fileobj, blocksize, skip):
+        super().__init__()
+        self.fileobj = fileobj
+        self.blocksize = blocksize
+        self.skip = skip
+        # The number of the block in data, and of the next block on the tape
+        self.block = None
+        self.data = b''
+        self.nextblock = 0
+        self.pos = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.pos
+
+    def seek(self, pos, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            pos += self.pos
+        elif whence != io.SEEK_SET:
+            raise io.UnsupportedOperation("Can only seek from the start of "
+                                          "the archive or current position")
+        first = self.nextblock if self.block is None else self.block
+        if pos < first * self.blocksize:
+            raise io.UnsupportedOperation("Cannot seek back on the tape")
+        self.pos = pos
+        return pos
+
+    def _load(self, block):
+        if block == self.block:
+            return
+        if block > self.nextblock:
+            self.skip(self.fileobj, block - self.nextblock)
+            self.nextblock = block
+        self.data = self.fileobj.read(self.blocksize)
+        self.block = block
+        self.nextblock += 1
+
+    def readinto(self, b):
+        block, start = divmod(self.pos, self.blocksize)
+        self._load(block)
+        n = min(len(b), len(self.data) - start)
+        if n <= 0:
+            # End of the archive
+            return 0
+        b[:n] = self.data[start:start + n]
+        self.pos += n
+        return n
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            return self.readall()
+        # Fill the buffer from as many blocks as we need
+        buf = bytearray(size)
+        view = memoryview(buf)
+        n = 0
+        while n < size:
+            got = self.readinto(view[n:])
+            if not got:
+                break
+            n += got
+        view.release()
+        del buf[n:]
+        return bytes(buf)
+
+
+def read_members(td, fileobj, tapefiles, blocksize):
+    """
+    Read the members for tapefiles, which must all have offsets, from the
+    tar archive on the tape device fileobj, which must be positioned at the
+    start of the archive. td is the TapeDrive, and the archive must have been
+    written in blocks of blocksize.
+
+    This is a generator, which yields (tapefile, tarinfo, fileobj) for each
+    member, in order of offset, where fileobj is a file object to read the
+    member data from. Raises TarIndexError if the member at the offset for a
+    tapefile is not that file.
+    """
+    reader = TapeBlockReader(fileobj, blocksize, td.skip_records)
+    for tapefile in sorted(tapefiles, key=lambda tf: tf.offset):
+        reader.seek(tapefile.offset)
+        try:
+            # With a file object, TarFile reads the first member header from
+            # the current position. That handles pax headers for us.
+            tar = tarfile.TarFile(fileobj=reader, mode='r')
+        except tarfile.ReadError as e:
+            raise TarIndexError("Could not read tar header for %s at offset "
+                                "%d: %s" % (tapefile.filename,
+                                            tapefile.offset, e))
+        tarinfo = tar.firstmember
+        if tarinfo is None or tarinfo.name != tapefile.filename:
+            raise TarIndexError("Expected %s at offset %d in tar archive, "
+                                "found %s" % (tapefile.filename,
+                                              tapefile.offset,
+                                              tarinfo.name if tarinfo else
+                                              "the end of the archive"))
+        yield tapefile, tarinfo, tar.extractfile(tarinfo)
+
+
+def extract_member(tarinfo, fileobj, path='.', chunksize=1048576):
+    """
+    Copy the data for tarinfo from fileobj to a file of the same name in the
+    directory path, hashing it as we go, and set its modification time.
+    Returns (size, md5).
+    """
+    filename = os.path.join(path, os.path.basename(tarinfo.name))
+    size = 0
+    hashobj = hashlib.md5()
+    with open(filename, 'wb') as f:
+        while chunk := fileobj.read(chunksize):
+            hashobj.update(chunk)
+            f.write(chunk)
+            size += len(chunk)
+    os.utime(filename, (tarinfo.mtime, tarinfo.mtime))
+    return size, hashobj.hexdigest()
@@ -2,6 +2,7 @@
 This module provides a tape drive handling class, and some utility classes to
 help with the tapeserver api.
 """
+import fcntl
 import http
 import sys
 import os
@@ -9,12 +10,40 @@ import shutil
 import subprocess
 import tarfile
 import re
+import struct
 
 import requests
 
 from fits_storage.config import get_config
 from fits_storage.logger_dummy import DummyLogger
 
+# From linux/mtio.h, for the MTIOCTOP ioctl on an open tape device
+MTIOCTOP = 0x40086d01
+MTFSR = 3
+MTBSR = 4
+
+
+class TapeTarFile(tarfile.TarFile):
+    """
+    A TarFile that closes the tape device it is reading or writing when it
+    is closed. See TapeDrive.opentar()
+    """
+    device = None
+
+    def close(self):
+        try:
+            super().close()
+        finally:
+            if self.device is not None:
+                self.device.close()
+
+    def __exit__(self, type, value, traceback):
+        try:
+            super().__exit__(type, value, traceback)
+        finally:
+            if self.device is not None:
+                self.device.close()
+
 
 class TapeDrive(object):
     """
@@ -74,14 +103,8 @@ class TapeDrive(object):
         an error and exit if the attempt fails
         returns [returncode, stdoutstring, stderrstring]
         """
-        cmd = ['/bin/mt', '-f', self.dev, mtcmd]
-        if mtarg:
-            cmd.append(mtarg)
         self.logger.debug("Running mt -f %s %s %s", self.dev, mtcmd, mtarg)
-        sp = subprocess.Popen(cmd, stdout=subprocess.PIPE,
-                              stderr=subprocess.PIPE)
-        (stdoutstring, stderrstring) = sp.communicate()
-        retval = sp.returncode
+        [retval, stdoutstring, stderrstring] = self._mt(mtcmd, mtarg)
 
         if retval and fail:
             self.logger.error('"mt -f %s %s %s" failed with exit value %d:',
@@ -92,6 +115,43 @@ class TapeDrive(object):
 
         return [retval, stdoutstring, stderrstring]
 
+    def _mt(self, mtcmd, mtarg=''):
+        """
+        Run the mt command and return [returncode, stdoutstring,
+        stderrstring]. This is the part of mt() that talks to the drive.
+        """
+        cmd = ['/bin/mt', '-f', self.dev, mtcmd]
+        if mtarg:
+            cmd.append(mtarg)
+        sp = subprocess.Popen(cmd, stdout=subprocess.PIPE,
+                              stderr=subprocess.PIPE)
+        (stdoutstring, stderrstring) = sp.communicate()
+        return [sp.returncode, stdoutstring, stderrstring]
+
+    def open(self, mode='rb'):
+        """
+        Open the tape device, at the current position, for reading ('rb')
+        or writing ('wb'). The file object is unbuffered, so each read or
+        write is one block on the tape. Closing it after writing writes a
+        file mark.
+        """
+        return open(self.dev, mode, buffering=0)
+
+    def opentar(self, mode='r|', bufsize=tarfile.RECORDSIZE):
+        """
+        Open a tar archive in stream mode ('r|' or 'w|') on the tape at the
+        current position. Closing the TarFile closes the tape device.
+        """
+        fileobj = self.open('wb' if mode.startswith('w') else 'rb')
+        try:
+            tar = TapeTarFile.open(fileobj=fileobj, mode=mode,
+                                   bufsize=bufsize)
+        except Exception:
+            fileobj.close()
+            raise
+        tar.device = fileobj
+        return tar
+
     def rewind(self, fail=False):
         """
         Rewinds the tape
@@ -158,6 +218,29 @@ class TapeDrive(object):
             self.mt('bsf', mtarg=arg, fail=fail)
         return returncode
 
+    def backspace_records(self, fileobj, nrecords, blocksize=None):
+        """
+        Move the tape back nrecords records (ie blocks). This is for use
+        while we have the device open to write a tar archive, so we can't use
+        mt, which would need to open the device itself - we do the ioctl on
+        fileobj, the open device. The next write truncates the tape at that
+        point. blocksize is not used, this has the same signature as
+        tapewriter.seek_backspace so we can pass it to TarTapeWriter.
+        """
+        self.logger.debug("Backspacing %d records on %s", nrecords, self.dev)
+        fcntl.ioctl(fileobj.fileno(), MTIOCTOP,
+                    struct.pack('hi', MTBSR, nrecords))
+
+    def skip_records(self, fileobj, nrecords):
+        """
+        Move the tape forward nrecords records (ie blocks), without reading
+        them. As backspace_records(), this is for use while we have the
+        device open, to read a tar archive.
+        """
+        self.logger.debug("Skipping %d records on %s", nrecords, self.dev)
+        fcntl.ioctl(fileobj.fileno(), MTIOCTOP,
+                    struct.pack('hi', MTFSR, nrecords))
+
     def eod(self, fail=True):
         """
         Send the tape to eod
@@ -252,13 +335,13 @@ class TapeDrive(object):
             self.rewind()
             self.setblk0()
             self.logger.debug("Looking for tapelabel in tar file...")
-            tar = tarfile.open(name=self.dev, mode='r|')
+            tar = self.opentar(mode='r|')
             tarnames = tar.getnames()
             tar.close()
             self.rewind()
             if tarnames == ['tapelabel']:
                 self.logger.debug("Reading tapelabel tar file...")
-                tar = tarfile.open(name=self.dev, mode='r|')
+                tar = self.opentar(mode='r|')
                 self.cdworkingdir()
                 tar.extractall()
                 tar.close()
@@ -302,7 +385,7 @@ class TapeDrive(object):
             f = open('tapelabel', 'w')
             f.write(label)
             f.close()
-            tar = tarfile.open(name=self.dev, mode='w|')
+            tar = self.opentar(mode='w|')
             tar.add('tapelabel')
             tar.close()
             os.unlink('tapelabel')
@@ -317,6 +400,17 @@ class TapeDrive(object):
                 raise
 
 
+def get_tapedrive(device, scratchdir, logger=None):
+    """
+    Return a TapeDrive for device, or if device is a directory, a
+    TapeEmulator that keeps the tape in that directory.
+    """
+    if os.path.isdir(device):
+        from fits_storage.server.tapeemulator import TapeEmulator
+        return TapeEmulator(device, scratchdir, logger=logger)
+    return TapeDrive(device, scratchdir, logger=logger)
+
+
 class FileOnTapeHelper(object):
     """
     This class streamlines querying if a file is on tape via the API. It
@@ -324,8 +418,15 @@ class FileOnTapeHelper(object):
     times you need to hit the API.
 
     You should instantiate this class once before looping through files, then
-    call the methods on it as appropriate for each file. Be aware if using this
-    in long-running processes that the cache can grow huge.
+    call the methods on it as appropriate for each file. If you know the files
+    you are going to check in advance, call populate_cache_bulk() with them
+    first, to get the results for all of them in one request. Be aware if
+    using this in long-running processes that the cache can grow huge.
+
+    The cache is a dictionary keyed by (trimmed_filename, data_md5), where
+    the trimmed filename has no .bz2, of the set of tape_ids that version of
+    the file is on. We also keep the data_md5s we have for each trimmed
+    filename, for checking without an md5, and the tape_set of each tape.
 
     As well as querying the tapeserver, this class can be used as a similarly
     caching query of the archive.
@@ -333,54 +434,134 @@ class FileOnTapeHelper(object):
     tapeserver = None
     archive = None
     _cache = None
+    _md5s = None
+    _tape_sets = None
     _queried = None
+    _queried_files = None
     reqses = None
 
+    # The maximum number of filenames to send in one bulk request
+    bulk_chunk = 20000
+
     def __init__(self, tapeserver=None, archive=None, logger=None):
         fsc = get_config()
         self.reqses = requests.Session()
         self.tapeserver = fsc.tape_server if tapeserver is None else tapeserver
         self.archive = archive
-        self._cache = []
+        self._cache = {}
+        self._md5s = {}
+        self._tape_sets = {}
         self._queried = []
+        self._queried_files = set()
         self.logger = DummyLogger() if logger is None else logger
 
+    def _results(self, req, server):
+        if req.status_code != http.HTTPStatus.OK:
+            self.logger.warning(f"Got HTTP status {req.status_code} from "
+                                f"{server}",)
+            return None
+        results = []
+        for i in req.json():
+            # We add a trimmed_filename to each entry now for efficiency
+            i['trimmed_filename'] = i['filename'].removesuffix(".bz2")
+            results.append(i)
+        return results
+
     def query_api(self, filepre):
         """
-        Query the server and return a list of dictionaries in the same format
-        as the cache. The cache is a list of dictionaries. This may not be most
-        efficient, but it's simple and robust.
+        Query the server and return a list of dictionaries of the results
+        for files starting with filepre:
         [{'filename': 'file.fits.bz2', 'trimmed_filename': 'file.fits',
         'data_md5': abc123, 'tape_id': 123, 'tape_set': 321}, ...]
         """
-        results = []
         server = self.archive if self.archive else self.tapeserver
         self.logger.debug(f"Querying {server} for {filepre}")
         self._queried.append(filepre)
         thing = "jsonfilelist/filepre=" if self.archive else "jsontapefile/"
         url = f"{server}/{thing}{filepre}"
 
-        req = self.reqses.get(url)
-        if req.status_code != http.HTTPStatus.OK:
-            self.logger.warning(f"Got HTTP status {req.status_code} from "
-                                f"{server}",)
-            return None
-        for i in req.json():
-            # We add a trimmed_filename to each entry now for efficiency
-            i['trimmed_filename'] = i['filename'].removesuffix(".bz2")
-            results.append(i)
-        return results
+        return self._results(self.reqses.get(url), server)
+
+    def query_api_bulk(self, filenames):
+        """
+        As query_api, but for a list of filenames (with or without .bz2),
+        which are POSTed to the tapeserver in one request.
+        """
+        self.logger.debug(f"Querying {self.tapeserver} for {len(filenames)} "
+                          f"files")
+        url = f"{self.tapeserver}/jsontapefile"
+
+        return self._results(self.reqses.post(url, json=list(filenames)),
+                             self.tapeserver)
+
+    def add_results(self, results):
+        """
+        Add a list of api results to the cache
+        """
+        for item in results:
+            tfilename = item['trimmed_filename']
+            data_md5 = item['data_md5']
+            tape_id = True if self.archive else item['tape_id']
+            self._cache.setdefault((tfilename, data_md5), set()).add(tape_id)
+            self._md5s.setdefault(tfilename, set()).add(data_md5)
+            if not self.archive:
+                self._tape_sets[tape_id] = item.get('tape_set')
+
+    def cached_count(self):
+        """
+        Returns the number of versions of files - distinct (filename,
+        data_md5) combinations - that we have cached results for.
+        """
+        return len(self._cache)
 
     def populate_cache(self, filepre):
         results = self.query_api(filepre)
         if results:
             self.logger.debug("Extending cache by %d results", len(results))
-            self._cache.extend(results)
+            self.add_results(results)
             return True
         else:
             self.logger.debug("Got no results to cache")
             return False
 
+    def populate_cache_bulk(self, filenames):
+        """
+        Get the results for all the filenames into the cache, with one
+        request per bulk_chunk files. Files with no results are remembered,
+        so check_file() won't query for them again. Returns False if any of
+        the requests failed.
+
+        The archive POST jsonfilelist only finds files by path and filename,
+        so for the archive we query the filepre for each of the files, which
+        is one request per night rather than per file.
+        """
+        filenames = sorted({f.removesuffix('.bz2') for f in filenames}
+                           - self._queried_files)
+        ok = True
+        if self.archive:
+            failed = set()
+            filepres = {self.make_filepre(f) for f in filenames}
+            for filepre in sorted(filepres - set(self._queried)):
+                results = self.query_api(filepre)
+                if results is None:
+                    failed.add(filepre)
+                else:
+                    self.add_results(results)
+            self._queried_files.update(f for f in filenames
+                                       if self.make_filepre(f) not in failed)
+            return not failed
+
+        for i in range(0, len(filenames), self.bulk_chunk):
+            chunk = filenames[i:i+self.bulk_chunk]
+            results = self.query_api_bulk(chunk)
+            if results is None:
+                ok = False
+                continue
+            self.logger.debug("Extending cache by %d results", len(results))
+            self.add_results(results)
+            self._queried_files.update(chunk)
+        return ok
+
     def make_filepre(self, filename):
         """
         This generates a filepre from a filename, to trigger a certain
@@ -402,40 +583,60 @@ class FileOnTapeHelper(object):
             return filename[:13]
         return filename
 
-    def check_results(self, filename, data_md5=None, api_results=None):
+    def check_results(self, filename, data_md5=None, api_results=None,
+                      tape_set=None):
         """
-        Check of a filename / data_md5 combination in a list of api results
-        that is in the cache format. If api_results is None, we use the
-        cache. If data_md5 is None, we don't match on md5.
-        Returns a set containing the tape_ids the file is on.
+        Check of a filename / data_md5 combination in a list of api results.
+        If api_results is None, we use the cache. If data_md5 is None, we
+        don't match on md5. If tape_set is given, only tapes in that set are
+        counted. Returns a set containing the tape_ids the file is on.
         """
-        tape_ids = set()
-        api_results = api_results if api_results else self._cache
         tfilename = filename.removesuffix('.bz2')
 
-        for item in api_results:
-            if item['trimmed_filename'] == tfilename:
-                if (data_md5 is None) or (data_md5 == item['data_md5']):
-                    if self.archive:
-                        tape_ids.add(True)
-                    else:
-                        tape_ids.add(item['tape_id'])
+        if api_results is not None:
+            tape_ids = set()
+            for item in api_results:
+                if item['trimmed_filename'] == tfilename:
+                    if (data_md5 is None) or (data_md5 == item['data_md5']):
+                        if self.archive:
+                            tape_ids.add(True)
+                        elif tape_set is None or \
+                                item.get('tape_set') == tape_set:
+                            tape_ids.add(item['tape_id'])
+            return tape_ids
+
+        if data_md5 is None:
+            md5s = self._md5s.get(tfilename, ())
+        else:
+            md5s = (data_md5, )
+        tape_ids = set()
+        for md5 in md5s:
+            tape_ids.update(self._cache.get((tfilename, md5), ()))
+        if tape_set is not None and not self.archive:
+            tape_ids = {tape_id for tape_id in tape_ids
+                        if self._tape_sets.get(tape_id) == tape_set}
         return tape_ids
 
-    def check_file(self, filename, data_md5=None):
+    def check_file(self, filename, data_md5=None, tape_set=None):
         """
-        Check if a file is on tape. First check the cache. If cache miss,
-        form a filepre for a direct query and check if we queried it already.
-        If not, query it, check those results, and add them to the cache.
+        Check if a file is on tape. First check the cache. If cache miss, and
+        we haven't already queried the file in bulk, form a filepre for a
+        direct query and check if we queried it already. If not, query it,
+        check those results, and add them to the cache.
         Return the set of tape_ids the file is on.
         """
 
         # Check the cache
-        cache_results = self.check_results(filename, data_md5)
+        cache_results = self.check_results(filename, data_md5,
+                                           tape_set=tape_set)
         if cache_results:
             self.logger.debug("Cache hit for %s", filename)
             return cache_results
 
+        if filename.removesuffix('.bz2') in self._queried_files:
+            self.logger.debug("File %s already checked, no results", filename)
+            return set()
+
         # Cache miss, get a filepre and query it
         self.logger.debug("Cache miss for %s", filename)
         filepre = self.make_filepre(filename)
@@ -445,6 +646,9 @@ class FileOnTapeHelper(object):
             return set()
         else:
             api_results = self.query_api(filepre)
-            new_results = self.check_results(filename, data_md5, api_results)
-            self._cache.extend(api_results)
+            if api_results is None:
+                return set()
+            new_results = self.check_results(filename, data_md5, api_results,
+                                             tape_set=tape_set)
+            self.add_results(api_results)
             return new_results
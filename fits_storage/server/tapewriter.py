@@ -0,0 +1,439 @@
+"""
+This module provides the classes used to write tar archives of files to tape.
+
+The files are read once, in a background thread which reads ahead of the tape
+and calculates the md5sum of each file as it reads it, so the drive can keep
+streaming while we open and read the next file, and we don't have to read
+every file a second time to check it before writing it. The archive is written
+in records of a fixed (and large) block size. If a file turns out not to match
+the md5sum we have for it, we roll the archive back to the end of the previous
+file, and carry on with the next one.
+"""
+import bisect
+import hashlib
+import os
+import queue
+import tarfile
+import threading
+
+from sqlalchemy import insert, select, exists, asc, nullslast
+
+from fits_storage.core.orm.file import File
+from fits_storage.core.orm.diskfile import DiskFile
+from fits_storage.core.orm.header import Header
+from fits_storage.server.orm.tapestuff import Tape, TapeWrite, TapeFile
+from fits_storage.logger_dummy import DummyLogger
+
+from fits_storage.config import get_config
+
+
+class SourceError(Exception):
+    """
+    Raised by TarTapeWriter.add() if the data for a member could not be read,
+    or did not match what we expected. The archive has been rolled back to the
+    end of the previous member when this is raised, so the caller can simply
+    carry on with the next one.
+    """
+    pass
+
+
+class ReadAhead(object):
+    """
+    Read a list of files, one after the other, in a background thread, and
+    pass the data back in blocks through a bounded queue, calculating the
+    size and md5sum of each file as we go. At most depth blocks are held in
+    the queue, so this uses about depth * blocksize bytes of memory.
+
+    Iterate this object to get a ReadAheadFile for each file, in order. You
+    must read all the blocks from one before moving on to the next.
+    """
+    def __init__(self, paths, blocksize=1048576, depth=16):
+        self.paths = paths
+        self.blocksize = blocksize
+        self.queue = queue.Queue(maxsize=max(depth, 2))
+        self._stop = threading.Event()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _put(self, item):
+        # Don't block forever if the consumer has gone away
+        while not self._stop.is_set():
+            try:
+                self.queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _run(self):
+        for path in self.paths:
+            try:
+                with open(path, 'rb', buffering=0) as f:
+                    if not self._put(('open', os.fstat(f.fileno()))):
+                        return
+                    hashobj = hashlib.md5()
+                    size = 0
+                    while chunk := f.read(self.blocksize):
+                        hashobj.update(chunk)
+                        size += len(chunk)
+                        if not self._put(('data', chunk)):
+                            return
+            except OSError as e:
+                if not self._put(('error', e)):
+                    return
+                continue
+            if not self._put(('eof', (size, hashobj.hexdigest()))):
+                return
+
+    def __iter__(self):
+        for path in self.paths:
+            kind, value = self.queue.get()
+            yield ReadAheadFile(self, path, kind, value)
+
+    def close(self):
+        self._stop.set()
+        self.thread.join()
+
+
+class ReadAheadFile(object):
+    """
+    One of the files read by a ReadAhead. stat is the os.stat result for the
+    file, or None if it could not be opened, in which case error is the
+    exception. Iterate blocks() to get the data. size and md5 are set once
+    all the data have been read.
+    """
+    def __init__(self, readahead, path, kind, value):
+        self.readahead = readahead
+        self.path = path
+        self.stat = value if kind == 'open' else None
+        self.error = value if kind == 'error' else None
+        self.size = None
+        self.md5 = None
+
+    def blocks(self):
+        if self.error is not None:
+            raise self.error
+        while True:
+            kind, value = self.readahead.queue.get()
+            if kind == 'data':
+                yield value
+            elif kind == 'eof':
+                self.size, self.md5 = value
+                return
+            else:
+                self.error = value
+                raise value
+
+
+def seek_backspace(fileobj, nrecords, blocksize):
+    """
+    Move back nrecords records in a regular file that we are writing a tar
+    archive to, and discard everything after that point. This is what a tape
+    drive does when we backspace and then write.
+    """
+    fileobj.seek(-nrecords * blocksize, os.SEEK_CUR)
+    fileobj.truncate()
+
+
+class TarTapeWriter(object):
+    """
+    Write a tar archive to a tape device, or any other unbuffered file-like
+    object, in records of exactly blocksize bytes, so that each write() is
+    one block on the tape.
+
+    The end of the last member that was written successfully generally falls
+    part way through a record, which has not been written yet. We keep a copy
+    of that partial record, so that if the next member goes wrong, we can roll
+    back by backspacing over the records written since, and carrying on from
+    the partial record. backspace is called as backspace(fileobj, nrecords,
+    blocksize) to do that - the default seeks back in a regular file, use
+    TapeDrive.backspace_records for tape devices.
+    """
+    def __init__(self, fileobj, blocksize=1048576, backspace=None,
+                 format=tarfile.DEFAULT_FORMAT):
+        if blocksize % tarfile.BLOCKSIZE:
+            raise ValueError("Tape block size must be a multiple of %d" %
+                             tarfile.BLOCKSIZE)
+        self.fileobj = fileobj
+        self.blocksize = blocksize
+        self.backspace = seek_backspace if backspace is None else backspace
+        self.format = format
+        self.buffer = bytearray()
+        self.records = 0
+        self.good_records = 0
+        self.good_buffer = b''
+        self.closed = False
+
+    @property
+    def offset(self):
+        """
+        The offset in bytes from the start of the archive that the next
+        member will be written at.
+        """
+        return self.records * self.blocksize + len(self.buffer)
+
+    @property
+    def written(self):
+        """
+        The number of bytes of the archive that have actually been written
+        to the tape, rather than being held in the buffer.
+        """
+        return self.records * self.blocksize
+
+    def _write(self, data):
+        self.buffer += data
+        if len(self.buffer) < self.blocksize:
+            return
+        view = memoryview(self.buffer)
+        pos = 0
+        try:
+            while len(self.buffer) - pos >= self.blocksize:
+                with view[pos:pos+self.blocksize] as record:
+                    n = self.fileobj.write(record)
+                if n != self.blocksize:
+                    # A short write on a tape means we hit the end of it
+                    raise OSError("Short write to tape: wrote %s of %d bytes"
+                                  % (n, self.blocksize))
+                pos += self.blocksize
+                self.records += 1
+        finally:
+            view.release()
+            del self.buffer[:pos]
+
+    def rollback(self):
+        """
+        Roll the archive back to the end of the last member that was added
+        successfully.
+        """
+        nrecords = self.records - self.good_records
+        if nrecords:
+            self.backspace(self.fileobj, nrecords, self.blocksize)
+        self.records = self.good_records
+        self.buffer = bytearray(self.good_buffer)
+
+    def add(self, tarinfo, source, md5=None):
+        """
+        Add a member to the archive. tarinfo is a TarInfo object giving the
+        name, size, etc. of the member and source gives the data. source is
+        normally a ReadAheadFile, which calculates the md5sum as it reads the
+        data, but can be any iterable of bytes objects, in which case we
+        calculate the md5sum here. If md5 is given, this is the md5sum we
+        expect the data to have.
+
+        Returns the md5sum of the data. If we can't read the data, or it is
+        not the size in tarinfo, or it does not match md5, we roll back the
+        archive and raise SourceError. Errors writing the archive are not
+        caught here.
+        """
+        if isinstance(source, ReadAheadFile):
+            hashobj = None
+            blocks = source.blocks()
+        else:
+            hashobj = hashlib.md5()
+            blocks = iter(source)
+
+        self._write(tarinfo.tobuf(self.format))
+        size = 0
+        while True:
+            try:
+                chunk = next(blocks)
+            except StopIteration:
+                break
+            except Exception as e:
+                self.rollback()
+                raise SourceError("Error reading %s: %s" %
+                                  (tarinfo.name, e)) from e
+            size += len(chunk)
+            # If the file has grown, we still read the rest of it so that
+            # the read ahead is at the start of the next file.
+            if size <= tarinfo.size:
+                if hashobj is not None:
+                    hashobj.update(chunk)
+                self._write(chunk)
+
+        if size != tarinfo.size:
+            self.rollback()
+            raise SourceError("Size mismatch for %s: expected %d bytes, read "
+                              "%d" % (tarinfo.name, tarinfo.size, size))
+        actual_md5 = source.md5 if hashobj is None else hashobj.hexdigest()
+        if md5 is not None and actual_md5 != md5:
+            self.rollback()
+            raise SourceError("md5sum mismatch for %s: file: %s, expected: %s"
+                              % (tarinfo.name, actual_md5, md5))
+
+        remainder = size % tarfile.BLOCKSIZE
+        if remainder:
+            self._write(tarfile.NUL * (tarfile.BLOCKSIZE - remainder))
+        self.good_records = self.records
+        self.good_buffer = bytes(self.buffer)
+        return actual_md5
+
+    def close(self):
+        """
+        Write the end of archive marker and pad out the last record. This
+        does nothing if the archive has already been closed.
+        """
+        if self.closed:
+            return
+        self.closed = True
+        self._write(tarfile.NUL * (2 * tarfile.BLOCKSIZE))
+        if self.buffer:
+            self._write(tarfile.NUL * (self.blocksize - len(self.buffer)))
+        self.good_records = self.records
+        self.good_buffer = b''
+
+
+def list_tape_diskfiles(session, selection, tape_ids=None, skip=False,
+                        yield_per=1000):
+    """
+    Return a list of the DiskFiles that satisfy selection, in ut_datetime
+    order, leaving out those that are already on tape, in one query.
+
+    If skip is True, we leave out files that are already on any active tape.
+    Otherwise, if tape_ids is given, we leave out files that are already on
+    any of those tapes. A file is on a tape if a TapeFile with the same
+    filename and md5 is part of a successful TapeWrite to the tape.
+
+    The results are streamed from the database yield_per at a time (using a
+    server side cursor, on postgres). The DiskFiles are expunged from the
+    session, so that committing the session while writing the tape doesn't
+    expire them, which would reload each one from the database as we use it.
+    """
+    query = session.query(DiskFile).select_from(Header)\
+        .join(DiskFile, Header.diskfile_id == DiskFile.id)\
+        .join(File, DiskFile.file_id == File.id)
+    query = selection.filter(query)
+
+    if skip or tape_ids:
+        on_tape = select(TapeFile.id)\
+            .join(TapeWrite, TapeFile.tapewrite_id == TapeWrite.id)\
+            .join(Tape, TapeWrite.tape_id == Tape.id)\
+            .where(Tape.active == True)\
+            .where(TapeWrite.succeeded == True)\
+            .where(TapeFile.filename == DiskFile.filename)\
+            .where(TapeFile.md5 == DiskFile.file_md5)
+        if not skip:
+            on_tape = on_tape.where(Tape.id.in_(tape_ids))
+        query = query.filter(~exists(on_tape))
+
+    query = query.order_by(nullslast(asc(Header.ut_datetime)), DiskFile.id)
+
+    diskfiles = []
+    for diskfile in query.yield_per(yield_per):
+        session.expunge(diskfile)
+        diskfiles.append(diskfile)
+    return diskfiles
+
+
+def make_tarinfo(name, stat):
+    """
+    Make a TarInfo for a regular file called name in the archive, with
+    properties from the os.stat result stat.
+    """
+    tarinfo = tarfile.TarInfo(name)
+    tarinfo.size = stat.st_size
+    tarinfo.mtime = stat.st_mtime
+    tarinfo.mode = stat.st_mode
+    tarinfo.type = tarfile.REGTYPE
+    tarinfo.uid = stat.st_uid
+    tarinfo.gid = stat.st_gid
+    return tarinfo
+
+
+def write_diskfiles(session, tapewrite, writer, diskfiles, checkpoint=1000,
+                    readahead=None, logger=DummyLogger()):
+    """
+    Write diskfiles to the archive being written by writer, checking each
+    against its file_md5 as we go, and record them as TapeFiles in tapewrite.
+    Each TapeFile records the offset of its tar header in the archive, and
+    the block that is in, so we can go straight to it when reading the tape.
+    When all the files have been added, we close the writer, which writes the
+    end of the archive.
+
+    The TapeFile rows are inserted in bulk, every checkpoint files, along
+    with updating tapewrite.size. A file is only recorded once all of it has
+    actually been written to the tape - the end of the most recent files is
+    generally still in the writer's buffer, waiting to fill a record, and is
+    recorded at a later checkpoint. Files which don't match their md5sum, or
+    which can't be read are logged and left out of the archive.
+
+    readahead is the number of bytes of data to read ahead of the tape. It
+    defaults to the tape_readahead_mb configuration value.
+
+    Returns a tuple (bytecount, bad) of the number of bytes of files written
+    and a list of the diskfiles that were left out. Errors writing the archive
+    are raised as they are, after trying to close the writer so that the
+    archive is terminated. The files recorded at checkpoints before the error
+    stay recorded, but those since are not.
+    """
+    if readahead is None:
+        readahead = get_config().tape_readahead_mb * 1048576
+    bytecount = 0
+    bad = []
+    # TapeFile rows not recorded yet, with the offsets their members end at
+    rows = []
+    ends = []
+    added = 0
+
+    def do_checkpoint():
+        # Record the files that are completely on the tape
+        n = bisect.bisect_right(ends, writer.written)
+        if n:
+            logger.debug("Checkpoint: adding %d TapeFile records", n)
+            session.execute(insert(TapeFile), rows[:n])
+            tapewrite.size = (tapewrite.size or 0) + \
+                sum(row['size'] for row in rows[:n])
+            del rows[:n]
+            del ends[:n]
+        session.commit()
+
+    reader = ReadAhead([df.fullpath for df in diskfiles],
+                       blocksize=writer.blocksize,
+                       depth=readahead // writer.blocksize)
+    try:
+        for df, rafile in zip(diskfiles, reader):
+            if rafile.stat is None:
+                logger.error("Cannot open %s - not writing it to tape: %s",
+                             df.filename, rafile.error)
+                bad.append(df)
+                continue
+            logger.debug("Adding %s to tar archive", df.filename)
+            tarinfo = make_tarinfo(df.filename, rafile.stat)
+            offset = writer.offset
+            try:
+                writer.add(tarinfo, rafile, md5=df.file_md5)
+            except SourceError as e:
+                logger.error("%s - rolled back the tar archive and not "
+                             "writing it to tape", e)
+                bad.append(df)
+                continue
+
+            rows.append({'tapewrite_id': tapewrite.id,
+                         'filename': df.filename,
+                         'md5': df.file_md5,
+                         'size': df.file_size,
+                         'lastmod': df.lastmod,
+                         'compressed': df.compressed,
+                         'data_size': df.data_size,
+                         'data_md5': df.data_md5,
+                         'offset': offset,
+                         'block': offset // writer.blocksize})
+            ends.append(writer.offset)
+            bytecount += df.file_size
+            added += 1
+            if added % checkpoint == 0:
+                do_checkpoint()
+        writer.close()
+    except Exception:
+        try:
+            writer.close()
+        except Exception:
+            logger.error("Exception closing tar archive after error",
+                         exc_info=True)
+        raise
+    finally:
+        reader.close()
+
+    # Everything is on the tape now
+    do_checkpoint()
+    return bytecount, bad
@@ -23,7 +23,7 @@ from fits_storage.web.fileserver import fileserver, download, download_post
 
 from fits_storage.web.searchform import searchform, nameresolver
 from fits_storage.web.file_list import xmlfilelist, jsonfilelist, \
-    jsonsummary, jsonqastate
+    jsonfilelist_post, jsonsummary, jsonqastate
 
 from fits_storage.web.progsobserved import progsobserved, sitemap
 
@@ -35,11 +35,11 @@ from fits_storage.web.user import whoami, login, logout, request_account, \
 from fits_storage.web.userprogram import my_programs
 
 from fits_storage.web.tapestuff import tape, tapewrite, tapefile, \
-    jsontapefilelist, taperead
+    jsontapefilelist, jsontapefilelist_post, taperead
 
 from fits_storage.web.upload_file import upload_file
 
-from fits_storage.web.update_headers import update_headers
+from fits_storage.web.update_headers import update_headers, header_delta
 
 from fits_storage.web.qastuff import qareport, qametrics, qaforgui
 
@@ -118,6 +118,7 @@ url_map = Map([
     Rule('/tapewrite/<label>', tapewrite),
     Rule('/tapefile/<int:tapewrite_id>', tapefile),
     Rule('/jsontapefile/<filepre>', jsontapefilelist),
+    Rule('/jsontapefile', jsontapefilelist_post, methods=['POST']),
     Rule('/taperead', taperead),
 
     # Diskfile Reports - you can give these either a diskfile_id or a filename
@@ -153,6 +154,7 @@ url_map = Map([
     Rule('/nameresolver/<resolver>/<target>', nameresolver),
     Rule('/xmlfilelist/<selection:selection>', xmlfilelist),
     Rule('/jsonfilelist/<selection:selection>', jsonfilelist),
+    Rule('/jsonfilelist', jsonfilelist_post, methods=['POST']),
     Rule('/jsonfilenames/<selection:selection>', partial(jsonfilelist,
                                                          fields={'name'})),
     Rule('/jsonsummary/<selection:selection>', jsonsummary,
@@ -173,7 +175,8 @@ url_map = Map([
     Rule('/reduction/<thing>', reduction),
 
     # Previews
-    Rule('/preview/<seq_of:things>', preview),
+    Rule('/preview/<seq_of:things>', preview,
+         collect_qs_args=dict(size='size'), defaults=dict(size=None)),
 
     # QA metrics
     Rule('/qareport', qareport, methods=['POST']),
@@ -184,6 +187,7 @@ url_map = Map([
     Rule('/notification', notification),
 
     Rule('/update_headers', update_headers, methods=['POST']),
+    Rule('/header_delta/<seq_of:things>', header_delta, methods=['POST']),
     Rule('/ingest_programs', ingest_programs, methods=['POST']),
 
     # Publication handling.
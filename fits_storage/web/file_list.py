@@ -6,14 +6,17 @@ from sqlalchemy import Integer, Text, DateTime, Numeric, Date, Time, \
 from fits_storage.core.orm.header import Header
 from fits_storage.core.orm.diskfile import DiskFile
 from fits_storage.core.orm.file import File
-from fits_storage.db.list_headers import list_headers
+from fits_storage.db.list_headers import list_headers, list_search_rows
+from fits_storage.db.selection import Selection
 from fits_storage.db.list_obslogs import  list_obslogs
 from fits_storage.web.standards import get_standard_obs, list_phot_std_obs
 from fits_storage.queues.orm.ingestqueueentry import IngestQueueEntry
+from fits_storage.queues.orm.fileopsqueueentry import FileopsQueueEntry
 
 from fits_storage.server.access_control_utils import canhave_coords
 
 from fits_storage.server.wsgi.context import get_context
+from fits_storage.server.wsgi.returnobj import Return
 
 from fits_storage.config import get_config
 
@@ -54,7 +57,8 @@ def diskfile_dicts(headers, return_header=False):
             thedict[field] = _for_json(getattr(header.diskfile, field))
         thedict['size'] = thedict['file_size']
         thedict['md5'] = thedict['file_md5']
-        # Check for presence on ingest queue
+        # Check for presence on ingest queue. A header update on the fileops
+        # queue will be followed by an ingest, so that counts too.
         thedict['pending_ingest'] = None
         ctx = get_context()
         fname = header.diskfile.file.name
@@ -65,6 +69,10 @@ def diskfile_dicts(headers, return_header=False):
             query = ctx.session.query(IngestQueueEntry)\
                 .filter(IngestQueueEntry.filename.like(fname))
             thedict['pending_ingest'] = query.count() > 0
+            if not thedict['pending_ingest']:
+                query = ctx.session.query(FileopsQueueEntry)\
+                    .filter(FileopsQueueEntry.filename.like(fname))
+                thedict['pending_ingest'] = query.count() > 0
 
         if not return_header:
             yield thedict
@@ -72,6 +80,43 @@ def diskfile_dicts(headers, return_header=False):
             yield thedict, header
 
 
+def searchrow_dicts(rows):
+    """
+    The equivalent of diskfile_dicts(headers, return_header=True) for
+    SearchRow objects. SearchRow has all the diskfile and header fields, so we
+    yield (dict, row) tuples and the row is used in place of the header.
+    The pending ingest check is done in one query per queue for all the rows.
+    """
+    ctx = get_context()
+    basenames = {}
+    for row in rows:
+        if row.file_name is not None:
+            fname = row.file_name
+            basenames[row.header_id] = fname[:-4] \
+                if fname.endswith('.bz2') else fname
+    pending = set()
+    if basenames:
+        names = set(basenames.values())
+        names |= {f"{name}.bz2" for name in names}
+        for entry in (IngestQueueEntry, FileopsQueueEntry):
+            query = ctx.session.query(entry.filename)\
+                .filter(entry.filename.in_(names))
+            pending |= {fname[:-4] if fname.endswith('.bz2') else fname
+                        for (fname,) in query}
+
+    for row in rows:
+        thedict = {}
+        thedict['name'] = _for_json(row.file_name)
+        for field in diskfile_fields:
+            thedict[field] = _for_json(getattr(row, field))
+        thedict['size'] = thedict['file_size']
+        thedict['md5'] = thedict['file_md5']
+        thedict['pending_ingest'] = None
+        if row.header_id in basenames:
+            thedict['pending_ingest'] = basenames[row.header_id] in pending
+        yield thedict, row
+
+
 def jsonfilelist(selection, fields=None):
     """
     This generates a JSON list of the files that met the selection.
@@ -105,6 +150,38 @@ def jsonfilelist(selection, fields=None):
 
 
 
+def jsonfilelist_post():
+    """
+    This is a POST version of jsonfilelist for looking up many files at once.
+    The POST data is a json list of "path/filename" strings (or just
+    "filename" if the path is empty), and we send the jsonfilelist for the
+    present files that match any of them, with or without a .bz2.
+
+    The exporter uses this to check which of a batch of files are already at
+    the destination with one request rather than one request per file.
+    Obslogs are not handled here, as they have no header entries.
+    """
+    ctx = get_context()
+
+    try:
+        files = ctx.json
+        if not isinstance(files, list) or \
+                not all(isinstance(f, str) for f in files):
+            raise ValueError
+    except (ValueError, TypeError):
+        ctx.resp.status = Return.HTTP_BAD_REQUEST
+        return
+
+    filelist = set()
+    for f in files:
+        f = f.removesuffix('.bz2')
+        filelist.update((f, f + '.bz2'))
+
+    selection = Selection({'present': True, 'filelist': sorted(filelist)})
+    headers = list_headers(selection, ['filename_asc'], unlimit=True)
+    ctx.resp.send_json(list(diskfile_dicts(headers)), indent=4)
+
+
 header_fields = ('program_id', 'engineering', 'science_verification',
                  'processing', 'calibration_program', 'observation_id',
                  'data_label', 'telescope', 'instrument', 'ut_datetime',
@@ -148,9 +225,19 @@ def jsonsummary(selection, orderby=None):
     user = ctx.user
     gotmagic = ctx.got_magic
 
-    headers = list_headers(selection, orderby)
+    fsc = get_config()
+    rows = None
+    if fsc.using_search_row:
+        rows = list_search_rows(selection, orderby)
+    if rows is not None:
+        # These come straight from the search_row table with no joins
+        dicts = searchrow_dicts(rows)
+    else:
+        headers = list_headers(selection, orderby)
+        dicts = diskfile_dicts(headers, return_header=True)
+
     thelist = []
-    for thedict, header in diskfile_dicts(headers, return_header=True):
+    for thedict, header in dicts:
         chc = canhave_coords(ctx.session, user, header, gotmagic)
         for field in header_fields:
             thedict[field] = _for_json(getattr(header, field))
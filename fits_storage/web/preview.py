@@ -1,4 +1,5 @@
 import datetime
+import email.utils
 import os
 
 from sqlalchemy.exc import MultipleResultsFound, NoResultFound
@@ -18,13 +19,14 @@ from fits_storage import utcnow
 fsc = get_config()
 
 if fsc.using_s3:
-    from fits_storage.server.aws_s3 import Boto3Helper
+    from botocore.exceptions import ClientError
+    from fits_storage.server.aws_s3 import Boto3Helper, key_missing
     s3 = Boto3Helper()
 
 from fits_storage.server.access_control_utils import icanhave
 
 
-def preview(things):
+def preview(things, size=None):
     """
     This is the preview server, it sends you the preview jpg/png for the
     requested file. It handles authentication in that it won't give you the
@@ -32,11 +34,21 @@ def preview(things):
 
     things is a list of / separated things from the request, which could have
     just been a header_id
+
+    size is from the size= query argument. If given, we send the smallest
+    version of the preview that is at least that many pixels wide and high,
+    if there are smaller versions, or the full size preview if not.
     """
 
     ctx = get_context()
     session = ctx.session
 
+    if size is not None:
+        try:
+            size = int(size[0])
+        except ValueError:
+            return Return.HTTP_BAD_REQUEST
+
     header = None
     try:
         header_id = int(things[0])
@@ -81,7 +93,7 @@ def preview(things):
         # Is the client allowed to get this file?
         if icanhave(ctx, header):
             # Send them the data if we can
-            sendpreview(header.diskfile.preview.filename)
+            sendpreview(header.diskfile.preview.filename_for_size(size))
         else:
             # Refuse to send data
             downloadlog.numdenied = 1
@@ -91,12 +103,80 @@ def preview(things):
         downloadlog.query_completed = utcnow()
 
 
+def not_modified(env, etag, last_modified):
+    """
+    Returns True if the conditional request headers in the wsgi environment
+    env show that the client already has the current version of a resource
+    with the given etag and last_modified datetime. As per RFC 9110,
+    If-Modified-Since is ignored if If-None-Match is given.
+    """
+    if 'HTTP_IF_NONE_MATCH' in env:
+        tags = [tag.strip() for tag in env['HTTP_IF_NONE_MATCH'].split(',')]
+        return '*' in tags or etag in tags
+
+    if 'HTTP_IF_MODIFIED_SINCE' in env:
+        try:
+            since = email.utils.parsedate_to_datetime(
+                env['HTTP_IF_MODIFIED_SINCE'])
+        except (TypeError, ValueError):
+            return False
+        if since.tzinfo is None:
+            since = since.replace(tzinfo=datetime.timezone.utc)
+        # Last-Modified only has a resolution of one second
+        return last_modified.replace(microsecond=0) <= since
+
+    return False
+
+
 def sendpreview(filename):
     """
-    Send the one referenced preview file
+    Send the one referenced preview file, with ETag and Last-Modified
+    headers, or a 304 Not Modified response if the client has it already.
     """
 
-    resp = get_context().resp
+    ctx = get_context()
+    resp = ctx.resp
+
+    # Find the preview, and its ETag and modification time. The ETags are
+    # strong validators - they change whenever the preview file is replaced.
+    if fsc.using_s3:
+        # S3 file server. The GET response has the ETag and modification
+        # time, so we don't need a HEAD request first. Previews are small, so
+        # we don't mind having started the GET if we end up not sending it.
+        keyname = f"{fsc.preview_path}/{filename}"
+        try:
+            s3obj = s3.get_object(keyname)
+        except ClientError as clienterror:
+            if key_missing(clienterror):
+                resp.status = Return.HTTP_NOT_FOUND
+                return
+            raise
+        etag = s3obj['ETag']
+        last_modified = s3obj['LastModified']
+    else:
+        # Serve from regular file
+        fullpath = os.path.join(fsc.storage_root, fsc.preview_path, filename)
+        try:
+            stat = os.stat(fullpath)
+        except FileNotFoundError:
+            resp.status = Return.HTTP_NOT_FOUND
+            return
+        etag = f'"{stat.st_mtime_ns:x}-{stat.st_size:x}"'
+        last_modified = datetime.datetime.fromtimestamp(
+            stat.st_mtime, tz=datetime.timezone.utc)
+
+    # Previews can be proprietary, so only the client may cache them
+    resp.set_header('ETag', etag)
+    resp.set_header('Last-Modified',
+                    email.utils.format_datetime(last_modified, usegmt=True))
+    resp.set_header('Cache-Control', 'private, max-age=86400')
+
+    if not_modified(ctx.req.env, etag, last_modified):
+        if fsc.using_s3:
+            s3obj['Body'].close()
+        resp.status = Return.HTTP_NOT_MODIFIED
+        return
+
     resp.set_header('Content-Disposition', f'inline; filename="{filename}"')
 
     if filename.endswith('.jpg'):
@@ -106,11 +186,6 @@ def sendpreview(filename):
 
     # Send them the data
     if fsc.using_s3:
-        # S3 file server
-        keyname = f"{fsc.preview_path}/{filename}"
-        flo = s3.get_flo(keyname)
-        resp.append_iterable(flo)
+        resp.append_iterable(s3obj['Body'])
     else:
-        # Serve from regular file
-        fullpath = os.path.join(fsc.storage_root, fsc.preview_path, filename)
         resp.sendfile(fullpath)
@@ -116,6 +116,10 @@ def summary_body(sumtype, selection, orderby, links=True,
     # Did we get any selection warnings?
     if 'warning' in selection:
         querylog.add_note(f"Selection Warning: {selection['warning']}")
+    # Note how any object name search was done
+    if selection.object_search_strategy:
+        querylog.add_note("Object search strategy: %s" %
+                          selection.object_search_strategy)
     # Note any notrecognised in the querylog
     if 'notrecognised' in selection.keys():
         querylog.add_note("Selection NotRecognised: %s" %
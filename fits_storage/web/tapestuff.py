@@ -8,6 +8,7 @@ from fits_storage.server.orm.tapestuff import Tape, TapeWrite, TapeFile, \
 from . import templating
 
 from fits_storage.server.wsgi.context import get_context
+from fits_storage.server.wsgi.returnobj import Return
 
 from sqlalchemy import join, desc, func
 
@@ -17,28 +18,62 @@ from fits_storage import utcnow
 from .file_list import _for_json
 
 
+def _tapefile_dicts(condition):
+    """
+    Return a list of dictionaries describing the copies on active tapes of
+    the tapefiles matching the sqlalchemy condition, as sent by the
+    jsontapefile endpoints. We query the tape details along with the
+    tapefiles rather than loading them for each tapefile.
+    """
+    query = get_context().session.query(
+            TapeFile.filename, TapeFile.size, TapeFile.md5, Tape.id, Tape.set,
+            TapeFile.data_size, TapeFile.data_md5)\
+        .select_from(join(TapeFile, join(TapeWrite, Tape)))\
+        .filter(Tape.active == True).filter(TapeWrite.succeeded == True)\
+        .filter(condition)
+
+    keys = ('filename', 'size', 'md5', 'tape_id', 'tape_set', 'data_size',
+            'data_md5')
+    return [{key: _for_json(value) for key, value in zip(keys, row)}
+            for row in query]
+
+
 def jsontapefilelist(filepre):
     """
     This generates a JSON list of tapefiles where the filename starts with
     filepre
     """
-    tfs = get_context().session.query(TapeFile)\
-        .select_from(join(TapeFile, join(TapeWrite, Tape)))\
-        .filter(Tape.active == True).filter(TapeWrite.succeeded == True)\
-        .filter(TapeFile.filename.startswith(filepre)).all()
-
-    thelist = []
-    for tf in tfs:
-        thelist.append({'filename': _for_json(tf.filename),
-                        'size': _for_json(tf.size),
-                        'md5': _for_json(tf.md5),
-                        'tape_id': _for_json(tf.tapewrite.tape.id),
-                        'tape_set': _for_json(tf.tapewrite.tape.set),
-                        'data_size': _for_json(tf.data_size),
-                        'data_md5': _for_json(tf.data_md5)
-                        })
-
-    get_context().resp.send_json(thelist)
+    get_context().resp.send_json(
+        _tapefile_dicts(TapeFile.filename.startswith(filepre)))
+
+
+def jsontapefilelist_post():
+    """
+    This is a POST version of jsontapefile for looking up many files at once.
+    The POST data is a json list of filenames, and we send the list of
+    tapefiles for any of them, with or without a .bz2, in the same format as
+    jsontapefile.
+
+    FileOnTapeHelper uses this to find which tapes a whole batch of files are
+    on with one request rather than one per night of data.
+    """
+    ctx = get_context()
+
+    try:
+        files = ctx.json
+        if not isinstance(files, list) or \
+                not all(isinstance(f, str) for f in files):
+            raise ValueError
+    except (ValueError, TypeError):
+        ctx.resp.status = Return.HTTP_BAD_REQUEST
+        return
+
+    filelist = set()
+    for f in files:
+        f = f.removesuffix('.bz2')
+        filelist.update((f, f + '.bz2'))
+
+    ctx.resp.send_json(_tapefile_dicts(TapeFile.filename.in_(filelist)))
 
 
 @templating.templated("tapestuff/tape.html", with_generator=True)
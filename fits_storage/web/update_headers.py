@@ -1,4 +1,6 @@
+from sqlalchemy import select, literal, union_all
 from sqlalchemy.exc import NoResultFound, MultipleResultsFound
+from sqlalchemy.orm import aliased
 
 from fits_storage.server.wsgi.context import get_context
 from fits_storage.server.wsgi.returnobj import Return
@@ -15,6 +17,10 @@ from fits_storage.core.orm.header import Header
 from fits_storage.config import get_config
 fsc = get_config()
 
+# Maximum number of payload entries in each update_headers_batch fileops
+# request. Entries for the same file always go in the same request.
+UPDATE_BATCH_SIZE = 100
+
 
 def error_response(message, id=None):
     response = {'result': False, 'error': message}
@@ -50,6 +56,152 @@ def check_exists(session, fn=None, dl=None):
         return 2
 
 
+def _find_present_diskfiles(session, filenames, datalabels):
+    """
+    Look up the filenames and data labels given with a single database query.
+    Returns a dictionary mapping ('filename', name) and ('data_label', label)
+    to a dictionary mapping the id of each file found to a list of the ids of
+    its present diskfiles. Filenames are looked up without any .bz2 suffix.
+    """
+    names = {fn.removesuffix('.bz2') for fn in filenames}
+    datalabels = set(datalabels)
+
+    present_df = aliased(DiskFile)
+    present_on = (present_df.file_id == File.id) & (present_df.present == True)
+
+    queries = []
+    if names:
+        queries.append(
+            select(literal('filename'), File.name, File.id, present_df.id)
+            .outerjoin(present_df, present_on)
+            .where(File.name.in_(names)))
+    if datalabels:
+        queries.append(
+            select(literal('data_label'), Header.data_label, File.id,
+                   present_df.id)
+            .select_from(File)
+            .join(DiskFile, DiskFile.file_id == File.id)
+            .join(Header, Header.diskfile_id == DiskFile.id)
+            .outerjoin(present_df, present_on)
+            .where(DiskFile.canonical == True)
+            .where(Header.data_label.in_(datalabels)))
+
+    found = {}
+    if queries:
+        query = queries[0] if len(queries) == 1 else union_all(*queries)
+        for kind, name, file_id, diskfile_id in session.execute(query):
+            dfids = found.setdefault((kind, name), {}).setdefault(file_id, [])
+            if diskfile_id is not None:
+                dfids.append(diskfile_id)
+    return found
+
+
+def _exists_status(files):
+    # The check_exists() return value for a value from _find_present_diskfiles
+    if len(files) > 1:
+        return 2
+    n = sum(len(dfids) for dfids in files.values())
+    return 2 if n > 1 else n
+
+
+def check_exists_many(session, filenames=(), datalabels=()):
+    """
+    Equivalent to calling check_exists() for each of the filenames and data
+    labels given, but with a single database query.
+
+    Returns two dictionaries, mapping each filename and each data label to
+    the check_exists() return value for it: 0 if does not exist, 1 if does
+    exist, 2 if multiple files exist.
+    """
+    found = _find_present_diskfiles(session, filenames, datalabels)
+
+    return ({fn: _exists_status(found.get(('filename',
+                                           fn.removesuffix('.bz2')), {}))
+             for fn in filenames},
+            {dl: _exists_status(found.get(('data_label', dl), {}))
+             for dl in datalabels})
+
+
+def queue_header_updates(session, payload):
+    """
+    Validate the update_headers payload, check that the files exist, and add
+    update_headers_batch requests for them to the fileops queue. Returns a
+    list with a result dictionary for each entry in the payload.
+
+    We check all the files with a single query and add all the fileops
+    requests in a single transaction. Each entry is resolved to the present
+    diskfile it refers to, and entries are grouped by diskfile and split into
+    update_headers_batch requests of up to UPDATE_BATCH_SIZE entries. All the
+    entries for a file go in the same fileops request, whether they give its
+    filename, with or without .bz2, or its data label, so that two requests
+    can never be editing the same file at once. We add the diskfile id to
+    each entry, so that update_headers_batch edits each file once.
+    """
+    results = [None] * len(payload)
+    valid = []
+    for i, update in enumerate(payload):
+        fn = update.get('filename')
+        dl = update.get('data_label')
+        values = update.get('values')
+        if not isinstance(values, dict):
+            results[i] = error_response('This looks like a malformed request. '
+                                        'values should be a dictionary')
+            continue
+        if fn is None and dl is None:
+            results[i] = error_response('No filename or data_label given')
+            continue
+        if fn is not None and dl is not None:
+            results[i] = error_response('filename and data_label both given -'
+                                        'this is an invalid request')
+            continue
+
+        args = {'filename': fn} if fn is not None else {'data_label': dl}
+        for key in values:
+            args[key] = values[key]
+        valid.append((i, fn, dl, args))
+
+    found = _find_present_diskfiles(
+        session, filenames={fn for i, fn, dl, args in valid if fn is not None},
+        datalabels={dl for i, fn, dl, args in valid if fn is None})
+
+    groups = {}
+    for i, fn, dl, args in valid:
+        files = found.get(('filename', fn.removesuffix('.bz2'))
+                          if fn is not None else ('data_label', dl), {})
+        exists = _exists_status(files)
+        if exists == 0:
+            results[i] = error_response('No present file found for filename '
+                                        'or datalabel', id=fn or dl)
+        elif exists == 2:
+            results[i] = error_response('Multiple files found for filename or '
+                                        'datalabel - request is ambiguous',
+                                        id=fn or dl)
+        else:
+            [[diskfile_id]] = files.values()
+            args['diskfile_id'] = diskfile_id
+            groups.setdefault(diskfile_id, []).append((i, args))
+
+    chunks = [[]]
+    for group in groups.values():
+        if chunks[-1] and len(chunks[-1]) + len(group) > UPDATE_BATCH_SIZE:
+            chunks.append([])
+        chunks[-1].extend(group)
+
+    fo_requests = [(FileOpsRequest(request='update_headers_batch',
+                                   args={'updates': [args for i, args in chunk]}),
+                    None) for chunk in chunks if chunk]
+    fq = FileopsQueue(session=session, logger=DummyLogger())
+    queued = fq.add_many(fo_requests) if fo_requests else []
+
+    for chunk in chunks:
+        for i, args in chunk:
+            id = args.get('filename') or args.get('data_label')
+            results[i] = {'result': True, 'id': id} if queued else \
+                error_response('Failed to queue header update', id=id)
+
+    return results
+
+
 @needs_cookie(magic_cookie='gemini_api_authorization', content_type='json')
 def update_headers():
     ctx = get_context()
@@ -74,64 +226,15 @@ def update_headers():
             # Assume old format
             payload = message
 
-        # Instantiate a FileOps Queue helper object
-        fq = FileopsQueue(session=ctx.session, logger=DummyLogger())
-
-        # Loop through all the requests in the payload and  add them to the
-        # fileops queue. We queue these as response_required = False as the
-        # ingest is always asynchronous anyway, so there's little value to
-        # the caller in getting a confirmation that the fileops update_header
-        # succeeded as they're going to have to basically poll to check it
-        # ingested or just assume success anyway. We don't need to add the
-        # file to the ingest queue here, the fileops update_headers method
-        # takes care of that.
-
-        results = []
-        for update in payload:
-            fn = update.get('filename')
-            dl = update.get('data_label')
-            values = update.get('values')
-            if not isinstance(values, dict):
-                results.append(
-                    error_response('This looks like a malformed request. '
-                                   'values should be a dictionary'))
-                continue
-            args = {}
-            if fn is not None:
-                args['filename']= fn
-            elif dl is not None:
-                args['data_label'] = dl
-            else:
-                results.append(
-                    error_response('No filename or data_label given'))
-                continue
-            if fn is not None and dl is not None:
-                results.append(
-                    error_response('filename and data_label both given -'
-                                   'this is an invalid request'))
-                continue
-
-            for key in values:
-                args[key] = values[key]
-
-            exists = check_exists(ctx.session, fn=fn, dl=dl)
-            if exists == 0:
-                results.append(
-                    error_response('No present file found for filename or '
-                                   'datalabel', id=fn or dl))
-                continue
-            elif exists == 2:
-                results.append(
-                    error_response('Multiple files found for filename or '
-                                   'datalabel - request is ambiguous',
-                                   id=fn or dl))
-                continue
-
-
-            fqrq = FileOpsRequest(request='update_headers', args=args)
-            fq.add(fqrq, filename=fn, response_required=False)
-            response = {'result': True, 'id': fn if fn else dl}
-            results.append(response)
+        # Check the files exist and add update_headers_batch requests for
+        # them to the fileops queue. We queue these as response_required =
+        # False as the ingest is always asynchronous anyway, so there's little
+        # value to the caller in getting a confirmation that the fileops
+        # update succeeded as they're going to have to basically poll to
+        # check it ingested or just assume success anyway. We don't need to
+        # add the files to the ingest queue here, the fileops
+        # update_headers_batch method takes care of that.
+        results = queue_header_updates(ctx.session, payload)
 
         # Add response to usagelog notes
         ctx.usagelog.add_note("Response: %s" % str(results))
@@ -145,3 +248,65 @@ def update_headers():
     except Exception as e:
         resp.append_json([error_response(e)])
         resp.status = Return.HTTP_INTERNAL_SERVER_ERROR
+
+
+@needs_cookie(magic_cookie='gemini_fits_upload_auth', content_type='json')
+def header_delta(things):
+    """
+    Apply a header update exported from an upstream server, instead of the
+    upstream server transferring the whole file. This is called by the
+    Exporter with the same authentication cookie as upload_file.
+
+    'things' is the path to the file, as for upload_file. The POST data is a
+    json dictionary with 'md5_before', the data_md5 the file must have before
+    the update, and 'header_update', the update_headers arguments to apply.
+
+    We queue a fileops update_headers request and return without waiting for
+    it, as editing the file can take longer than we want to tie up a web
+    server worker for. We return a list containing one dictionary with
+    'result' and either 'fileops_id' or 'error'. The queued update shows as
+    pending_ingest in jsonfilelist until the file has been edited and
+    re-ingested, so the exporter upstream waits for it and then checks the
+    new data_md5, rather than sending the whole file while the update is in
+    progress.
+    """
+    ctx = get_context()
+    resp = ctx.resp
+    resp.content_type = 'application/json'
+
+    if len(things) == 0:
+        resp.status = Return.HTTP_NOT_FOUND
+        return
+
+    filename = things[-1]
+    try:
+        message = ctx.json
+        ctx.usagelog.add_note(f"Header delta for {filename}: {message}")
+        header_update = message['header_update']
+        if not isinstance(header_update, dict):
+            raise ValueError('header_update must be a dictionary')
+        args = {key: header_update[key] for key in header_update
+                if key not in ('filename', 'data_label')}
+        args['filename'] = filename
+        args['md5_before'] = message['md5_before']
+    except (ValueError, KeyError, TypeError) as e:
+        resp.append_json([error_response(f'Malformed request: {e}',
+                                          id=filename)])
+        resp.status = Return.HTTP_BAD_REQUEST
+        return
+
+    if check_exists(ctx.session, fn=filename) != 1:
+        resp.append_json([error_response('No unique present file found',
+                                          id=filename)])
+        return
+
+    fq = FileopsQueue(session=ctx.session, logger=DummyLogger())
+    fqe = fq.add(FileOpsRequest(request='update_headers', args=args),
+                 filename=filename)
+    if fqe is None:
+        result = error_response('Could not queue header update', id=filename)
+    else:
+        result = {'result': True, 'id': filename, 'fileops_id': fqe.id}
+
+    ctx.usagelog.add_note(f"Response: {result}")
+    resp.append_json([result])
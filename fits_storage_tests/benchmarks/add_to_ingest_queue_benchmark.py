@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+"""
+Benchmark adding many files to the ingest queue, comparing IngestQueue.add()
+for each file, which commits each entry (as add_to_ingest_queue.py used to
+do), with IngestQueue.add_many().
+
+This uses a testing environment with an SQLite database by default. To
+benchmark against PostgreSQL, point the fits_storage_db config at a scratch
+PostgreSQL database - the ingestqueue table in it is emptied between runs.
+Adding entries one at a time is slow, so we only time that for a sample of
+the files and extrapolate.
+"""
+import datetime
+import tempfile
+import time
+from argparse import ArgumentParser
+
+from fits_storage_tests.code_tests.helpers import get_test_config
+get_test_config()
+
+from fits_storage_tests.code_tests.helpers import make_empty_testing_db_env
+from fits_storage.db import sessionfactory
+from fits_storage.logger_dummy import DummyLogger
+
+from fits_storage.queues.orm.ingestqueueentry import IngestQueueEntry
+from fits_storage.queues.queue.ingestqueue import IngestQueue
+
+parser = ArgumentParser(description=__doc__)
+parser.add_argument("--files", action="store", type=int, dest="files",
+                    default=1000000, help="Number of files to queue")
+parser.add_argument("--sample", action="store", type=int, dest="sample",
+                    default=2000, help="Number of files to queue with add()")
+parser.add_argument("--postgres", action="store_true", dest="postgres",
+                    help="Use the configured database rather than SQLite")
+args = parser.parse_args()
+
+
+def files(n):
+    # A mix of facility standard and other filenames, across many nights
+    first_night = datetime.date(2020, 1, 1)
+    for i in range(n):
+        night = first_night + datetime.timedelta(days=i // 5000)
+        if i % 10:
+            yield f"N{night:%Y%m%d}S{i % 5000:04d}.fits", f"{night:%Y}"
+        else:
+            yield f"misc_file_{i}.fits", ""
+
+
+def clear(session):
+    session.query(IngestQueueEntry).delete()
+    session.commit()
+
+
+def per_entry(iq, n):
+    for filename, path in files(n):
+        iq.add(filename, path)
+    return n
+
+
+def add_many(iq, n):
+    return iq.add_many(files(n))
+
+
+def run(session):
+    iq = IngestQueue(session, logger=DummyLogger())
+    clear(session)
+
+    start = time.perf_counter()
+    per_entry(iq, args.sample)
+    elapsed = time.perf_counter() - start
+    print(f"add()     : {args.sample} files in {elapsed:6.2f} s, "
+          f"{args.sample / elapsed:9.0f} files/s, "
+          f"{args.files} files would take {elapsed * args.files / args.sample:8.1f} s")
+    clear(session)
+
+    start = time.perf_counter()
+    added = add_many(iq, args.files)
+    elapsed = time.perf_counter() - start
+    print(f"add_many(): {added} files in {elapsed:6.2f} s, "
+          f"{added / elapsed:9.0f} files/s")
+
+    # Adding them again should add nothing
+    start = time.perf_counter()
+    added = add_many(iq, args.files)
+    elapsed = time.perf_counter() - start
+    print(f"add_many() again: {added} files added in {elapsed:6.2f} s")
+    clear(session)
+
+
+if args.postgres:
+    run(sessionfactory())
+else:
+    with tempfile.TemporaryDirectory() as tmpdir:
+        run(make_empty_testing_db_env(tmpdir))
@@ -0,0 +1,159 @@
+#!/usr/bin/env python3
+"""
+Benchmark StreamBz2Compressor throughput and peak memory use, against the
+previous implementation, which kept the compressed data in a bytes buffer that
+was extended with += and sliced for each read.
+
+The source is a synthetic file-like object of 16 bit image-like data (noise
+on a background), generated as it is read, so nothing large is held in memory
+or on disk. Each case is run in a fresh process so that its peak RSS can be
+reported separately.
+
+The time to compress the data is dominated by bz2 itself, so the buffer
+cases run both implementations with passthrough=True, which leaves just the
+buffer handling and the md5sum.
+
+The 'file then md5sum' case is how the exporter used to send files that are
+already compressed: it posted the file object itself and then read the file
+again to calculate the md5sum for the verification. Now it passes the data
+through a StreamBz2Compressor with passthrough=True, which calculates the
+md5sum as it goes, which is the 'new buffer' case. The synthetic data are not
+actually bz2 compressed, but that makes no difference to passing them through.
+"""
+import hashlib
+import multiprocessing
+import resource
+import time
+from argparse import ArgumentParser
+
+import numpy as np
+
+from fits_storage.server.bz2stream import StreamBz2Compressor
+
+MB = 1048576
+
+
+class SyntheticSource(object):
+    """
+    File-like object that provides size bytes of synthetic 16 bit image data.
+    We cycle through a few different blocks, each bigger than the bz2 block
+    size so the repetition does not help the compression.
+    """
+    def __init__(self, size, blocksize=4*MB, nblocks=4):
+        rng = np.random.default_rng(1234)
+        self.blocks = [(rng.normal(1000, 30, blocksize // 2)
+                        .astype('>i2').tobytes()) for _ in range(nblocks)]
+        self.blocksize = blocksize
+        self.size = size
+        self.pos = 0
+
+    def read(self, n=-1):
+        if n < 0:
+            n = self.size - self.pos
+        n = min(n, self.size - self.pos)
+        out = bytearray()
+        while len(out) < n:
+            block = self.blocks[(self.pos // self.blocksize) % len(self.blocks)]
+            offset = self.pos % self.blocksize
+            piece = block[offset:offset + n - len(out)]
+            out += piece
+            self.pos += len(piece)
+        return bytes(out)
+
+
+class LegacyStreamBz2Compressor(StreamBz2Compressor):
+    """
+    The previous implementation of the read buffer, for comparison.
+    """
+    def __init__(self, src, **kwargs):
+        super().__init__(src, **kwargs)
+        self.output_buffer = bytes(0)
+
+    def _fill_buffer(self, request_size):
+        while not self.done and len(self.output_buffer) < request_size:
+            chunk = self.src.read(self.chunksize)
+            if not chunk:
+                comp = self.comp.flush() if self.comp else None
+                if comp:
+                    self.output_buffer += comp
+                self.done = True
+            else:
+                comp = self.comp.compress(chunk) if self.comp else chunk
+                if comp:
+                    self.output_buffer += comp
+
+    def read(self, n):
+        if len(self.output_buffer) < n:
+            self._fill_buffer(n)
+        if not self.output_buffer:
+            return None
+        ret = self.output_buffer[:n]
+        self.output_buffer = self.output_buffer[n:]
+        self._bytes_output += len(ret)
+        self.hashobj.update(ret)
+        return ret
+
+
+def consume(flo, readsize):
+    # Read everything, as requests does when posting the data. With a
+    # readsize of None we iterate the object, which reads itersize chunks.
+    nbytes = 0
+    if readsize is None:
+        for chunk in flo:
+            nbytes += len(chunk)
+    else:
+        while chunk := flo.read(readsize):
+            nbytes += len(chunk)
+    return nbytes
+
+
+def run_case(case, size, readsize, results):
+    src = SyntheticSource(size)
+    start = time.perf_counter()
+    if case == 'file then md5sum':
+        # Post the file object, then read it all again for the md5sum
+        consume(src, readsize or 1000000)
+        src = SyntheticSource(size)
+        hashobj = hashlib.md5()
+        while chunk := src.read(1000000):
+            hashobj.update(chunk)
+        md5 = hashobj.hexdigest()
+    else:
+        cls = LegacyStreamBz2Compressor if case.startswith('legacy') \
+            else StreamBz2Compressor
+        flo = cls(src, passthrough=case.endswith('buffer'))
+        consume(flo, readsize)
+        md5 = flo.md5sum_output
+    elapsed = time.perf_counter() - start
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    results.put((elapsed, maxrss, md5))
+
+
+def main():
+    parser = ArgumentParser(description=__doc__)
+    parser.add_argument("--size", action="store", type=int, default=1024,
+                        help="Size of the synthetic source file in MB")
+    parser.add_argument("--readsize", action="store", type=int, default=None,
+                        help="Read this many bytes at a time rather than "
+                             "iterating as requests does")
+    parser.add_argument("--cases", action="store", nargs="+",
+                        default=['legacy', 'new', 'legacy buffer',
+                                 'new buffer', 'file then md5sum'])
+    args = parser.parse_args()
+    size = args.size * MB
+
+    ctx = multiprocessing.get_context('spawn')
+    for case in args.cases:
+        results = ctx.Queue()
+        proc = ctx.Process(target=run_case,
+                           args=(case, size, args.readsize, results))
+        proc.start()
+        elapsed, maxrss, md5 = results.get()
+        proc.join()
+        print(f"{case:20s}: {args.size} MB in {elapsed:7.2f} s, "
+              f"{args.size / elapsed:7.1f} MB/s, peak RSS {maxrss:7.1f} MB, "
+              f"md5 {md5}")
+
+
+if __name__ == '__main__':
+    main()
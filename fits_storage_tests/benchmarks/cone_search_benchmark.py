@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+"""
+Benchmark RA/Dec box searches against HTM cone searches on a synthetic table.
+
+This builds a standalone table with the same spatial columns as the header
+table (ra, dec with B-tree indexes, and htm_id, cx, cy, cz) populated with a
+synthetic set of positions, many of which are clustered in a few popular
+fields, then times the box search that query_selection does without the
+spatial index against the HTM cone search.
+
+By default this uses an SQLite file in the current directory. Pass
+--database-url to run against eg a local PostgreSQL instance.
+"""
+import math
+import random
+import time
+from argparse import ArgumentParser
+
+from sqlalchemy import create_engine, MetaData, Table, Column, Index, select
+from sqlalchemy import Integer, BigInteger, Float, and_, func
+
+from fits_storage.core.htm import htm_id, radec_to_vector, cone_filter
+
+parser = ArgumentParser(description=__doc__)
+parser.add_argument("--database-url", action="store", dest="database_url",
+                    default="sqlite:///cone_search_benchmark.db",
+                    help="SQLAlchemy database URL to use")
+parser.add_argument("--n", action="store", type=int, dest="n",
+                    default=1000000, help="Number of synthetic headers")
+parser.add_argument("--queries", action="store", type=int, dest="queries",
+                    default=100, help="Number of cone searches to time")
+parser.add_argument("--sr", action="store", type=float, dest="sr",
+                    default=180.0, help="Search radius in arcsec")
+parser.add_argument("--reuse", action="store_true", dest="reuse",
+                    help="Reuse an existing populated table")
+args = parser.parse_args()
+
+# Some popular fields, where a large fraction of the data is clustered
+FIELDS = [(150.1, 2.2), (53.1, -27.8), (189.2, 62.2), (83.8, -5.4),
+          (201.4, -43.0), (10.7, 41.3)]
+
+engine = create_engine(args.database_url)
+metadata = MetaData()
+table = Table('bench_header', metadata,
+              Column('id', Integer, primary_key=True),
+              Column('ra', Float), Column('dec', Float),
+              Column('htm_id', BigInteger),
+              Column('cx', Float), Column('cy', Float), Column('cz', Float),
+              Index('ix_bench_header_ra', 'ra'),
+              Index('ix_bench_header_dec', 'dec'),
+              Index('ix_bench_header_htm_id', 'htm_id'))
+c = table.c
+
+rng = random.Random(2024)
+
+
+def random_position():
+    if rng.random() < 0.5:
+        ra, dec = rng.choice(FIELDS)
+        return (ra + rng.gauss(0, 0.3)) % 360.0, \
+            max(-89.9, min(89.9, dec + rng.gauss(0, 0.3)))
+    return rng.uniform(0, 360), math.degrees(math.asin(rng.uniform(-1, 1)))
+
+
+if not args.reuse:
+    metadata.drop_all(engine)
+    metadata.create_all(engine)
+    print(f"Populating {args.n} rows")
+    start = time.perf_counter()
+    batch = []
+    with engine.begin() as conn:
+        for i in range(args.n):
+            ra, dec = random_position()
+            cx, cy, cz = radec_to_vector(ra, dec)
+            batch.append({'id': i, 'ra': ra, 'dec': dec,
+                          'htm_id': htm_id(ra, dec),
+                          'cx': cx, 'cy': cy, 'cz': cz})
+            if len(batch) == 10000:
+                conn.execute(table.insert(), batch)
+                batch = []
+        if batch:
+            conn.execute(table.insert(), batch)
+    print(f"Populated in {time.perf_counter() - start:.1f}s")
+
+
+def box_query(ra, dec, sr):
+    # This mirrors what query_selection does without the spatial index
+    cosdec = math.cos(math.radians(dec))
+    return select(func.count()).where(
+        and_(c.dec >= dec - sr, c.dec < dec + sr,
+             c.ra >= ra - sr / cosdec, c.ra < ra + sr / cosdec))
+
+
+def cone_query(ra, dec, sr):
+    return select(func.count()).where(
+        cone_filter(c.htm_id, c.cx, c.cy, c.cz, ra, dec, sr))
+
+
+sr = args.sr / 3600.0
+centres = [rng.choice(FIELDS) for _ in range(args.queries)]
+centres = [(ra + rng.gauss(0, 0.1), dec + rng.gauss(0, 0.1))
+           for ra, dec in centres]
+
+with engine.connect() as conn:
+    for name, func_ in (('box', box_query), ('htm cone', cone_query)):
+        start = time.perf_counter()
+        total = 0
+        for ra, dec in centres:
+            total += conn.execute(func_(ra, dec, sr)).scalar()
+        elapsed = time.perf_counter() - start
+        print(f"{name:10s}: {args.queries} queries in {elapsed:.3f}s "
+              f"({1000 * elapsed / args.queries:.2f} ms/query), "
+              f"{total} rows matched")
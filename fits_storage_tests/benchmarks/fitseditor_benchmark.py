@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+"""
+Benchmark a one-keyword header edit of a bz2 compressed FITS file, comparing
+the full decompress / astropy update / recompress that FitsEditor does for
+single-stream bz2 files against the header-only edit of a multi-stream file.
+
+This generates a synthetic multi-extension FITS file with noisy integer data
+(which compresses roughly like real raw data), writes it both as a normal
+single-stream bz2 file and as a multi-stream file, and times editing a
+primary header keyword in each.
+"""
+import bz2
+import io
+import os
+import tempfile
+import time
+from argparse import ArgumentParser
+
+import astropy.io.fits
+import numpy
+
+from fits_storage.server.bz2multistream import HeaderOnlyEditor, \
+    write_multistream
+
+parser = ArgumentParser(description=__doc__)
+parser.add_argument("--size", action="store", type=int, dest="size",
+                    default=100, help="Approximate uncompressed size in MB")
+parser.add_argument("--extensions", action="store", type=int,
+                    dest="extensions", default=4, help="Number of extensions")
+parser.add_argument("--repeat", action="store", type=int, dest="repeat",
+                    default=3, help="Number of edits to time")
+parser.add_argument("--split-extensions", action="store_true",
+                    dest="split_extensions",
+                    help="Put extension headers in their own streams")
+args = parser.parse_args()
+
+
+def make_fits():
+    rng = numpy.random.default_rng(2024)
+    npix = args.size * 1024 * 1024 // 2 // args.extensions
+    side = int(npix ** 0.5)
+    hdus = [astropy.io.fits.PrimaryHDU()]
+    hdus[0].header['RAWGEMQA'] = 'UNKNOWN'
+    for i in range(args.extensions):
+        data = (1000 + rng.normal(0, 20, (side, side))).astype(numpy.int16)
+        hdus.append(astropy.io.fits.ImageHDU(data, name='SCI'))
+    buffer = io.BytesIO()
+    astropy.io.fits.HDUList(hdus).writeto(buffer)
+    return buffer.getvalue()
+
+
+def full_edit(path, tmpdir, value):
+    # What FitsEditor does for a single-stream bz2 file
+    uncompressed = os.path.join(tmpdir, 'uncompressed.fits')
+    with bz2.open(path, 'rb') as src, open(uncompressed, 'wb') as dest:
+        while chunk := src.read(1024*1024):
+            dest.write(chunk)
+    with astropy.io.fits.open(uncompressed, mode='update',
+                              do_not_scale_image_data=True) as hdulist:
+        hdulist[0].header['RAWGEMQA'] = value
+        with bz2.open(path, 'wb') as f:
+            hdulist.writeto(f)
+    os.unlink(uncompressed)
+
+
+def header_only_edit(path, value):
+    editor = HeaderOnlyEditor(path, True)
+    editor[0].header['RAWGEMQA'] = value
+    return editor.write()
+
+
+def timeit(func, *fargs):
+    times = []
+    for i in range(args.repeat):
+        value = ('USABLE', 'BAD')[i % 2]
+        start = time.perf_counter()
+        func(*fargs, value)
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+raw = make_fits()
+with tempfile.TemporaryDirectory() as tmpdir:
+    single = os.path.join(tmpdir, 'single.fits.bz2')
+    multi = os.path.join(tmpdir, 'multi.fits.bz2')
+    with open(single, 'wb') as f:
+        f.write(bz2.compress(raw))
+    with io.BytesIO(raw) as src, open(multi, 'wb') as dest:
+        write_multistream(src, dest, split_extensions=args.split_extensions)
+
+    print(f"Uncompressed size: {len(raw)/1e6:.1f} MB, "
+          f"single-stream: {os.path.getsize(single)/1e6:.1f} MB, "
+          f"multi-stream: {os.path.getsize(multi)/1e6:.1f} MB")
+
+    full = timeit(full_edit, single, tmpdir)
+    print(f"Full decompress / recompress edit: {full*1000:.1f} ms")
+    header = timeit(header_only_edit, multi)
+    print(f"Header-only edit:                  {header*1000:.1f} ms "
+          f"({full/header:.0f}x faster)")
+
+    with astropy.io.fits.open(multi) as hdulist:
+        assert hdulist[0].header['RAWGEMQA'] in ('USABLE', 'BAD')
+        assert len(hdulist) == args.extensions + 1
@@ -0,0 +1,133 @@
+#!/usr/bin/env python3
+"""
+Benchmark the metadata validator over a corpus of synthetic GMOS files.
+
+DiskFileReport used to run the validator on the filename, so it opened the
+file again with astropy, verified the whole HDUList, and ran the rules on the
+astropy Headers, trying each instrument's rules in turn. Each Evaluator also
+parsed the rule files again. Now the parsed rules are shared by the whole
+process, the instrument rules are indexed by INSTRUME, and the validator can
+run on the headers of the AstroData object the ingester has open anyway,
+copied into dictionaries.
+
+"file" is the cost per file validating by filename, and "in memory" that
+validating the AstroData object, not counting opening it. "first file"
+includes parsing the rules, which now only happens once per process.
+"""
+import os
+import tempfile
+import time
+from argparse import ArgumentParser
+
+import numpy as np
+import astropy.io.fits as pf
+import astrodata
+
+from fits_storage.config import get_config
+
+# The rule files in this source tree, rather than the installed location
+DEF_PATH = os.path.join(os.path.dirname(__file__), '..', '..', 'fits_storage',
+                        'fits_validator', 'dataDefinition')
+get_config(configstring=f"""
+           [DEFAULT]
+           validation_def_path = {os.path.abspath(DEF_PATH)}
+           """, builtinonly=True, reload=True)
+
+from fits_storage.fits_validator.gemini_fits_validator import \
+    AstroDataEvaluator
+
+PDU_CARDS = {
+    'INSTRUME': 'GMOS-N', 'TELESCOP': 'Gemini-North',
+    'OBSERVAT': 'Gemini-North', 'FRAME': 'FK5', 'RA': 150.1, 'DEC': 2.2,
+    'TRKFRAME': 'FK5', 'DECTRACK': 0.0, 'TRKEPOCH': 2000.0, 'RATRACK': 0.0,
+    'PMDEC': 0.0, 'PMRA': 0.0, 'DATE': '2023-01-01', 'DATE-OBS': '2023-01-01',
+    'GEMPRGID': 'GN-2023A-Q-1', 'OBSID': 'GN-2023A-Q-1-1', 'OBJECT': 'M31',
+    'OBSTYPE': 'OBJECT', 'RAWGEMQA': 'USABLE', 'RAWPIREQ': 'YES',
+    'RAWBG': 'Any', 'RAWCC': '50-percentile', 'RAWIQ': '70-percentile',
+    'RAWWV': 'Any', 'RELEASE': '2024-01-01', 'SSA': 'someone',
+    'UT': '01:00:00', 'AZIMUTH': 10.0, 'ELEVATIO': 60.0, 'CRPA': 1.0,
+    'PA': 0.0, 'IAA': 0.0, 'OBSCLASS': 'science', 'DARKTIME': 10.0,
+    'EXPTIME': 10.0, 'MASKID': 0, 'MASKNAME': 'None', 'MASKTYP': 0,
+    'MASKLOC': 0, 'FILTER1': 'open1-6', 'FILTER2': 'g_G0301', 'FILTID1': 0,
+    'FILTID2': 0, 'GRATING': 'MIRROR', 'GRATID': 0, 'TIME-OBS': '01:00:00',
+    'UTSTART': '01:00:00'}
+
+WCS_CARDS = {
+    'CTYPE1': 'RA---TAN', 'CTYPE2': 'DEC--TAN', 'CRPIX1': 1.0, 'CRPIX2': 1.0,
+    'CRVAL1': 1.0, 'CRVAL2': 1.0, 'CD1_1': 1.0, 'CD1_2': 0.0, 'CD2_1': 0.0,
+    'CD2_2': 1.0}
+
+EXT_CARDS = {
+    'EXTNAME': 'SCI', 'GAIN': 2.0, 'RDNOISE': 3.0, 'CCDSUM': '1 1',
+    'CCDNAME': 'EEV', 'CCDSIZE': '[1:2048,1:4608]',
+    'CCDSEC': '[1:512,1:4608]', 'DATASEC': '[1:512,1:4608]',
+    'DETSEC': '[1:512,1:4608]', 'BIASSEC': '[1:32,1:4608]'}
+
+
+def make_file(path, i, next, nfiller):
+    phu = pf.PrimaryHDU()
+    phu.header.update(PDU_CARDS)
+    phu.header.update(WCS_CARDS)
+    phu.header['DATALAB'] = f'GN-2023A-Q-1-1-{i + 1:03d}'
+    for j in range(nfiller):
+        phu.header[f'FILL{j:04d}'] = (j * 1.5, 'filler keyword')
+    hdus = [phu]
+    for e in range(next):
+        ext = pf.ImageHDU(data=np.zeros((2, 2), dtype=np.int16))
+        ext.header.update(EXT_CARDS)
+        ext.header.update(WCS_CARDS)
+        ext.header['EXTVER'] = e + 1
+        for j in range(nfiller // 4):
+            ext.header[f'FILL{j:04d}'] = j
+        hdus.append(ext)
+    pf.HDUList(hdus).writeto(path)
+
+
+def from_file(paths, opened):
+    evaluator = AstroDataEvaluator()
+    return [evaluator.evaluate(path) for path in paths]
+
+
+def in_memory(paths, opened):
+    evaluator = AstroDataEvaluator()
+    return [evaluator.evaluate(ad) for ad in opened]
+
+
+def main():
+    parser = ArgumentParser(description=__doc__)
+    parser.add_argument("--files", action="store", type=int, default=200,
+                        help="Number of files in the corpus")
+    parser.add_argument("--extensions", action="store", type=int, default=12,
+                        help="Number of image extensions in each file")
+    parser.add_argument("--filler", action="store", type=int, default=150,
+                        help="Number of extra keywords in each PHU")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        paths = [os.path.join(tmpdir, f'N20230101S{i:04d}.fits')
+                 for i in range(args.files)]
+        for i, path in enumerate(paths):
+            make_file(path, i, args.extensions, args.filler)
+        # The ingester has the files open already
+        opened = [astrodata.open(path) for path in paths]
+
+        start = time.perf_counter()
+        AstroDataEvaluator().evaluate(paths[0])
+        elapsed = time.perf_counter() - start
+        print(f"{'first file':10s}: {1000 * elapsed:7.2f} ms")
+
+        reference = None
+        for name, func in (('file', from_file), ('in memory', in_memory)):
+            start = time.perf_counter()
+            results = func(paths, opened)
+            elapsed = time.perf_counter() - start
+            print(f"{name:10s}: {1000 * elapsed / args.files:7.2f} ms per file, "
+                  f"{results[0].code}")
+            if reference is None:
+                reference = results
+            elif results != reference:
+                print("Results differ from validating the files!")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,145 @@
+#!/usr/bin/env python3
+"""
+Benchmark rendering preview images with the 'pillow' and 'matplotlib'
+preview renderers, on synthetic data shaped like GMOS, GNIRS and GHOST raw
+data.
+
+The data are wrapped in minimal stand-ins for AstroData objects, which
+provide just what Previewer.render_image() uses, so this doesn't need any
+data files. We also time importing the modules that each renderer needs, in
+a fresh python process, as every preview worker pays that.
+"""
+import io
+import subprocess
+import sys
+import tempfile
+import time
+from argparse import ArgumentParser
+from types import SimpleNamespace
+
+import numpy
+
+from fits_storage_tests.code_tests.helpers import get_test_config
+get_test_config()
+
+from fits_storage.server.previewer import Previewer
+
+parser = ArgumentParser(description=__doc__)
+parser.add_argument("--repeat", action="store", type=int, dest="repeat",
+                    default=3, help="Number of times to render each preview")
+parser.add_argument("--instruments", action="store", nargs="+",
+                    dest="instruments", default=['GMOS', 'GNIRS', 'GHOST'])
+args = parser.parse_args()
+
+rng = numpy.random.default_rng(1234)
+
+
+class FakeExtension(object):
+    def __init__(self, data, data_section=None, detector_section=None,
+                 overscan_section=None, gain=1.0):
+        self.data = data
+        self._data_section = data_section
+        self._detector_section = detector_section
+        self._overscan_section = overscan_section
+        self._gain = gain
+
+    def data_section(self):
+        return self._data_section
+
+    def detector_section(self):
+        return self._detector_section
+
+    def overscan_section(self):
+        return self._overscan_section
+
+    def gain(self):
+        return self._gain
+
+
+class FakeAstroData(list):
+    def __init__(self, instrument, extensions, tags=()):
+        super().__init__(extensions)
+        self._instrument = instrument
+        self.tags = set(tags)
+
+    def instrument(self):
+        return self._instrument
+
+    def detector_section(self):
+        return [ext.detector_section() for ext in self]
+
+    def detector_x_bin(self):
+        return 1
+
+    def detector_y_bin(self):
+        return 1
+
+
+def noise(shape, level=1000, sigma=30):
+    return rng.normal(level, sigma, shape).astype(numpy.uint16)
+
+
+def gmos():
+    # 12 amplifiers of 512 x 4224 pixels, each with a 32 column overscan
+    extensions = []
+    for amp in range(12):
+        data = noise((4224, 544), level=1000 + 10 * amp)
+        extensions.append(FakeExtension(
+            data, data_section=[0, 512, 0, 4224],
+            detector_section=[amp * 512, (amp + 1) * 512, 0, 4224],
+            overscan_section=[512, 544, 0, 4224], gain=1.5))
+    return 'GMOS-N', FakeAstroData('GMOS-N', extensions)
+
+
+def gnirs():
+    return 'GNIRS', FakeAstroData('GNIRS',
+                                  [FakeExtension(noise((1022, 1024)))])
+
+
+def ghost():
+    # A bundle, with the slit viewer then the red and blue cameras
+    extensions = [FakeExtension(noise((160, 160))),
+                  FakeExtension(noise((6160, 6144))),
+                  FakeExtension(noise((4112, 4096)))]
+    return 'GHOST', FakeAstroData('GHOST', extensions, tags=['BUNDLE'])
+
+
+def render(instrument, ad, renderer, tmpdir):
+    header = SimpleNamespace(instrument=instrument, processing='Raw',
+                             types='RAW')
+    diskfile = SimpleNamespace(filename='bench.fits', keyname='bench.fits',
+                               get_ad_object=ad)
+    p = Previewer(diskfile, None, previewpath=tmpdir, using_s3=False,
+                  header=header, renderer=renderer)
+    fp = io.BytesIO()
+    start = time.perf_counter()
+    assert p.render_image(fp)
+    return time.perf_counter() - start, len(fp.getvalue())
+
+
+def import_time(statement):
+    start = time.perf_counter()
+    subprocess.run([sys.executable, '-c', statement], check=True)
+    return time.perf_counter() - start
+
+
+print(f"python startup and import numpy:  "
+      f"{import_time('import numpy'):.2f} s")
+print(f"... and import PIL.Image:         "
+      f"{import_time('import numpy, PIL.Image'):.2f} s")
+print(f"... and import matplotlib.pyplot: "
+      f"{import_time('import numpy, matplotlib.pyplot'):.2f} s")
+
+makers = {'GMOS': gmos, 'GNIRS': gnirs, 'GHOST': ghost}
+with tempfile.TemporaryDirectory() as tmpdir:
+    for name in args.instruments:
+        instrument, ad = makers[name]()
+        for renderer in ('matplotlib', 'pillow'):
+            # Render once first, so that imports are not included
+            render(instrument, ad, renderer, tmpdir)
+            times = []
+            for _ in range(args.repeat):
+                secs, size = render(instrument, ad, renderer, tmpdir)
+                times.append(secs)
+            print(f"{name:6s} {renderer:10s}: {min(times):6.2f} s per "
+                  f"preview, {size / 1024:6.0f} kB")
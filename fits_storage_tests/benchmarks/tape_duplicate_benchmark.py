@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+"""
+Benchmark building the list of files for write_to_tape.py to write, leaving
+out files that are already on tape.
+
+write_to_tape.py used to get the headers from list_headers(), build the list
+of diskfiles from them, then run a query per file to check whether it was on
+these tapes, and another per file to check whether it was on any tape (with
+--skip, as in --auto mode). Now list_tape_diskfiles() does it all in one
+query.
+
+This uses a testing environment with an SQLite database, populated with
+synthetic File, DiskFile and Header rows over a range of nights, and with a
+fraction of them already on tape.
+"""
+import datetime
+import tempfile
+import time
+from argparse import ArgumentParser
+
+from sqlalchemy import insert, join
+
+from fits_storage_tests.code_tests.helpers import get_test_config
+get_test_config()
+
+from fits_storage_tests.code_tests.helpers import make_empty_testing_db_env
+
+from fits_storage.core.orm.file import File
+from fits_storage.core.orm.diskfile import DiskFile
+from fits_storage.core.orm.header import Header
+from fits_storage.db.list_headers import list_headers
+from fits_storage.db.selection.get_selection import from_url_things
+from fits_storage.server.orm.tapestuff import Tape, TapeWrite, TapeFile
+from fits_storage.server.tapewriter import list_tape_diskfiles
+
+parser = ArgumentParser(description=__doc__)
+parser.add_argument("--files", action="store", type=int, dest="files",
+                    default=20000, help="Number of files in the selection")
+parser.add_argument("--nights", action="store", type=int, dest="nights",
+                    default=14, help="Number of nights to spread them over")
+parser.add_argument("--ontape", action="store", type=float, dest="ontape",
+                    default=0.5, help="Fraction of the files already on tape")
+args = parser.parse_args()
+
+FIRST_NIGHT = datetime.date(2024, 1, 1)
+
+
+def populate(session):
+    perfile = args.files // args.nights
+    files = []
+    headers = []
+    for i in range(args.files):
+        night = FIRST_NIGHT + datetime.timedelta(days=i // perfile)
+        filename = f"N{night:%Y%m%d}S{i % perfile:04d}.fits"
+        files.append({'id': i + 1, 'name': filename})
+        headers.append({'id': i + 1, 'diskfile_id': i + 1,
+                        'telescope': 'Gemini-North',
+                        'ut_datetime': datetime.datetime.combine(
+                            night, datetime.time(12)) +
+                        datetime.timedelta(seconds=i % perfile)})
+    session.execute(insert(File.__table__), files)
+    session.execute(insert(DiskFile.__table__), [
+        {'id': f['id'], 'file_id': f['id'], 'filename': f['name'],
+         'path': '', 'present': True, 'canonical': True,
+         'file_md5': f"md5-{f['id']}", 'file_size': 1000} for f in files])
+    session.execute(insert(Header.__table__), headers)
+
+    session.execute(insert(Tape.__table__), [
+        {'id': 1, 'label': 'T1', 'active': True},
+        {'id': 2, 'label': 'T2', 'active': True}])
+    session.execute(insert(TapeWrite.__table__), [
+        {'id': 1, 'tape_id': 1, 'succeeded': True},
+        {'id': 2, 'tape_id': 2, 'succeeded': True}])
+    ontape = int(args.files * args.ontape)
+    session.execute(insert(TapeFile.__table__), [
+        {'tapewrite_id': 1 + i % 2, 'filename': f['name'],
+         'md5': f"md5-{f['id']}"} for i, f in enumerate(files[:ontape])])
+    session.commit()
+
+
+def legacy(session, selection, tapeids):
+    headers = list_headers(selection, ['ut_datetime'], session=session,
+                           unlimit=True)
+    diskfiles = [header.diskfile for header in headers]
+
+    deduplicated = []
+    for df in diskfiles:
+        numtapes = session.query(Tape)\
+            .select_from(join(TapeFile, join(TapeWrite, Tape)))\
+            .filter(Tape.active == True)\
+            .filter(TapeWrite.succeeded == True)\
+            .filter(TapeFile.filename == df.filename)\
+            .filter(TapeFile.md5 == df.file_md5)\
+            .filter(Tape.id.in_(tapeids))\
+            .count()
+        if numtapes == 0:
+            deduplicated.append(df)
+
+    actual = []
+    for df in deduplicated:
+        num = session.query(TapeFile)\
+            .select_from(join(TapeFile, join(TapeWrite, Tape)))\
+            .filter(Tape.active == True)\
+            .filter(TapeWrite.succeeded == True)\
+            .filter(TapeFile.filename == df.filename)\
+            .filter(TapeFile.md5 == df.file_md5)\
+            .count()
+        if num == 0:
+            actual.append(df)
+    return actual
+
+
+def new(session, selection, tapeids):
+    return list_tape_diskfiles(session, selection, tape_ids=tapeids,
+                               skip=True)
+
+
+with tempfile.TemporaryDirectory() as tmpdir:
+    session = make_empty_testing_db_env(tmpdir)
+    populate(session)
+    last = FIRST_NIGHT + datetime.timedelta(days=args.nights - 1)
+    selection = from_url_things([f"{FIRST_NIGHT:%Y%m%d}-{last:%Y%m%d}",
+                                 'present'])
+    for name, func in (('legacy', legacy), ('new', new)):
+        session.expunge_all()
+        start = time.perf_counter()
+        diskfiles = func(session, selection, {1})
+        elapsed = time.perf_counter() - start
+        print(f"{name:8s}: {len(diskfiles)} of {args.files} files to write "
+              f"in {elapsed:7.2f} s")
@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+"""
+Benchmark writing a tar archive of files to a tape, the way write_to_tape.py
+used to do it and with the TarTapeWriter.
+
+Previously, we read every file once to check its md5sum, then wrote them all
+with tarfile in 64kB blocks, reading every file a second time. Now we read
+each file once, in a read ahead thread that calculates the md5sum as it goes,
+and write the archive in large blocks.
+
+The tape is a TapeEmulator with the given throughput and drive buffer size.
+If the buffer runs empty while writing, the drive stops, and has to
+reposition (backhitch) before carrying on. The emulator keeps the data it
+writes in a directory, so that needs space for the archive. The files are
+evicted from the page cache (with posix_fadvise, so it only works for data on
+a local disk, and on linux) before each case, so that they are read from disk
+each time.
+"""
+import hashlib
+import os
+import tempfile
+import time
+from argparse import ArgumentParser
+
+from fits_storage.server.tapeemulator import TapeEmulator
+from fits_storage.server.tapewriter import ReadAhead, TarTapeWriter, \
+    make_tarinfo
+
+MB = 1048576
+
+
+def evict(paths):
+    for path in paths:
+        with open(path, 'rb') as f:
+            os.fdatasync(f.fileno())
+            os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_DONTNEED)
+
+
+def md5file(path):
+    hashobj = hashlib.md5()
+    with open(path, 'rb') as f:
+        while chunk := f.read(1000000):
+            hashobj.update(chunk)
+    return hashobj.hexdigest()
+
+
+def legacy(paths, md5s, td, blocksize):
+    for path, md5 in zip(paths, md5s):
+        assert md5file(path) == md5
+    tar = td.opentar(mode='w|', bufsize=64 * 1024)
+    for path in paths:
+        with open(path, 'rb') as f:
+            tar.addfile(make_tarinfo(os.path.basename(path), os.stat(path)), f)
+    tar.close()
+
+
+def new(paths, md5s, td, blocksize, readahead=64*MB):
+    fileobj = td.open('wb')
+    writer = TarTapeWriter(fileobj, blocksize=blocksize,
+                           backspace=td.backspace_records)
+    reader = ReadAhead(paths, blocksize=blocksize,
+                       depth=readahead // blocksize)
+    for path, md5, rafile in zip(paths, md5s, reader):
+        writer.add(make_tarinfo(os.path.basename(path), rafile.stat), rafile,
+                   md5=md5)
+    reader.close()
+    writer.close()
+    fileobj.close()
+
+
+def main():
+    parser = ArgumentParser(description=__doc__)
+    parser.add_argument("--nfiles", action="store", type=int, default=32,
+                        help="Number of files to write")
+    parser.add_argument("--size", action="store", type=int, default=32,
+                        help="Size of each file in MB")
+    parser.add_argument("--rate", action="store", type=float, default=300,
+                        help="Tape throughput in MB/s")
+    parser.add_argument("--buffer", action="store", type=int, default=64,
+                        help="Tape drive buffer size in MB")
+    parser.add_argument("--backhitch", action="store", type=float,
+                        default=1.0, help="Time in seconds for the drive to "
+                                          "reposition if its buffer empties")
+    parser.add_argument("--blocksize", action="store", type=int,
+                        default=1048576, help="Block size for the new writer")
+    parser.add_argument("--dir", action="store", default=None,
+                        help="Directory to make the files in")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(dir=args.dir) as tmpdir:
+        paths = []
+        md5s = []
+        for i in range(args.nfiles):
+            path = os.path.join(tmpdir, f"N20240101S{i:04d}.fits")
+            data = os.urandom(args.size * MB)
+            with open(path, 'wb') as f:
+                f.write(data)
+            paths.append(path)
+            md5s.append(hashlib.md5(data).hexdigest())
+        total = args.nfiles * args.size
+
+        for name, func in (('legacy', legacy), ('new', new)):
+            evict(paths)
+            td = TapeEmulator(os.path.join(tmpdir, 'tape'), tmpdir,
+                              rate=args.rate * MB, buffer=args.buffer * MB,
+                              backhitch=args.backhitch)
+            td.rewind()
+            start = time.perf_counter()
+            func(paths, md5s, td, args.blocksize)
+            elapsed = time.perf_counter() - start
+            print(f"{name:8s}: {total} MB in {elapsed:6.2f} s, "
+                  f"{total / elapsed:6.1f} MB/s, "
+                  f"{td.nblocks(td.files[0])} blocks")
+
+
+if __name__ == '__main__':
+    main()
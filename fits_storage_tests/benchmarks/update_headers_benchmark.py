@@ -0,0 +1,166 @@
+#!/usr/bin/env python3
+"""
+Benchmark processing an update_headers payload end to end - checking the
+files exist, adding to the fileops queue, and running the fileops requests to
+edit the files and queue them for ingest - comparing one update_headers
+fileops request per payload entry (as the update_headers handler used to do)
+against the update_headers_batch requests it now uses.
+
+This builds a testing environment with an SQLite database and small
+synthetic bz2 compressed files, with database rows added directly rather than
+by ingesting the files. The payload is like a night of QA state updates from
+the ODB, with some files appearing in several entries.
+"""
+import hashlib
+import io
+import os
+import random
+import tempfile
+import time
+from argparse import ArgumentParser
+
+from fits_storage_tests.code_tests.helpers import get_test_config
+get_test_config()
+
+import astropy.io.fits
+import numpy
+from sqlalchemy import insert
+
+from fits_storage_tests.code_tests.helpers import make_empty_testing_db_env
+from fits_storage.config import get_config
+from fits_storage.db import sessionfactory
+from fits_storage.logger_dummy import DummyLogger
+
+from fits_storage.core.orm.file import File
+from fits_storage.core.orm.diskfile import DiskFile
+from fits_storage.core.orm.header import Header
+from fits_storage.queues.orm.fileopsqueueentry import FileopsQueueEntry
+from fits_storage.queues.orm.ingestqueueentry import IngestQueueEntry
+from fits_storage.queues.queue.fileopsqueue import FileopsQueue, \
+    FileOpsRequest
+from fits_storage.server.bz2multistream import write_multistream
+from fits_storage.server.fileopser import FileOpser
+from fits_storage.web.update_headers import check_exists, \
+    queue_header_updates
+
+parser = ArgumentParser(description=__doc__)
+parser.add_argument("--entries", action="store", type=int, dest="entries",
+                    default=1000, help="Number of entries in the payload")
+parser.add_argument("--files", action="store", type=int, dest="files",
+                    default=600, help="Number of distinct files they refer to")
+args = parser.parse_args()
+
+rng = random.Random(2024)
+QA_STATES = ['Pass', 'Usable', 'Fail', 'Check']
+RAW_SITES = ['iq70', 'iqany', 'cc50', 'cc80', 'bg50', 'wvany']
+
+
+def make_fits():
+    phu = astropy.io.fits.PrimaryHDU()
+    phu.header['RAWGEMQA'] = 'UNKNOWN'
+    phu.header['RAWPIREQ'] = 'UNKNOWN'
+    for keyword in ('RAWIQ', 'RAWCC', 'RAWBG', 'RAWWV'):
+        phu.header[keyword] = 'Any'
+    sci = astropy.io.fits.ImageHDU(numpy.arange(40000, dtype=numpy.int16))
+    buffer = io.BytesIO()
+    astropy.io.fits.HDUList([phu, sci]).writeto(buffer)
+    return buffer.getvalue()
+
+
+def filename(i):
+    return f"N20240101S{i:04d}.fits.bz2"
+
+
+def write_files(raw):
+    fsc = get_config()
+    for i in range(args.files):
+        with open(os.path.join(fsc.storage_root, filename(i)), 'wb') as f:
+            write_multistream(io.BytesIO(raw), f)
+
+
+def populate_database(session, raw):
+    data_md5 = hashlib.md5(raw).hexdigest()
+    session.execute(insert(File.__table__), [{'id': i + 1, 'name': filename(i)[:-4]}
+                                   for i in range(args.files)])
+    session.execute(insert(DiskFile.__table__), [
+        {'id': i + 1, 'file_id': i + 1, 'filename': filename(i), 'path': '',
+         'present': True, 'canonical': True, 'compressed': True,
+         'data_md5': data_md5, 'data_size': len(raw)}
+        for i in range(args.files)])
+    session.execute(insert(Header.__table__), [
+        {'id': i + 1, 'diskfile_id': i + 1,
+         'data_label': f'GN-2024A-Q-1-{i}-001'}
+        for i in range(args.files)])
+    session.commit()
+
+
+def make_payload():
+    payload = []
+    for n in range(args.entries):
+        i = n if n < args.files else rng.randrange(args.files)
+        values = {'qa_state': rng.choice(QA_STATES)} if rng.random() < 0.7 \
+            else {'raw_site': rng.choice(RAW_SITES)}
+        if rng.random() < 0.8:
+            payload.append({'filename': filename(i), 'values': values})
+        else:
+            payload.append({'data_label': f'GN-2024A-Q-1-{i}-001',
+                            'values': values})
+    return payload
+
+
+def per_entry(session, payload):
+    # What the update_headers handler used to do
+    fq = FileopsQueue(session, logger=DummyLogger())
+    for update in payload:
+        fn = update.get('filename')
+        dl = update.get('data_label')
+        if check_exists(session, fn=fn, dl=dl) != 1:
+            raise RuntimeError(f'{fn or dl} does not exist')
+        fqargs = {'filename': fn} if fn else {'data_label': dl}
+        fqargs.update(update['values'])
+        fq.add(FileOpsRequest(request='update_headers', args=fqargs),
+               filename=fn)
+
+
+def batched(session, payload):
+    results = queue_header_updates(session, payload)
+    if not all(r['result'] for r in results):
+        raise RuntimeError('queue_header_updates failed')
+
+
+def run(session, queue_func, payload):
+    start = time.perf_counter()
+    queue_func(session, payload)
+    queued = time.perf_counter()
+    fo = FileOpser(session, DummyLogger())
+    nrequests = 0
+    for fqe in session.query(FileopsQueueEntry).order_by(FileopsQueueEntry.id):
+        fo.fileop(fqe)
+        if not fo.response.ok:
+            raise RuntimeError(fo.response.error)
+        fo.reset()
+        nrequests += 1
+    end = time.perf_counter()
+    session.query(FileopsQueueEntry).delete()
+    nqueued = session.query(IngestQueueEntry).count()
+    session.query(IngestQueueEntry).delete()
+    session.commit()
+    return queued - start, end - start, nrequests, nqueued
+
+
+with tempfile.TemporaryDirectory() as tmpdir:
+    make_empty_testing_db_env(tmpdir)
+    session = sessionfactory()
+    raw = make_fits()
+    write_files(raw)
+    populate_database(session, raw)
+    payload = make_payload()
+    print(f"{len(payload)} entries for {args.files} files")
+
+    for name, queue_func in (('Per entry', per_entry), ('Batched', batched)):
+        write_files(raw)
+        queue_time, total, nrequests, nqueued = run(session, queue_func,
+                                                    payload)
+        print(f"{name:10s}: queueing {queue_time*1000:7.1f} ms, "
+              f"end to end {total:6.2f} s, {nrequests} fileops requests, "
+              f"{nqueued} files queued for ingest")
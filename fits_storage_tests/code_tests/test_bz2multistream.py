@@ -0,0 +1,148 @@
+import bz2
+import hashlib
+import io
+import os
+
+import numpy
+import astropy.io.fits
+
+from fits_storage.server.bz2multistream import write_multistream, \
+    is_multistream, read_fits_header, data_size, HeaderOnlyEditor, md5sums, \
+    read_primary_header
+
+
+def make_fits():
+    phu = astropy.io.fits.PrimaryHDU()
+    phu.header['RAWGEMQA'] = 'UNKNOWN'
+    sci = astropy.io.fits.ImageHDU(
+        numpy.arange(200000, dtype=numpy.int16).reshape(200, 1000))
+    var = astropy.io.fits.ImageHDU(numpy.ones((50, 50), dtype=numpy.float32))
+    buffer = io.BytesIO()
+    astropy.io.fits.HDUList([phu, sci, var]).writeto(buffer)
+    return buffer.getvalue()
+
+
+def test_read_fits_header():
+    raw = make_fits()
+    f = io.BytesIO(raw)
+    header = read_fits_header(f)
+    assert len(header) == 2880
+    assert data_size(header) == 0
+    header = read_fits_header(f)
+    assert header.startswith(b'XTENSION')
+    assert data_size(header) == 400320
+
+
+def test_write_multistream():
+    raw = make_fits()
+    for split in (False, True):
+        out = io.BytesIO()
+        write_multistream(io.BytesIO(raw), out, split_extensions=split)
+        assert bz2.decompress(out.getvalue()) == raw
+        assert is_multistream(io.BytesIO(out.getvalue()))
+
+    assert not is_multistream(io.BytesIO(bz2.compress(raw)))
+
+
+def _write(path, raw, split):
+    with open(path, 'wb') as f:
+        write_multistream(io.BytesIO(raw), f, split_extensions=split)
+
+
+def test_header_only_editor_compressed(tmp_path):
+    raw = make_fits()
+    path = os.path.join(tmp_path, 'test.fits.bz2')
+
+    _write(path, raw, False)
+    editor = HeaderOnlyEditor(path, True)
+    editor[0].header['RAWGEMQA'] = 'USABLE'
+    editor[0].header['FELINE'] = 'Sleepy'
+    # Extension headers are not in their own streams
+    try:
+        editor[1]
+        assert False
+    except IndexError:
+        pass
+    assert editor.write() in ('in place', 'spliced')
+    with astropy.io.fits.open(path) as hdulist:
+        assert hdulist[0].header['RAWGEMQA'] == 'USABLE'
+        assert hdulist[0].header['FELINE'] == 'Sleepy'
+        assert (hdulist[1].data == numpy.arange(200000, dtype=numpy.int16)
+                .reshape(200, 1000)).all()
+    assert editor.write() == 'unchanged'
+
+    _write(path, raw, True)
+    editor = HeaderOnlyEditor(path, True)
+    editor[2].header['EXTVER'] = 2
+    editor[0].header['RAWGEMQA'] = 'BAD'
+    editor.write()
+    with astropy.io.fits.open(path) as hdulist:
+        assert hdulist[0].header['RAWGEMQA'] == 'BAD'
+        assert hdulist[2].header['EXTVER'] == 2
+        assert (hdulist[2].data == 1).all()
+
+
+def test_header_only_editor_uncompressed(tmp_path):
+    raw = make_fits()
+    path = os.path.join(tmp_path, 'test.fits')
+    with open(path, 'wb') as f:
+        f.write(raw)
+
+    editor = HeaderOnlyEditor(path, False)
+    editor[0].header['RAWGEMQA'] = 'USABLE'
+    editor[1].header['FELINE'] = 'Sleepy'
+    assert editor.write() == 'in place'
+    assert os.path.getsize(path) == len(raw)
+
+    # Grow the primary header past a 2880 byte block
+    for i in range(40):
+        editor[0].header[f'KEY{i}'] = i
+    assert editor.write() == 'spliced'
+    assert os.path.getsize(path) == len(raw) + 2880
+
+    with astropy.io.fits.open(path) as hdulist:
+        assert hdulist[0].header['RAWGEMQA'] == 'USABLE'
+        assert hdulist[0].header['KEY39'] == 39
+        assert hdulist[1].header['FELINE'] == 'Sleepy'
+        assert (hdulist[2].data == 1).all()
+
+
+def test_md5sums(tmp_path):
+    data = make_fits()
+    path = os.path.join(tmp_path, 'test.fits.bz2')
+    with open(path, 'wb') as f:
+        written = write_multistream(io.BytesIO(data), f, split_extensions=True)
+    with open(path, 'rb') as f:
+        compressed = f.read()
+
+    assert md5sums(path, True) == (len(compressed),
+                                   hashlib.md5(compressed).hexdigest(),
+                                   len(data), hashlib.md5(data).hexdigest())
+    assert written == md5sums(path, True)
+    assert read_primary_header(path, True) == data[:2880]
+
+    path = os.path.join(tmp_path, 'test.fits')
+    with open(path, 'wb') as f:
+        f.write(data)
+    md5 = hashlib.md5(data).hexdigest()
+    assert md5sums(path, False) == (len(data), md5, len(data), md5)
+
+
+def test_header_only_editor_md5sums(tmp_path):
+    raw = make_fits()
+    for compressed, split in ((True, False), (True, True), (False, False)):
+        path = os.path.join(tmp_path, f'test{compressed}{split}.fits')
+        if compressed:
+            _write(path, raw, split)
+        else:
+            with open(path, 'wb') as f:
+                f.write(raw)
+        editor = HeaderOnlyEditor(path, compressed)
+        editor[0].header['RAWGEMQA'] = 'USABLE'
+        editor.write()
+        assert editor.md5sums == md5sums(path, compressed)
+        # Spliced
+        for i in range(40):
+            editor[0].header[f'KEY{i}'] = i
+        assert editor.write() == 'spliced'
+        assert editor.md5sums == md5sums(path, compressed)
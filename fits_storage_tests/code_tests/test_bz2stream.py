@@ -62,3 +62,59 @@ def test_bzstream4():
 def test_bzstream5():
     do_test(datasize=500000, chunksize=100000, readsize=1000)
 
+
+def test_bzstream6():
+    do_test(datasize=2000000, chunksize=1000000, readsize=700000)
+
+
+def test_bzstream_readinto():
+    src_data = random.randbytes(500000)
+    check_data = bz2.compress(src_data)
+
+    sbc = StreamBz2Compressor(io.BytesIO(src_data), chunksize=100000)
+    buffer = bytearray(1000)
+    comp_data = bytearray()
+    while n := sbc.readinto(buffer):
+        comp_data += buffer[:n]
+
+    assert comp_data == check_data
+    assert sbc.bytes_output == len(check_data)
+    assert sbc.md5sum_output == hashlib.md5(check_data).hexdigest()
+
+
+def test_bzstream_passthrough():
+    # Already compressed data are passed through as they are
+    src_data = bz2.compress(random.randbytes(100000))
+
+    sbc = StreamBz2Compressor(io.BytesIO(src_data), chunksize=1000,
+                              passthrough=True)
+    comp_data = bytes(0)
+    while data := sbc.read(1500):
+        comp_data += data
+
+    assert comp_data == src_data
+    assert sbc.bytes_output == len(src_data)
+    assert sbc.md5sum_output == hashlib.md5(src_data).hexdigest()
+
+
+def test_bzstream_len(tmp_path):
+    # We know the length of data passed through from a file, so that requests
+    # can set Content-Length, but not of data we compress
+    src_data = bz2.compress(random.randbytes(100000))
+    path = tmp_path / 'src.bz2'
+    path.write_bytes(src_data)
+
+    with open(path, 'rb') as f:
+        f.seek(1000)
+        sbc = StreamBz2Compressor(f, passthrough=True)
+        assert len(sbc) == len(src_data) - 1000
+        sbc.read(500)
+        assert len(sbc) == len(src_data) - 1500
+
+    with open(path, 'rb') as f:
+        sbc = StreamBz2Compressor(f)
+        assert len(sbc) == 0
+        assert sbc
+
+    sbc = StreamBz2Compressor(io.BytesIO(src_data), passthrough=True)
+    assert len(sbc) == 0
@@ -0,0 +1,37 @@
+from fits_storage_tests.code_tests.helpers import get_test_config
+get_test_config()
+
+from types import SimpleNamespace
+
+import fits_storage.core.orm.diskfilereport
+from fits_storage.core.orm.diskfilereport import DiskFileReport
+
+
+class FakeDiskFile(object):
+    id = 1
+
+    def __init__(self, ad_object=None):
+        self.ad_object = ad_object
+        self.mdready = None
+
+    def get_uncompressed_file(self):
+        return 'file.fits'
+
+
+def test_md_in_memory(monkeypatch):
+    sources = []
+
+    def evaluate(source):
+        sources.append(source)
+        return SimpleNamespace(passes=True, code='CORRECT', message=None)
+
+    monkeypatch.setattr(fits_storage.core.orm.diskfilereport, 'evaluate',
+                        evaluate)
+    report = DiskFileReport(FakeDiskFile(), skip_fv=True, skip_md=True)
+
+    # The open AstroData object is only used if there is one, and in_memory
+    ad = object()
+    report.md(FakeDiskFile(ad), in_memory=True)
+    report.md(FakeDiskFile(), in_memory=True)
+    report.md(FakeDiskFile(ad), in_memory=False)
+    assert sources == [ad, 'file.fits', 'file.fits']
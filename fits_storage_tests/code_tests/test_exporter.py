@@ -3,6 +3,9 @@ import os.path
 
 import requests
 
+from fits_storage_tests.code_tests.helpers import get_test_config
+get_test_config()
+
 from fits_storage_tests.code_tests.helpers import make_empty_testing_db_env
 from fits_storage.db import sessionfactory
 from fits_storage.config import get_config
@@ -164,3 +167,110 @@ def test_destination_server_failure_handling(tmpdir):
         session.delete(eqe2)
         session.delete(eqe3)
         session.commit()
+
+
+class DummyHeaderDeltaSession(object):
+    # Dummy requests session that records header_delta posts and responds
+    # with the given result
+    def __init__(self, result=True):
+        self.result = result
+        self.posts = []
+
+    def post(self, url, json=None, **kwargs):
+        self.posts.append((url, json))
+        response = DummyRequestsResponse()
+        if self.result:
+            response.text = '[{"result": true, "id": "file1.fits.bz2", ' \
+                            '"fileops_id": 1}]'
+        else:
+            response.text = '[{"result": false, "id": "file1.fits.bz2", ' \
+                            '"error": "No unique present file found"}]'
+        return response
+
+
+def test_transfer_headers():
+    exp = Exporter(None, DummyLogger())
+
+    eqe = dummy_qe()
+    eqe.filename = 'file1.fits'
+    eqe.path = ''
+    eqe.destination = 'destination1'
+    eqe.header_update = '{"generic": [["RAWGEMQA", "BAD"]]}'
+    eqe.md5_before_header_update = 'before'
+    eqe.md5_after_header_update = 'after'
+    exp.eqe = eqe
+    exp._set_eqe_destination_path()
+    exp.df = dummy_qe()
+    exp.df.data_md5 = 'after'
+
+    # Destination has the expected file and queues the update
+    exp.destination_md5 = 'before'
+    exp.rs = DummyHeaderDeltaSession()
+    assert exp.transfer_headers() is True
+    assert exp.rs.posts == [('destination1/header_delta/file1.fits.bz2',
+                             {'md5_before': 'before',
+                              'header_update':
+                                  {'generic': [['RAWGEMQA', 'BAD']]}})]
+
+    # Destination refuses the update
+    exp.rs = DummyHeaderDeltaSession(result=False)
+    assert exp.transfer_headers() is False
+
+    # Destination does not have the file we updated. Don't even try.
+    exp.destination_md5 = 'other'
+    exp.rs = DummyHeaderDeltaSession()
+    assert exp.transfer_headers() is False
+    assert exp.rs.posts == []
+
+
+def test_export_file_header_delta(tmpdir):
+    # The header update is sent once, then the export is deferred and checked
+    # on the next pass, falling back to a file transfer if it didn't work.
+    make_empty_testing_db_env(tmpdir)
+    session = sessionfactory()
+
+    for destination_md5, transferred in (('after', False), ('before', True)):
+        eqe = ExportQueueEntry('file1.fits', '', 'destination1',
+                               md5_before_header_update='before',
+                               md5_after_header_update='after',
+                               header_update='{"qa_state": "Pass"}')
+        session.add(eqe)
+        session.commit()
+        eqe_id = eqe.id
+
+        exp = Exporter(session, DummyLogger())
+        exp.rs = DummyHeaderDeltaSession()
+        exp.header_delta_wait = 30
+        df = dummy_qe()
+        df.id = 1
+        df.data_md5 = 'after'
+
+        def get_df():
+            exp.df = df
+            return True
+        exp.get_df = get_df
+        file_transfers = []
+        exp.file_transfer = lambda: file_transfers.append(exp.eqe.id)
+
+        now = utcnow()
+        exp.export_file(eqe, destination_info=('before', False))
+        assert len(exp.rs.posts) == 1
+        assert file_transfers == []
+        eqe = session.get(ExportQueueEntry, eqe_id)
+        assert eqe.header_update is None
+        assert eqe.inprogress is False
+        assert (eqe.after - now).total_seconds() >= 30
+
+        # The destination still has the update pending, so wait for it
+        exp.export_file(eqe, destination_info=('before', True))
+        assert file_transfers == []
+
+        exp.export_file(eqe, destination_info=(destination_md5, False))
+        assert len(exp.rs.posts) == 1
+        if transferred:
+            assert file_transfers == [eqe_id]
+            session.delete(eqe)
+            session.commit()
+        else:
+            assert file_transfers == []
+            assert session.get(ExportQueueEntry, eqe_id) is None
@@ -0,0 +1,231 @@
+from fits_storage_tests.code_tests.helpers import get_test_config
+get_test_config()
+
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from sqlalchemy import insert
+
+from fits_storage_tests.code_tests.helpers import make_empty_testing_db_env
+
+from fits_storage.config import get_config
+from fits_storage.logger_dummy import DummyLogger
+from fits_storage.core.orm.file import File
+from fits_storage.core.orm.diskfile import DiskFile
+from fits_storage.queues.orm.exportqueueentry import ExportQueueEntry
+from fits_storage.queues.queue.exportqueue import ExportQueue
+from fits_storage.server.exporter import Exporter
+from fits_storage.server.exportsupervisor import ExportSupervisor
+
+# Seconds the stand in destination takes to respond to each request
+LATENCY = 0.05
+
+
+class Receiver(ThreadingHTTPServer):
+    """
+    A stand in for destination servers. The first path component is the
+    destination name, then jsonfilelist or upload_file as on a real server.
+    Files listed in present[destination] are reported as being there already,
+    and uploads to destinations in failing get an error.
+    """
+    daemon_threads = True
+
+    def __init__(self):
+        super().__init__(('127.0.0.1', 0), ReceiverHandler)
+        self.lock = threading.Lock()
+        self.present = {}
+        self.failing = set()
+        self.uploads = Counter()
+        self.requests = Counter()
+        self.active = Counter()
+        self.max_active = Counter()
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server_port}"
+
+
+class ReceiverHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def respond(self, status, obj):
+        body = json.dumps(obj).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        destination, action, *_ = self.path.lstrip('/').split('/')
+        with self.server.lock:
+            self.server.requests[(destination, 'GET ' + action)] += 1
+        time.sleep(LATENCY)
+        # Per file query, like .../jsonfilelist/present/path=/filename=x
+        filename = self.path.rsplit('filename=', 1)[-1]
+        present = self.server.present.get(destination, {})
+        self.respond(200, [{'filename': fn, 'path': '', 'data_md5': md5}
+                           for fn, md5 in present.items()
+                           if fn.removesuffix('.bz2') == filename])
+
+    def do_POST(self):
+        destination, action, *rest = self.path.lstrip('/').split('/')
+        data = self.rfile.read(int(self.headers['Content-Length']))
+        server = self.server
+        with server.lock:
+            server.requests[(destination, action)] += 1
+        time.sleep(LATENCY)
+
+        if action == 'jsonfilelist':
+            wanted = json.loads(data)
+            present = server.present.get(destination, {})
+            self.respond(200, [{'filename': fn, 'path': '', 'data_md5': md5}
+                               for fn, md5 in present.items()
+                               if fn.removesuffix('.bz2') in wanted])
+            return
+
+        if action != 'upload_file':
+            self.respond(404, [])
+            return
+
+        with server.lock:
+            server.active[destination] += 1
+            server.max_active[destination] = max(
+                server.max_active[destination], server.active[destination])
+        try:
+            time.sleep(LATENCY)
+            if destination in server.failing:
+                self.respond(500, [])
+            else:
+                with server.lock:
+                    server.uploads[destination] += 1
+                self.respond(200, [{'filename': rest[-1], 'size': len(data),
+                                    'md5': hashlib.md5(data).hexdigest()}])
+        finally:
+            with server.lock:
+                server.active[destination] -= 1
+
+
+def make_files(session, n):
+    fsc = get_config()
+    filenames = [f'N20200101S{i:04d}.fits.bz2' for i in range(n)]
+    for fn in filenames:
+        with open(os.path.join(fsc.storage_root, fn), 'wb') as f:
+            f.write(fn.encode())
+    session.execute(insert(File.__table__), [
+        {'id': i + 1, 'name': fn[:-4]} for i, fn in enumerate(filenames)])
+    session.execute(insert(DiskFile.__table__), [
+        {'id': i + 1, 'file_id': i + 1, 'filename': fn, 'path': '',
+         'present': True, 'data_md5': f'md5-{fn}'}
+        for i, fn in enumerate(filenames)])
+    session.commit()
+    return filenames
+
+
+def queue_exports(session, filenames, destinations):
+    eq = ExportQueue(session, logger=DummyLogger())
+    for destination in destinations:
+        for fn in filenames:
+            assert eq.add(fn, '', destination) is True
+
+
+def remaining(session):
+    return Counter(eqe.destination.rsplit('/', 1)[-1]
+                   for eqe in session.query(ExportQueueEntry))
+
+
+def test_get_destination_info_many(tmp_path):
+    make_empty_testing_db_env(tmp_path)
+    receiver = Receiver()
+    threading.Thread(target=receiver.serve_forever, daemon=True).start()
+    try:
+        receiver.present['dest1'] = {'a.fits.bz2': 'md5a', 'b.fits': 'md5b'}
+        exp = Exporter(None, DummyLogger())
+        info = exp.get_destination_info_many(
+            f"{receiver.url}/dest1", [('', 'a.fits'), ('', 'b.fits.bz2'),
+                                      ('', 'c.fits.bz2'),
+                                      ('', '20200101_obslog.txt')])
+        assert info == {('', 'a.fits'): ('md5a', False),
+                        ('', 'b.fits.bz2'): ('md5b', False),
+                        ('', 'c.fits.bz2'): (None, None)}
+        assert receiver.requests[('dest1', 'jsonfilelist')] == 1
+
+        # A destination that does not support POST jsonfilelist
+        assert exp.get_destination_info_many(
+            f"{receiver.url}/nosuchdest/x", [('', 'a.fits')]) == {}
+    finally:
+        receiver.shutdown()
+
+
+def test_export_supervisor(tmp_path):
+    session = make_empty_testing_db_env(tmp_path)
+    receiver = Receiver()
+    threading.Thread(target=receiver.serve_forever, daemon=True).start()
+    try:
+        filenames = make_files(session, 20)
+        destinations = [f"{receiver.url}/dest1", f"{receiver.url}/dest2"]
+        # dest1 already has the first file
+        receiver.present['dest1'] = {filenames[0]: f'md5-{filenames[0]}'}
+
+        # Export one file at a time, as service_export_queue.py does
+        queue_exports(session, filenames, destinations)
+        eq = ExportQueue(session, logger=DummyLogger())
+        exporter = Exporter(session, DummyLogger())
+        start = time.perf_counter()
+        while (eqe := eq.pop()) is not None:
+            exporter.export_file(eqe)
+        sequential = time.perf_counter() - start
+        assert remaining(session) == Counter()
+        assert receiver.uploads == {'dest1': 19, 'dest2': 20}
+
+        # And with the supervisor
+        receiver.uploads.clear()
+        receiver.requests.clear()
+        queue_exports(session, filenames, destinations)
+        supervisor = ExportSupervisor(session, DummyLogger(), workers=6,
+                                      destination_limit=3)
+        start = time.perf_counter()
+        supervisor.run(empty=True)
+        concurrent = time.perf_counter() - start
+        assert remaining(session) == Counter()
+        assert receiver.uploads == {'dest1': 19, 'dest2': 20}
+        assert receiver.max_active['dest1'] <= 3
+        assert receiver.max_active['dest2'] <= 3
+        # The destination checks are batched rather than one per file
+        assert receiver.requests[('dest1', 'GET jsonfilelist')] == 0
+        assert receiver.requests[('dest1', 'jsonfilelist')] < 10
+        assert concurrent < sequential / 3
+    finally:
+        receiver.shutdown()
+
+
+def test_export_supervisor_delay_destination(tmp_path):
+    session = make_empty_testing_db_env(tmp_path)
+    receiver = Receiver()
+    threading.Thread(target=receiver.serve_forever, daemon=True).start()
+    try:
+        filenames = make_files(session, 10)
+        destinations = [f"{receiver.url}/dest1", f"{receiver.url}/dest2"]
+        receiver.failing.add('dest2')
+        queue_exports(session, filenames, destinations)
+
+        supervisor = ExportSupervisor(session, DummyLogger(), workers=4,
+                                      destination_limit=2)
+        supervisor.run(empty=True)
+
+        # dest1 is unaffected. dest2 gets delayed after its first failures,
+        # so we only try as many as were in progress when that happened.
+        assert receiver.uploads == {'dest1': 10}
+        assert remaining(session) == Counter({'dest2': 10})
+        assert receiver.requests[('dest2', 'upload_file')] <= 2
+        assert f"{receiver.url}/dest2" in supervisor.delayed
+    finally:
+        receiver.shutdown()
@@ -0,0 +1,81 @@
+from fits_storage_tests.code_tests.helpers import get_test_config
+get_test_config()
+
+from fits_storage.server.tapeutils import FileOnTapeHelper
+
+
+class FakeResponse(object):
+    def __init__(self, results, status_code=200):
+        self.results = results
+        self.status_code = status_code
+
+    def json(self):
+        return self.results
+
+
+class FakeTapeServer(object):
+    """
+    Stands in for the requests session, answering jsontapefile requests from
+    a list of tapefile dictionaries
+    """
+    def __init__(self, tapefiles):
+        self.tapefiles = tapefiles
+        self.requests = []
+
+    def get(self, url):
+        self.requests.append(url)
+        filepre = url.split('/jsontapefile/')[1]
+        return FakeResponse([tf for tf in self.tapefiles
+                             if tf['filename'].startswith(filepre)])
+
+    def post(self, url, json=None):
+        self.requests.append(url)
+        if len(json) > 2:
+            return FakeResponse([], status_code=500)
+        names = set(json) | {fn + '.bz2' for fn in json}
+        return FakeResponse([tf for tf in self.tapefiles
+                             if tf['filename'] in names])
+
+
+def tapefile(filename, data_md5, tape_id, tape_set=1):
+    return {'filename': filename, 'size': 10, 'md5': 'x', 'tape_id': tape_id,
+            'tape_set': tape_set, 'data_size': 10, 'data_md5': data_md5}
+
+
+def test_fileontapehelper():
+    server = FakeTapeServer([
+        tapefile('N20240101S0001.fits.bz2', 'md5-1', 1),
+        tapefile('N20240101S0001.fits.bz2', 'md5-1', 2, tape_set=2),
+        tapefile('N20240101S0001.fits.bz2', 'old', 3),
+        tapefile('N20240101S0002.fits', 'md5-2', 1),
+        tapefile('N20240102S0001.fits.bz2', 'md5-3', 1),
+        tapefile('N20240103S0001.fits.bz2', 'md5-4', 2)])
+    foth = FileOnTapeHelper(tapeserver='http://tapeserver')
+    foth.reqses = server
+    foth.bulk_chunk = 2
+    assert foth.cached_count() == 0
+
+    # Three files (one not on tape) in two bulk requests
+    assert foth.populate_cache_bulk(['N20240101S0001.fits.bz2',
+                                     'N20240101S0002.fits', 'N20240101S0001',
+                                     'N20240104S0001.fits'])
+    assert server.requests == ['http://tapeserver/jsontapefile'] * 2
+    assert foth.cached_count() == 3
+
+    assert foth.check_file('N20240101S0001.fits', 'md5-1') == {1, 2}
+    assert foth.check_file('N20240101S0001.fits.bz2') == {1, 2, 3}
+    assert foth.check_file('N20240101S0001.fits', 'md5-1', tape_set=2) == {2}
+    assert foth.check_file('N20240101S0002.fits.bz2', 'md5-2') == {1}
+    assert foth.check_file('N20240101S0002.fits', 'other') == set()
+    assert foth.check_file('N20240104S0001.fits') == set()
+    assert len(server.requests) == 2
+
+    # Files we didn't ask about are queried by filepre
+    assert foth.check_file('N20240102S0001.fits', 'md5-3') == {1}
+    assert foth.check_file('N20240102S0002.fits') == set()
+    assert server.requests[2:] == ['http://tapeserver/jsontapefile/N20240102']
+
+    # A failed request is reported
+    foth.bulk_chunk = 3
+    assert not foth.populate_cache_bulk(['N20240103S0001.fits', 'a', 'b'])
+    assert foth.check_file('N20240103S0001.fits') == {2}
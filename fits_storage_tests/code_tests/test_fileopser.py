@@ -1,4 +1,6 @@
+import bz2
 import datetime
+import hashlib
 import astrodata
 
 from fits_storage.config import get_config
@@ -19,6 +21,8 @@ from fits_storage.queues.orm.ingestqueueentry import IngestQueueEntry
 from fits_storage.logger_dummy import DummyLogger
 from fits_storage.core.ingester import Ingester
 from fits_storage.core.orm.diskfile import DiskFile
+from fits_storage.core.orm.header import Header
+from fits_storage.core.orm.fulltextheader import FullTextHeader
 
 from fits_storage_tests.code_tests.helpers import make_empty_testing_db_env, \
     fetch_file
@@ -199,9 +203,12 @@ def test_update_headers(tmp_path):
 
     if fo.response.ok is not True:
         print(f'fo response error: {fo.response.error}')
+    # The response value is the data_md5 of the updated file
+    with bz2.open(df.fullpath, 'rb') as f:
+        data_md5 = hashlib.md5(f.read()).hexdigest()
     assert fo.response.ok is True
     assert fo.response.error == ''
-    assert fo.response.value is None
+    assert fo.response.value == data_md5
 
     fqe_fetch = session.query(FileopsQueueEntry).one()
     resp_fetch = FileOpsResponse()
@@ -209,7 +216,7 @@ def test_update_headers(tmp_path):
 
     assert resp_fetch.ok is True
     assert resp_fetch.error == ''
-    assert resp_fetch.value is None
+    assert resp_fetch.value == data_md5
 
     # Check final headers
     ad = astrodata.open(df.fullpath)
@@ -219,3 +226,132 @@ def test_update_headers(tmp_path):
     assert ad.phu['RAWCC'] == '80-percentile'
     assert ad.phu['SSA'] == 'Mickey Mouse'
     assert ad.phu['KANGAROO'] == 'Jumpy'
+
+
+def test_update_headers_header_delta(tmp_path):
+    make_empty_testing_db_env(tmp_path)
+    fsc = get_config()
+    session = sessionfactory()
+    logger = DummyLogger(print=True)
+    filename = 'N20200127S0023.fits.bz2'
+
+    fetch_file(filename, fsc.storage_root)
+    iqe = IngestQueueEntry(filename, '')
+    session.add(iqe)
+    session.commit()
+    ingester = Ingester(session, logger)
+    ingester.ingest_file(iqe)
+    df = session.query(DiskFile).filter(DiskFile.filename == filename).one()
+    orig_data_md5 = df.data_md5
+
+    # Only keywords that map directly to header columns
+    args = {'filename': filename, 'qa_state': 'Fail', 'raw_site': 'iqany'}
+    fqreq = FileOpsRequest(request='update_headers', args=args)
+    fqe = FileopsQueueEntry(fqreq.json(), response_required=True)
+    session.add(fqe)
+    session.commit()
+    fo = FileOpser(session, logger)
+    fo.fileop(fqe)
+    session.commit()
+    assert fo.response.ok is True
+
+    iqe = session.query(IngestQueueEntry).one()
+    assert iqe.md5_before_header_update == orig_data_md5
+    assert iqe.md5_after_header_update != orig_data_md5
+    assert iqe.file_md5_after_header_update == df.get_file_md5()
+    ingester.ingest_file(iqe)
+
+    # The existing diskfile and header are updated in place
+    assert session.query(IngestQueueEntry).count() == 0
+    assert session.query(DiskFile).count() == 1
+    df = session.query(DiskFile).one()
+    assert df.present is True
+    assert df.data_md5 == iqe.md5_after_header_update
+    assert df.file_md5 == df.get_file_md5()
+    header = session.query(Header).one()
+    assert header.qa_state == 'Fail'
+    assert header.raw_iq == 100
+    fth = session.query(FullTextHeader).one()
+    assert "RAWGEMQA= 'BAD" in fth.fulltext
+
+    # Check the md5 really is that of the data
+    df.get_uncompressed_file()
+    assert df.data_md5 == iqe.md5_after_header_update
+    df.cleanup()
+
+    # Other keywords need a full ingest, which adds a new diskfile
+    args = {'filename': filename, 'generic': {'OBJECT': 'Elephant'}}
+    fqreq = FileOpsRequest(request='update_headers', args=args)
+    fqe = FileopsQueueEntry(fqreq.json(), response_required=True)
+    session.add(fqe)
+    session.commit()
+    fo.fileop(fqe)
+    session.commit()
+    iqe = session.query(IngestQueueEntry).one()
+    ingester.ingest_file(iqe)
+    assert session.query(DiskFile).count() == 2
+
+    # Replaying an update with the wrong md5_before does not modify the file
+    file_md5 = df.get_file_md5()
+    args = {'filename': filename, 'qa_state': 'Pass', 'md5_before': 'wrong'}
+    fqreq = FileOpsRequest(request='update_headers', args=args)
+    fqe = FileopsQueueEntry(fqreq.json(), response_required=True)
+    session.add(fqe)
+    session.commit()
+    fo.fileop(fqe)
+    assert fo.response.ok is False
+    assert 'does not match md5_before' in fo.response.error
+    assert df.get_file_md5() == file_md5
+
+
+def test_update_headers_batch(tmp_path):
+    make_empty_testing_db_env(tmp_path)
+    fsc = get_config()
+    session = sessionfactory()
+    logger = DummyLogger(print=True)
+    filename = 'N20200127S0023.fits.bz2'
+
+    fetch_file(filename, fsc.storage_root)
+    iqe = IngestQueueEntry(filename, '')
+    session.add(iqe)
+    session.commit()
+    Ingester(session, logger).ingest_file(iqe)
+    df = session.query(DiskFile).filter(DiskFile.filename == filename).one()
+    orig_lastmod = df.get_file_lastmod()
+
+    # Several updates to the same file are applied in order, with one edit,
+    # however they name the file as long as they have the same diskfile_id
+    data_label = session.query(Header.data_label)\
+        .filter(Header.diskfile_id == df.id).scalar()
+    args = {'updates': [{'filename': filename, 'qa_state': 'Fail',
+                         'diskfile_id': df.id},
+                        {'filename': filename.removesuffix('.bz2'),
+                         'raw_site': 'iqany', 'diskfile_id': df.id},
+                        {'data_label': data_label, 'qa_state': 'Pass',
+                         'diskfile_id': df.id},
+                        {'filename': 'nosuchfile.fits', 'qa_state': 'Pass'}]}
+    fqreq = FileOpsRequest(request='update_headers_batch', args=args)
+    fqe = FileopsQueueEntry(fqreq.json(), response_required=True)
+    session.add(fqe)
+    session.commit()
+    fo = FileOpser(session, logger)
+    fo.fileop(fqe)
+    session.commit()
+
+    assert fo.response.ok is True
+    results = fo.response.value
+    assert len(results) == 2
+    assert results[0]['id'] == filename
+    assert results[0]['result'] is True
+    with bz2.open(df.fullpath, 'rb') as f:
+        assert results[0]['md5'] == hashlib.md5(f.read()).hexdigest()
+    assert results[1]['id'] == 'nosuchfile.fits'
+    assert results[1]['result'] is False
+
+    ad = astrodata.open(df.fullpath)
+    assert ad.qa_state() == 'Pass'
+    assert ad.phu['RAWIQ'] == 'Any'
+    assert df.get_file_lastmod() > orig_lastmod
+
+    iqe = session.query(IngestQueueEntry).one()
+    assert iqe.filename == filename
@@ -0,0 +1,141 @@
+from fits_storage_tests.code_tests.helpers import get_test_config
+get_test_config()
+
+import os
+
+import numpy as np
+import astropy.io.fits as pf
+import astrodata
+import pytest
+
+from fits_storage.fits_validator import fits_validator
+from fits_storage.fits_validator.fits_validator import Environment, \
+    OverrideStack
+from fits_storage.fits_validator.gemini_fits_validator import \
+    AstroDataEvaluator, HeaderView
+
+DEF_PATH = os.path.join(os.path.dirname(fits_validator.__file__),
+                        'dataDefinition')
+
+PHU = {
+    'INSTRUME': 'GMOS-N', 'TELESCOP': 'Gemini-North',
+    'OBSERVAT': 'Gemini-North', 'FRAME': 'FK5', 'RA': 150.1, 'DEC': 2.2,
+    'TRKFRAME': 'FK5', 'DECTRACK': 0.0, 'TRKEPOCH': 2000.0, 'RATRACK': 0.0,
+    'PMDEC': 0.0, 'PMRA': 0.0, 'DATE': '2023-01-01', 'DATE-OBS': '2023-01-01',
+    'GEMPRGID': 'GN-2023A-Q-1', 'OBSID': 'GN-2023A-Q-1-1', 'OBJECT': 'M31',
+    'DATALAB': 'GN-2023A-Q-1-1-001', 'OBSTYPE': 'OBJECT',
+    'RAWGEMQA': 'USABLE', 'RAWPIREQ': 'YES', 'RAWBG': 'Any',
+    'RAWCC': '50-percentile', 'RAWIQ': '70-percentile', 'RAWWV': 'Any',
+    'RELEASE': '2024-01-01', 'SSA': 'someone', 'UT': '01:00:00',
+    'AZIMUTH': 10.0, 'ELEVATIO': 60.0, 'CRPA': 1.0, 'PA': 0.0, 'IAA': 0.0,
+    'OBSCLASS': 'science', 'DARKTIME': 10.0, 'EXPTIME': 10.0, 'MASKID': 0,
+    'MASKNAME': 'None', 'MASKTYP': 0, 'MASKLOC': 0, 'FILTER1': 'open1-6',
+    'FILTER2': 'g_G0301', 'FILTID1': 0, 'FILTID2': 0, 'GRATING': 'MIRROR',
+    'GRATID': 0, 'TIME-OBS': '01:00:00', 'UTSTART': '01:00:00'}
+
+EXT = {
+    'GAIN': 2.0, 'RDNOISE': 3.0, 'CCDSUM': '1 1', 'CCDNAME': 'EEV',
+    'CCDSIZE': '[1:2048,1:4608]', 'CCDSEC': '[1:512,1:4608]',
+    'DATASEC': '[1:512,1:4608]', 'DETSEC': '[1:512,1:4608]',
+    'BIASSEC': '[1:32,1:4608]'}
+
+WCS = {
+    'CTYPE1': 'RA---TAN', 'CTYPE2': 'DEC--TAN', 'CRPIX1': 1.0, 'CRPIX2': 1.0,
+    'CRVAL1': 1.0, 'CRVAL2': 1.0, 'CD1_1': 1.0, 'CD1_2': 0.0, 'CD2_1': 0.0,
+    'CD2_2': 1.0}
+
+
+@pytest.fixture
+def evaluator(monkeypatch):
+    monkeypatch.setattr(fits_validator, 'validation_def_path', DEF_PATH)
+    return AstroDataEvaluator()
+
+
+def make_file(path, phu=PHU, next=3):
+    # Raw GMOS files don't have EXTNAME in the extensions
+    hdus = [pf.PrimaryHDU()]
+    hdus[0].header.update(phu)
+    hdus[0].header.update(WCS)
+    for i in range(next):
+        ext = pf.ImageHDU(data=np.zeros((2, 2), dtype=np.int16))
+        ext.header.update(EXT)
+        ext.header.update(WCS)
+        hdus.append(ext)
+    pf.HDUList(hdus).writeto(path)
+    return path
+
+
+def make_env():
+    env = Environment()
+    env.features = set()
+    env.final = False
+    env.keeptesting = True
+    env.overrides = OverrideStack()
+    return env
+
+
+def test_rules_parsed_once(evaluator):
+    evaluator.init()
+    other = AstroDataEvaluator()
+    other.init()
+    assert other.rq.entryPoint is evaluator.rq.entryPoint
+
+
+def test_instrument_index(evaluator):
+    evaluator.init()
+    root = evaluator.rq.entryPoint
+    env = make_env()
+    assert [alt.fn for alt in root.candidates([{'INSTRUME': 'GMOS-S'}], env)] \
+        == ['facility/gmos']
+    assert list(root.candidates([{'INSTRUME': 'NOTHING'}], env)) == []
+    assert list(root.candidates([{}], env)) == []
+    env.final = True
+    assert root.candidates([{'INSTRUME': 'GMOS-S'}], env) == root.alts
+
+
+@pytest.mark.parametrize('phu,code', [
+    (PHU, 'CORRECT'),
+    ({**PHU, 'GRATING': ''}, 'NOPASS'),
+    ({**PHU, 'RAWGEMQA': 'BAD'}, 'BAD'),
+    ({**PHU, 'INSTRUME': 'NOTHING'}, 'NOTGEMINI'),
+    ])
+def test_evaluate_in_memory(evaluator, tmp_path, phu, code):
+    path = make_file(os.path.join(tmp_path, 'N20230101S0001.fits'), phu=phu)
+    result = evaluator.evaluate(path)
+    assert result.code == code
+
+    ad = astrodata.open(path)
+    assert evaluator.evaluate(ad) == result
+    with pf.open(path) as hdulist:
+        assert evaluator.evaluate([hdu.header for hdu in hdulist]) == result
+
+
+def validated_headers(evaluator, monkeypatch, source):
+    headers = []
+    monkeypatch.setattr(evaluator.rq, 'test', lambda hlist, env:
+                        headers.extend(hlist) or (True, []))
+    evaluator.evaluate(source)
+    return headers
+
+
+def test_astrodata_headers(evaluator, monkeypatch, tmp_path):
+    path = make_file(os.path.join(tmp_path, 'N20230101S0001.fits'), next=1)
+    ad = astrodata.open(path)
+    assert ad[0].hdr['EXTNAME'] == 'SCI'
+
+    # The evaluator doesn't see the EXTNAME and EXTVER AstroData added
+    headers = validated_headers(evaluator, monkeypatch, ad)
+    assert headers[0] is ad.phu
+    assert isinstance(headers[1], HeaderView)
+    assert 'EXTNAME' not in headers[1] and headers[1].get('EXTVER') is None
+    assert headers[1]['GAIN'] == 2.0
+    with pytest.raises(KeyError):
+        headers[1]['EXTNAME']
+
+    # A single image file is validated as one HDU, as it is in the file
+    single = os.path.join(tmp_path, 'N20230101S0002.fits')
+    hdu = pf.PrimaryHDU(data=np.zeros((2, 2), dtype=np.int16))
+    hdu.header.update(PHU)
+    hdu.writeto(single)
+    ad = astrodata.open(single)
+    assert validated_headers(evaluator, monkeypatch, ad) == [ad.phu]
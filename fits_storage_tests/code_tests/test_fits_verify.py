@@ -0,0 +1,72 @@
+import os
+import stat
+import textwrap
+
+from fits_storage.fits_verify import fitsverify, FitsVerifyProcess
+
+# A stand in for fitsverify, which writes a report in the same format for
+# the file given, counting the times it is run. Files containing "bad" have
+# an error, and files containing "notfits" are not FITS files.
+FAKE_FITSVERIFY = '''\
+    #!/usr/bin/env python3
+    import os, sys
+    with open(os.path.join(os.path.dirname(sys.argv[0]), 'count'), 'a') as f:
+        f.write('x')
+    print(" fitsverify 4.22 (CFITSIO V4.3.0)\\n --------------\\n")
+    for filename in sys.argv[1:]:
+        print(f"\\nFile: {filename}\\n")
+        data = open(filename).read()
+        if 'notfits' in data:
+            print("This does not look like a FITS file.")
+            continue
+        errors = 1 if 'bad' in data else 0
+        print(f"**** Verification found 0 warning(s) and {errors} error(s). "
+              "****")
+    '''
+
+
+def make_fitsverify(tmp_path):
+    path = os.path.join(tmp_path, 'fitsverify')
+    with open(path, 'w') as f:
+        f.write(textwrap.dedent(FAKE_FITSVERIFY))
+    os.chmod(path, stat.S_IRWXU)
+    return path
+
+
+def runs(tmp_path):
+    with open(os.path.join(tmp_path, 'count')) as f:
+        return len(f.read())
+
+
+def make_files(tmp_path, contents):
+    paths = []
+    for i, content in enumerate(contents):
+        path = os.path.join(tmp_path, f'file{i}.fits')
+        with open(path, 'w') as f:
+            f.write(content)
+        paths.append(path)
+    return paths
+
+
+def test_fitsverify(tmp_path):
+    fvpath = make_fitsverify(tmp_path)
+    paths = make_files(tmp_path, ['good', 'bad', 'notfits'])
+    results = [fitsverify(path, fvpath=fvpath)
+               for path in paths + ['nonexistent']]
+    assert runs(tmp_path) == 3
+    assert [r[:3] for r in results] == [[True, 0, 0], [True, 0, 1],
+                                        [False, 0, 0], [False, 0, 1]]
+    assert 'fitsverify 4.22' in results[1][3]
+
+
+def test_fitsverify_process(tmp_path):
+    # Several files can be verified at once, and the results collected later
+    fvpath = make_fitsverify(tmp_path)
+    paths = make_files(tmp_path, ['good', 'bad'] * 4)
+    processes = [FitsVerifyProcess(path, fvpath=fvpath) for path in paths]
+    assert [p.result()[2] for p in processes] == [0, 1] * 4
+    assert runs(tmp_path) == 8
+
+    process = FitsVerifyProcess('nonexistent', fvpath=fvpath)
+    assert process.subp is None
+    assert process.result()[:3] == [False, 0, 1]
@@ -6,6 +6,7 @@ import astrodata
 from fits_storage_tests.code_tests.helpers import get_test_config, make_diskfile
 
 from fits_storage.server.fitseditor import FitsEditor
+from fits_storage.server.bz2multistream import is_multistream
 from fits_storage.logger_dummy import DummyLogger
 
 def get_from_file(fpfn, headers=[]):
@@ -91,3 +92,41 @@ def test_fitseditor(tmp_path):
     assert ff['SSA'] == 'Mickey Mouse'
     assert ff['FELINE'] == 'Sleepy'
     assert ff['KANGAROO'] is None
+
+
+def test_fitseditor_header_only(tmp_path):
+    get_test_config()
+
+    diskfile = make_diskfile('N20200127S0023.fits.bz2', tmp_path)
+    df_fp = diskfile.fullpath
+
+    # The first edit has to recompress the whole file, and writes it as a
+    # multi-stream file.
+    fe = FitsEditor(filename='N20200127S0023.fits', do_setup=False)
+    fe.diskfile = diskfile
+    fe._get_header_editor()
+    assert fe.header_editor is None
+    fe._get_localfile()
+    fe._get_hdulist()
+    assert fe.set_qa_state('Pass') is True
+    fe.close()
+
+    with open(df_fp, 'rb') as f:
+        assert is_multistream(f)
+
+    # Subsequent edits are header only
+    diskfile.uncompressed_cache_file = None
+    fe = FitsEditor(filename='N20200127S0023.fits', do_setup=False)
+    fe.diskfile = diskfile
+    fe._get_header_editor()
+    assert fe.header_editor is not None
+    assert fe.set_qa_state('Fail') is True
+    assert fe.set_release('2025-01-02') is True
+    assert fe.set_header('FELINE', 'Sleepy') is True
+    fe.close()
+
+    assert os.listdir(diskfile.storage_root) == ['N20200127S0023.fits.bz2']
+    ff = get_from_file(df_fp, headers=['FELINE'])
+    assert ff['qa_state'] == 'Fail'
+    assert ff['release'] == '2025-01-02'
+    assert ff['FELINE'] == 'Sleepy'
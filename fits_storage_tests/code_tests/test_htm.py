@@ -0,0 +1,100 @@
+import math
+import random
+
+from sqlalchemy import create_engine, MetaData, Table, Column, select
+from sqlalchemy import Integer, BigInteger, Float
+
+from fits_storage.core.htm import htm_id, cone_ranges, cone_filter, \
+    radec_to_vector, vector_to_radec, polygon_centre_radius, HTM_DEPTH
+
+
+def _random_position(rng):
+    ra = rng.uniform(0.0, 360.0)
+    dec = math.degrees(math.asin(rng.uniform(-1.0, 1.0)))
+    return ra, dec
+
+
+def _separation(ra1, dec1, ra2, dec2):
+    v1 = radec_to_vector(ra1, dec1)
+    v2 = radec_to_vector(ra2, dec2)
+    dot = sum(a * b for a, b in zip(v1, v2))
+    return math.degrees(math.acos(max(-1.0, min(1.0, dot))))
+
+
+def test_vector_roundtrip():
+    for ra, dec in ((0.0, 0.0), (123.456, -45.678), (359.9, 89.9)):
+        rra, rdec = vector_to_radec(radec_to_vector(ra, dec))
+        assert abs(rra - ra) < 1e-9
+        assert abs(rdec - dec) < 1e-9
+
+
+def test_htm_id_depth():
+    # Top level trixels are 8..15, each level appends two bits
+    assert 8 <= htm_id(10.0, 20.0, depth=0) <= 15
+    hid = htm_id(10.0, 20.0)
+    assert hid >> (2 * HTM_DEPTH) == htm_id(10.0, 20.0, depth=0)
+    assert hid >> 2 == htm_id(10.0, 20.0, depth=HTM_DEPTH-1)
+    assert htm_id(None, 20.0) is None
+
+
+def test_cone_ranges_superset():
+    rng = random.Random(1234)
+    for _ in range(50):
+        ra, dec = _random_position(rng)
+        radius = 10 ** rng.uniform(-3, 0)
+        ranges = cone_ranges(ra, dec, radius)
+        assert 0 < len(ranges) <= 64
+        # Any position within the cone must be in one of the ranges
+        for _ in range(50):
+            pra = ra + rng.uniform(-2, 2) * radius
+            pdec = dec + rng.uniform(-2, 2) * radius
+            if abs(pdec) >= 90.0:
+                continue
+            pra %= 360.0
+            if _separation(ra, dec, pra, pdec) <= radius:
+                hid = htm_id(pra, pdec)
+                assert any(lo <= hid < hi for lo, hi in ranges)
+
+
+def test_polygon_centre_radius():
+    fp = [(10.0, 20.0), (10.1, 20.0), (10.1, 20.1), (10.0, 20.1)]
+    ra, dec, radius = polygon_centre_radius(fp)
+    assert abs(ra - 10.05) < 1e-6
+    assert abs(dec - 20.05) < 1e-3
+    for pra, pdec in fp:
+        assert _separation(ra, dec, pra, pdec) <= radius + 1e-9
+
+
+def test_cone_filter_sqlite():
+    engine = create_engine('sqlite:///:memory:')
+    metadata = MetaData()
+    table = Table('positions', metadata,
+                  Column('id', Integer, primary_key=True),
+                  Column('ra', Float), Column('dec', Float),
+                  Column('htm_id', BigInteger, index=True),
+                  Column('cx', Float), Column('cy', Float), Column('cz', Float))
+    metadata.create_all(engine)
+
+    rng = random.Random(42)
+    rows = []
+    for i in range(2000):
+        # Cluster half the positions around the search position
+        if i % 2:
+            ra, dec = 150.0 + rng.gauss(0, 0.2), 2.0 + rng.gauss(0, 0.2)
+        else:
+            ra, dec = _random_position(rng)
+        cx, cy, cz = radec_to_vector(ra, dec)
+        rows.append({'id': i, 'ra': ra, 'dec': dec, 'htm_id': htm_id(ra, dec),
+                     'cx': cx, 'cy': cy, 'cz': cz})
+
+    with engine.begin() as conn:
+        conn.execute(table.insert(), rows)
+        c = table.c
+        stmt = select(c.id).where(cone_filter(c.htm_id, c.cx, c.cy, c.cz,
+                                              150.0, 2.0, 0.1))
+        got = {r[0] for r in conn.execute(stmt)}
+
+    expected = {r['id'] for r in rows
+                if _separation(150.0, 2.0, r['ra'], r['dec']) <= 0.1}
+    assert len(expected) > 0
+    assert got == expected
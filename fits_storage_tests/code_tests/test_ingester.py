@@ -1,6 +1,8 @@
 from fits_storage_tests.code_tests.helpers import get_test_config
 get_test_config()
 
+from types import SimpleNamespace
+
 from fits_storage_tests.code_tests.helpers import make_empty_testing_db_env, \
     fetch_file
 
@@ -36,4 +38,56 @@ def test_ingester(tmp_path):
     assert df.present is True
 
     h = session.query(Header).filter(Header.diskfile_id == df.id).one()
-    assert h.data_label == 'GN-2019B-FT-111-31-001'
\ No newline at end of file
+    assert h.data_label == 'GN-2019B-FT-111-31-001'
+
+def test_add_fitsfile_opens_once(tmp_path, monkeypatch):
+    # The file is opened once with AstroData, and the metadata validation
+    # uses that rather than opening the file again.
+    import astrodata
+    from astropy.io import fits
+    import fits_storage.core.orm.diskfilereport
+
+    make_empty_testing_db_env(tmp_path)
+    fsc = get_config()
+    session = sessionfactory()
+    filename = 'N20200127S0023.fits'
+    phu = fits.PrimaryHDU()
+    phu.header['TELESCOP'] = 'Gemini-North'
+    phu.header['INSTRUME'] = 'GMOS-N'
+    phu.writeto(f"{fsc.storage_root}/{filename}")
+
+    ad_opens = []
+    ad_open = astrodata.open
+    monkeypatch.setattr(astrodata, 'open',
+                        lambda *args, **kwargs: ad_opens.append(args) or
+                        ad_open(*args, **kwargs))
+
+    sources = []
+
+    def evaluate(source):
+        sources.append(source)
+        return SimpleNamespace(passes=True, code='CORRECT', message=None)
+    monkeypatch.setattr(fits_storage.core.orm.diskfilereport, 'evaluate',
+                        evaluate)
+
+    class FakeFitsVerifyProcess(object):
+        def __init__(self, filename, fvpath=None):
+            pass
+
+        def result(self):
+            return [True, 0, 0, 'Verification found 0 errors']
+    monkeypatch.setattr(fits_storage.core.orm.diskfilereport,
+                        'FitsVerifyProcess', FakeFitsVerifyProcess)
+
+    iqe = IngestQueueEntry(filename, '')
+    session.add(iqe)
+    session.commit()
+    ingester = Ingester(session, DummyLogger(), skip_md=False, skip_fv=False)
+    ingester.ingest_file(iqe)
+
+    df = session.query(DiskFile).filter(DiskFile.filename == filename).one()
+    assert df.fverrors == 0
+    assert df.mdready is True
+    assert len(ad_opens) == 1
+    assert len(sources) == 1
+    assert isinstance(sources[0], astrodata.AstroData)
@@ -0,0 +1,112 @@
+from fits_storage_tests.code_tests.helpers import get_test_config
+get_test_config()
+
+import datetime
+import os
+import struct
+
+from sqlalchemy import insert
+
+from fits_storage_tests.code_tests.helpers import make_empty_testing_db_env
+
+from fits_storage.config import get_config
+from fits_storage.logger_dummy import DummyLogger
+from fits_storage.core.orm.file import File
+from fits_storage.core.orm.diskfile import DiskFile
+from fits_storage.queues.orm.ingestqueueentry import IngestQueueEntry
+from fits_storage.queues.queue.ingestqueue import skip_file
+from fits_storage.server.inotify import Inotify, IN_Q_OVERFLOW
+from fits_storage.server.ingestwatcher import IngestWatcher
+
+
+def write(dirname, filename):
+    with open(os.path.join(dirname, filename), 'w') as f:
+        f.write('SIMPLE')
+
+
+def queued(session):
+    entries = session.query(IngestQueueEntry)\
+        .order_by(IngestQueueEntry.filename)
+    return [(iqe.filename, iqe.path) for iqe in entries]
+
+
+def test_skip_file():
+    assert skip_file('N20200101S0001.fits') is False
+    assert skip_file('N20200101S0001.fits.bz2') is False
+    assert skip_file('N20200101_obslog.txt') is False
+    assert skip_file('miscfile_1234') is False
+    assert skip_file('N20200101S0001.jpg') is True
+    assert skip_file('tmpN20200101S0001.fits') is True
+    assert skip_file('.N20200101S0001.fits.ABC123') is True
+    assert skip_file('notes.txt') is True
+
+
+def test_inotify_parse(tmp_path):
+    with Inotify() as inotify:
+        wd = inotify.add_watch(str(tmp_path), IngestWatcher.mask)
+        write(tmp_path, 'file1.fits')
+        os.rename(os.path.join(tmp_path, 'file1.fits'),
+                  os.path.join(tmp_path, 'file2.fits'))
+        events = inotify.read(1)
+    assert [(e.wd, e.name) for e in events] == [(wd, 'file1.fits'),
+                                                 (wd, 'file2.fits')]
+
+
+def test_ingestwatcher(tmp_path):
+    session = make_empty_testing_db_env(tmp_path)
+    storage_root = get_config().storage_root
+    os.mkdir(os.path.join(storage_root, 'sub'))
+
+    # A file that's already ingested, one that has been modified since it
+    # was ingested, and one that is not in the database
+    for fn in ('ingested.fits', 'modified.fits', 'new.fits', 'tmp.fits'):
+        write(storage_root, fn)
+    mtime = os.path.getmtime(os.path.join(storage_root, 'ingested.fits'))
+    lastmod = datetime.datetime.fromtimestamp(mtime)
+    session.execute(insert(File.__table__), [
+        {'id': 1, 'name': 'ingested.fits'}, {'id': 2, 'name': 'modified.fits'}])
+    session.execute(insert(DiskFile.__table__), [
+        {'id': 1, 'file_id': 1, 'filename': 'ingested.fits', 'path': '',
+         'present': True, 'lastmod': lastmod},
+        {'id': 2, 'file_id': 2, 'filename': 'modified.fits', 'path': '',
+         'present': True, 'lastmod': lastmod - datetime.timedelta(hours=1)}])
+    session.commit()
+
+    watcher = IngestWatcher(session, DummyLogger(), paths=['', 'sub'],
+                            debounce=0.2, max_delay=10)
+    watcher.start()
+    try:
+        # Reconcile on startup
+        assert queued(session) == [('modified.fits', ''), ('new.fits', '')]
+        session.query(IngestQueueEntry).delete()
+        session.commit()
+
+        # New files are queued once the events stop for debounce seconds
+        write(storage_root, 'file1.fits')
+        write(os.path.join(storage_root, 'sub'), 'file2.fits')
+        write(storage_root, 'file1.fits')
+        write(storage_root, '.file3.fits.part')
+        os.rename(os.path.join(storage_root, '.file3.fits.part'),
+                  os.path.join(storage_root, 'file3.fits'))
+        write(storage_root, 'preview.jpg')
+        watcher.poll(timeout=0.1)
+        assert watcher.pending == {('file1.fits', ''), ('file2.fits', 'sub'),
+                                   ('file3.fits', '')}
+        assert queued(session) == []
+        for _ in range(10):
+            watcher.poll(timeout=0.1)
+        assert watcher.pending == set()
+        assert queued(session) == [('file1.fits', ''), ('file2.fits', 'sub'),
+                                   ('file3.fits', '')]
+
+        # After an overflow, we reconcile with the database
+        session.query(IngestQueueEntry).delete()
+        session.commit()
+        overflow = struct.pack('iIII', -1, IN_Q_OVERFLOW, 0, 0)
+        watcher.inotify.read = lambda timeout: list(Inotify.parse(overflow))
+        watcher.poll(timeout=0.1)
+        assert ('new.fits', '') in queued(session)
+        assert ('file2.fits', 'sub') in queued(session)
+        assert ('ingested.fits', '') not in queued(session)
+    finally:
+        watcher.stop()
@@ -0,0 +1,91 @@
+from fits_storage_tests.code_tests.helpers import get_test_config
+get_test_config()
+
+import datetime
+import os
+from types import SimpleNamespace
+
+import numpy
+from PIL import Image
+
+from fits_storage.server.orm.preview import Preview
+from fits_storage.server.previewer import Previewer
+from fits_storage.web.preview import not_modified
+
+
+class FakeExtension(object):
+    def __init__(self, data):
+        self.data = data
+
+
+class FakeAstroData(list):
+    tags = set()
+
+    def instrument(self):
+        return 'NIRI'
+
+
+def test_preview_filename_for_size():
+    p = Preview(SimpleNamespace(id=1), 'N20200101S0001.jpg')
+    assert p.sizelist == []
+    assert p.filename_for_size(128) == 'N20200101S0001.jpg'
+
+    p.sizes = '128,512'
+    assert p.sizelist == [128, 512]
+    assert p.filename_for_size(None) == 'N20200101S0001.jpg'
+    assert p.filename_for_size(100) == 'N20200101S0001_128.jpg'
+    assert p.filename_for_size(128) == 'N20200101S0001_128.jpg'
+    assert p.filename_for_size(300) == 'N20200101S0001_512.jpg'
+    assert p.filename_for_size(800) == 'N20200101S0001.jpg'
+
+
+def test_previewer_thumbnails(tmp_path):
+    rng = numpy.random.default_rng(1)
+    ad = FakeAstroData([FakeExtension(rng.normal(1000, 30, (2048, 1536)))])
+    header = SimpleNamespace(instrument='NIRI', processing='Raw', types='RAW')
+    diskfile = SimpleNamespace(id=1, filename='N20200101S0001.fits',
+                               keyname='N20200101S0001.fits',
+                               get_ad_object=ad)
+    p = Previewer(diskfile, None, previewpath=str(tmp_path), using_s3=False,
+                  header=header, renderer='pillow')
+
+    assert p.make_preview_file() is True
+    sizes = {}
+    for filename in os.listdir(tmp_path):
+        with Image.open(os.path.join(tmp_path, filename)) as image:
+            sizes[filename] = image.size
+    assert sizes == {'N20200101S0001.jpg': (768, 1024),
+                     'N20200101S0001_512.jpg': (384, 512),
+                     'N20200101S0001_128.jpg': (96, 128)}
+
+    p.delete_file()
+    assert os.listdir(tmp_path) == []
+
+
+def test_not_modified():
+    etag = '"abc-123"'
+    last_modified = datetime.datetime(2024, 1, 2, 3, 4, 5, 678,
+                                      tzinfo=datetime.timezone.utc)
+
+    assert not_modified({}, etag, last_modified) is False
+    assert not_modified({'HTTP_IF_NONE_MATCH': '"abc-123"'},
+                        etag, last_modified) is True
+    assert not_modified({'HTTP_IF_NONE_MATCH': '"xyz", "abc-123"'},
+                        etag, last_modified) is True
+    assert not_modified({'HTTP_IF_NONE_MATCH': '"xyz"'},
+                        etag, last_modified) is False
+    assert not_modified({'HTTP_IF_NONE_MATCH': '*'},
+                        etag, last_modified) is True
+
+    since = 'Tue, 02 Jan 2024 03:04:05 GMT'
+    assert not_modified({'HTTP_IF_MODIFIED_SINCE': since},
+                        etag, last_modified) is True
+    earlier = 'Tue, 02 Jan 2024 03:04:04 GMT'
+    assert not_modified({'HTTP_IF_MODIFIED_SINCE': earlier},
+                        etag, last_modified) is False
+    # If-None-Match takes precedence
+    assert not_modified({'HTTP_IF_NONE_MATCH': '"xyz"',
+                         'HTTP_IF_MODIFIED_SINCE': since},
+                        etag, last_modified) is False
+    assert not_modified({'HTTP_IF_MODIFIED_SINCE': 'garbage'},
+                        etag, last_modified) is False
@@ -0,0 +1,88 @@
+import io
+
+import numpy
+from PIL import Image
+
+from fits_storage.server import preview_render
+
+
+def test_downsample():
+    data = numpy.arange(64, dtype=numpy.uint16).reshape(8, 8)
+
+    # Small enough already, but still a new float32 array
+    small = preview_render.downsample(data, maxsize=8)
+    assert small.dtype == numpy.float32
+    assert (small == data).all()
+    small[0, 0] = 99
+    assert data[0, 0] == 0
+
+    mean = preview_render.downsample(data, maxsize=4)
+    assert mean.shape == (4, 4)
+    assert mean[0, 0] == (0 + 1 + 8 + 9) / 4
+    assert mean[3, 3] == (54 + 55 + 62 + 63) / 4
+
+    stride = preview_render.downsample(data, maxsize=4, method='stride')
+    assert stride.shape == (4, 4)
+    assert stride[1, 1] == 18
+
+    # Pixels that don't fill a block are dropped
+    assert preview_render.downsample(data, maxsize=3).shape == (2, 2)
+
+
+def test_sampled_percentiles():
+    rng = numpy.random.default_rng(42)
+    data = rng.normal(1000, 30, (2000, 2048)).astype(numpy.float32)
+    data[::7, ::3] = numpy.nan
+
+    finite = data[numpy.isfinite(data)]
+    exact = numpy.percentile(finite, [5, 50, 95])
+    estimate = preview_render.sampled_percentiles(data, [5, 50, 95],
+                                                  max_samples=100000)
+    assert numpy.allclose(estimate, exact, atol=1)
+    assert abs(preview_render.sampled_median(data) - exact[1]) < 1
+
+    # The sample doesn't just hit the same columns in every row
+    indices = numpy.arange(2000 * 2048).reshape(2000, 2048)
+    sampled = preview_render.sample(indices, max_samples=1000)
+    assert len(numpy.unique(sampled % 2048)) > 500
+
+    assert preview_render.sampled_percentiles(
+        numpy.full((10, 10), numpy.nan), [5, 95]) == [0.0, 0.0]
+
+
+def test_norm_and_encode():
+    data = numpy.linspace(0, 1000, 100 * 200).reshape(100, 200)
+    data[0, 0] = numpy.nan
+    normed = preview_render.norm(data, percentile=1)
+    assert normed.min() == 0
+    assert normed.max() == 1
+    assert numpy.isfinite(normed).all()
+
+    # Integer data is converted
+    normed = preview_render.norm(numpy.arange(100, dtype=numpy.uint16)
+                                 .reshape(10, 10), percentile=0)
+    assert normed.dtype == numpy.float32
+    assert normed[0, 0] == 0 and normed[9, 9] == 1
+
+    for filetype, fmt in (('jpg', 'JPEG'), ('png', 'PNG')):
+        fp = io.BytesIO()
+        preview_render.encode(normed, fp, filetype)
+        fp.seek(0)
+        with Image.open(fp) as image:
+            assert image.format == fmt
+            assert image.mode == 'L'
+            assert image.size == (10, 10)
+            if fmt == 'PNG':
+                pixels = numpy.asarray(image)
+                assert pixels[0, 0] == 0 and pixels[9, 9] == 255
+
+
+def test_pyramid():
+    data = numpy.ones((1000, 600), dtype=numpy.float32)
+    images = preview_render.pyramid(data, sizes=(128, 512))
+    assert sorted(images) == [128, 512]
+    assert images[512].shape == (500, 300)
+    assert images[128].shape == (125, 75)
+
+    # No versions bigger than the image itself
+    assert list(preview_render.pyramid(data[:300, :300])) == [128]
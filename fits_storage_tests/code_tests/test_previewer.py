@@ -1,6 +1,8 @@
 import os
 from logging import getLogger
 
+from PIL import Image
+
 from fits_storage.core.hashes import md5sum
 from fits_storage.server.previewer import Previewer
 from fits_storage.core.orm.header import Header
@@ -16,7 +18,7 @@ def test_niri(tmp_path):
     header = Header(diskfile)
 
     p = Previewer(diskfile, None, logger=getLogger(), previewpath=tmp_path,
-                  using_s3=False, header=header)
+                  using_s3=False, header=header, renderer='matplotlib')
 
     assert p.filename == 'N20180329S0134.jpg'
     assert p.spectrum is False
@@ -40,7 +42,7 @@ def test_gmos(tmp_path):
     header = Header(diskfile)
 
     p = Previewer(diskfile, None, logger=getLogger(), previewpath=tmp_path,
-                  using_s3=False, header=header)
+                  using_s3=False, header=header, renderer='matplotlib')
 
     assert p.filename == 'N20191002S0080.jpg'
     assert p.spectrum is False
@@ -54,3 +56,40 @@ def test_gmos(tmp_path):
     assert md5sum(p.fpfn) == '643b0650c49fa5b2062b92de57fa8e49'
 
     diskfile.cleanup()
+
+
+def test_niri_pillow(tmp_path):
+    get_test_config()
+
+    data_file = 'N20180329S0134.fits'
+    diskfile = make_diskfile(data_file, tmp_path)
+    header = Header(diskfile)
+
+    p = Previewer(diskfile, None, logger=getLogger(), previewpath=tmp_path,
+                  using_s3=False, header=header, renderer='pillow')
+
+    assert p.make_preview_file() is True
+    with Image.open(p.fpfn) as image:
+        assert image.format == 'JPEG'
+        assert image.size == (1024, 1024)
+
+    diskfile.cleanup()
+
+
+def test_gmos_pillow(tmp_path):
+    get_test_config()
+
+    data_file = 'N20191002S0080.fits'
+    diskfile = make_diskfile(data_file, tmp_path)
+    header = Header(diskfile)
+
+    p = Previewer(diskfile, None, logger=getLogger(), previewpath=tmp_path,
+                  using_s3=False, header=header, renderer='pillow')
+
+    assert p.make_preview_file() is True
+    with Image.open(p.fpfn) as image:
+        assert image.format == 'JPEG'
+        # The mosaic is reduced to fit in the maximum preview size
+        assert max(image.size) <= 1024
+
+    diskfile.cleanup()
@@ -0,0 +1,52 @@
+from fits_storage_tests.code_tests.helpers import get_test_config
+get_test_config()
+
+import time
+
+from fits_storage_tests.code_tests.helpers import make_empty_testing_db_env
+
+from fits_storage.logger_dummy import DummyLogger
+from fits_storage.queues.queue.exportqueue import ExportQueue
+from fits_storage.queues.queue.ingestqueue import IngestQueue
+from fits_storage.queues.orm.ingestqueueentry import IngestQueueEntry
+
+
+def test_queue_wait_sqlite(tmp_path):
+    # On SQLite there are no notifications, so wait() falls back to sleeping
+    session = make_empty_testing_db_env(tmp_path)
+    eq = ExportQueue(session, logger=DummyLogger())
+    assert eq.add('filename', 'path', 'destination') is True
+    assert eq.length() == 1
+
+    start = time.monotonic()
+    assert eq.wait(0.2) is False
+    assert time.monotonic() - start >= 0.2
+
+    eqe = eq.pop()
+    assert eqe.filename == 'filename'
+
+
+def test_ingestqueue_add_many(tmp_path):
+    session = make_empty_testing_db_env(tmp_path)
+    iq = IngestQueue(session, logger=DummyLogger())
+    assert iq.add('N20200101S0003.fits', '') is not None
+
+    files = [(f'N20200101S{i:04d}.fits', '') for i in range(1, 8)]
+    files.append(('N20200101S0001.fits', 'otherpath'))
+    files.append(('N20200101S0002.fits', ''))
+    # S0003 is already on the queue, and S0002 is in the list twice
+    assert iq.add_many(iter(files), force=True, chunk_size=3) == 7
+    assert iq.length() == 8
+
+    entries = session.query(IngestQueueEntry)\
+        .filter(IngestQueueEntry.filename == 'N20200101S0005.fits').all()
+    assert len(entries) == 1
+    assert entries[0].force is True
+    assert entries[0].failed is False
+    assert entries[0].sortkey == \
+        IngestQueueEntry('N20200101S0005.fits', '').sortkey
+
+    # Entries added in bulk pop in the same order as ones added by add()
+    assert iq.pop().filename == 'N20200101S0007.fits'
+
+    assert iq.add_many([]) == 0
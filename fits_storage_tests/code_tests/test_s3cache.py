@@ -0,0 +1,163 @@
+from fits_storage_tests.code_tests.helpers import get_test_config
+get_test_config()
+
+import hashlib
+import os
+import shutil
+import threading
+import time
+from types import SimpleNamespace
+
+from botocore.exceptions import ClientError
+
+from fits_storage.server.aws_s3 import Boto3Helper
+from fits_storage.server.s3cache import S3DiskCache
+
+
+def md5(data):
+    return hashlib.md5(data).hexdigest()
+
+
+def writer(data, calls=None, delay=0):
+    # A fetch function for the cache, which writes data to the file
+    def fetch(filename):
+        if calls is not None:
+            calls.append(filename)
+        time.sleep(delay)
+        with open(filename, 'wb') as f:
+            f.write(data)
+        return True
+    return fetch
+
+
+class DirectoryS3Client(object):
+    """
+    Stands in for the boto3 S3 client, with the bucket in a directory.
+    """
+    def __init__(self, bucketdir):
+        self.bucketdir = bucketdir
+        self.downloads = []
+
+    def download_file(self, bucket, keyname, filename, Config=None):
+        self.downloads.append(keyname)
+        shutil.copyfile(os.path.join(self.bucketdir, keyname), filename)
+
+    def get_object(self, Bucket, Key):
+        self.downloads.append(Key)
+        return {'Body': open(os.path.join(self.bucketdir, Key), 'rb')}
+
+
+class DirectoryS3Helper(Boto3Helper):
+    """
+    A Boto3Helper with the bucket in a directory. Objects have an md5 in the
+    metadata unless they are in nomd5.
+    """
+    def __init__(self, bucketdir, nomd5=(), **kwargs):
+        super().__init__(bucket_name='test', underlay_bucket_name='',
+                         access_key='', secret_key='', **kwargs)
+        self.b = SimpleNamespace(name='test')
+        self.client = DirectoryS3Client(bucketdir)
+        self.nomd5 = nomd5
+        self.heads = []
+
+    @property
+    def s3_client(self):
+        return self.client
+
+    def get_key(self, keyname):
+        self.heads.append(keyname)
+        path = os.path.join(self.client.bucketdir, keyname)
+        if not os.path.exists(path):
+            raise ClientError({'Error': {'Code': '404'}}, 'HeadObject')
+        with open(path, 'rb') as f:
+            data = f.read()
+        metadata = {} if keyname in self.nomd5 else {'md5': md5(data)}
+        return SimpleNamespace(content_length=len(data), metadata=metadata)
+
+
+def test_s3cache_get(tmp_path):
+    cache = S3DiskCache(os.path.join(tmp_path, 'cache'), 10000)
+    data = os.urandom(1000)
+    calls = []
+
+    path = cache.get(md5(data), writer(data, calls))
+    assert path == cache.path(md5(data))
+    with open(path, 'rb') as f:
+        assert f.read() == data
+    assert cache.get(md5(data), writer(data, calls)) == path
+    assert len(calls) == 1
+
+    # Data that don't match the md5 are not cached
+    assert cache.get(md5(b'other'), writer(data, calls)) is None
+    assert not os.path.exists(cache.path(md5(b'other')))
+    assert os.listdir(cache.tmpdir) == []
+
+    assert cache.stats() == {'hits': 1, 'misses': 2, 'evictions': 0,
+                             'bytes_fetched': 1000}
+
+
+def test_s3cache_evict(tmp_path):
+    cache = S3DiskCache(os.path.join(tmp_path, 'cache'), 3000)
+    blobs = [os.urandom(1000) for i in range(4)]
+    for i, data in enumerate(blobs[:3]):
+        path = cache.get(md5(data), writer(data))
+        os.utime(path, (i, i))
+
+    # Using the first makes the second the least recently used
+    cache.get(md5(blobs[0]), writer(blobs[0]))
+    cache.get(md5(blobs[3]), writer(blobs[3]))
+    cached = [os.path.exists(cache.path(md5(data))) for data in blobs]
+    assert cached == [True, False, True, True]
+    assert cache.stats()['evictions'] == 1
+
+
+def test_s3cache_concurrent(tmp_path):
+    cache = S3DiskCache(os.path.join(tmp_path, 'cache'), 10000)
+    data = os.urandom(1000)
+    calls = []
+    paths = []
+    threads = [threading.Thread(target=lambda: paths.append(
+        cache.get(md5(data), writer(data, calls, delay=0.2))))
+        for i in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert len(calls) == 1
+    assert paths == [cache.path(md5(data))] * 4
+
+
+def test_boto3helper_cache(tmp_path):
+    bucketdir = os.path.join(tmp_path, 'bucket')
+    os.mkdir(bucketdir)
+    objects = {'small.fits': b'\n'.join(os.urandom(100) for i in range(10)),
+               'big.fits': os.urandom(5000), 'nomd5.fits': os.urandom(1000)}
+    for keyname, data in objects.items():
+        with open(os.path.join(bucketdir, keyname), 'wb') as f:
+            f.write(data)
+
+    storageroot = os.path.join(tmp_path, 'storage_root')
+    s3 = DirectoryS3Helper(bucketdir, nomd5=('nomd5.fits', ),
+                           storage_root=storageroot,
+                           cache_dir=os.path.join(tmp_path, 'cache'),
+                           cache_gb=20000 / 1E9)
+
+    for i in range(2):
+        for keyname, data in objects.items():
+            with s3.get_flo(keyname) as flo:
+                assert flo.read() == data
+    # One HEAD request for each
+    assert len(s3.heads) == 6
+
+    # The cached file iterates in chunks, not lines
+    with s3.get_flo('small.fits') as flo:
+        assert list(flo) == [objects['small.fits']]
+    assert s3.fetch_to_storageroot('small.fits')
+    with open(os.path.join(storageroot, 'small.fits'), 'rb') as f:
+        assert f.read() == objects['small.fits']
+
+    # The big object and the one without an md5 aren't cached
+    assert sorted(s3.client.downloads) == \
+        ['big.fits', 'big.fits', 'nomd5.fits', 'nomd5.fits', 'small.fits']
+    assert s3.cache.stats()['hits'] == 3
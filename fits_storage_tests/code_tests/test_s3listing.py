@@ -0,0 +1,174 @@
+from fits_storage_tests.code_tests.helpers import get_test_config
+get_test_config()
+
+import pytest
+
+from fits_storage.server.aws_s3 import Boto3Helper
+from fits_storage.server.s3listing import S3Listing, ListedKey
+
+BUCKET = {
+    'N20230101S0001.fits': (1000, '"0123456789abcdef0123456789abcdef"'),
+    'N20230101S0002.fits': (2000, '"fedcba9876543210fedcba9876543210-2"'),
+    'N20230102S0001.fits': (3000, '"00000000000000000000000000000000"'),
+    'processed/N20230101S0001_flat.fits':
+        (4000, '"11111111111111111111111111111111"'),
+    }
+
+
+class ListingS3Client(object):
+    """
+    Stands in for the boto3 S3 client, listing the keys in buckets, pagesize
+    at a time.
+    """
+    def __init__(self, buckets, pagesize=2, encryption=None):
+        self.buckets = buckets
+        self.pagesize = pagesize
+        self.encryption = encryption
+        self.listed = []
+        self.deleted = []
+        self.heads = []
+
+    def get_paginator(self, operation):
+        assert operation == 'list_objects_v2'
+        return self
+
+    def paginate(self, Bucket, Prefix):
+        self.listed.append((Bucket, Prefix))
+        keys = sorted(k for k in self.buckets[Bucket] if k.startswith(Prefix))
+        for i in range(0, len(keys), self.pagesize):
+            yield {'Contents': [
+                {'Key': k, 'Size': self.buckets[Bucket][k][0],
+                 'ETag': self.buckets[Bucket][k][1]}
+                for k in keys[i:i + self.pagesize]]}
+        if not keys:
+            yield {'KeyCount': 0}
+
+    def delete_object(self, Bucket, Key):
+        self.deleted.append(Key)
+
+    def head_object(self, Bucket, Key):
+        self.heads.append(Key)
+        response = {'ETag': self.buckets[Bucket][Key][1], 'Metadata': {}}
+        if self.encryption is not None:
+            response['ServerSideEncryption'] = self.encryption
+        return response
+
+
+class ListingS3Helper(Boto3Helper):
+    """
+    A Boto3Helper which can only list keys. Anything that would make a
+    request per key fails.
+    """
+    def __init__(self, buckets, underlay_bucket_name='', encryption=None):
+        super().__init__(bucket_name='test',
+                         underlay_bucket_name=underlay_bucket_name,
+                         access_key='', secret_key='')
+        self.client = ListingS3Client(buckets, encryption=encryption)
+
+    @property
+    def s3_client(self):
+        return self.client
+
+    @property
+    def bucket(self):
+        raise AssertionError("Request for a single key")
+
+    def get_key(self, keyname):
+        raise AssertionError(f"HEAD request for {keyname}")
+
+
+def test_s3listing():
+    client = ListingS3Client({'test': BUCKET})
+    listing = S3Listing('test')
+    assert listing.lookup('N20230101S0001.fits') is None
+
+    listing.load(client, 'N20230101')
+    listing.load(client, 'N20230101S0001')
+    assert client.listed == [('test', 'N20230101')]
+    assert listing.requests == 1
+    assert listing.lookup('N20230101S0001.fits') == \
+        ListedKey(1000, '0123456789abcdef0123456789abcdef')
+    assert listing.lookup('N20230101S0002.fits').md5 is None
+    assert listing.lookup('N20230101S0003.fits') is False
+    assert listing.lookup('N20230102S0001.fits') is None
+
+    listing.invalidate('N20230101S0001.fits')
+    assert listing.lookup('N20230101S0001.fits') is None
+    listing.invalidate('N20230101S0002.fits', deleted=True)
+    assert listing.lookup('N20230101S0002.fits') is False
+
+    # Listing again brings the changed keys up to date
+    listing.load(client, '')
+    assert listing.requests == 3
+    assert listing.lookup('N20230101S0001.fits').size == 1000
+    assert listing.lookup('N20230102S0001.fits').size == 3000
+
+
+def test_s3listing_reload():
+    bucket = dict(BUCKET)
+    client = ListingS3Client({'test': bucket})
+    listing = S3Listing('test')
+    listing.load(client, 'N20230101')
+
+    # Changes made by someone else are only seen if we reload
+    bucket['N20230101S0001.fits'] = (5000, '"2222222222222222"')
+    del bucket['N20230101S0002.fits']
+    bucket['N20230101S0003.fits'] = (6000, '"3333333333333333"')
+    listing.load(client, 'N20230101')
+    assert listing.lookup('N20230101S0001.fits').size == 1000
+    assert listing.lookup('N20230101S0003.fits') is False
+
+    listing.load(client, 'N20230101', reload=True)
+    assert client.listed == [('test', 'N20230101')] * 2
+    assert listing.prefixes == ['N20230101']
+    assert listing.lookup('N20230101S0001.fits').size == 5000
+    assert listing.lookup('N20230101S0002.fits') is False
+    assert listing.lookup('N20230101S0003.fits').size == 6000
+
+
+def test_boto3helper_listing():
+    s3 = ListingS3Helper({'test': BUCKET})
+    s3.preload('N2023')
+    assert s3.exists_key('N20230101S0001.fits')
+    assert not s3.exists_key('N20230101S0003.fits')
+    assert s3.get_md5('N20230102S0001.fits') == \
+        '00000000000000000000000000000000'
+    assert s3.get_md5('N20230101S0001.fits') == \
+        '0123456789abcdef0123456789abcdef'
+    # One HEAD request to check the ETags are md5s
+    assert s3.client.heads == ['N20230102S0001.fits']
+
+    # Not in the listing, or can't tell the md5 from the ETag
+    for call, keyname in (
+            (s3.exists_key, 'processed/N20230101S0001_flat.fits'),
+            (s3.get_md5, 'N20230101S0002.fits')):
+        with pytest.raises(AssertionError):
+            call(keyname)
+
+    assert s3.delete_key('N20230101S0001.fits')
+    assert not s3.exists_key('N20230101S0001.fits')
+
+
+def test_boto3helper_listing_underlay():
+    s3 = ListingS3Helper({'test': {}, 'underlay': BUCKET},
+                         underlay_bucket_name='underlay')
+    s3.preload()
+    assert s3.client.listed == [('test', ''), ('underlay', '')]
+    assert s3.exists_key('processed/N20230101S0001_flat.fits')
+    assert not s3.exists_key('N20230101S0003.fits')
+
+
+def test_boto3helper_listing_encrypted():
+    # With SSE-KMS, the ETags are not md5s, so we use the metadata md5
+    s3 = ListingS3Helper({'test': BUCKET}, encryption='aws:kms')
+    s3.preload('N2023')
+    for keyname in ('N20230101S0001.fits', 'N20230102S0001.fits'):
+        with pytest.raises(AssertionError):
+            s3.get_md5(keyname)
+    assert s3.client.heads == ['N20230101S0001.fits']
+    assert s3.exists_key('N20230101S0001.fits')
+
+    s3 = ListingS3Helper({'test': BUCKET}, encryption='AES256')
+    s3.preload('N2023')
+    assert s3.get_md5('N20230101S0001.fits') == \
+        '0123456789abcdef0123456789abcdef'
@@ -0,0 +1,238 @@
+from fits_storage_tests.code_tests.helpers import get_test_config
+get_test_config()
+
+import hashlib
+import io
+import os
+import threading
+from types import SimpleNamespace
+
+import pytest
+from botocore.exceptions import ClientError
+
+from fits_storage.core.hashes import md5sum_etag
+from fits_storage.server.aws_s3 import Boto3Helper, RangedReader, \
+    DownloadError, MB, key_missing
+
+
+class RangeS3Client(object):
+    """
+    Stands in for the boto3 S3 client get_object, serving ranges of data.
+    If gate is given, requests wait for it, so we can see how many are made
+    ahead of the reader.
+    """
+    def __init__(self, data, etag='"abc"', gate=None):
+        self.data = data
+        self.etag = etag
+        self.gate = gate
+        self.ranges = []
+        self.lock = threading.Lock()
+
+    def get_object(self, Bucket, Key, Range=None, IfMatch=None):
+        assert IfMatch is None or IfMatch == self.etag
+        if Range is None:
+            with self.lock:
+                self.ranges.append(None)
+            return {'Body': io.BytesIO(self.data), 'ETag': self.etag}
+        if not self.data:
+            raise ClientError({'Error': {'Code': 'InvalidRange'}},
+                              'GetObject')
+        start, end = (int(i) for i in Range[len('bytes='):].split('-'))
+        end = min(end, len(self.data) - 1)
+        with self.lock:
+            self.ranges.append(start)
+        if self.gate is not None:
+            self.gate.wait()
+        return {'Body': io.BytesIO(self.data[start:end + 1]),
+                'ETag': self.etag,
+                'ContentRange': f'bytes {start}-{end}/{len(self.data)}'}
+
+
+class FakeS3Helper(Boto3Helper):
+    """
+    A Boto3Helper with no cache, using client, which must not make HEAD
+    requests.
+    """
+    def __init__(self, client, part_size=1000, ranges=3):
+        super().__init__(bucket_name='test', underlay_bucket_name='',
+                         access_key='', secret_key='')
+        self.client = client
+        self.cache = None
+        self.part_size = part_size
+        self.get_flo_ranges = ranges
+
+    @property
+    def s3_client(self):
+        return self.client
+
+    def get_key(self, keyname):
+        raise AssertionError("Unexpected HEAD request")
+
+
+def reader(client, size=None, rangesize=1000, depth=3):
+    size = len(client.data) if size is None else size
+    return RangedReader(client, 'test', 'key.fits', size, client.etag,
+                        rangesize, depth)
+
+
+def multipart_etag(data, partsize):
+    digests = b''.join(hashlib.md5(data[i:i + partsize]).digest()
+                       for i in range(0, len(data), partsize))
+    nparts = -(-len(data) // partsize)
+    return f'{hashlib.md5(digests).hexdigest()}-{nparts}'
+
+
+def test_md5sum_etag(tmp_path):
+    data = os.urandom(2500)
+    path = os.path.join(tmp_path, 'file.dat')
+    with open(path, 'wb') as f:
+        f.write(data)
+    assert md5sum_etag(path, 1000) == (hashlib.md5(data).hexdigest(),
+                                       multipart_etag(data, 1000))
+    assert md5sum_etag(path, 1000)[1].endswith('-3')
+
+
+def test_etag_matches(tmp_path):
+    data = os.urandom(3 * MB + 5)
+    path = os.path.join(tmp_path, 'file.dat')
+    with open(path, 'wb') as f:
+        f.write(data)
+    s3 = Boto3Helper(bucket_name='test', underlay_bucket_name='',
+                     access_key='', secret_key='')
+
+    def key(etag):
+        return SimpleNamespace(e_tag=f'"{etag}"')
+
+    assert s3.etag_matches(key(hashlib.md5(data).hexdigest()), path)
+    # Uploaded with a part size we don't use, but a whole number of MB
+    assert s3.etag_matches(key(multipart_etag(data, 2 * MB)), path)
+    assert s3.etag_matches(key(multipart_etag(data, MB)), path)
+    assert not s3.etag_matches(key(multipart_etag(data[:-1] + b'x', MB)),
+                               path)
+    assert not s3.etag_matches(key('0123456789abcdef-4'), path)
+
+
+def test_key_missing():
+    def error(code, operation='GetObject'):
+        return ClientError({'Error': {'Code': code}}, operation)
+
+    assert key_missing(error('NoSuchKey'))
+    assert key_missing(error('404', 'HeadObject'))
+    assert not key_missing(error('AccessDenied'))
+    assert not key_missing(ClientError({}, 'GetObject'))
+
+
+@pytest.mark.parametrize('size', [1, 10, 999, 1000, 4096])
+def test_ranged_reader_read(size):
+    data = os.urandom(4500)
+    client = RangeS3Client(data)
+    got = b''
+    with reader(client) as flo:
+        while True:
+            chunk = flo.read(size)
+            assert len(chunk) == size or len(chunk) == len(data) - len(got)
+            if not chunk:
+                break
+            got += chunk
+            assert flo.tell() == len(got)
+    assert got == data
+    assert sorted(client.ranges) == [0, 1000, 2000, 3000, 4000]
+
+
+def test_ranged_reader_iter_and_readall():
+    data = os.urandom(4500)
+    with reader(RangeS3Client(data)) as flo:
+        chunks = list(flo)
+    assert [len(chunk) for chunk in chunks] == [1000] * 4 + [500]
+    assert b''.join(chunks) == data
+
+    with reader(RangeS3Client(data)) as flo:
+        assert flo.read(10) == data[:10]
+        assert flo.read() == data[10:]
+        assert flo.read() == b''
+
+
+def test_ranged_reader_depth():
+    gate = threading.Event()
+    client = RangeS3Client(os.urandom(10000), gate=gate)
+    flo = reader(client, depth=3)
+    # Only the first depth ranges are requested before we read
+    assert len(flo.pending) == 3
+    gate.set()
+    assert len(flo.read(1500)) == 1500
+    assert len(flo.pending) == 3
+    # Closing early doesn't fetch the rest
+    flo.close()
+    assert flo.closed
+    assert len(client.ranges) <= 5
+
+
+def test_ranged_reader_short():
+    client = RangeS3Client(os.urandom(1500))
+    with reader(client, size=2000) as flo:
+        assert len(flo.read(1000)) == 1000
+        with pytest.raises(DownloadError):
+            flo.read(1000)
+
+
+@pytest.mark.parametrize('size', [0, 1, 1000, 1001, 4500])
+def test_get_flo(size):
+    data = os.urandom(size)
+    client = RangeS3Client(data)
+    with FakeS3Helper(client).get_flo('key.fits') as flo:
+        assert flo.read() == data
+    if size == 0:
+        # An empty object has no first range, so we get it all
+        assert client.ranges == [None]
+    else:
+        # The first range tells us the size, so there's no HEAD request, and
+        # small objects are read in one request.
+        assert sorted(client.ranges) == list(range(0, size, 1000))
+
+    # Without ranges, we just get the whole object
+    client = RangeS3Client(data)
+    with FakeS3Helper(client, ranges=1).get_flo('key.fits') as flo:
+        assert flo.read() == data
+    assert client.ranges == [None]
+
+
+class UploadS3Helper(Boto3Helper):
+    """
+    A Boto3Helper that doesn't upload anything, and says the object has the
+    given ETag, size and metadata
+    """
+    def __init__(self, e_tag, content_length, metadata):
+        super().__init__(bucket_name='test', underlay_bucket_name='',
+                         access_key='', secret_key='')
+        self.b = SimpleNamespace(name='test')
+        self.client = SimpleNamespace(upload_file=lambda *a, **kw: None)
+        self.obj = SimpleNamespace(e_tag=e_tag, content_length=content_length,
+                                   metadata=metadata,
+                                   wait_until_exists=lambda: None)
+
+    @property
+    def s3_client(self):
+        return self.client
+
+    def get_key(self, keyname):
+        return self.obj
+
+
+def test_upload_file_verify(tmp_path):
+    data = os.urandom(2500)
+    path = os.path.join(tmp_path, 'file.dat')
+    with open(path, 'wb') as f:
+        f.write(data)
+    md5 = hashlib.md5(data).hexdigest()
+
+    s3 = UploadS3Helper(f'"{md5}"', len(data), {'md5': md5})
+    assert s3.upload_file('file.dat', path) is s3.obj
+
+    # With SSE-KMS or SSE-C, the ETag is not the md5, so we can only check
+    # the size and metadata
+    s3 = UploadS3Helper('"0123456789abcdef"', len(data), {'md5': md5})
+    assert s3.upload_file('file.dat', path) is s3.obj
+    s3 = UploadS3Helper('"0123456789abcdef"', len(data) - 1, {'md5': md5})
+    assert s3.upload_file('file.dat', path) is None
+    s3 = UploadS3Helper('"0123456789abcdef"', len(data), {})
+    assert s3.upload_file('file.dat', path) is None
@@ -0,0 +1,90 @@
+from fits_storage_tests.code_tests.helpers import get_test_config
+get_test_config()
+
+from fits_storage_tests.code_tests.helpers import make_empty_testing_db_env, \
+    fetch_file
+
+from fits_storage.db import sessionfactory
+from fits_storage.config import get_config
+from fits_storage.logger_dummy import DummyLogger
+
+from fits_storage.queues.orm.ingestqueueentry import IngestQueueEntry
+from fits_storage.core.ingester import Ingester
+
+from fits_storage.core.orm.diskfile import DiskFile
+from fits_storage.core.orm.header import Header
+from fits_storage.db.selection import Selection
+from fits_storage.db.list_headers import list_headers, list_search_rows
+from fits_storage.server.orm.searchrow import SearchRow, rebuild_search_rows, \
+    inconsistent_search_rows
+
+
+def _ingest(session, filename):
+    fsc = get_config()
+    fetch_file(filename, fsc.storage_root)
+    iqe = IngestQueueEntry(filename, '')
+    session.add(iqe)
+    session.commit()
+    Ingester(session, DummyLogger()).ingest_file(iqe)
+
+
+def test_searchrow_rebuild_and_check(tmp_path):
+    make_empty_testing_db_env(tmp_path)
+    session = sessionfactory()
+    filename = 'N20200127S0023.fits.bz2'
+    _ingest(session, filename)
+
+    # Not enabled, so not maintained
+    assert session.query(SearchRow).count() == 0
+    assert len(inconsistent_search_rows(session)[0]) == 1
+
+    rebuild_search_rows(session)
+    session.commit()
+    assert inconsistent_search_rows(session) == ([], [], [])
+
+    row = session.query(SearchRow).one()
+    header = session.query(Header).one()
+    assert row.header_id == header.id
+    assert row.filename == filename
+    assert row.file_name == filename
+    assert row.data_label == header.data_label
+    assert row.present is True
+
+    # Changes are not picked up until using_search_row is set
+    header.qa_state = 'Fail'
+    session.commit()
+    assert inconsistent_search_rows(session)[2] == [header.id]
+
+
+def test_searchrow_maintained(tmp_path):
+    make_empty_testing_db_env(tmp_path)
+    fsc = get_config()
+    fsc['using_search_row'] = 'True'
+    session = sessionfactory()
+    filename = 'N20200127S0023.fits.bz2'
+    _ingest(session, filename)
+
+    assert inconsistent_search_rows(session) == ([], [], [])
+    header = session.query(Header).one()
+
+    header.qa_state = 'Pass'
+    session.commit()
+    assert session.query(SearchRow).one().qa_state == 'Pass'
+
+    selection = Selection({'data_label': header.data_label, 'qa_state': 'Pass'})
+    rows = list_search_rows(selection, ['filename'], session=session)
+    assert [r.header_id for r in rows] == [header.id]
+    assert list_headers(selection, ['filename'], session=session) == [header]
+
+    selection = Selection({'data_label': header.data_label, 'qa_state': 'Fail'})
+    assert list_search_rows(selection, None, session=session) == []
+
+    # Selections that need other tables fall back to the header query
+    selection = Selection({'publication': 'asdf'})
+    assert list_search_rows(selection, None, session=session) is None
+
+    diskfile = session.query(DiskFile).one()
+    diskfile.canonical = False
+    session.commit()
+    assert session.query(SearchRow).one().canonical is False
+    assert inconsistent_search_rows(session) == ([], [], [])
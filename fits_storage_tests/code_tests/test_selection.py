@@ -198,3 +198,77 @@ def test_programobsdl_precedence():
     assert selection['data_label'] == 'GN-2010A-Q-123-01-123'
 
 
+
+
+def test_normalize_object_name():
+    from fits_storage.core.orm.header import normalize_object_name
+
+    assert normalize_object_name('WD 0145+234') == 'wd0145+234'
+    assert normalize_object_name(' NGC\t1234 ') == 'ngc1234'
+    assert normalize_object_name('*M 31*') == '*m31*'
+    assert normalize_object_name(None) is None
+
+
+def test_object_search_strategy():
+    get_test_config()
+    from sqlalchemy import select
+    from fits_storage.db.selection import Selection
+    from fits_storage.db.selection.query_selection import _object_search
+    from fits_storage.core.orm.header import Header
+
+    strategies = {'NGC 1234': 'exact match (b-tree index)',
+                  'ngc*': 'prefix match (pattern index)',
+                  '*1234': 'suffix match (trigram index)',
+                  '*gc 12*': 'infix match (trigram index)',
+                  'n*34': 'wildcard match (too short to use index)',
+                  '*12*': 'infix match (too short to use index)'}
+
+    for name, strategy in strategies.items():
+        selection = Selection({'object': name})
+        query = _object_search(selection, select(Header.id))
+        assert selection.object_search_strategy == strategy
+        assert 'object_norm' in str(query)
+
+
+def test_time_period_cache():
+    get_test_config()
+    from fits_storage.db.selection.query_selection import _time_period, \
+        _cached_time_period
+
+    _cached_time_period.cache_clear()
+    assert _time_period('20200101') == _time_period('20200101')
+    assert _cached_time_period.cache_info().hits == 1
+    # Relative dates aren't cached
+    _time_period('today')
+    assert _cached_time_period.cache_info().currsize == 1
+
+
+def test_compiled_cache_hits(tmp_path):
+    # Selections with the same keys and different values should compile to
+    # the same statement, so the second one is a compiled cache hit.
+    from sqlalchemy import event
+    from fits_storage_tests.code_tests.helpers import \
+        make_empty_testing_db_env
+    from fits_storage.db.selection import Selection
+    from fits_storage.db.list_headers import list_headers
+
+    session = make_empty_testing_db_env(tmp_path)
+    engine = session.get_bind()
+    cache_hits = []
+
+    def after_execute(conn, cursor, statement, params, context, many):
+        cache_hits[-1].append(context.cache_hit == context.dialect.CACHE_HIT)
+
+    event.listen(engine, 'after_cursor_execute', after_execute)
+    try:
+        for telescope, inst, night in (('Gemini-North', 'GMOS-N', '20200101'),
+                                       ('Gemini-South', 'GMOS-S', '20210202')):
+            selection = Selection({'telescope': telescope, 'inst': inst,
+                                   'night': night, 'present': True})
+            cache_hits.append([])
+            list_headers(selection, [], session=session)
+    finally:
+        event.remove(engine, 'after_cursor_execute', after_execute)
+        session.close()
+
+    assert cache_hits == [[False], [True]]
@@ -0,0 +1,186 @@
+from fits_storage_tests.code_tests.helpers import get_test_config
+get_test_config()
+
+import errno
+import hashlib
+import io
+import os
+import tarfile
+from types import SimpleNamespace
+
+import pytest
+
+from fits_storage.server.tapeutils import get_tapedrive
+from fits_storage.server.tapeemulator import TapeEmulator
+from fits_storage.server.tapewriter import TarTapeWriter, SourceError, \
+    make_tarinfo
+from fits_storage.server.tapereader import read_members, extract_member, \
+    TarIndexError
+
+BLOCKSIZE = 4096
+
+
+def make_tape(tmp_path, **kwargs):
+    scratchdir = os.path.join(tmp_path, 'scratch')
+    os.makedirs(scratchdir, exist_ok=True)
+    return TapeEmulator(os.path.join(tmp_path, 'tape'), scratchdir, **kwargs)
+
+
+def write_archive(td, members):
+    with td.opentar(mode='w|', bufsize=BLOCKSIZE) as tar:
+        for name, data in members.items():
+            tarinfo = tarfile.TarInfo(name)
+            tarinfo.size = len(data)
+            tar.addfile(tarinfo, io.BytesIO(data))
+
+
+def read_archive(td):
+    with td.opentar(mode='r|', bufsize=BLOCKSIZE) as tar:
+        return {ti.name: tar.extractfile(ti).read() for ti in tar}
+
+
+def test_label_and_positioning(tmp_path):
+    td = make_tape(tmp_path)
+    assert td.online()
+    assert td.readlabel() is None
+    td.writelabel('TAPE01')
+    assert td.readlabel() == 'TAPE01'
+    assert (td.fileno(), td.blockno()) == (0, 0)
+
+    archives = [{'a.fits': b'a' * 5000}, {'b.fits': b'b' * 100,
+                                          'c.fits': os.urandom(20000)}]
+    td.eod()
+    for archive in archives:
+        write_archive(td, archive)
+    assert td.fileno() == 3
+    assert 'EOD' in td.status()
+
+    # The tape keeps its position, and what is on it, between processes
+    td = get_tapedrive(td.dev, td.scratchdir)
+    assert isinstance(td, TapeEmulator)
+    assert td.fileno() == 3
+    td.skipto(2)
+    assert read_archive(td) == archives[1]
+    td.skipto(1)
+    assert read_archive(td) == archives[0]
+    assert td.blockno() > 0
+    td.skipto(1)
+    assert td.blockno() == 0
+    assert td.fsf(5, fail=False) != 0
+
+    # Writing part way through truncates the tape
+    td.skipto(2)
+    write_archive(td, {'d.fits': b'd'})
+    td.eod()
+    assert td.fileno() == 3
+    td.skipto(2)
+    assert read_archive(td) == {'d.fits': b'd'}
+    assert td.readlabel() == 'TAPE01'
+
+
+def test_blocks_and_capacity(tmp_path):
+    td = make_tape(tmp_path, capacity=10 * BLOCKSIZE)
+    with td.open('wb') as f:
+        for i in range(3):
+            f.write(bytes([i]) * BLOCKSIZE)
+        f.write(b'x' * 100)
+    td.rewind()
+    with td.open('rb') as f:
+        # Reads return one block, and must be big enough for the block
+        assert f.read(2 * BLOCKSIZE) == b'\0' * BLOCKSIZE
+        with pytest.raises(OSError) as excinfo:
+            f.read(100)
+        assert excinfo.value.errno == errno.ENOMEM
+        assert f.read(BLOCKSIZE) == b'\2' * BLOCKSIZE
+        assert f.read(BLOCKSIZE) == b'x' * 100
+        # The file mark, then the end of data
+        assert f.read(BLOCKSIZE) == b''
+        with pytest.raises(OSError):
+            f.read(BLOCKSIZE)
+
+    td.eod()
+    assert not td.eot()
+    with pytest.raises(OSError) as excinfo:
+        with td.open('wb') as f:
+            for i in range(10):
+                f.write(b'y' * BLOCKSIZE)
+    assert excinfo.value.errno == errno.ENOSPC
+    assert td.eot()
+
+
+def test_writer_rollback(tmp_path):
+    # The TarTapeWriter rolls back by backspacing on the tape
+    td = make_tape(tmp_path)
+    members = {'a.fits': os.urandom(3000), 'b.fits': os.urandom(5 * BLOCKSIZE),
+               'c.fits': os.urandom(7000)}
+    stat = os.stat(tmp_path)
+    with td.open('wb') as f:
+        writer = TarTapeWriter(f, blocksize=BLOCKSIZE,
+                               backspace=td.backspace_records)
+        for name, data in members.items():
+            tarinfo = make_tarinfo(name, stat)
+            tarinfo.size = len(data)
+            md5 = hashlib.md5(data).hexdigest() if name != 'b.fits' else 'bad'
+            try:
+                writer.add(tarinfo, [data], md5=md5)
+            except SourceError:
+                pass
+        writer.close()
+    assert td.fileno() == 1
+
+    td.rewind()
+    del members['b.fits']
+    assert read_archive(td) == members
+
+
+def test_read_members(tmp_path):
+    # Write an archive, keeping the index as write_diskfiles does, then read
+    # some of the members back by going straight to them
+    td = make_tape(tmp_path)
+    stat = os.stat(tmp_path)
+    sizes = [100, 3 * BLOCKSIZE, 5, 2 * BLOCKSIZE + 10, 700, BLOCKSIZE - 512]
+    members = {f'file{i}.fits': os.urandom(size)
+               for i, size in enumerate(sizes)}
+    tapefiles = {}
+    with td.open('wb') as f:
+        writer = TarTapeWriter(f, blocksize=BLOCKSIZE)
+        for name, data in members.items():
+            tarinfo = make_tarinfo(name, stat)
+            tarinfo.size = len(data)
+            offset = writer.offset
+            md5 = writer.add(tarinfo, [data])
+            tapefiles[name] = SimpleNamespace(filename=name, offset=offset,
+                                              block=offset // BLOCKSIZE,
+                                              md5=md5)
+        writer.close()
+
+    wanted = [tapefiles[name] for name in
+              ('file5.fits', 'file1.fits', 'file2.fits', 'file4.fits')]
+    outdir = tmp_path / 'out'
+    outdir.mkdir()
+    skipped = []
+    skip_records = td.skip_records
+    td.skip_records = lambda fo, n: skipped.append(n) or skip_records(fo, n)
+    td.rewind()
+    with td.open('rb') as f:
+        read = []
+        for tf, tarinfo, fo in read_members(td, f, wanted, BLOCKSIZE):
+            size, md5 = extract_member(tarinfo, fo, path=outdir)
+            assert md5 == tf.md5
+            assert size == len(members[tf.filename])
+            read.append(tf.filename)
+    # We skipped over the blocks of file3 rather than reading them, the
+    # others are next to each other
+    assert len(skipped) == 1
+    assert 1 <= skipped[0] <= (tapefiles['file4.fits'].block -
+                               tapefiles['file3.fits'].block)
+    assert read == ['file1.fits', 'file2.fits', 'file4.fits', 'file5.fits']
+    assert (outdir / 'file4.fits').read_bytes() == members['file4.fits']
+
+    # A wrong index is noticed
+    td.rewind()
+    bad = SimpleNamespace(filename='file3.fits', offset=tapefiles['file2.fits']
+                          .offset, md5=None)
+    with td.open('rb') as f:
+        with pytest.raises(TarIndexError):
+            list(read_members(td, f, [bad], BLOCKSIZE))
@@ -0,0 +1,231 @@
+from fits_storage_tests.code_tests.helpers import get_test_config
+get_test_config()
+
+import datetime
+import hashlib
+import io
+import os
+import tarfile
+from types import SimpleNamespace
+
+import pytest
+from sqlalchemy import select, insert
+
+from fits_storage_tests.code_tests.helpers import make_empty_testing_db_env
+
+from fits_storage.core.orm.file import File
+from fits_storage.core.orm.diskfile import DiskFile
+from fits_storage.core.orm.header import Header
+from fits_storage.db.selection.get_selection import from_url_things
+from fits_storage.server.orm.tapestuff import Tape, TapeWrite, TapeFile
+from fits_storage.server.tapewriter import ReadAhead, TarTapeWriter, \
+    SourceError, make_tarinfo, write_diskfiles, list_tape_diskfiles
+
+BLOCKSIZE = 4096
+
+
+def make_files(tmp_path, sizes):
+    paths = []
+    for i, size in enumerate(sizes):
+        path = os.path.join(tmp_path, f"file{i}.fits")
+        with open(path, 'wb') as f:
+            f.write(os.urandom(size))
+        paths.append(path)
+    return paths
+
+
+def md5(path):
+    with open(path, 'rb') as f:
+        return hashlib.md5(f.read()).hexdigest()
+
+
+def read_archive(path):
+    with tarfile.open(path, mode='r|', bufsize=BLOCKSIZE) as tar:
+        return {ti.name: hashlib.md5(tar.extractfile(ti).read()).hexdigest()
+                for ti in tar}
+
+
+def test_readahead(tmp_path):
+    paths = make_files(tmp_path, [0, 100, 3 * BLOCKSIZE + 1])
+    os.unlink(paths[1])
+    reader = ReadAhead(paths, blocksize=BLOCKSIZE, depth=2)
+    for path, rafile in zip(paths, reader):
+        if path == paths[1]:
+            assert rafile.stat is None
+            assert isinstance(rafile.error, FileNotFoundError)
+            continue
+        data = b''.join(rafile.blocks())
+        assert rafile.size == len(data) == rafile.stat.st_size
+        assert rafile.md5 == md5(path)
+    reader.close()
+
+    # Closing it part way through doesn't hang, with the thread blocked on
+    # the full queue
+    reader = ReadAhead(paths[2:] * 10, blocksize=BLOCKSIZE, depth=2)
+    rafile = next(iter(reader))
+    next(rafile.blocks())
+    reader.close()
+    assert not reader.thread.is_alive()
+
+
+def test_writer_rollback(tmp_path):
+    paths = make_files(tmp_path, [1000, 5 * BLOCKSIZE + 100, 20000, 10])
+    archive = os.path.join(tmp_path, 'archive.tar')
+    with open(archive, 'wb', buffering=0) as fo:
+        writer = TarTapeWriter(fo, blocksize=BLOCKSIZE)
+        for i, path in enumerate(paths):
+            with open(path, 'rb') as f:
+                data = f.read()
+            tarinfo = make_tarinfo(os.path.basename(path), os.stat(path))
+            # The second file doesn't match its md5 and goes over several
+            # records, which have to be rolled back. The third is shorter
+            # than it should be.
+            expected = 'bad' if i == 1 else hashlib.md5(data).hexdigest()
+            if i == 2:
+                tarinfo.size += 1
+            try:
+                writer.add(tarinfo, [data[:3000], data[3000:]], md5=expected)
+            except SourceError:
+                assert i in (1, 2)
+            else:
+                assert i in (0, 3)
+        writer.close()
+
+    assert os.path.getsize(archive) % BLOCKSIZE == 0
+    assert read_archive(archive) == {'file0.fits': md5(paths[0]),
+                                     'file3.fits': md5(paths[3])}
+
+
+def test_write_diskfiles(tmp_path):
+    session = make_empty_testing_db_env(tmp_path)
+    tape = Tape('TAPE1')
+    session.add(tape)
+    session.commit()
+    tw = TapeWrite()
+    tw.tape_id = tape.id
+    session.add(tw)
+    session.commit()
+
+    paths = make_files(tmp_path, [100, 3 * BLOCKSIZE, 5000, 7])
+    diskfiles = [SimpleNamespace(filename=os.path.basename(p), fullpath=p,
+                                 file_md5=md5(p), file_size=os.path.getsize(p),
+                                 lastmod=None, compressed=False,
+                                 data_size=os.path.getsize(p), data_md5=md5(p))
+                 for p in paths]
+    diskfiles[2].file_md5 = 'bad'
+    diskfiles[3].fullpath = 'nonexistent'
+
+    fo = io.BytesIO()
+    writer = TarTapeWriter(fo, blocksize=BLOCKSIZE)
+    bytecount, bad = write_diskfiles(session, tw, writer, diskfiles,
+                                     checkpoint=1, readahead=2 * BLOCKSIZE)
+
+    assert bad == diskfiles[2:]
+    assert bytecount == tw.size == 100 + 3 * BLOCKSIZE
+    rows = session.execute(select(TapeFile.filename, TapeFile.md5,
+                                  TapeFile.offset, TapeFile.block)
+                           .order_by(TapeFile.filename)).all()
+    assert [row[:2] for row in rows] == \
+        [(df.filename, df.file_md5) for df in diskfiles[:2]]
+
+    fo.seek(0)
+    with tarfile.open(fileobj=fo, mode='r|') as tar:
+        assert [(ti.name, ti.offset, ti.offset // BLOCKSIZE) for ti in tar] \
+            == [(row[0],) + tuple(row[2:]) for row in rows]
+
+
+class FailingTape(io.BytesIO):
+    # A tape that fills up after nrecords records
+    def __init__(self, nrecords):
+        super().__init__()
+        self.nrecords = nrecords
+        self.writes = 0
+
+    def write(self, data):
+        self.writes += 1
+        if self.writes > self.nrecords:
+            raise OSError("No space left on device")
+        return super().write(data)
+
+
+def test_write_diskfiles_error(tmp_path):
+    session = make_empty_testing_db_env(tmp_path)
+    tape = Tape('TAPE1')
+    session.add(tape)
+    session.commit()
+    tw = TapeWrite()
+    tw.tape_id = tape.id
+    session.add(tw)
+    session.commit()
+
+    paths = make_files(tmp_path, [100, 3 * BLOCKSIZE, BLOCKSIZE])
+    diskfiles = [SimpleNamespace(filename=os.path.basename(p), fullpath=p,
+                                 file_md5=md5(p), file_size=os.path.getsize(p),
+                                 lastmod=None, compressed=False,
+                                 data_size=os.path.getsize(p), data_md5=md5(p))
+                 for p in paths]
+
+    # The first file is on the tape after the first record. The end of the
+    # second is still in the buffer when the tape fills up during the third
+    # file, so only the first is recorded, even though we checkpoint after
+    # every file.
+    writer = TarTapeWriter(FailingTape(3), blocksize=BLOCKSIZE)
+    with pytest.raises(OSError):
+        write_diskfiles(session, tw, writer, diskfiles, checkpoint=1,
+                        readahead=2 * BLOCKSIZE)
+
+    assert writer.closed
+    assert session.execute(select(TapeFile.filename)).scalars().all() == \
+        ['file0.fits']
+    assert tw.size == 100
+
+
+def test_list_tape_diskfiles(tmp_path):
+    session = make_empty_testing_db_env(tmp_path)
+    # Files 1-6 are in the selection, 7 is outside the date range and 8 is
+    # not present. Tape 1 has file 1, and file 2 with a different md5, tape 2
+    # has file 3, tape 3 (inactive) has file 4 and the write of file 5 to
+    # tape 2 failed.
+    session.execute(insert(File.__table__), [
+        {'id': i, 'name': f'file{i}.fits'} for i in range(1, 9)])
+    session.execute(insert(DiskFile.__table__), [
+        {'id': i, 'file_id': i, 'filename': f'file{i}.fits', 'path': '',
+         'present': i != 8, 'canonical': True, 'file_md5': f'md5-{i}',
+         'file_size': 10} for i in range(1, 9)])
+    session.execute(insert(Header.__table__), [
+        {'id': i, 'diskfile_id': i, 'telescope': 'Gemini-North',
+         'ut_datetime': datetime.datetime(2024, 1, 20 if i == 7 else 10 - i,
+                                          12)}
+        for i in range(1, 9)])
+    session.execute(insert(Tape.__table__), [
+        {'id': 1, 'label': 'T1', 'active': True},
+        {'id': 2, 'label': 'T2', 'active': True},
+        {'id': 3, 'label': 'T3', 'active': False}])
+    session.execute(insert(TapeWrite.__table__), [
+        {'id': 1, 'tape_id': 1, 'succeeded': True},
+        {'id': 2, 'tape_id': 2, 'succeeded': True},
+        {'id': 3, 'tape_id': 3, 'succeeded': True},
+        {'id': 4, 'tape_id': 2, 'succeeded': False}])
+    session.execute(insert(TapeFile.__table__), [
+        {'tapewrite_id': tw, 'filename': f'file{i}.fits', 'md5': md5}
+        for tw, i, md5 in [(1, 1, 'md5-1'), (1, 2, 'other'), (2, 3, 'md5-3'),
+                           (3, 4, 'md5-4'), (4, 5, 'md5-5')]])
+    session.commit()
+
+    selection = from_url_things(['20240101-20240115', 'present'])
+
+    def filenums(**kwargs):
+        return [int(df.filename[4]) for df in
+                list_tape_diskfiles(session, selection, **kwargs)]
+
+    # In ut_datetime order
+    assert filenums() == [6, 5, 4, 3, 2, 1]
+    assert filenums(tape_ids={1}) == [6, 5, 4, 3, 2]
+    assert filenums(tape_ids={1, 2}) == [6, 5, 4, 2]
+    assert filenums(tape_ids={1, 3}) == [6, 5, 4, 3, 2]
+    assert filenums(skip=True) == [6, 5, 4, 2]
+
+    # Committing doesn't expire the diskfiles
+    diskfiles = list_tape_diskfiles(session, selection, yield_per=2)
+    session.commit()
+    assert diskfiles[0].filename == 'file6.fits'
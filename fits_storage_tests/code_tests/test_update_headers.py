@@ -0,0 +1,100 @@
+import json
+
+from fits_storage_tests.code_tests.helpers import get_test_config
+get_test_config()
+
+from sqlalchemy import insert
+
+from fits_storage_tests.code_tests.helpers import make_empty_testing_db_env
+from fits_storage.db import sessionfactory
+
+from fits_storage.core.orm.file import File
+from fits_storage.core.orm.diskfile import DiskFile
+from fits_storage.core.orm.header import Header
+from fits_storage.queues.orm.fileopsqueueentry import FileopsQueueEntry
+
+import fits_storage.web.update_headers
+from fits_storage.web.update_headers import check_exists, \
+    check_exists_many, queue_header_updates
+
+
+def populate(session):
+    # file1 and file6 are present, file2 has no present diskfile, file3 has
+    # two present diskfiles. file4 and file5 share a data label.
+    session.execute(insert(File.__table__), [
+        {'id': i, 'name': f'file{i}.fits'} for i in range(1, 7)])
+    session.execute(insert(DiskFile.__table__), [
+        {'id': i, 'file_id': file_id, 'filename': f'file{file_id}.fits',
+         'path': '', 'present': present, 'canonical': True}
+        for i, file_id, present in [(1, 1, True), (2, 2, False),
+                                    (3, 3, True), (4, 3, True),
+                                    (5, 4, True), (6, 5, True),
+                                    (7, 6, True)]])
+    session.execute(insert(Header.__table__), [
+        {'id': i, 'diskfile_id': i, 'data_label': dl}
+        for i, dl in [(1, 'DL-1'), (2, 'DL-2'), (3, 'DL-3'), (5, 'DL-45'),
+                      (6, 'DL-45'), (7, 'DL-6')]])
+    session.commit()
+
+
+def test_check_exists_many(tmp_path):
+    make_empty_testing_db_env(tmp_path)
+    session = sessionfactory()
+    populate(session)
+
+    filenames = ['file1.fits', 'file1.fits.bz2', 'file2.fits', 'file3.fits',
+                 'nosuchfile.fits']
+    datalabels = ['DL-1', 'DL-2', 'DL-3', 'DL-45', 'DL-NONE']
+    fn_exists, dl_exists = check_exists_many(session, filenames, datalabels)
+
+    for fn in filenames:
+        assert fn_exists[fn] == check_exists(session, fn=fn)
+    for dl in datalabels:
+        assert dl_exists[dl] == check_exists(session, dl=dl)
+    assert fn_exists == {'file1.fits': 1, 'file1.fits.bz2': 1,
+                         'file2.fits': 0, 'file3.fits': 2,
+                         'nosuchfile.fits': 0}
+    assert dl_exists == {'DL-1': 1, 'DL-2': 0, 'DL-3': 2, 'DL-45': 2,
+                         'DL-NONE': 0}
+
+    assert check_exists_many(session) == ({}, {})
+
+
+def test_queue_header_updates(tmp_path, monkeypatch):
+    make_empty_testing_db_env(tmp_path)
+    session = sessionfactory()
+    populate(session)
+    monkeypatch.setattr(fits_storage.web.update_headers, 'UPDATE_BATCH_SIZE',
+                        2)
+
+    payload = [{'filename': 'file1.fits', 'values': {'qa_state': 'Pass'}},
+               {'filename': 'file2.fits', 'values': {'qa_state': 'Pass'}},
+               {'data_label': 'DL-1', 'values': {'release': '2025-01-01'}},
+               {'filename': 'file6.fits', 'values': {'qa_state': 'Fail'}},
+               {'filename': 'file1.fits.bz2', 'values': {'raw_site': 'iq70'}},
+               {'filename': 'file1.fits', 'data_label': 'DL-1',
+                'values': {}},
+               {'filename': 'file1.fits', 'values': 'Pass'}]
+    results = queue_header_updates(session, payload)
+
+    assert [r['result'] for r in results] == [True, False, True, True, True,
+                                              False, False]
+    assert results[0] == {'result': True, 'id': 'file1.fits'}
+    assert results[1]['id'] == 'file2.fits'
+
+    # All three updates to file1, by filename with or without .bz2 and by
+    # data label, go in the same request, in order. That request is then
+    # full, so the file6 update goes in another.
+    fqes = session.query(FileopsQueueEntry).order_by(FileopsQueueEntry.id)
+    requests = [json.loads(fqe.request) for fqe in fqes]
+    assert requests == [
+        {'request': 'update_headers_batch',
+         'args': {'updates': [{'filename': 'file1.fits', 'qa_state': 'Pass',
+                               'diskfile_id': 1},
+                              {'data_label': 'DL-1',
+                               'release': '2025-01-01', 'diskfile_id': 1},
+                              {'filename': 'file1.fits.bz2',
+                               'raw_site': 'iq70', 'diskfile_id': 1}]}},
+        {'request': 'update_headers_batch',
+         'args': {'updates': [{'filename': 'file6.fits',
+                               'qa_state': 'Fail', 'diskfile_id': 7}]}}]
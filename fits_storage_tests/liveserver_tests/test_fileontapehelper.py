@@ -6,8 +6,8 @@ def test_fileontape1():
     foth.populate_cache('N20220501S0001')
 
     assert foth._queried == ['N20220501S0001']
-    assert len(foth._cache) == 2
-    assert foth._cache[0]['filename'] == 'N20220501S0001.fits.bz2'
+    assert len(foth._md5s) == 1
+    assert 'N20220501S0001.fits' in foth._md5s
     assert foth.check_results('N20220501S0001.fits.bz2') == {113, 114}
 
 def test_fileontape2():
@@ -21,4 +21,15 @@ def test_fileontape2():
     assert foth.check_file('N20220501S0002.fits') == {113, 114}
     end = datetime.datetime.now()
     jiffy = datetime.timedelta(milliseconds=10)
-    assert end - start < jiffy
\ No newline at end of file
+    assert end - start < jiffy
+
+def test_fileontape_bulk():
+    foth = FileOnTapeHelper(tapeserver='hbffitstape-lp2')
+
+    # One request for both files
+    assert foth.populate_cache_bulk(['N20220501S0001.fits.bz2',
+                                     'N20220501S0002.fits'])
+    assert foth._queried == []
+    assert foth.check_file('N20220501S0001.fits') == {113, 114}
+    assert foth.check_file('N20220501S0002.fits') == {113, 114}
+    assert foth._queried == []